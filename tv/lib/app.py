@@ -45,6 +45,8 @@ donate_manager = None
 # database object
 db = None
 
+db_maintainer = None
+
 # BulkSQLManager for the main miro database
 bulk_sql_manager = None
 
@@ -0,0 +1,245 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""containerformat.py -- Format for SchemaReprContainer columns.
+
+We used to store lists, dicts and tuples in the database using repr() and
+restore them with eval().  That's slow, since eval() has to compile the
+value each time, and it executes whatever code happens to be in the
+database.
+
+This module stores them as JSON instead.  The json module parses values in
+C, and only ever creates JSON types, so bad data can make decode() fail,
+but not run code.  JSON doesn't have all the types that we store, so we
+convert the others to single-key objects, with the key naming the type:
+
+    - str: {"b": the bytes as a latin-1 string}
+    - tuple: {"t": list of items}
+    - dict, if it has keys that aren't unicode or could be mistaken for one
+      of these objects: {"d": list of [key, value] pairs}
+    - datetime: {"dt": [year, month, day, hour, minute, second, microsecond]}
+    - timedelta: {"td": [days, seconds, microseconds]}
+
+decode() converts those back, and checks that their contents have the right
+types.  We don't convert anything else.
+
+Encoded values look like this:
+
+    - "MRC" (magic bytes)
+    - 1 byte: format version
+    - 1 byte: flags (FLAG_HAS_SPECIAL_TYPES)
+    - the JSON data, in ASCII
+"""
+
+import datetime
+import json
+import time
+
+MAGIC = 'MRC'
+# Version 1 was marshal data.  It never made it into a release, and we
+# don't read it since marshal isn't safe against bad data.
+FORMAT_VERSION = 2
+HEADER_LENGTH = len(MAGIC) + 2
+
+# set when the data contains objects that we need to convert back after
+# parsing.  When this is unset, decode() is just a json.loads() call.
+FLAG_HAS_SPECIAL_TYPES = 1
+
+class FormatError(ValueError):
+    """Data isn't in our format, or was made by a newer version."""
+    pass
+
+_encoder = json.JSONEncoder(ensure_ascii=True, check_circular=False,
+                            separators=(',', ':'))
+
+def is_encoded(data):
+    """Check if data was created by encode()."""
+    return (isinstance(data, (str, buffer)) and
+            str(data[:len(MAGIC)]) == MAGIC)
+
+def encode(value):
+    """Encode a list/dict/tuple value.
+
+    value should already be validated by its SchemaItem.
+
+    :returns: byte string with the encoded data
+    """
+    converter = _JSONConverter()
+    data = _encoder.encode(converter.convert(value))
+    flags = 0
+    if converter.has_special_types:
+        flags |= FLAG_HAS_SPECIAL_TYPES
+    return '%s%c%c%s' % (MAGIC, FORMAT_VERSION, flags, data)
+
+def decode(data):
+    """Decode data created by encode().
+
+    :param data: byte string or buffer object
+    :raises FormatError: data isn't valid
+    """
+    if not is_encoded(data) or len(data) <= HEADER_LENGTH:
+        raise FormatError("Bad header for container data")
+    version = ord(data[len(MAGIC)])
+    if version != FORMAT_VERSION:
+        raise FormatError("Unknown container format: %s" % version)
+    flags = ord(data[len(MAGIC)+1])
+    if flags & FLAG_HAS_SPECIAL_TYPES:
+        object_hook = _from_json_object
+    else:
+        object_hook = None
+    try:
+        return json.loads(str(buffer(data, HEADER_LENGTH)),
+                          object_hook=object_hook)
+    except FormatError:
+        raise
+    except (ValueError, TypeError, RuntimeError), e:
+        # RuntimeError happens if the data is nested too deeply
+        raise FormatError("Error parsing container data: %s" % e)
+
+class _JSONConverter(object):
+    """Convert a value to one that only uses JSON types."""
+
+    def __init__(self):
+        self.has_special_types = False
+
+    def special(self, type_name, value):
+        self.has_special_types = True
+        return {type_name: value}
+
+    def convert(self, value):
+        # check exact types first, they're the common case
+        value_type = type(value)
+        if value_type in (unicode, int, long, float, bool, type(None)):
+            return value
+        elif value_type is list:
+            return [self.convert(v) for v in value]
+        elif value_type is dict:
+            return self.convert_dict(value)
+        elif value_type is str:
+            return self.special(u'b', value.decode('latin-1'))
+        elif isinstance(value, time.struct_time):
+            # repr()/eval() used to turn these into plain tuples, keep doing
+            # that
+            return self.special(u't', list(value))
+        elif isinstance(value, tuple):
+            return self.special(u't', [self.convert(v) for v in value])
+        elif isinstance(value, datetime.datetime):
+            return self.special(u'dt', [value.year, value.month, value.day,
+                                        value.hour, value.minute,
+                                        value.second, value.microsecond])
+        elif isinstance(value, datetime.timedelta):
+            return self.special(u'td', [value.days, value.seconds,
+                                        value.microseconds])
+        elif isinstance(value, dict):
+            return self.convert_dict(value)
+        elif isinstance(value, list):
+            return [self.convert(v) for v in value]
+        elif isinstance(value, unicode):
+            return unicode(value)
+        elif isinstance(value, str):
+            return self.special(u'b', str(value).decode('latin-1'))
+        elif isinstance(value, bool):
+            return bool(value)
+        elif isinstance(value, (int, long)):
+            return long(value)
+        elif isinstance(value, float):
+            return float(value)
+        else:
+            raise ValueError("Can't encode %r" % (value,))
+
+    def convert_dict(self, value):
+        if (all(type(k) is unicode for k in value) and
+                not (len(value) == 1 and
+                     iter(value).next() in _special_types)):
+            return dict((k, self.convert(v)) for k, v in value.iteritems())
+        return self.special(u'd', [[self.convert(k), self.convert(v)]
+                                   for k, v in value.iteritems()])
+
+def _check_list(value, item_type=None, length=None):
+    if type(value) is not list:
+        raise FormatError("Expected list, got %r" % (value,))
+    if length is not None and len(value) != length:
+        raise FormatError("Expected %s items, got %r" % (length, value))
+    if item_type is not None:
+        for item in value:
+            if type(item) is not item_type:
+                raise FormatError("Bad value in %r" % (value,))
+    return value
+
+def _decode_bytes(value):
+    if type(value) is not unicode:
+        raise FormatError("Expected string, got %r" % (value,))
+    try:
+        return value.encode('latin-1')
+    except UnicodeError:
+        raise FormatError("Bad byte string: %r" % (value,))
+
+def _decode_tuple(value):
+    return tuple(_check_list(value))
+
+def _decode_dict(value):
+    rv = {}
+    for pair in _check_list(value, list):
+        key, item = _check_list(pair, length=2)
+        if type(key) in (list, dict):
+            raise FormatError("Bad dict key: %r" % (key,))
+        rv[key] = item
+    return rv
+
+def _decode_datetime(value):
+    try:
+        return datetime.datetime(*_check_list(value, int, 7))
+    except (ValueError, OverflowError), e:
+        raise FormatError("Bad datetime %r: %s" % (value, e))
+
+def _decode_timedelta(value):
+    try:
+        return datetime.timedelta(*_check_list(value, int, 3))
+    except (ValueError, OverflowError), e:
+        raise FormatError("Bad timedelta %r: %s" % (value, e))
+
+_special_types = {
+    u'b': _decode_bytes,
+    u't': _decode_tuple,
+    u'd': _decode_dict,
+    u'dt': _decode_datetime,
+    u'td': _decode_timedelta,
+}
+
+def _from_json_object(obj):
+    # object_hook for json.loads().  It gets called for each JSON object,
+    # innermost first, so the contents of obj are already converted.
+    if len(obj) != 1:
+        return obj
+    type_name, value = obj.items()[0]
+    try:
+        decoder = _special_types[type_name]
+    except KeyError:
+        return obj
+    return decoder(value)
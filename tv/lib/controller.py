@@ -105,6 +105,8 @@ class Controller:
         eventloop.shutdown()
         logging.info("Saving cached ItemInfo objects")
         logging.info("Commiting DB changes")
+        if app.db_maintainer is not None:
+            app.db_maintainer.stop()
         app.db.finish_transaction()
         logging.info("Closing Database...")
         if app.db is not None:
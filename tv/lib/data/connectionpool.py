@@ -27,29 +27,62 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
-"""miro.data.connectionpool -- SQLite connection pool """
+"""miro.data.connectionpool -- SQLite connection pool
+
+Opening a connection is fairly expensive, since we need to set up our
+collations and functions for each one.  ConnectionPool keeps connections
+around after they're released, then closes the extra ones once they've been
+idle for a while.
+
+When all max_connections are checked out, get_connection() waits for another
+thread to release one.  If there's no other thread that could release a
+connection, or we time out waiting, it opens an extra connection rather
+than fail.  Those get closed as soon as they're released.
+"""
 import contextlib
 import logging
+import thread
+import threading
+import time
 
 import sqlite3
 
 from miro import messages
+from miro import queryprofile
 from miro.data import dbcollations
-
-class ConnectionLimitError(StandardError):
-    """We've hit our connection limits."""
+from miro.data import fulltextsearch
 
 class Connection(object):
-    """Wraps the sqlite3.Connection object."""
-    def __init__(self, path):
+    """Wraps the sqlite3.Connection object.
+
+    If query_profiler is given, we record our queries with it.  We only time
+    the execute() call, since callers fetch rows from the cursor themselves.
+    That includes the work SQLite does before it returns the first row (for
+    example sorting without an index), but not the time to fetch the rest.
+    """
+    def __init__(self, path, query_profiler=None):
+        # ConnectionPool makes sure that only 1 thread uses a connection at
+        # once, but it may not be the thread that opened it.
         self._connection = sqlite3.connect(
-            path, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES)
+            path, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False)
+        self.query_profiler = query_profiler
 
     def execute(self, sql, values=()):
-        return self._connection.execute(sql, values)
+        if self.query_profiler is None:
+            return self._connection.execute(sql, values)
+        start = time.time()
+        cursor = self._connection.execute(sql, values)
+        self.query_profiler.record(sql, values, time.time() - start,
+                                   explain=self._explain)
+        return cursor
 
     def execute_many(self, sql, values):
-        self._connection.execute_many(sql, values)
+        self._connection.executemany(sql, values)
+
+    def _explain(self, sql, values):
+        return self._connection.execute("EXPLAIN QUERY PLAN " + sql,
+                                        values).fetchall()
 
     def commit(self):
         self._connection.commit()
@@ -63,20 +96,44 @@ class Connection(object):
 class ConnectionPool(object):
     """Pool of SQLite database connections
 
+    ConnectionPool is thread-safe.
+
     :attribute wal_mode: Is the database using WAL mode for its journal?
+    :attribute query_profiler: QueryProfiler shared by our connections
     """
-    def __init__(self, db_path, min_connections=2, max_connections=7):
+    # seconds to wait for another thread to release a connection
+    WAIT_TIMEOUT = 2.0
+    # seconds to keep extra connections open after they're released
+    IDLE_TTL = 60.0
+
+    def __init__(self, db_path, min_connections=2, max_connections=7,
+                 wait_timeout=WAIT_TIMEOUT, idle_ttl=IDLE_TTL):
         """Create a new ConnectionPool
 
         :param db_path: path to the database to connect to
         :param min_connections: Minimum number of connections to maintain
-        :param max_connections: Maximum number of connections to the database
+        :param max_connections: Number of connections we can have before
+            get_connection() needs to wait for one to be released
+        :param wait_timeout: Max time get_connection() waits
+        :param idle_ttl: Close connections above min_connections once
+            they've been idle for this long
         """
         self.db_path = db_path
         self.min_connections = min_connections
         self.max_connections = max_connections
+        self.wait_timeout = wait_timeout
+        self.idle_ttl = idle_ttl
         self.all_connections = set()
+        # connections that aren't checked out, most recently released last
         self.free_connections = []
+        # maps free connections -> time they were released
+        self._release_times = {}
+        # maps checked out connections -> (thread id, checkout time)
+        self._checkouts = {}
+        self._condition = threading.Condition(threading.Lock())
+        self.query_profiler = queryprofile.QueryProfiler(
+            'frontend connections to %s' % db_path)
+        self.reset_stats()
         self._check_wal_mode()
 
     def _check_wal_mode(self):
@@ -90,47 +147,231 @@ class ConnectionPool(object):
 
     def _make_new_connection(self):
         # TODO: should have error handling here, but what should we do?
-        connection = Connection(self.db_path)
+        connection = Connection(self.db_path, self.query_profiler)
         dbcollations.setup_collations(connection)
-        self.free_connections.append(connection)
+        fulltextsearch.setup_rank_function(connection._connection)
         self.all_connections.add(connection)
+        self.stats['opened'] += 1
+        return connection
+
+    def _close_connection(self, connection):
+        connection.close()
+        self.all_connections.discard(connection)
+        self.stats['closed'] += 1
+
+    def warm_up(self, count=None):
+        """Open connections ahead of time.
+
+        This moves the work of opening connections away from the first
+        get_connection() calls.
+
+        :param count: make sure we have at least this many connections.
+            Defaults to min_connections.  Connections above min_connections
+            are still closed once they've been idle for idle_ttl seconds.
+        """
+        if count is None:
+            count = self.min_connections
+        count = min(count, self.max_connections)
+        self._condition.acquire()
+        try:
+            now = time.time()
+            while len(self.all_connections) < count:
+                connection = self._make_new_connection()
+                self._add_free_connection(connection, now)
+        finally:
+            self._condition.release()
 
     def destroy(self):
         """Forcably destroy all connections."""
-        for connection in self.all_connections:
-            connection.close()
-        self.all_connections = []
-        self.free_connections = []
-
-    def get_connection(self):
+        self._condition.acquire()
+        try:
+            for connection in self.all_connections:
+                connection.close()
+            self.all_connections = set()
+            self.free_connections = []
+            self._release_times = {}
+            self._checkouts = {}
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def get_connection(self, timeout=None):
         """Get a new connection to the database
 
         When you're finished with the connection, call release_connection() to
         put it back into the pool.
 
         If there are max_connections checked out and get_connection() is
-        called again, ConnectionLimitError will be raised.
+        called again, we wait for a connection to be released.  We only wait
+        if another thread has a connection checked out, since the current
+        thread can't release one while it's waiting.  If no connection is
+        available after that, we open an extra one.
 
-        :returns sqlite3.Connection object
+        :param timeout: max time to wait, defaults to wait_timeout
+        :returns Connection object
         """
-        if not self.free_connections:
-            if len(self.all_connections) < self.max_connections:
-                self._make_new_connection()
+        if timeout is None:
+            timeout = self.wait_timeout
+        self._condition.acquire()
+        try:
+            start = time.time()
+            self._close_idle_connections(start)
+            waited = False
+            while (not self.free_connections and
+                   len(self.all_connections) >= self.max_connections):
+                remaining = start + timeout - time.time()
+                if remaining <= 0 or not self._other_thread_has_connection():
+                    break
+                waited = True
+                self._condition.wait(remaining)
+            now = time.time()
+            if waited:
+                self._record_wait(now - start)
+            if self.free_connections:
+                connection = self.free_connections.pop()
+                del self._release_times[connection]
             else:
-                raise ConnectionLimitError()
-        return self.free_connections.pop()
+                if len(self.all_connections) >= self.max_connections:
+                    self.stats['overflows'] += 1
+                    logging.debug("%s: all %d connections in use, opening "
+                                  "an extra one", self.db_path,
+                                  self.max_connections)
+                connection = self._make_new_connection()
+            self._checkouts[connection] = (thread.get_ident(), now)
+            self.stats['checkouts'] += 1
+            in_use = len(self._checkouts)
+            if in_use > self.stats['max_in_use']:
+                self.stats['max_in_use'] = in_use
+            return connection
+        finally:
+            self._condition.release()
 
     def release_connection(self, connection):
         """Put a connection back into the pool."""
 
-        if connection not in self.all_connections:
-            raise ValueError("%s not from this pool" % connection)
-        connection.rollback()
-        if len(self.all_connections) > self.min_connections:
-            connection.close()
-            self.all_connections.remove(connection)
-        else:
-            self.free_connections.append(connection)
+        self._condition.acquire()
+        try:
+            if connection not in self.all_connections:
+                raise ValueError("%s not from this pool" % connection)
+            connection.rollback()
+            now = time.time()
+            try:
+                thread_id, checkout_time = self._checkouts.pop(connection)
+            except KeyError:
+                pass
+            else:
+                self._record_checkout_time(now - checkout_time)
+            if len(self.all_connections) > self.max_connections:
+                self._close_connection(connection)
+            else:
+                self._add_free_connection(connection, now)
+                self._condition.notify()
+            self._close_idle_connections(now)
+        finally:
+            self._condition.release()
+
+    def close_idle_connections(self, idle_ttl=None):
+        """Close connections that have been idle for more than idle_ttl.
+
+        We also do this in get_connection() and release_connection(), call
+        this to release connections when the pool isn't being used.
+
+        :param idle_ttl: close connections idle for this long, defaults to
+            our idle_ttl attribute.  Pass in 0 to close all free connections
+            above min_connections.
+        """
+        self._condition.acquire()
+        try:
+            self._close_idle_connections(time.time(), idle_ttl)
+        finally:
+            self._condition.release()
+
+    def _add_free_connection(self, connection, now):
+        self.free_connections.append(connection)
+        self._release_times[connection] = now
+
+    def _close_idle_connections(self, now, idle_ttl=None):
+        if idle_ttl is None:
+            idle_ttl = self.idle_ttl
+        # the least recently released connections are at the start of the
+        # list
+        while (self.free_connections and
+               len(self.all_connections) > self.min_connections):
+            connection = self.free_connections[0]
+            if now - self._release_times[connection] < idle_ttl:
+                break
+            del self.free_connections[0]
+            del self._release_times[connection]
+            self._close_connection(connection)
+            self.stats['expired'] += 1
+
+    def _other_thread_has_connection(self):
+        thread_id = thread.get_ident()
+        for owner, checkout_time in self._checkouts.values():
+            if owner != thread_id:
+                return True
+        return False
+
+    def _record_wait(self, duration):
+        self.stats['waits'] += 1
+        self.stats['wait_time'] += duration
+        if duration > self.stats['max_wait_time']:
+            self.stats['max_wait_time'] = duration
+
+    def _record_checkout_time(self, duration):
+        self.stats['checkout_time'] += duration
+        if duration > self.stats['max_checkout_time']:
+            self.stats['max_checkout_time'] = duration
+
+    def reset_stats(self):
+        self.stats = {
+            'checkouts': 0,
+            'checkout_time': 0.0,
+            'max_checkout_time': 0.0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'max_wait_time': 0.0,
+            'overflows': 0,
+            'opened': 0,
+            'closed': 0,
+            'expired': 0,
+            'max_in_use': 0,
+        }
+
+    def get_stats(self):
+        """Get a snapshot of our stats.
+
+        :returns: dict of counters since the last reset_stats() call, plus
+            these keys for the current state of the pool:
+            - in_use: number of connections checked out
+            - free: number of connections waiting to be used
+        """
+        self._condition.acquire()
+        try:
+            stats = self.stats.copy()
+            stats['in_use'] = len(self._checkouts)
+            stats['free'] = len(self.free_connections)
+        finally:
+            self._condition.release()
+        return stats
+
+    def format_report(self):
+        """Format our stats as a human-readable string."""
+        stats = self.get_stats()
+        lines = ['Connection pool stats for %s' % self.db_path, '']
+        lines.append('in use: %d (max %d) free: %d limit: %d' %
+                     (stats['in_use'], stats['max_in_use'], stats['free'],
+                      self.max_connections))
+        lines.append('checkouts: %d total time: %.3fs max: %.3fs' %
+                     (stats['checkouts'], stats['checkout_time'],
+                      stats['max_checkout_time']))
+        lines.append('waits: %d total time: %.3fs max: %.3fs '
+                     'extra connections: %d' %
+                     (stats['waits'], stats['wait_time'],
+                      stats['max_wait_time'], stats['overflows']))
+        lines.append('connections opened: %d closed: %d (%d idle)' %
+                     (stats['opened'], stats['closed'], stats['expired']))
+        return '\n'.join(lines)
 
     @contextlib.contextmanager
     def context(self):
@@ -179,6 +420,7 @@ class ConnectionPoolTracker(object):
     """
     def __init__(self, main_db_path):
         self.main_pool = ConnectionPool(main_db_path)
+        self.main_pool.warm_up()
         self.pool_map = {}
 
     def reset(self):
@@ -206,11 +448,18 @@ class ConnectionPoolTracker(object):
 
     def _ensure_connection_pool(self, tab_info):
         if tab_info.id not in self.pool_map:
-            self.pool_map[tab_info.id] = self._make_connection_pool(tab_info)
+            pool = self._make_connection_pool(tab_info)
+            # The user will probably look at the new tab soon.  Open a
+            # connection now, so that the ItemTracker for it doesn't have
+            # to.  If they don't, the pool will close it after a while.
+            pool.warm_up(1)
+            self.pool_map[tab_info.id] = pool
 
     def _ensure_no_connection_pool(self, tab_id):
         if tab_id in self.pool_map:
-            del self.pool_map[tab_id]
+            # ItemTrackers may still be using connections from the pool, but
+            # we can close the ones that aren't in use.
+            self.pool_map.pop(tab_id).close_idle_connections(0)
 
     def on_tabs_changed(self, message):
         if message.type != 'connect':
@@ -28,9 +28,49 @@
 # statement from all source files in the program, then also delete it here.
 
 """miro.data.fulltextsearch -- Set up full text search in our SQLite DB
+
+item_fts is kept up to date with triggers on the item table.  The update
+triggers only fire when one of the indexed columns changes, so that status
+updates like watched_time or download progress don't rewrite the full text
+index.
+
+Each change adds a small segment to the index.  FTS4 merges those segments
+together when there's too many of them, which can make a simple UPDATE slow.
+merge() does that work in small steps instead, so that we can run it in the
+background (see dbmaintenance).  rebuild_chunk() can be used to rebuild the
+index for an existing database a few rows at a time.
+
+setup_rank_function() defines fts_rank(), which scores rows for ORDER BY
+clauses.  Use it like this::
+
+    SELECT docid FROM item_fts WHERE item_fts MATCH ?
+    ORDER BY fts_rank(matchinfo(item_fts, 'pcnalx')) DESC
 """
+import math
+import re
+import struct
+
 from miro import app
 
+# number of pages that merge() writes with each step
+MERGE_PAGES = 200
+# min number of segments at a level before merge() merges them
+MERGE_SEGMENTS = 8
+
+# BM25 parameters, these are the usual values
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+MATCHINFO_FORMAT = 'pcnalx'
+
+def fulltext_columns(path_column='filename', has_entry_description=True):
+    """Get the item columns that we index."""
+    columns = ['title', 'description', 'artist', 'album',
+               'genre', path_column, 'parent_title', ]
+    if has_entry_description:
+        columns.append('entry_description')
+    return columns
+
 def setup_fulltext_search(connection, table='item', path_column='filename',
                          has_entry_description=True):
     """Set up fulltext search on a newly created database."""
@@ -38,23 +78,24 @@ def setup_fulltext_search(connection, table='item', path_column='filename',
         # handle unittests not defining the item table in their schemas
         return
 
-    columns = ['title', 'description', 'artist', 'album',
-               'genre', path_column, 'parent_title', ]
-    if has_entry_description:
-        columns.append('entry_description')
+    columns = fulltext_columns(path_column, has_entry_description)
     column_list = ', '.join(c for c in columns)
-    column_list_for_new = ', '.join("new.%s" % c for c in columns)
     column_list_with_types = ', '.join('%s text' % c for c in columns)
     connection.execute("CREATE VIRTUAL TABLE item_fts USING fts4(%s)" %
                        column_list_with_types)
     connection.execute("INSERT INTO item_fts(docid, %s)"
                        "SELECT %s.id, %s FROM %s" %
                        (column_list, table, column_list, table))
-    # make triggers to keep item_fts up to date
+    create_triggers(connection, table, columns)
+
+def create_triggers(connection, table, columns):
+    """Create the triggers that keep item_fts up to date."""
+    column_list = ', '.join(c for c in columns)
+    column_list_for_new = ', '.join("new.%s" % c for c in columns)
     connection.execute("CREATE TRIGGER item_bu "
-                       "BEFORE UPDATE ON %s BEGIN "
+                       "BEFORE UPDATE OF %s ON %s BEGIN "
                        "DELETE FROM item_fts WHERE docid=old.id; "
-                       "END;" % (table,))
+                       "END;" % (column_list, table))
 
     connection.execute("CREATE TRIGGER item_bd "
                        "BEFORE DELETE ON %s BEGIN "
@@ -62,10 +103,11 @@ def setup_fulltext_search(connection, table='item', path_column='filename',
                        "END;" % (table,))
 
     connection.execute("CREATE TRIGGER item_au "
-                       "AFTER UPDATE ON %s BEGIN "
+                       "AFTER UPDATE OF %s ON %s BEGIN "
                        "INSERT INTO item_fts(docid, %s) "
                        "VALUES(new.id, %s); "
-                       "END;" % (table, column_list, column_list_for_new))
+                       "END;" % (column_list, table, column_list,
+                                 column_list_for_new))
 
     connection.execute("CREATE TRIGGER item_ai "
                        "AFTER INSERT ON %s BEGIN "
@@ -73,6 +115,118 @@ def setup_fulltext_search(connection, table='item', path_column='filename',
                        "VALUES(new.id, %s); "
                        "END;" % (table, column_list, column_list_for_new))
 
+def has_fulltext_table(connection):
+    return not _no_item_table(connection, 'item_fts')
+
+def merge(connection, pages=MERGE_PAGES, segments=MERGE_SEGMENTS):
+    """Run one step of an incremental merge of the item_fts segments.
+
+    :returns: True if there was something to merge.  Keep calling merge()
+        until it returns False to fully merge the index.
+    """
+    before = connection.total_changes
+    connection.execute("INSERT INTO item_fts(item_fts) VALUES(?)",
+                       ('merge=%d,%d' % (pages, segments),))
+    # FTS4 changes total_changes by less than 2 if the merge was a no-op
+    return connection.total_changes - before >= 2
+
+def optimize(connection):
+    """Merge all item_fts segments into one.
+
+    This can take a long time for big databases, merge() is normally a
+    better choice.
+    """
+    connection.execute("INSERT INTO item_fts(item_fts) VALUES('optimize')")
+
+def rebuild_chunk(cursor, table, columns, start_id=0, limit=500):
+    """Re-index some of the rows in a table.
+
+    This handles at most limit rows at a time, so it can be run in small
+    chunks.  Rows that change while we're running are fine, the triggers
+    will have re-indexed them already.
+
+    :param cursor: cursor for the database
+    :param table: item table to index
+    :param columns: columns to index (see fulltext_columns())
+    :param start_id: only index rows with ids >= this
+    :param limit: max number of rows to index
+    :returns: (next_start_id, row_count) tuple.  next_start_id is None if
+        we're done with the table.
+    """
+    cursor.execute("SELECT id FROM %s WHERE id >= ? ORDER BY id LIMIT ?" %
+                   table, (start_id, limit))
+    ids = [row[0] for row in cursor.fetchall()]
+    if not ids:
+        cursor.execute("DELETE FROM item_fts WHERE docid >= ?", (start_id,))
+        return None, 0
+    end_id = ids[-1]
+    column_list = ', '.join(columns)
+    # this also removes rows for items that have been deleted
+    cursor.execute("DELETE FROM item_fts WHERE docid >= ? AND docid <= ?",
+                   (start_id, end_id))
+    cursor.execute("INSERT INTO item_fts(docid, %s) "
+                   "SELECT id, %s FROM %s WHERE id >= ? AND id <= ?" %
+                   (column_list, column_list, table),
+                   (start_id, end_id))
+    if len(ids) < limit:
+        cursor.execute("DELETE FROM item_fts WHERE docid > ?", (end_id,))
+        return None, len(ids)
+    return end_id + 1, len(ids)
+
+def setup_rank_function(connection):
+    """Define fts_rank() for a sqlite3 connection."""
+    connection.create_function('fts_rank', -1, bm25)
+
+def bm25(matchinfo, *weights):
+    """Calculate the BM25 score for a row matched by a full text search.
+
+    :param matchinfo: value of matchinfo(item_fts, 'pcnalx') for the row
+    :param weights: weights for each column.  Columns without a weight get
+        1.0
+    :returns: score for the row, higher values are better matches
+    """
+    values = struct.unpack('@%dI' % (len(matchinfo) // 4), str(matchinfo))
+    phrase_count, column_count, row_count = values[:3]
+    avg_lengths = values[3:3+column_count]
+    lengths = values[3+column_count:3+column_count*2]
+    hits = values[3+column_count*2:]
+    score = 0.0
+    for column in xrange(column_count):
+        if column < len(weights):
+            weight = weights[column]
+        else:
+            weight = 1.0
+        if not weight:
+            continue
+        avg_length = max(avg_lengths[column], 1)
+        length_norm = (1 - BM25_B +
+                       BM25_B * float(lengths[column]) / avg_length)
+        for phrase in xrange(phrase_count):
+            pos = 3 * (phrase * column_count + column)
+            term_freq = hits[pos]
+            if term_freq == 0:
+                continue
+            docs_with_hits = hits[pos+2]
+            idf = math.log(1.0 + (row_count - docs_with_hits + 0.5) /
+                           (docs_with_hits + 0.5))
+            score += weight * idf * (term_freq * (BM25_K1 + 1) /
+                                     (term_freq + BM25_K1 * length_norm))
+    return score
+
+# matches tokens the same way as the FTS4 simple tokenizer.  It treats all
+# non-ASCII characters as part of a token and only lowercases ASCII ones.
+_token_re = re.compile(u'[0-9A-Za-z\u0080-\uffff]+')
+_ascii_lowercase_map = dict((ord(c), ord(c.lower()))
+                            for c in u'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+
+def tokenize(text):
+    """Split text into the tokens that FTS4 would index."""
+    if text is None:
+        return []
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return _token_re.findall(text.translate(_ascii_lowercase_map))
+
 def _no_item_table(connection, table_name):
     cursor = connection.execute("SELECT COUNT(*) FROM sqlite_master "
                                 "WHERE type='table' and name=?",
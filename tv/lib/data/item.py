@@ -91,6 +91,11 @@ class SelectColumn(object):
         schema_item = self._schema_map[self.table, self.column]
         return app.db.get_sqlite_type(schema_item)
 
+    def schema_item(self):
+        """Get the SchemaItem for this column, or None if we don't know it.
+        """
+        return self._schema_map.get((self.table, self.column))
+
 class ItemSelectInfo(object):
     """Describes query the data needed for an ItemInfo."""
 
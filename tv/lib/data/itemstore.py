@@ -0,0 +1,395 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""miro.data.itemstore -- Compact storage for ItemInfo data.
+
+ColumnarItemStore works like a dict that maps item ids to ItemInfo objects,
+but it stores the data for each column together instead of keeping a tuple
+and an ItemInfo object around for every item:
+
+- int, float and datetime columns are stored in arrays
+- short strings are interned, so all tracks from an album share the same
+  album/artist/genre strings
+- ItemInfo objects are created when they're asked for.  We keep the ones
+  used most recently around, which is normally the rows that are visible.
+
+ItemTracker can use it to store its row data (see the columnar_store
+parameter).
+"""
+
+import array
+import datetime
+import itertools
+
+from miro import schema
+from miro import util
+
+# don't intern strings longer than this, they're most likely unique
+INTERN_MAX_LENGTH = 200
+
+# we store datetimes as microseconds since this.  As a double, that's exact
+# for a couple hundred years before and after it.
+EPOCH = datetime.datetime(1970, 1, 1)
+MAX_MICROSECONDS = 2 ** 53
+
+class _ValueDoesntFit(Exception):
+    """Raised when a column can't store a value in its array."""
+
+class _Column(object):
+    """Column that stores python objects in a list."""
+    def __init__(self):
+        self.values = []
+
+    def add_slots(self, count):
+        self.values.extend([None] * count)
+
+    def get(self, slot):
+        return self.values[slot]
+
+    def set(self, slot, value):
+        self.values[slot] = value
+
+    def set_many(self, slots, values):
+        column_values = self.values
+        for slot, value in itertools.izip(slots, values):
+            column_values[slot] = value
+
+    def clear(self, slot):
+        self.values[slot] = None
+
+class _StringColumn(_Column):
+    """Column that interns the strings that it stores."""
+    def __init__(self, strings):
+        _Column.__init__(self)
+        self.strings = strings
+
+    def set(self, slot, value):
+        if value is not None and len(value) <= INTERN_MAX_LENGTH:
+            interned = self.strings.get(value)
+            # u'abc' == 'abc', so make sure we don't change the type
+            if interned is not None and type(interned) is type(value):
+                value = interned
+            else:
+                self.strings[value] = value
+        self.values[slot] = value
+
+    def set_many(self, slots, values):
+        column_values = self.values
+        strings = self.strings
+        for slot, value in itertools.izip(slots, values):
+            if value is not None and len(value) <= INTERN_MAX_LENGTH:
+                interned = strings.get(value)
+                if interned is not None and type(interned) is type(value):
+                    value = interned
+                else:
+                    strings[value] = value
+            column_values[slot] = value
+
+class _ArrayColumn(_Column):
+    """Column that stores values of a single type in an array.
+
+    We also keep a byte for each slot to handle None.  If we get a value of
+    another type, set() raises _ValueDoesntFit and ColumnarItemStore
+    switches to a _Column.
+    """
+    def __init__(self, typecode, value_type):
+        self.values = array.array(typecode)
+        self.nulls = bytearray()
+        self.value_type = value_type
+
+    def add_slots(self, count):
+        self.values.extend(array.array(self.values.typecode, [0]) * count)
+        self.nulls.extend('\x01' * count)
+
+    def get(self, slot):
+        if self.nulls[slot]:
+            return None
+        return self.values[slot]
+
+    def set(self, slot, value):
+        if value is None:
+            self.nulls[slot] = 1
+            return
+        if type(value) is not self.value_type:
+            raise _ValueDoesntFit()
+        try:
+            self.values[slot] = value
+        except OverflowError:
+            raise _ValueDoesntFit()
+        self.nulls[slot] = 0
+
+    def set_many(self, slots, values):
+        # This can raise _ValueDoesntFit after setting some of the values.
+        # That's okay, ColumnarItemStore converts the column and sets them
+        # all again.
+        column_values = self.values
+        nulls = self.nulls
+        value_type = self.value_type
+        try:
+            for slot, value in itertools.izip(slots, values):
+                if value is None:
+                    nulls[slot] = 1
+                elif type(value) is value_type:
+                    column_values[slot] = value
+                    nulls[slot] = 0
+                else:
+                    raise _ValueDoesntFit()
+        except OverflowError:
+            raise _ValueDoesntFit()
+
+    def clear(self, slot):
+        self.nulls[slot] = 1
+
+    def to_object_column(self):
+        column = _Column()
+        column.values = [self.get(slot) for slot in xrange(len(self.nulls))]
+        return column
+
+class _DateTimeColumn(_ArrayColumn):
+    """Column that stores datetimes as microseconds since EPOCH."""
+    def __init__(self):
+        _ArrayColumn.__init__(self, 'd', datetime.datetime)
+
+    def get(self, slot):
+        if self.nulls[slot]:
+            return None
+        return EPOCH + datetime.timedelta(microseconds=int(self.values[slot]))
+
+    def set(self, slot, value):
+        self.set_many((slot,), (value,))
+
+    def set_many(self, slots, values):
+        column_values = self.values
+        nulls = self.nulls
+        for slot, value in itertools.izip(slots, values):
+            if value is None:
+                nulls[slot] = 1
+                continue
+            if (type(value) is not datetime.datetime or
+                    value.tzinfo is not None):
+                raise _ValueDoesntFit()
+            delta = value - EPOCH
+            microseconds = ((delta.days * 86400 + delta.seconds) * 1000000 +
+                            delta.microseconds)
+            if abs(microseconds) >= MAX_MICROSECONDS:
+                raise _ValueDoesntFit()
+            column_values[slot] = float(microseconds)
+            nulls[slot] = 0
+
+def _make_column(select_column, strings):
+    schema_item = select_column.schema_item()
+    if isinstance(schema_item, (schema.SchemaInt, schema.SchemaBool)):
+        return _ArrayColumn('l', int)
+    elif isinstance(schema_item, schema.SchemaFloat):
+        return _ArrayColumn('d', float)
+    elif isinstance(schema_item, schema.SchemaDateTime):
+        return _DateTimeColumn()
+    elif isinstance(schema_item, (schema.SchemaString, schema.SchemaURL,
+                                  schema.SchemaFilename)):
+        return _StringColumn(strings)
+    else:
+        return _Column()
+
+class _ItemInfoCache(util.Cache):
+    def __init__(self, store, size):
+        util.Cache.__init__(self, size)
+        self.store = store
+
+    def create_new_value(self, id_, invalidator=None):
+        return self.store._make_item_info(id_)
+
+class ColumnarItemStore(object):
+    """Store ItemInfo data for an ItemTracker in columns.
+
+    This supports the parts of the dict API that ItemTracker uses for its
+    row_data: ids map to ItemInfo objects.  ItemInfos that we can't store in
+    columns, like DBErrorItemInfo, are stored as-is.
+
+    ItemInfos returned by this class are snapshots like the ones that
+    ItemFetcher creates.  Changing the data for an item doesn't change
+    ItemInfos that were returned before.
+    """
+
+    # number of ItemInfo objects to keep around
+    INFO_CACHE_SIZE = 500
+    # min number of slots to add when the columns are full.  Adding them one
+    # at a time is slow, since we have to add a slot to each column.
+    MIN_GROW_SLOTS = 64
+
+    def __init__(self, item_source):
+        """Create a ColumnarItemStore
+
+        :param item_source: ItemSource that the ItemInfos come from
+        """
+        self.item_source = item_source
+        self.select_columns = item_source.select_info.select_columns
+        self._init_storage()
+
+    def _init_storage(self):
+        # maps interned strings to themselves
+        self._strings = {}
+        self.columns = [_make_column(c, self._strings)
+                        for c in self.select_columns]
+        # maps item ids to their slot in the columns.  Ids for ItemInfos
+        # that we can't store in columns map to None.
+        self._slots = {}
+        self._free_slots = []
+        self._slot_count = 0
+        # slots freed since we last cleaned up _strings
+        self._freed_count = 0
+        # ItemInfos that we can't store in columns
+        self._other_infos = {}
+        self._info_cache = _ItemInfoCache(self, self.INFO_CACHE_SIZE)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, id_):
+        return id_ in self._slots
+
+    def __iter__(self):
+        return iter(self._slots)
+
+    def ids(self):
+        """Get a dict whose keys are the ids in the store.
+
+        Don't change it.  Testing ids against it is faster than using the
+        in operator with the store, which matters in big loops.
+        """
+        return self._slots
+
+    def keys(self):
+        return self._slots.keys()
+
+    def iteritems(self):
+        for id_ in self.keys():
+            yield id_, self[id_]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def get(self, id_, default=None):
+        if id_ in self._slots:
+            return self[id_]
+        return default
+
+    def clear(self):
+        self._init_storage()
+
+    def __getitem__(self, id_):
+        if self._slots[id_] is None:
+            return self._other_infos[id_]
+        return self._info_cache.get(id_)
+
+    def __setitem__(self, id_, item_info):
+        self.update(((id_, item_info),))
+
+    def update(self, items):
+        """Store several ItemInfos at once.
+
+        :param items: iterable of (id, ItemInfo) pairs, like dict.update()
+
+        This is a lot faster than setting the rows one at a time, since we
+        can fill in each column for all the rows with one method call.
+        """
+        column_count = len(self.columns)
+        slots = []
+        rows = []
+        for id_, item_info in items:
+            row_data = getattr(item_info, 'row_data', None)
+            if (type(row_data) is not tuple or
+                    len(row_data) != column_count):
+                if id_ in self._slots:
+                    del self[id_]
+                self._slots[id_] = None
+                self._other_infos[id_] = item_info
+                continue
+            slot = self._slots.get(id_)
+            if slot is None:
+                self._other_infos.pop(id_, None)
+                slot = self._slots[id_] = self._alloc_slot()
+            slots.append(slot)
+            rows.append(row_data)
+            # this is probably about to be used, so keep it around
+            self._info_cache.set(id_, item_info)
+        if not rows:
+            return
+        for i, values in enumerate(zip(*rows)):
+            column = self.columns[i]
+            try:
+                column.set_many(slots, values)
+            except _ValueDoesntFit:
+                column = self.columns[i] = column.to_object_column()
+                column.set_many(slots, values)
+
+    def __delitem__(self, id_):
+        slot = self._slots.pop(id_)
+        if slot is None:
+            del self._other_infos[id_]
+            return
+        self._info_cache.remove(id_)
+        for column in self.columns:
+            column.clear(slot)
+        self._free_slots.append(slot)
+        self._freed_count += 1
+        if self._freed_count > max(len(self._strings), 1000):
+            self._compact_strings()
+
+    def _alloc_slot(self):
+        if not self._free_slots:
+            self._grow()
+        return self._free_slots.pop()
+
+    def _grow(self):
+        # grow by 1/8th like python lists, so memory overhead stays low
+        count = max(self._slot_count // 8, self.MIN_GROW_SLOTS)
+        for column in self.columns:
+            column.add_slots(count)
+        new_slots = xrange(self._slot_count, self._slot_count + count)
+        # pop() takes from the end, so use the lowest slots first
+        self._free_slots.extend(reversed(new_slots))
+        self._slot_count += count
+
+    def _make_item_info(self, id_):
+        slot = self._slots[id_]
+        row_data = tuple([column.get(slot) for column in self.columns])
+        return self.item_source.make_item_info(row_data)
+
+    def _compact_strings(self):
+        """Forget interned strings that aren't used anymore."""
+        live_strings = {}
+        for column in self.columns:
+            if isinstance(column, _StringColumn):
+                for value in column.values:
+                    if value is not None and len(value) <= INTERN_MAX_LENGTH:
+                        live_strings[value] = value
+        # the columns share our dict, so update it in place
+        self._strings.clear()
+        self._strings.update(live_strings)
+        self._freed_count = 0
@@ -29,7 +29,10 @@
 
 """miro.data.itemtrack -- Track Items in the database
 """
+import bisect
 import collections
+import heapq
+import itertools
 import logging
 import string
 import sqlite3
@@ -43,7 +46,9 @@ from miro import prefs
 from miro import schema
 from miro import signals
 from miro import util
+from miro.data import fulltextsearch
 from miro.data import item
+from miro.data import itemstore
 from miro.gtcache import gettext as _
 
 ItemTrackerCondition = util.namedtuple(
@@ -61,12 +66,14 @@ ItemTrackerCondition = util.namedtuple(
 
 ItemTrackerOrderBy = util.namedtuple(
     "ItemTrackerOrderBy",
-    "columns sql",
+    "columns sql reverse_sql",
 
     """ItemTrackerOrderBy defines one term for the ORDER BY clause of a query.
 
     :attribute columns: list of (table, column) tuples used in the query
     :attribute sql: sql expression
+    :attribute reverse_sql: sql expression for the reverse order, or None if
+    we don't know it
     """)
 
 class ItemTrackerQueryBase(object):
@@ -74,11 +81,21 @@ class ItemTrackerQueryBase(object):
 
     select_info = item.ItemSelectInfo()
 
+    # weights for the item_fts columns when ranking search results.  title
+    # is the first column for all our item tables.
+    RANK_WEIGHTS = (2.0,)
+    # arguments for fulltextsearch.fulltext_columns() for our item table
+    fulltext_path_column = 'filename'
+    fulltext_has_entry_description = True
+
     def __init__(self):
         self.conditions = []
         self.match_string = None
+        self.search_terms = None
+        self.search_ranked = False
         self.order_by = None
         self.limit = None
+        self.offset = None
 
     def join_sql(self, table, join_type='LEFT JOIN'):
         return self.select_info.join_sql(table, join_type=join_type)
@@ -121,10 +138,16 @@ class ItemTrackerQueryBase(object):
         cond = ItemTrackerCondition([(table, column)], sql, (value,))
         self.conditions.append(cond)
 
-    def set_search(self, search_string):
-        """Set the full-text search to use for this item tracker."""
+    def set_search(self, search_string, ranked=False):
+        """Set the full-text search to use for this item tracker.
+
+        :param search_string: text the user typed in
+        :param ranked: if True, put the best matches first.  Our ORDER BY
+            clause is then only used to order matches with the same score.
+        """
+        self.search_ranked = ranked
         if search_string is None:
-            self.match_string = None
+            self.match_string = self.search_terms = None
             return
         # parse search_string and make a string for the sqlite3 match command
         # We do the following:
@@ -140,8 +163,9 @@ class ItemTrackerQueryBase(object):
             terms.remove('torrent')
             self.add_condition("remote_downloader.type", '=', 'BitTorrent')
             if not terms:
-                self.match_string = None
+                self.match_string = self.search_terms = None
                 return
+        self.search_terms = terms
         self.match_string = " ".join(terms)
         if self.match_string and search_string[-1] != ' ':
             self.match_string += "*"
@@ -180,6 +204,7 @@ class ItemTrackerQueryBase(object):
             raise ValueError("sequence length mismatch")
 
         sql_parts = []
+        reverse_sql_parts = []
         order_by_columns = []
         for column, collation in zip(columns, collations):
             if column[0] == '-':
@@ -191,8 +216,11 @@ class ItemTrackerQueryBase(object):
             order_by_columns.append((table, column))
             sql_parts.append(self._order_by_expression(table, column,
                                                        descending, collation))
+            reverse_sql_parts.append(self._order_by_expression(
+                table, column, not descending, collation))
         self.order_by = ItemTrackerOrderBy(order_by_columns,
-                                           ', '.join(sql_parts))
+                                           ', '.join(sql_parts),
+                                           ', '.join(reverse_sql_parts))
 
     def set_complex_order_by(self, columns, sql):
         """Change the ORDER BY clause to a complex SQL expression
@@ -201,7 +229,7 @@ class ItemTrackerQueryBase(object):
         :param sql: SQL to execute
         """
         order_by_columns = [self._parse_column(c) for c in columns]
-        self.order_by = ItemTrackerOrderBy(order_by_columns, sql)
+        self.order_by = ItemTrackerOrderBy(order_by_columns, sql, None)
 
     def _order_by_expression(self, table, column, descending, collation):
         parts = []
@@ -217,6 +245,32 @@ class ItemTrackerQueryBase(object):
     def set_limit(self, limit):
         self.limit = limit
 
+    def set_offset(self, offset):
+        self.offset = offset
+
+    def is_prefix_search(self):
+        """Is the last search term a prefix?"""
+        return self.match_string is not None and self.match_string[-1] == '*'
+
+    def is_ranked_search(self):
+        return self.search_ranked and self.match_string is not None
+
+    def get_search_columns(self):
+        """Get the item columns that set_search() matches against."""
+        return fulltextsearch.fulltext_columns(
+            self.fulltext_path_column, self.fulltext_has_entry_description)
+
+    def cache_key(self):
+        """Get a key for everything in this query except the search.
+
+        Two queries with the same cache_key() will return the same items, in
+        the same order, if their searches match the same items.
+        """
+        return (self.table_name(),
+                tuple((c.sql, tuple(c.values)) for c in self.conditions),
+                self.order_by, self.is_ranked_search(), self.limit,
+                self.offset)
+
     def get_columns_to_track(self):
         """Get the columns that affect the results of the query """
         columns = set()
@@ -243,10 +297,10 @@ class ItemTrackerQueryBase(object):
         other_tables.discard('item')
         return other_tables
 
-    def select_ids(self, connection):
-        """Run the select statement for this query
+    def select_ids_sql(self):
+        """Get the select statement for select_ids()
 
-        :returns: list of item ids
+        :returns: (sql, arg_list) tuple
         """
         sql_parts = []
         arg_list = []
@@ -256,7 +310,14 @@ class ItemTrackerQueryBase(object):
         self._add_conditions(sql_parts, arg_list)
         self._add_order_by(sql_parts, arg_list)
         self._add_limit(sql_parts, arg_list)
-        sql = ' '.join(sql_parts)
+        return ' '.join(sql_parts), arg_list
+
+    def select_ids(self, connection):
+        """Run the select statement for this query
+
+        :returns: list of item ids
+        """
+        sql, arg_list = self.select_ids_sql()
         logging.debug("ItemTracker: running query %s (%s)", sql, arg_list)
         item_ids = [row[0] for row in connection.execute(sql, arg_list)]
         logging.debug("ItemTracker: done running query")
@@ -335,18 +396,38 @@ class ItemTrackerQueryBase(object):
             '(%s)' % part for part in where_parts))
 
     def _add_order_by(self, sql_parts, arg_list):
+        order_parts = []
+        if self.is_ranked_search():
+            order_parts.append("fts_rank(matchinfo(item_fts, '%s'), %s) DESC"
+                               % (fulltextsearch.MATCHINFO_FORMAT,
+                                  ', '.join(str(w) for w in
+                                            self.RANK_WEIGHTS)))
         if self.order_by:
-            sql_parts.append("ORDER BY %s" % self.order_by.sql)
+            order_parts.append(self.order_by.sql)
+        else:
+            # Without an explicit order, the order SQLite returns rows in
+            # depends on which index it picks.  Use the id so that adding
+            # an index doesn't reorder unsorted trackers.
+            order_parts.append("%s.id" % self.table_name())
+        sql_parts.append("ORDER BY %s" % ', '.join(order_parts))
 
     def _add_limit(self, sql_parts, arg_list):
         if self.limit is not None:
             sql_parts.append("LIMIT %s" % self.limit)
+        elif self.offset is not None:
+            sql_parts.append("LIMIT -1")
+        if self.offset is not None:
+            sql_parts.append("OFFSET %s" % self.offset)
 
     def copy(self):
         retval = self.__class__()
         retval.conditions = self.conditions[:]
         retval.order_by = self.order_by
         retval.match_string = self.match_string
+        retval.search_terms = self.search_terms
+        retval.search_ranked = self.search_ranked
+        retval.limit = self.limit
+        retval.offset = self.offset
         return retval
 
 class ItemTrackerQuery(ItemTrackerQueryBase):
@@ -371,6 +452,8 @@ class SharingItemTrackerQuery(ItemTrackerQueryBase):
     """ItemTrackerQuery for SharingItems."""
 
     select_info = item.SharingItemSelectInfo()
+    fulltext_path_column = 'video_path'
+    fulltext_has_entry_description = False
 
     def tracking_playlist_map(self):
         for c in self.conditions:
@@ -385,6 +468,396 @@ class SharingItemTrackerQuery(ItemTrackerQueryBase):
         else:
             return ItemTrackerQueryBase.could_list_change(self, message)
 
+class SearchResultCache(object):
+    """Cache the results of recent searches for an ItemTracker.
+
+    As the user types out a search, each search usually narrows the one
+    before it.  "foob*" can only match items that "foo*" matched, and so
+    can "foo bar*".  When that happens we filter the cached ids in python,
+    using the item_fts tokens for those items, instead of running the query
+    against the whole library again.  Filtering keeps the order of the
+    cached ids, so this only works for unranked queries without a limit.
+
+    ItemTracker calls on_item_changes() for each ItemChanges message, which
+    drops results that the changes could make wrong.
+    """
+
+    # number of searches to remember
+    MAX_SEARCHES = 10
+    # don't cache searches that match more than this many items
+    MAX_RESULTS = 5000
+
+    _cacheable_term_re = re.compile('^[0-9a-z]+$')
+
+    def __init__(self, select_ids=None):
+        """Create a SearchResultCache
+
+        :param select_ids: function to select ids when we can't use the
+        cache.  It inputs a query and a connection.  By default we call
+        query.select_ids().
+        """
+        # list of (cache_key, terms, is_prefix, id_list, tokens) tuples, most
+        # recent last.  tokens maps ids to sets of tokens.  We load it the
+        # first time we need to narrow an entry.
+        self.entries = []
+        self.hits = self.misses = 0
+        if select_ids is None:
+            select_ids = lambda query, connection: query.select_ids(connection)
+        self._select_ids = select_ids
+
+    def clear(self):
+        self.entries = []
+
+    def on_item_changes(self, message, query):
+        """Drop results that could have been changed by a message.
+
+        :param message: ItemChanges message
+        :param query: query that the ItemTracker uses now.  We can only
+            check if the message affects its conditions, so we also drop
+            results for other queries.
+        """
+        if (query.could_list_change(message) or
+                message.changed_columns.intersection(
+                    query.get_search_columns())):
+            self.clear()
+        else:
+            key = query.cache_key()
+            self.entries = [entry for entry in self.entries
+                            if entry[0] == key]
+
+    def select_ids(self, query, connection):
+        """Get the ids for a query, using the cache if we can.
+
+        :returns: list of item ids
+        """
+        if not self._can_cache(query):
+            return self._select_ids(query, connection)
+        key = query.cache_key()
+        terms = query.search_terms
+        is_prefix = query.is_prefix_search()
+        entry = self._find_superset(key, terms, is_prefix)
+        if entry is not None:
+            self.hits += 1
+            tokens = self._get_tokens(entry, connection)
+            id_list = [id_ for id_ in entry[3]
+                       if self._matches(tokens[id_], terms, is_prefix)]
+            tokens = dict((id_, tokens[id_]) for id_ in id_list)
+        else:
+            self.misses += 1
+            id_list = self._select_ids(query, connection)
+            tokens = None
+        if len(id_list) <= self.MAX_RESULTS:
+            self.entries.append((key, terms, is_prefix, id_list, tokens))
+            del self.entries[:-self.MAX_SEARCHES]
+        return id_list
+
+    def _can_cache(self, query):
+        if (query.match_string is None or query.is_ranked_search() or
+                query.limit is not None or query.offset is not None):
+            return False
+        # we tokenize items ourselves, so play it safe and only handle terms
+        # where we know we'll do the same thing as sqlite.
+        return all(self._cacheable_term_re.match(t)
+                   for t in query.search_terms)
+
+    def _find_superset(self, key, terms, is_prefix):
+        """Find a cached search whose results include all matches for
+        terms.
+        """
+        for entry in reversed(self.entries):
+            entry_key, entry_terms, entry_is_prefix = entry[:3]
+            if entry_key != key or len(entry_terms) > len(terms):
+                continue
+            last = len(entry_terms) - 1
+            if entry_terms[:last] != terms[:last]:
+                continue
+            if entry_is_prefix:
+                if terms[last].startswith(entry_terms[last]):
+                    return entry
+            elif (terms[last] == entry_terms[last] and
+                    not (last == len(terms) - 1 and is_prefix)):
+                return entry
+        return None
+
+    def _get_tokens(self, entry, connection):
+        tokens = entry[4]
+        if tokens is None:
+            tokens = {}
+            if entry[3]:
+                sql = ("SELECT *, docid FROM item_fts WHERE docid IN (%s)" %
+                       ', '.join(str(id_) for id_ in entry[3]))
+                for row in connection.execute(sql):
+                    row_tokens = set()
+                    for value in row[:-1]:
+                        row_tokens.update(fulltextsearch.tokenize(value))
+                    tokens[row[-1]] = row_tokens
+            for id_ in entry[3]:
+                tokens.setdefault(id_, set())
+            self.entries[self.entries.index(entry)] = entry[:4] + (tokens,)
+        return tokens
+
+    def _matches(self, tokens, terms, is_prefix):
+        if is_prefix:
+            last = terms[-1]
+            if not any(t.startswith(last) for t in tokens):
+                return False
+            terms = terms[:-1]
+        for term in terms:
+            if term not in tokens:
+                return False
+        return True
+
+class QueryResultCache(object):
+    """Cache the id lists for queries from many ItemTrackers.
+
+    ItemListPool makes sure that we only have 1 ItemList for a tab, but
+    changing the sort or filters for that list still runs its query again.
+    For big lists, sorting is what makes those queries slow.  Since this
+    cache is shared, a tracker can also use results from other trackers for
+    the same database.  Besides returning results for the same query, we can
+    calculate results for a query from cached results when:
+
+    - the order of a cached query is the reverse of ours.  We reverse the
+      ids.
+    - a cached query uses a subset of our conditions.  We select the ids
+      that match the other conditions, without sorting them, and filter the
+      cached ids with those.
+
+    Both need the queries to have the same search and no limit.
+
+    Call on_item_changes() with each ItemChanges message (and the device
+    and sharing versions).  We drop the results that it could have changed.
+
+    The backend can add or remove items before we get the message for it.
+    A tracker's ids and row data need to come from the same transaction, so
+    we also store the item count and max id with each result, like
+    ItemFetcherWAL does, and drop results when they don't match the ones
+    for the connection we're called with.
+    """
+
+    # number of query results to remember
+    MAX_ENTRIES = 20
+    # don't cache results with more than this many items
+    MAX_RESULTS = 100000
+
+    def __init__(self):
+        # list of (item_source, query, id_list, snapshot) tuples, most
+        # recent last.  snapshot is the (item count, max id) for the table
+        # when we got id_list.
+        self.entries = []
+        self.hits = self.derived = self.misses = 0
+
+    def clear(self):
+        self.entries = []
+
+    def select_ids(self, query, item_source, connection):
+        """Get the ids for a query, using the cache if we can.
+
+        :param query: ItemTrackerQuery to run
+        :param item_source: ItemSource for the database that connection is
+        for
+        :param connection: connection to use if we need to select ids
+        :returns: list of item ids
+        """
+        snapshot = self._calc_snapshot(item_source, connection)
+        self._drop_stale_entries(item_source, snapshot)
+        entry = self._find_entry(query, item_source)
+        if entry is not None:
+            self.hits += 1
+            self.entries.remove(entry)
+            self.entries.append(entry)
+            return list(entry[2])
+        id_list = self._derive_ids(query, item_source, connection)
+        if id_list is not None:
+            self.derived += 1
+        else:
+            self.misses += 1
+            id_list = query.select_ids(connection)
+        if len(id_list) <= self.MAX_RESULTS:
+            # trackers append to their id lists in load_more(), so store a
+            # copy
+            self.entries.append((item_source, query.copy(), list(id_list),
+                                 snapshot))
+            del self.entries[:-self.MAX_ENTRIES]
+        return id_list
+
+    def on_item_changes(self, message, source_type):
+        """Drop results that could have been changed by a message.
+
+        :param message: ItemChanges, DeviceItemChanges or
+        SharingItemChanges message
+        :param source_type: ItemSource subclass for the message
+        """
+        self.entries = [entry for entry in self.entries
+                        if not (type(entry[0]) is source_type and
+                                entry[1].could_list_change(message))]
+
+    def _calc_snapshot(self, item_source, connection):
+        sql = ("SELECT COUNT(1), MAX(id) FROM %s" %
+               item_source.select_info.table_name)
+        return tuple(connection.execute(sql).fetchone())
+
+    def _drop_stale_entries(self, item_source, snapshot):
+        self.entries = [entry for entry in self.entries
+                        if not (self._same_source(entry, item_source) and
+                                entry[3] != snapshot)]
+
+    def _same_source(self, entry, item_source):
+        return entry[0].connection_pool is item_source.connection_pool
+
+    def _find_entry(self, query, item_source):
+        key = (query.cache_key(), query.match_string)
+        for entry in reversed(self.entries):
+            if (self._same_source(entry, item_source) and
+                    (entry[1].cache_key(), entry[1].match_string) == key):
+                return entry
+        return None
+
+    def _derive_ids(self, query, item_source, connection):
+        """Try to calculate the ids for query from a cached query.
+
+        :returns: list of ids, or None if no cached query can be used
+        """
+        if not self._can_derive(query):
+            return None
+        conditions = self._condition_keys(query)
+        for entry in reversed(self.entries):
+            cached_query = entry[1]
+            if (not self._same_source(entry, item_source) or
+                    not self._can_derive(cached_query) or
+                    cached_query.match_string != query.match_string):
+                continue
+            order = self._compare_order(cached_query.order_by,
+                                        query.order_by)
+            if order is None:
+                continue
+            extra_conditions = self._extra_conditions(
+                self._condition_keys(cached_query), conditions)
+            if extra_conditions is None:
+                continue
+            id_list = list(entry[2])
+            if order == 'reversed':
+                id_list.reverse()
+            if extra_conditions:
+                filter_query = query.__class__()
+                filter_query.conditions = extra_conditions
+                matching_ids = set(filter_query.select_ids(connection))
+                id_list = [id_ for id_ in id_list if id_ in matching_ids]
+            return id_list
+        return None
+
+    def _can_derive(self, query):
+        return (query.limit is None and query.offset is None and
+                not query.is_ranked_search())
+
+    def _condition_keys(self, query):
+        return [((c.sql, tuple(c.values)), c) for c in query.conditions]
+
+    def _extra_conditions(self, cached_conditions, conditions):
+        """Get the conditions that a query adds to a cached one.
+
+        :returns: list of ItemTrackerConditions, or None if the cached query
+        has conditions that the new query doesn't.
+        """
+        extra = [c for key, c in conditions]
+        keys = [key for key, c in conditions]
+        for key, c in cached_conditions:
+            try:
+                index = keys.index(key)
+            except ValueError:
+                return None
+            del keys[index]
+            del extra[index]
+        return extra
+
+    def _compare_order(self, cached_order_by, order_by):
+        """Compare the order of a cached query with a new one.
+
+        :returns: "same", "reversed" or None if we can't tell.
+        """
+        if cached_order_by == order_by:
+            return 'same'
+        if (cached_order_by is not None and order_by is not None and
+                cached_order_by.reverse_sql is not None and
+                cached_order_by.reverse_sql == order_by.sql):
+            return 'reversed'
+        return None
+
+class ListDiff(object):
+    """Positional changes between 2 lists of ids.
+
+    To turn the old list into the new list, remove the rows in removed,
+    starting with the last one, then insert the rows in inserted, starting
+    with the first one.  Items that moved are both removed and inserted.
+
+    :attribute removed: sorted list of indexes in the old list
+    :attribute inserted: sorted list of indexes in the new list
+    """
+    def __init__(self, removed, inserted):
+        self.removed = removed
+        self.inserted = inserted
+
+    def __len__(self):
+        return len(self.removed) + len(self.inserted)
+
+    @classmethod
+    def calc(cls, old_ids, new_ids):
+        """Calculate the changes between two lists of ids.
+
+        We keep the most items that we can in place (the longest common
+        subsequence of old_ids and new_ids).  Since ids are unique, that's
+        the longest increasing subsequence of the old indexes, taken in
+        new_ids order.
+        """
+        old_index = dict((id_, i) for i, id_ in enumerate(old_ids))
+        common = [(old_index[id_], j) for j, id_ in enumerate(new_ids)
+                  if id_ in old_index]
+        # patience sort.  tails[k] is the smallest old index that ends an
+        # increasing subsequence of length k+1 and tail_pos[k] its position
+        # in common.
+        tails = []
+        tail_pos = []
+        prev = [None] * len(common)
+        for pos, (i, j) in enumerate(common):
+            k = bisect.bisect_left(tails, i)
+            if k > 0:
+                prev[pos] = tail_pos[k-1]
+            if k == len(tails):
+                tails.append(i)
+                tail_pos.append(pos)
+            else:
+                tails[k] = i
+                tail_pos[k] = pos
+        kept_old = set()
+        kept_new = set()
+        if tail_pos:
+            pos = tail_pos[-1]
+            while pos is not None:
+                i, j = common[pos]
+                kept_old.add(i)
+                kept_new.add(j)
+                pos = prev[pos]
+        return cls([i for i in xrange(len(old_ids)) if i not in kept_old],
+                   [j for j in xrange(len(new_ids)) if j not in kept_new])
+
+    @staticmethod
+    def _ranges(indexes):
+        rv = []
+        for index in indexes:
+            if rv and rv[-1][0] + rv[-1][1] == index:
+                rv[-1][1] += 1
+            else:
+                rv.append([index, 1])
+        return [tuple(r) for r in rv]
+
+    def removed_ranges(self):
+        """Get the removed rows as a list of (start, count) tuples."""
+        return self._ranges(self.removed)
+
+    def inserted_ranges(self):
+        """Get the inserted rows as a list of (start, count) tuples."""
+        return self._ranges(self.inserted)
+
 class ItemTracker(signals.SignalEmitter):
     """Track items in the database
 
@@ -396,6 +869,16 @@ class ItemTracker(signals.SignalEmitter):
 
     - Fetches ids first, then fetches row data when it's requested, or in
       idle callbacks.
+    - Only keeps the row data near the visible rows for big lists.  The view
+      should call set_visible_range() when it scrolls.  We prefetch rows
+      around that range in idle callbacks and forget rows that are far away
+      from it once we have more than max_loaded_rows.  Views that don't
+      call it get prefetching around the last row passed to get_row().
+    - Finishes the read transaction when we don't have rows to prefetch, so
+      that we don't keep the database from checkpointing while a big list
+      is open (see _load_rows() for what happens after that).
+    - Can store the row data in a ColumnarItemStore, which uses much less
+      memory per row, so we can keep more rows loaded.
     - Can efficently tell what's changed in an item list when another process
       modifies the item data
 
@@ -404,12 +887,24 @@ class ItemTracker(signals.SignalEmitter):
     - "items-changed" (changed_id_list): some items have been changed, but the
     list is the same.
     - "list-changed": items have been added, removed, or reorded in the list.
+    - "list-diff" (diff): emitted right before list-changed when an
+    ItemChanges message changed the list and the changes were small
+    enough.  diff is a ListDiff that views can use to update themselves
+    instead of reloading the entire list.
     """
 
     # how many rows we fetch at one time in _ensure_row_loaded()
     FETCH_ROW_CHUNK_SIZE = 25
-
-    def __init__(self, idle_scheduler, query, item_source):
+    # how many rows before/after the visible ones we prefetch
+    READ_AHEAD_ROWS = 100
+    # default for max_loaded_rows
+    MAX_LOADED_ROWS = 2000
+    # don't emit list-diff if it changes more than this fraction of the rows
+    MAX_DIFF_FRACTION = 0.5
+
+    def __init__(self, idle_scheduler, query, item_source,
+                 max_loaded_rows=None, result_cache=None,
+                 columnar_store=False):
         """Create an ItemTracker
 
         :param idle_scheduler: function to schedule idle callback functions.
@@ -417,16 +912,43 @@ class ItemTracker(signals.SignalEmitter):
         idletime.
         :param query: ItemTrackerQuery to use
         :param item_source: ItemSource to use.
+        :param max_loaded_rows: max number of rows to keep loaded.  Lists
+        smaller than this get fully loaded in idle callbacks.  Defaults to
+        MAX_LOADED_ROWS.
+        :param result_cache: QueryResultCache to share with other trackers.
+        Whoever creates it must call its on_item_changes() method for each
+        ItemChanges message.
+        :param columnar_store: store row data in a ColumnarItemStore instead
+        of a dict.  It uses less memory per row, but loading rows is slower,
+        so it's only worth it with a big max_loaded_rows.
         """
         signals.SignalEmitter.__init__(self)
         self.create_signal("will-change")
         self.create_signal("items-changed")
         self.create_signal("list-changed")
+        self.create_signal("list-diff")
         self.idle_scheduler = idle_scheduler
         self.idle_work_scheduled = False
         self.item_fetcher = None
+        self.columnar_store = columnar_store
+        if max_loaded_rows is None:
+            max_loaded_rows = self.MAX_LOADED_ROWS
+        self.max_loaded_rows = max_loaded_rows
+        self.visible_range = None
+        # have we called done_fetching() on our ItemFetcher?
+        self._fetching_done = False
+        # have items been added/removed since the read transaction that we
+        # got id_list from?
+        self._id_list_stale = False
+        # row that get_row() was last called for.  We prefetch around this
+        # if the view hasn't called set_visible_range()
+        self._last_row = 0
+        # row where _load_next_chunk() last found unloaded data
+        self._next_chunk_hint = 0
         self.item_source = item_source
         self._db_retry_callback_pending = False
+        self.result_cache = result_cache
+        self.search_cache = SearchResultCache(self._select_ids)
         self._set_query(query)
         self._fetch_id_list()
         if self.item_fetcher is not None:
@@ -489,16 +1011,32 @@ class ItemTracker(signals.SignalEmitter):
     def _fetch_id_list(self):
         """Fetch the ids for this list.  """
         self._destroy_item_fetcher()
+        self._fetching_done = self._id_list_stale = False
         try:
             connection = self.item_source.get_connection()
             connection.execute("BEGIN TRANSACTION")
-            self.id_list = self.query.select_ids(connection)
+            self.id_list = self.search_cache.select_ids(self.query,
+                                                        connection)
             self.item_fetcher = self.make_item_fetcher(connection, self.id_list)
         except sqlite3.DatabaseError, e:
             logging.warn("%s while fetching items", e, exc_info=True)
             self._make_empty_list_after_db_error()
         self.id_to_index = dict((id_, i) for i, id_ in enumerate(self.id_list))
-        self.row_data = {}
+        self.row_data = self._make_row_data()
+
+    def _make_row_data(self):
+        """Make the object that maps ids to ItemInfos for loaded rows."""
+        if self.columnar_store:
+            return itemstore.ColumnarItemStore(self.item_source)
+        else:
+            return {}
+
+    def _select_ids(self, query, connection):
+        if self.result_cache is not None:
+            return self.result_cache.select_ids(query, self.item_source,
+                                                connection)
+        else:
+            return query.select_ids(connection)
 
     def _make_empty_list_after_db_error(self):
         self.id_list = []
@@ -519,15 +1057,101 @@ class ItemTracker(signals.SignalEmitter):
             # destroy() was called while the idle callback was still
             # scheduled.  Just return.
             return
-        for i in xrange(len(self.id_list)):
-            if not self._row_loaded(i):
+        start, end = self._prefetch_range()
+        if self._load_next_chunk(start, end):
+            return
+        if len(self.id_list) > self.max_loaded_rows:
+            # We can't keep the entire list in memory.  Forget the rows that
+            # are furthest away from the visible ones.
+            self._evict_rows()
+        elif self._load_next_chunk(0, len(self.id_list)):
+            # The entire list fits, so load the rest of it.
+            return
+        # Nothing left to prefetch, finish the read transaction.
+        self._done_fetching()
+
+    def _done_fetching(self):
+        if not self._fetching_done:
+            self.item_fetcher.done_fetching()
+            self._fetching_done = True
+
+    def _load_next_chunk(self, start, end):
+        """Load the first unloaded row between start and end.
+
+        If we load a row, we also schedule do_idle_work() to run again.
+
+        :returns: True if there was a row to load
+        """
+        # this gets called with big ranges, so avoid calling _row_loaded()
+        # for each row
+        id_list = self.id_list
+        if self.columnar_store:
+            loaded_ids = self.row_data.ids()
+        else:
+            loaded_ids = self.row_data
+        # Rows before the one we loaded last time are most likely still
+        # loaded, so start there and wrap around.  Starting at the top each
+        # time makes loading the entire list quadratic.
+        hint = min(max(self._next_chunk_hint, start), end)
+        for i in itertools.chain(xrange(hint, end), xrange(start, hint)):
+            if id_list[i] not in loaded_ids:
                 # row data unloaded, call _ensure_row_loaded to load this row
                 # and adjecent rows then schedule another run later
+                self._next_chunk_hint = i
                 self._ensure_row_loaded(i)
                 self._schedule_idle_work()
-                return
-        # no rows need loading
-        self.item_fetcher.done_fetching()
+                return True
+        return False
+
+    def set_visible_range(self, start, end):
+        """Tell the ItemTracker which rows are visible.
+
+        We will prefetch READ_AHEAD_ROWS around them in idle callbacks, and
+        rows far away from them are the first ones we forget.
+
+        :param start: index of the first visible row
+        :param end: index after the last visible row
+        """
+        if self.visible_range == (start, end):
+            return
+        self.visible_range = (start, end)
+        if self.item_fetcher is not None:
+            self._schedule_idle_work()
+
+    def _focus_range(self):
+        """Get the (start, end) range of rows that the view is showing."""
+        if self.visible_range is not None:
+            start, end = self.visible_range
+        else:
+            start, end = self._last_row, self._last_row + 1
+        end = min(end, len(self.id_list))
+        return min(start, end), end
+
+    def _prefetch_range(self):
+        start, end = self._focus_range()
+        return (max(start - self.READ_AHEAD_ROWS, 0),
+                min(end + self.READ_AHEAD_ROWS, len(self.id_list)))
+
+    def _evict_rows(self):
+        """Forget row data until we have at most max_loaded_rows rows."""
+        excess = len(self.row_data) - self.max_loaded_rows
+        if excess <= 0:
+            return
+        start, end = self._focus_range()
+        id_to_index = self.id_to_index
+        def distance(id_):
+            index = id_to_index[id_]
+            if index < start:
+                return start - index
+            else:
+                return max(index - end + 1, 0)
+        # Don't use _uncache_row_data() here, the data hasn't changed so
+        # subclasses don't need to know about it.
+        for id_ in heapq.nlargest(excess, self.row_data, key=distance):
+            del self.row_data[id_]
+
+    def _all_rows_loaded(self):
+        return len(self.row_data) == len(self.id_list)
 
     def _uncache_row_data(self, id_list):
         for id_ in id_list:
@@ -543,6 +1167,41 @@ class ItemTracker(signals.SignalEmitter):
         if send_signals:
             self.emit("list-changed")
 
+    def _update_id_list(self):
+        """Refetch our id list after items were added/removed/moved.
+
+        Unlike _refetch_id_list(), we keep the row data for items that are
+        still in the list and emit list-diff before list-changed.
+        """
+        old_id_list = self.id_list
+        old_row_data = self.row_data
+        self._fetch_id_list()
+        self._restore_row_data(old_row_data)
+        diff = ListDiff.calc(old_id_list, self.id_list)
+        max_changes = max(len(old_id_list), len(self.id_list))
+        if len(diff) <= max_changes * self.MAX_DIFF_FRACTION:
+            self.emit("list-diff", diff)
+        self.emit("list-changed")
+
+    def _restore_row_data(self, old_row_data):
+        """Put back row data from before _fetch_id_list() was called.
+
+        This should only be called with rows that haven't changed since
+        they were loaded.
+        """
+        id_to_index = self.id_to_index
+        if isinstance(old_row_data, itemstore.ColumnarItemStore):
+            # cheaper to remove the items that aren't in the list anymore
+            # than to copy all the others to the new store.
+            for id_ in old_row_data.keys():
+                if id_ not in id_to_index:
+                    del old_row_data[id_]
+            self.row_data = old_row_data
+            return
+        for id_, item_info in old_row_data.iteritems():
+            if id_ in id_to_index:
+                self.row_data[id_] = item_info
+
     def get_items(self):
         """Get a list of all items in sorted order."""
         return [self.get_row(i) for i in xrange(len(self.id_list))]
@@ -550,7 +1209,7 @@ class ItemTracker(signals.SignalEmitter):
     def get_playable_ids(self):
         """Get a list of ids for items that can be played."""
         # If we have loaded all items, then we can just use that data
-        if not self.idle_work_scheduled:
+        if self._all_rows_loaded():
             return [i.id for i in self.get_items() if i.is_playable]
         else:
             try:
@@ -562,7 +1221,7 @@ class ItemTracker(signals.SignalEmitter):
 
     def has_playables(self):
         """Can we play any items from this item list?"""
-        if not self.idle_work_scheduled:
+        if self._all_rows_loaded():
             return any(i for i in self.get_items() if i.is_playable)
         else:
             try:
@@ -604,9 +1263,21 @@ class ItemTracker(signals.SignalEmitter):
         self.row_data
 
         :param rows_to_load: indexes of the rows to load.
+
+        If we called done_fetching() on our ItemFetcher, this starts a new
+        read transaction, so the rows can be newer than our id list.  Changed
+        rows are fine, the ItemChanges message for them will reload them.
+        But if items were removed, some of our ids could be missing.  We use
+        DBErrorItemInfo placeholders for those until the message comes and
+        updates the list.
         """
         ids_to_load = set(self.id_list[i] for i in rows_to_load)
         try:
+            if self._fetching_done:
+                if self.item_fetcher.resume_fetching():
+                    self._id_list_stale = True
+                self._fetching_done = False
+                self._schedule_idle_work()
             items = self.item_fetcher.fetch_items(ids_to_load)
         except sqlite3.DatabaseError, e:
             logging.warn("%s while fetching items", e, exc_info=True)
@@ -615,11 +1286,17 @@ class ItemTracker(signals.SignalEmitter):
         returned_ids = set()
         for item_info in items:
             pos = self.id_to_index[item_info.id]
-            self.row_data[item_info.id] = item_info
             returned_ids.add(item_info.id)
+        # ColumnarItemStore is faster when it gets all the rows at once
+        self.row_data.update((item_info.id, item_info)
+                             for item_info in items)
         if returned_ids != ids_to_load:
             extra = tuple(returned_ids - ids_to_load)
             missing = tuple(ids_to_load - returned_ids)
+            if self._id_list_stale and not extra:
+                for item_id in missing:
+                    self.row_data[item_id] = item.DBErrorItemInfo(item_id)
+                return
             msg = ("ItemFetcher didn't return the correct rows "
                    "(extra: %s, missing: %s)" % (extra, missing))
             raise AssertionError(msg)
@@ -643,6 +1320,7 @@ class ItemTracker(signals.SignalEmitter):
         :raises IndexError: index out of range
         """
         self._ensure_row_loaded(index)
+        self._last_row = index
         try:
             id_ = self.id_list[index]
         except IndexError:
@@ -660,6 +1338,59 @@ class ItemTracker(signals.SignalEmitter):
         """Get the index of an item in the list."""
         return self.id_to_index[item_id]
 
+    def has_more(self):
+        """Could load_more() add items to this list?
+
+        This is True when our query has a limit and we got that many
+        items.
+        """
+        return (self.query.limit is not None and
+                len(self.id_list) >= self.query.limit)
+
+    def load_more(self, count=None):
+        """Add the next page of items for a query that uses a limit.
+
+        If anything was added, this emits will-change, then list-changed.
+        Our query's limit gets increased, so that refetching the list
+        keeps the items that we've loaded.
+
+        :param count: max number of items to add.  Defaults to our query's
+            limit.
+        :returns: True if any items were added
+        """
+        if not self.has_more() or self.item_fetcher is None:
+            return False
+        if count is None:
+            count = self.query.limit
+        page_query = self.query.copy()
+        page_query.set_offset((self.query.offset or 0) + len(self.id_list))
+        page_query.set_limit(count)
+        try:
+            new_ids = [id_ for id_ in
+                       page_query.select_ids(self.item_fetcher.connection)
+                       if id_ not in self.id_to_index]
+            self.item_fetcher.add_items(new_ids)
+        except sqlite3.DatabaseError, e:
+            logging.warn("%s while loading more items", e, exc_info=True)
+            self._run_db_error_dialog()
+            return False
+        new_query = self.query.copy()
+        new_query.set_limit(self.query.limit + count)
+        self._set_query(new_query)
+        if not new_ids:
+            return False
+        self.emit('will-change')
+        self._append_ids(new_ids)
+        self.emit('list-changed')
+        self._schedule_idle_work()
+        return True
+
+    def _append_ids(self, new_ids):
+        for id_ in new_ids:
+            self.id_to_index[id_] = len(self.id_list)
+            # extend id_list in place, since our ItemFetcher shares it
+            self.id_list.append(id_)
+
     def change_query(self, new_query):
         """Change the query for this select
 
@@ -680,12 +1411,12 @@ class ItemTracker(signals.SignalEmitter):
         :param message: an ItemChanges message
         """
         self.emit('will-change')
+        self.search_cache.on_item_changes(message, self.query)
         changed_ids = [item_id for item_id in message.changed
                        if self.item_in_list(item_id)]
         self._uncache_row_data(changed_ids)
         if self._could_list_change(message):
-            self._refetch_id_list(send_signals=False)
-            self.emit("list-changed")
+            self._update_id_list()
         else:
             if len(self.id_list) == 0:
                 # special case when the list is empty.  This avoids accessing
@@ -701,10 +1432,18 @@ class ItemTracker(signals.SignalEmitter):
                 self.emit("list-changed")
                 return
             if not need_refetch:
+                # refresh_items() may have started a new read transaction.
+                # Let do_idle_work() finish it once we've loaded the changed
+                # rows.
+                self._fetching_done = self._id_list_stale = False
+                self._schedule_idle_work()
                 self.emit('items-changed', changed_ids)
             else:
-                self._refetch_id_list(send_signals=False)
-                self.emit("list-changed")
+                # items were added/removed without the message telling us,
+                # so cached results could be wrong too
+                if self.result_cache is not None:
+                    self.result_cache.clear()
+                self._update_id_list()
 
     def _could_list_change(self, message):
         """Calculate if an ItemChanges means the list may have changed."""
@@ -769,14 +1508,24 @@ class ItemFetcher(object):
         pass
 
     def done_fetching(self):
-        """Called when ItemTracker has fetched all the ItemInfos in its list
+        """Called when ItemTracker doesn't have rows to prefetch.
 
-        ItemFetcher should release resources that are no longer needed,
-        however it should be ready to fetch items again if refresh_items() is
-        called.
+        That happens once it has fetched all the ItemInfos in its list, or
+        the ones around the visible rows for lists that are too big to keep
+        loaded.  ItemFetcher should release resources that are no longer
+        needed, however it should be ready to fetch items again if
+        resume_fetching() or refresh_items() is called.
         """
         pass
 
+    def resume_fetching(self):
+        """Called before fetching items again after done_fetching().
+
+        :returns: True if items may have been added/removed since the
+        transaction that our id list came from.
+        """
+        return False
+
     def fetch_items(self, item_ids):
         """Get a list of ItemInfo
 
@@ -786,6 +1535,14 @@ class ItemFetcher(object):
         """
         raise NotImplementedError()
 
+    def add_items(self, item_ids):
+        """Prepare to fetch items that weren't in our original id list.
+
+        ItemTracker calls this before adding the ids to its list in
+        load_more().  By default this does nothing.
+        """
+        pass
+
     def refresh_items(self, changed_ids):
         """Refresh item data.
 
@@ -812,6 +1569,44 @@ class ItemFetcher(object):
         """
         raise NotImplementedError()
 
+    def select_attrs(self, attr_names):
+        """Select some ItemInfo attributes for all items in the list.
+
+        This lets us calculate things for the entire list, like grouping,
+        without having to create an ItemInfo for each item.
+
+        :param attr_names: ItemInfo attributes to select.  Attributes that
+        don't have a column for our item table get the default value from
+        ItemInfoBase.
+        :returns: dict mapping item ids to tuples of attribute values
+        """
+        columns = dict((c.attr_name, c) for c in self.select_columns())
+        select_parts = []
+        arg_list = []
+        select_columns = []
+        for name in attr_names:
+            if name in columns:
+                select_parts.append(self._attr_sql(columns[name]))
+                select_columns.append(columns[name])
+            else:
+                select_parts.append('?')
+                arg_list.append(getattr(item.ItemInfoBase, name))
+        sql = self._select_attrs_sql(', '.join(select_parts), select_columns)
+        return dict((row[0], row[1:])
+                    for row in self.connection.execute(sql, arg_list))
+
+    def _attr_sql(self, select_column):
+        """Get the expression to select a column in select_attrs()."""
+        raise NotImplementedError()
+
+    def _select_attrs_sql(self, select_list, select_columns):
+        """Get the statement to run for select_attrs().
+
+        :param select_list: expressions to select after the item id
+        :param select_columns: SelectColumns used in select_list
+        """
+        raise NotImplementedError()
+
 class ItemFetcherWAL(ItemFetcher):
     def __init__(self, connection, item_source, id_list):
         ItemFetcher.__init__(self, connection, item_source, id_list)
@@ -823,9 +1618,18 @@ class ItemFetcherWAL(ItemFetcher):
         self.release_connection()
 
     def done_fetching(self):
-        # We can safely finish the read transaction here
+        # We can safely finish the read transaction here.  Keeping it open
+        # would stop checkpoints from truncating the WAL file.
         self.connection.commit()
 
+    def resume_fetching(self):
+        self.connection.execute("BEGIN TRANSACTION")
+        # Don't update item_count and max_item_id here, refresh_items()
+        # still needs to see the change when the ItemChanges message for it
+        # comes in.
+        return (self.calc_max_item_id() != self.max_item_id or
+                self.calc_item_count() != self.item_count)
+
     def calc_item_count(self):
         sql = "SELECT COUNT(1) FROM %s" % self.table_name()
         return self.connection.execute(sql).fetchone()[0]
@@ -862,7 +1666,13 @@ class ItemFetcherWAL(ItemFetcher):
         # a new transaction.  This can happen if the backend changes some
         # items sends an ItemsChanged message, then deletes them before we
         # process the message (see #19823)
+        return self._check_for_new_items()
+
+    def _check_for_new_items(self):
+        """Check if items were added/removed since the last check.
 
+        :returns: True if they were
+        """
         new_max_id = self.calc_max_item_id()
         new_item_count = self.calc_item_count()
         # checks for items have been added
@@ -897,6 +1707,19 @@ class ItemFetcherWAL(ItemFetcher):
                 ','.join(str(id_) for id_ in self.id_list)))
         return self.connection.execute(sql).fetchone()[0] == 1
 
+    def _attr_sql(self, select_column):
+        return '%s.%s' % (select_column.table, select_column.column)
+
+    def _select_attrs_sql(self, select_list, select_columns):
+        join_tables = set(c.table for c in select_columns
+                          if c.table != self.table_name())
+        select_info = self.item_source.select_info
+        return ("SELECT %s.id, %s FROM %s %s WHERE %s.id IN (%s)" %
+                (self.table_name(), select_list, self.table_name(),
+                 ' '.join(select_info.join_sql(t) for t in join_tables),
+                 self.table_name(),
+                 ','.join(str(id_) for id_ in self.id_list)))
+
 class ItemFetcherNoWAL(ItemFetcher):
     def __init__(self, connection, item_source, id_list):
         ItemFetcher.__init__(self, connection, item_source, id_list)
@@ -953,6 +1776,10 @@ WHERE $table_name.id in ($id_list)""")
         return [self.item_source.make_item_info(row)
                 for row in self.connection.execute(sql)]
 
+    def add_items(self, item_ids):
+        if item_ids:
+            self._select_into_temp_table(item_ids)
+
     def refresh_items(self, changed_ids):
         self._select_into_temp_table(changed_ids)
         return False
@@ -975,6 +1802,13 @@ WHERE $table_name.id in ($id_list)""")
                 ','.join(str(id_) for id_ in self.id_list)))
         return self.connection.execute(sql).fetchone()[0] == 1
 
+    def _attr_sql(self, select_column):
+        return select_column.attr_name
+
+    def _select_attrs_sql(self, select_list, select_columns):
+        # our temp table already has the data for every item in the list
+        return "SELECT id, %s FROM %s" % (select_list, self.temp_table_name)
+
 class BackendItemTracker(signals.SignalEmitter):
     """Item tracker used by the backend
 
@@ -35,6 +35,11 @@ import threading
 from miro import app
 from miro import signals
 from miro import threadcheck
+from miro import viewpredicate
+
+# sqlite can only handle 999 variables in a single statement.  Use 990 to be
+# on the safe side (see util.split_values_for_sqlite())
+SQLITE_MAX_VARIABLES = 990
 
 class DatabaseException(StandardError):
     """Superclass database errors."""
@@ -114,9 +119,10 @@ class ViewObjectFetcher(object):
         pass
 
 class DDBObjectFetcher(ViewObjectFetcher):
-    def __init__(self, klass, db_info):
+    def __init__(self, klass, db_info, load_lazy_columns=False):
         self.klass = klass
         self.db_info = db_info
+        self.load_lazy_columns = load_lazy_columns
 
     def fetch_obj(self, id_):
         return self.db_info.db.get_obj_by_id(id_, self.klass)
@@ -136,6 +142,10 @@ class DDBObjectFetcher(ViewObjectFetcher):
                            if self.db_info.db.id_alive(i, self.klass)]
             if len(new_id_list) < id_list:
                 id_list[:] = new_id_list # update id_list in-place
+        if self.load_lazy_columns:
+            db = self.db_info.db
+            db.load_lazy_columns([db.get_obj_by_id(i, self.klass)
+                                  for i in id_list])
 
 class IDOnlyFetcher(ViewObjectFetcher):
     """Fetcher that just emits the IDs of objects
@@ -227,6 +237,18 @@ class ViewTrackerManager(object):
         for tracker in self.trackers_for_ddb_class(obj.__class__):
             tracker.object_changed(obj, can_change_views)
 
+    def update_view_trackers_for_objects(self, table_name, objects):
+        """Update view trackers based on changes to many objects.
+
+        This works like calling update_view_trackers() for each object, but
+        each tracker checks the objects together, which lets it batch any
+        SQL queries it needs to make.
+        """
+        if not objects:
+            return
+        for tracker in list(self.trackers_for_table(table_name)):
+            tracker.check_objects(objects)
+
     def bulk_update_view_trackers(self, table_name):
         for tracker in self.trackers_for_table(table_name):
             tracker.check_all_objects()
@@ -254,6 +276,7 @@ class ViewTracker(signals.SignalEmitter):
         self.joins = joins
         self.db_info = db_info
         self.bulk_mode = False
+        self.predicate = self._compile_predicate()
         self.current_ids = self._view_object_ids()
         vt_manager = self.db_info.view_tracker_manager
         vt_manager.trackers_for_table(self.table_name).add(self)
@@ -271,8 +294,40 @@ class ViewTracker(signals.SignalEmitter):
         """
         self.bulk_mode = bulk_mode
 
+    def _compile_predicate(self):
+        """Try to compile our WHERE clause into a python predicate.
+
+        This lets us check if objects are in our view without going to the
+        database.  Returns None if the view is too complex for that.
+        """
+        if self.joins:
+            return None
+        try:
+            columns = self.db_info.db.table_fields(self.table_name)
+        except KeyError:
+            return None
+        return viewpredicate.compile_where(self.where, self.values,
+                                           self.table_name, columns)
+
+    def _check_in_memory(self, obj):
+        """Check if an object is in our view using our predicate.
+
+        :returns: True/False, or None if we need to query the database
+        """
+        if self.predicate is None or not self.predicate.can_check(obj):
+            return None
+        if not self.db_info.db.id_alive(obj.id, obj.__class__):
+            return False
+        try:
+            return self.predicate(obj)
+        except AttributeError:
+            return None
+
     def _obj_in_view(self, obj):
         """Check if a single object is in our view."""
+        in_view = self._check_in_memory(obj)
+        if in_view is not None:
+            return in_view
         where = '%s.id = ?' % (self.table_name,)
         if self.where:
             where += ' AND (%s)' % (self.where,)
@@ -281,6 +336,34 @@ class ViewTracker(signals.SignalEmitter):
         return self.db_info.db.query_count(self.table_name, where, values,
                 self.joins) > 0
 
+    def _objs_in_view(self, objects):
+        """Check which objects from a list are in our view.
+
+        Objects that we can't check in memory get checked with a single
+        query (or one query per chunk of ids for huge lists).
+
+        :returns: set of ids for the objects in our view
+        """
+        in_view = set()
+        ids_to_query = []
+        for obj in objects:
+            result = self._check_in_memory(obj)
+            if result is None:
+                ids_to_query.append(obj.id)
+            elif result:
+                in_view.add(obj.id)
+        # leave room for our values in each query
+        chunk_size = max(1, SQLITE_MAX_VARIABLES - len(self.values))
+        for start in xrange(0, len(ids_to_query), chunk_size):
+            id_chunk = tuple(ids_to_query[start:start+chunk_size])
+            where = '%s.id IN (%s)' % (self.table_name,
+                                       ', '.join('?' * len(id_chunk)))
+            if self.where:
+                where += ' AND (%s)' % (self.where,)
+            in_view.update(self.db_info.db.query_ids(self.table_name, where,
+                id_chunk + self.values, joins=self.joins))
+        return in_view
+
     def _view_object_ids(self):
         """Get all object ids in our view."""
         return set(self.db_info.db.query_ids(self.table_name,
@@ -304,8 +387,21 @@ class ViewTracker(signals.SignalEmitter):
             self.emit('removed', self.fetcher.fetch_obj_for_ddb_object(obj))
 
     def check_object(self, obj):
+        self._update_for_check(obj, self._obj_in_view(obj))
+
+    def check_objects(self, objects):
+        """Check a list of objects.
+
+        This emits the same signals as calling check_object() for each
+        object, but only needs at most one query for the objects that we
+        can't check in memory.
+        """
+        in_view = self._objs_in_view(objects)
+        for obj in objects:
+            self._update_for_check(obj, obj.id in in_view)
+
+    def _update_for_check(self, obj, now):
         before = (obj.id in self.current_ids)
-        now = self._obj_in_view(obj)
         if before and not now:
             self.current_ids.remove(obj.id)
             self.emit('removed', self.fetcher.fetch_obj_for_ddb_object(obj))
@@ -358,8 +454,10 @@ class BulkSQLManager(object):
         self.active = False
         self.to_insert = {}
         self.to_remove = {}
+        self.to_change = {}
         self.pending_inserts = set()
         self.pending_removes = set()
+        self.pending_changes = set()
 
         self.last_call = None
 
@@ -392,22 +490,28 @@ class BulkSQLManager(object):
         for x in range(100):
             to_insert = self.to_insert
             to_remove = self.to_remove
+            to_change = self.to_change
             self.to_insert = {}
             self.to_remove = {}
+            self.to_change = {}
+            self.pending_changes = set()
             self._commit_sql(to_insert, to_remove)
-            self._update_view_trackers(to_insert, to_remove)
-            if len(self.to_insert) == len(self.to_remove) == 0:
+            self._update_view_trackers(to_insert, to_remove, to_change)
+            if (len(self.to_insert) == len(self.to_remove) ==
+                    len(self.to_change) == 0):
                 break
             # inside _commit_sql() or _update_view_trackers(), we were
-            # asked to insert or remove more items, repeat the
+            # asked to insert, remove or change more items, repeat the
             # proccess again
         else:
             raise AssertionError("Called _commit_sql 100 times and still "
                     "have items to commit.  Are we in a circular loop?")
         self.to_insert = {}
         self.to_remove = {}
+        self.to_change = {}
         self.pending_inserts = set()
         self.pending_removes = set()
+        self.pending_changes = set()
 
     def _commit_sql(self, to_insert, to_remove):
         for table_name, objects in to_insert.items():
@@ -422,29 +526,41 @@ class BulkSQLManager(object):
             for obj in objects:
                 obj.removed_from_db()
 
-    def _update_view_trackers(self, to_insert, to_remove):
-        # figure out the total number of objects that have changed
-        changed_objs = set()
-        for table_name, objects in to_insert.items():
-            changed_objs.update(objects)
-        for table_name, objects in to_remove.items():
-            changed_objs.update(objects)
+    def _update_view_trackers(self, to_insert, to_remove, to_change):
+        # figure out the total number of objects that have been inserted or
+        # removed
+        count = 0
+        for objects in to_insert.values() + to_remove.values():
+            count += len(objects)
         # Figure out which strategy is fastest based on the number of objects
         # that have changed
-        if len(changed_objs) < 100:
-            self._update_view_trackers_by_object(changed_objs)
+        if count < 100:
+            self._update_view_trackers_by_object(to_insert, to_remove,
+                                                 to_change)
         else:
-            self._update_view_trackers_by_table(to_insert, to_remove)
+            self._update_view_trackers_by_table(to_insert, to_remove,
+                                                to_change)
 
-    def _update_view_trackers_by_object(self, changed_objs):
+    def _update_view_trackers_by_object(self, to_insert, to_remove,
+                                        to_change):
         """Update view trackers by checking each changed object.
 
         This method is the fastest when there are not a lot of changed objects
         """
-        for obj in changed_objs:
-            self.view_tracker_manager.update_view_trackers(obj)
+        removed_ids = set()
+        for table_name, objects in to_remove.items():
+            self.view_tracker_manager.bulk_remove_from_view_trackers(
+                table_name, objects)
+            removed_ids.update(obj.id for obj in objects)
+        for table_name, objects in to_insert.items():
+            self.view_tracker_manager.update_view_trackers_for_objects(
+                table_name, objects)
+        for table_name, objects in to_change.items():
+            self.view_tracker_manager.update_view_trackers_for_objects(
+                table_name, [o for o in objects if o.id not in removed_ids])
 
-    def _update_view_trackers_by_table(self, to_insert, to_remove):
+    def _update_view_trackers_by_table(self, to_insert, to_remove,
+                                       to_change):
         """Update view trackers by checking each table
 
         This method is fastest when there are many changed objects
@@ -452,13 +568,22 @@ class BulkSQLManager(object):
         for table_name in to_insert:
             self.view_tracker_manager.bulk_update_view_trackers(table_name)
 
+        removed_ids = set()
         for table_name, objects in to_remove.items():
+            removed_ids.update(obj.id for obj in objects)
             if table_name in to_insert:
                 # already updated the view above
                 continue
             self.view_tracker_manager.bulk_remove_from_view_trackers(
                 table_name, objects)
 
+        for table_name, objects in to_change.items():
+            if table_name in to_insert:
+                # already updated the view above
+                continue
+            self.view_tracker_manager.update_view_trackers_for_objects(
+                table_name, [o for o in objects if o.id not in removed_ids])
+
     def add_insert(self, obj):
         table_name = self.db.table_name(obj.__class__)
         try:
@@ -469,6 +594,23 @@ class BulkSQLManager(object):
         inserts_for_table.append(obj)
         self.pending_inserts.add(obj.id)
 
+    def add_change(self, obj):
+        """Check the view trackers for a changed object when we commit.
+
+        This lets the view trackers check all the objects that changed
+        during the bulk operation at once.
+        """
+        if obj.id in self.pending_changes:
+            return
+        table_name = self.db.table_name(obj.__class__)
+        try:
+            changes_for_table = self.to_change[table_name]
+        except KeyError:
+            changes_for_table = []
+            self.to_change[table_name] = changes_for_table
+        changes_for_table.append(obj)
+        self.pending_changes.add(obj.id)
+
     def will_insert(self, id_):
         return id_ in self.pending_inserts
 
@@ -503,7 +645,7 @@ class AttributeUpdateTracker(object):
         try:
             return instance.__dict__[self.name]
         except KeyError:
-            raise AttributeError(self.name)
+            return instance.load_lazy_column(self.name)
         except AttributeError:
             if instance is None:
                 raise AttributeError(
@@ -518,8 +660,19 @@ class AttributeUpdateTracker(object):
 
 class DDBObject(signals.SignalEmitter):
     """Dynamic Database object
+
+    Set cache_evictable to True in subclasses whose objects can be evicted
+    from memory when LiveStorage goes over its object cache budget.  They
+    get re-restored from the database when they're needed again, so
+    subclasses need to be okay with setup_restored() being called more than
+    once for the same row.
     """
 
+    cache_evictable = False
+    # lazy columns that haven't been loaded yet.  LiveStorage sets this
+    # when it restores objects (see ObjectSchema.lazy_columns)
+    unloaded_columns = frozenset()
+
     def __init__(self, *args, **kwargs):
         self.confirm_db_thread()
         self.in_db_init = True
@@ -582,12 +735,18 @@ class DDBObject(signals.SignalEmitter):
 
     @classmethod
     def make_view(cls, where=None, values=None, order_by=None, joins=None,
-            limit=None, db_info=None):
+            limit=None, db_info=None, load_lazy_columns=False):
+        """Make a View for objects of this class
+
+        :param load_lazy_columns: load all lazy columns for the objects when
+            the view is iterated through, instead of one object at a time
+            when they get accessed.
+        """
         if values is None:
             values = ()
         if db_info is None:
             db_info = app.db_info
-        fetcher = DDBObjectFetcher(cls, db_info)
+        fetcher = DDBObjectFetcher(cls, db_info, load_lazy_columns)
         return View(fetcher, where, values, order_by, joins, limit, db_info)
 
     @classmethod
@@ -640,6 +799,29 @@ class DDBObject(signals.SignalEmitter):
         """Called after an object has been inserted into the db."""
         pass
 
+    def load_lazy_column(self, name):
+        """Load a lazy column that we skipped when restoring this object.
+
+        All of our unloaded columns get loaded at once.
+
+        :returns: value for name
+        :raises AttributeError: name isn't an unloaded column
+        """
+        if name not in self.unloaded_columns:
+            raise AttributeError(name)
+        self.db_info.db.load_lazy_columns([self])
+        return self.__dict__[name]
+
+    def can_evict(self):
+        """Check if this object can be evicted from memory right now.
+
+        By default, we don't evict objects with unsaved changes or objects
+        with signal callbacks connected.  Subclasses can extend this to
+        protect in-memory state that isn't saved to the database.
+        """
+        return not (self.changed_attributes or self.in_db_init or
+                    self.has_callbacks())
+
     @classmethod
     def track_attribute_changes(cls, name):
         """Set up tracking when attributes get set.
@@ -746,6 +928,11 @@ class DDBObject(signals.SignalEmitter):
             return
         if needs_save:
             self.db_info.db.update_obj(self)
+        if can_change_views and self.db_info.bulk_sql_manager.active:
+            # Check the view trackers when BulkSQLManager.finish() is
+            # called, along with the other objects that changed.
+            self.db_info.bulk_sql_manager.add_change(self)
+            return
         self.db_info.view_tracker_manager.update_view_trackers(
             self, can_change_views)
 
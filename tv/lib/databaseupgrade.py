@@ -53,6 +53,7 @@ from miro import schema
 from miro import util
 import types
 from miro import app
+from miro import containerformat
 from miro import dbupgradeprogress
 from miro import prefs
 
@@ -4417,3 +4418,82 @@ def upgrade201(cursor):
             where_values.append((feed_id,))
     cursor.executemany("UPDATE feed SET expire_timedelta=NULL "
                        "WHERE id=?", where_values)
+
+def upgrade202(cursor):
+    """Start storing container columns using containerformat.
+
+    Converting every row here would make the upgrade slow for big
+    databases, so we convert them lazily instead.  LiveStorage reads both
+    formats, rewrites old values when objects get saved, and converts the
+    rest in the background using convert_repr_containers().
+    """
+    pass
+
+@run_on_both
+def upgrade203(cursor):
+    """Only update item_fts when one of the indexed columns changes."""
+    if is_device_db(cursor):
+        item_table = 'device_item'
+    else:
+        item_table = 'item'
+    columns = ['title', 'description', 'artist', 'album', 'genre',
+               'filename', 'parent_title', 'entry_description']
+    column_list = ', '.join(c for c in columns)
+    column_list_for_new = ', '.join("new.%s" % c for c in columns)
+    cursor.execute("DROP TRIGGER item_bu")
+    cursor.execute("CREATE TRIGGER item_bu "
+                   "BEFORE UPDATE OF %s ON %s BEGIN "
+                   "DELETE FROM item_fts WHERE docid=old.id; "
+                   "END;" % (column_list, item_table))
+    cursor.execute("DROP TRIGGER item_au")
+    cursor.execute("CREATE TRIGGER item_au "
+                   "AFTER UPDATE OF %s ON %s BEGIN "
+                   "INSERT INTO item_fts(docid, %s) "
+                   "VALUES(new.id, %s); "
+                   "END;" % (column_list, item_table, column_list,
+                             column_list_for_new))
+
+def convert_repr_containers(cursor, table_name, columns, start_id=0,
+                            limit=500):
+    """Convert container columns stored with repr() to containerformat.
+
+    This handles at most limit rows at a time, so it can be run in small
+    chunks.  Values that we can't eval() are left alone, LiveStorage will
+    deal with them when the object gets loaded.
+
+    :param cursor: cursor for the database
+    :param table_name: table to convert
+    :param columns: names of the container columns in the table
+    :param start_id: only convert rows with ids >= this
+    :param limit: max number of rows to look at
+    :returns: id to use for start_id for the next chunk, or None if we're
+        done with the table
+    """
+    where = ' OR '.join("typeof(%s)='text'" % c for c in columns)
+    cursor.execute("SELECT id, %s FROM %s WHERE id >= ? AND (%s) "
+                   "ORDER BY id LIMIT ?" % (', '.join(columns), table_name,
+                                            where),
+                   (start_id, limit))
+    rows = cursor.fetchall()
+    for row in rows:
+        setters = []
+        values = []
+        for name, value in zip(columns, row[1:]):
+            if not isinstance(value, basestring):
+                continue
+            try:
+                value = eval_container(value)
+                encoded = containerformat.encode(value)
+            except StandardError:
+                logging.warn("convert_repr_containers: error converting "
+                             "%s.%s (id: %s)", table_name, name, row[0])
+                continue
+            setters.append("%s=?" % name)
+            values.append(buffer(encoded))
+        if setters:
+            values.append(row[0])
+            cursor.execute("UPDATE %s SET %s WHERE id=?" %
+                           (table_name, ', '.join(setters)), values)
+    if len(rows) < limit:
+        return None
+    return rows[-1][0] + 1
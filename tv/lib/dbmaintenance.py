@@ -0,0 +1,359 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.dbmaintenance`` -- Background maintenance for the main database.
+
+The main database runs in WAL mode.  SQLite normally checkpoints the WAL
+from whatever connection happens to commit once it reaches 1000 pages,
+which means the event loop thread pays for it at random times.  Worse, the
+frontend connection pools hold read transactions open for a long time, so
+those checkpoints often can't reset the WAL and it keeps growing.
+
+DatabaseMaintainer checks on the database every CHECK_INTERVAL seconds.
+The actual work runs in a thread with its own connection:
+
+- If the WAL is bigger than WAL_CHECKPOINT_SIZE, we run a PASSIVE
+  checkpoint, which never waits for readers or writers.  If it's bigger
+  than WAL_RESTART_SIZE we run a RESTART checkpoint, which waits (up to
+  BUSY_TIMEOUT) for readers to finish so the WAL can be reused from the
+  beginning.
+- Once the database has been idle (no commits) for IDLE_TIME seconds, we
+  run an incremental vacuum if too many pages are free and ANALYZE if it
+  hasn't run for ANALYZE_INTERVAL seconds.  Incremental vacuum only works
+  for databases created with auto_vacuum=INCREMENTAL (see
+  LiveStorage._switch_to_wal_mode()).  For older databases we just report
+  the fragmentation.  We also merge the segments of the full text index a
+  few steps at a time (see fulltextsearch.merge()), so that FTS4 doesn't
+  have to do big merges in the middle of an UPDATE.
+"""
+
+import logging
+import os
+import sqlite3
+import time
+
+from miro import eventloop
+from miro.data import fulltextsearch
+
+CHECK_INTERVAL = 60
+IDLE_TIME = 60
+WAL_CHECKPOINT_SIZE = 4 * 1024 * 1024
+WAL_RESTART_SIZE = 32 * 1024 * 1024
+# fraction of free pages that triggers an incremental vacuum
+FRAGMENTATION_LIMIT = 0.1
+# max pages to free with each incremental vacuum.  This keeps the write lock
+# short, so we don't block the event loop thread for long.
+VACUUM_PAGES = 1000
+ANALYZE_INTERVAL = 24 * 60 * 60
+# max number of fulltextsearch.merge() steps for each run.  Each step commits
+# on its own, so this just bounds how long a run can take.
+FTS_MERGE_STEPS = 20
+# seconds that our connection waits for a lock.  This is much less than the
+# main connection's timeout, so that we give up before it does.
+BUSY_TIMEOUT = 1.0
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+def wal_size(db_path):
+    """Get the size of the WAL file for a database."""
+    try:
+        return os.path.getsize(db_path + '-wal')
+    except OSError:
+        return 0
+
+def read_page_stats(cursor):
+    """Get page stats for a database.
+
+    :returns: dict with page_count, freelist_count, page_size and
+        auto_vacuum
+    """
+    stats = {}
+    for name in ('page_count', 'freelist_count', 'page_size', 'auto_vacuum'):
+        cursor.execute("PRAGMA %s" % name)
+        stats[name] = cursor.fetchone()[0]
+    return stats
+
+def fragmentation(page_stats):
+    """Get the fraction of a database's pages that are free."""
+    if page_stats['page_count'] == 0:
+        return 0.0
+    return float(page_stats['freelist_count']) / page_stats['page_count']
+
+def run_maintenance(db_path, vacuum, analyze, fts_merge=False):
+    """Run maintenance on a database.
+
+    This creates its own connection, so it's safe to call from any thread.
+    We always checkpoint the WAL if it's too big.
+
+    :param db_path: path to the database
+    :param vacuum: should we free unused pages if the database is too
+        fragmented?
+    :param analyze: should we run ANALYZE?
+    :param fts_merge: should we merge full text index segments?
+    :returns: dict describing what we did
+    """
+    start = time.time()
+    result = {
+        'checkpoint': None,
+        'checkpoint_busy': False,
+        'pages_checkpointed': 0,
+        'vacuumed_pages': 0,
+        'analyzed': False,
+        'fts_merge_steps': 0,
+        'busy': False,
+    }
+    result['wal_size_before'] = size = wal_size(db_path)
+    connection = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT,
+                                 isolation_level=None)
+    try:
+        cursor = connection.cursor()
+        try:
+            if size > WAL_RESTART_SIZE:
+                _checkpoint(cursor, 'RESTART', result)
+            elif size > WAL_CHECKPOINT_SIZE:
+                _checkpoint(cursor, 'PASSIVE', result)
+            page_stats = read_page_stats(cursor)
+            if (vacuum and
+                    page_stats['auto_vacuum'] == AUTO_VACUUM_INCREMENTAL and
+                    fragmentation(page_stats) > FRAGMENTATION_LIMIT):
+                pages = min(page_stats['freelist_count'], VACUUM_PAGES)
+                cursor.execute("PRAGMA incremental_vacuum(%d)" % pages)
+                # incremental_vacuum returns a row for each page freed
+                cursor.fetchall()
+                new_stats = read_page_stats(cursor)
+                result['vacuumed_pages'] = (page_stats['freelist_count'] -
+                                            new_stats['freelist_count'])
+                page_stats = new_stats
+            if analyze:
+                cursor.execute("ANALYZE")
+                result['analyzed'] = True
+            if fts_merge and fulltextsearch.has_fulltext_table(connection):
+                while (result['fts_merge_steps'] < FTS_MERGE_STEPS and
+                        fulltextsearch.merge(connection)):
+                    result['fts_merge_steps'] += 1
+        except sqlite3.OperationalError, e:
+            # Most likely the database was locked.  We'll try again on our
+            # next run.
+            logging.debug("database maintenance interrupted: %s", e)
+            result['busy'] = True
+            page_stats = None
+    finally:
+        connection.close()
+    result['page_stats'] = page_stats
+    result['wal_size_after'] = wal_size(db_path)
+    result['duration'] = time.time() - start
+    return result
+
+def _checkpoint(cursor, mode, result):
+    cursor.execute("PRAGMA wal_checkpoint(%s)" % mode)
+    busy, log_pages, checkpointed = cursor.fetchone()
+    result['checkpoint'] = mode
+    result['checkpoint_busy'] = bool(busy)
+    result['pages_checkpointed'] = max(checkpointed, 0)
+
+class DatabaseMaintainer(object):
+    """Schedule maintenance for a LiveStorage database.
+
+    Attributes:
+
+    - enabled -- are we running maintenance?  False for in-memory
+      databases.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.enabled = (db.path != ':memory:' and not db.temp_mode)
+        self.last_commit = time.time()
+        self.last_analyze = None
+        self._timeout = None
+        self._running = False
+        self._transaction_callback = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {
+            'runs': 0,
+            'passive_checkpoints': 0,
+            'restart_checkpoints': 0,
+            'checkpoints_busy': 0,
+            'pages_checkpointed': 0,
+            'vacuums': 0,
+            'vacuumed_pages': 0,
+            'analyzes': 0,
+            'fts_merge_steps': 0,
+            'busy': 0,
+            'errors': 0,
+            'total_time': 0.0,
+            'max_time': 0.0,
+            'wal_size': None,
+            'max_wal_size': 0,
+            'page_stats': None,
+        }
+
+    def start(self):
+        if not self.enabled or self._transaction_callback is not None:
+            return
+        self._transaction_callback = self.db.connect('transaction-finished',
+                self.on_transaction_finished)
+        self._schedule_check()
+
+    def stop(self):
+        if self._transaction_callback is not None:
+            self.db.disconnect(self._transaction_callback)
+            self._transaction_callback = None
+        if self._timeout is not None:
+            self._timeout.cancel()
+            self._timeout = None
+
+    def on_transaction_finished(self, db, commit):
+        self.last_commit = time.time()
+
+    def is_idle(self):
+        return time.time() - self.last_commit >= IDLE_TIME
+
+    def analyze_due(self):
+        return (self.last_analyze is None or
+                time.time() - self.last_analyze >= ANALYZE_INTERVAL)
+
+    def _schedule_check(self):
+        self._timeout = eventloop.add_timeout(CHECK_INTERVAL, self.check,
+                                              "database maintenance")
+
+    def check(self):
+        """Decide if we need to run maintenance and start it if so."""
+        self._timeout = None
+        if self.db.is_closed():
+            return
+        # LiveStorage can switch to an in-memory database after an error
+        if not self._running and not self.db.temp_mode:
+            size = wal_size(self.db.path)
+            self.stats['wal_size'] = size
+            self.stats['max_wal_size'] = max(self.stats['max_wal_size'], size)
+            idle = self.is_idle()
+            if size > WAL_CHECKPOINT_SIZE or idle:
+                self._running = True
+                # don't free the space that LiveStorage preallocated
+                vacuum = idle and not self.db.preallocate
+                analyze = idle and self.analyze_due()
+                eventloop.call_in_thread_class(
+                    eventloop.TASK_CLASS_DB_MAINTENANCE,
+                    self._on_maintenance_done, self._on_maintenance_error,
+                    run_maintenance, "database maintenance", self.db.path,
+                    vacuum, analyze, idle)
+        self._schedule_check()
+
+    def _on_maintenance_done(self, result):
+        self._running = False
+        self.record_result(result)
+
+    def _on_maintenance_error(self, error):
+        self._running = False
+        self.stats['errors'] += 1
+        logging.warn("error running database maintenance: %s", error)
+
+    def record_result(self, result):
+        """Update our stats with a result from run_maintenance()."""
+        stats = self.stats
+        stats['runs'] += 1
+        stats['total_time'] += result['duration']
+        stats['max_time'] = max(stats['max_time'], result['duration'])
+        stats['wal_size'] = result['wal_size_after']
+        stats['max_wal_size'] = max(stats['max_wal_size'],
+                                    result['wal_size_before'])
+        if result['checkpoint'] == 'PASSIVE':
+            stats['passive_checkpoints'] += 1
+        elif result['checkpoint'] == 'RESTART':
+            stats['restart_checkpoints'] += 1
+        if result['checkpoint_busy']:
+            stats['checkpoints_busy'] += 1
+        stats['pages_checkpointed'] += result['pages_checkpointed']
+        if result['vacuumed_pages']:
+            stats['vacuums'] += 1
+            stats['vacuumed_pages'] += result['vacuumed_pages']
+        if result['analyzed']:
+            stats['analyzes'] += 1
+            self.last_analyze = time.time()
+        stats['fts_merge_steps'] += result['fts_merge_steps']
+        if result['busy']:
+            stats['busy'] += 1
+        if result['page_stats'] is not None:
+            stats['page_stats'] = result['page_stats']
+        if result['checkpoint'] or result['vacuumed_pages'] or \
+                result['analyzed'] or result['fts_merge_steps']:
+            logging.info("database maintenance: checkpoint: %s (%d pages) "
+                         "vacuumed: %d pages analyzed: %s "
+                         "fts merge steps: %d (%.3f secs)",
+                         result['checkpoint'], result['pages_checkpointed'],
+                         result['vacuumed_pages'], result['analyzed'],
+                         result['fts_merge_steps'], result['duration'])
+
+    def get_stats(self):
+        """Get a copy of our stats.
+
+        :returns: dict of counters for the maintenance we've done, plus
+            wal_size/max_wal_size (in bytes) and page_stats (from our last
+            run, see read_page_stats()).
+        """
+        stats = self.stats.copy()
+        if stats['page_stats'] is not None:
+            stats['fragmentation'] = fragmentation(stats['page_stats'])
+        else:
+            stats['fragmentation'] = None
+        return stats
+
+    def format_report(self):
+        """Format our stats as a human-readable string."""
+        stats = self.get_stats()
+        lines = ['Database maintenance stats', '']
+        if not self.enabled:
+            lines.append('disabled (in-memory database)')
+            return '\n'.join(lines)
+        lines.append('runs: %d total: %.3fs max: %.3fs busy: %d errors: %d'
+                     % (stats['runs'], stats['total_time'],
+                        stats['max_time'], stats['busy'], stats['errors']))
+        if stats['wal_size'] is not None:
+            lines.append('WAL size: %d bytes (max %d)' %
+                         (stats['wal_size'], stats['max_wal_size']))
+        lines.append('checkpoints: %d passive, %d restart, %d busy, '
+                     '%d pages' % (stats['passive_checkpoints'],
+                                   stats['restart_checkpoints'],
+                                   stats['checkpoints_busy'],
+                                   stats['pages_checkpointed']))
+        lines.append('incremental vacuums: %d (%d pages)' %
+                     (stats['vacuums'], stats['vacuumed_pages']))
+        lines.append('analyzes: %d' % stats['analyzes'])
+        lines.append('full text index merge steps: %d' %
+                     stats['fts_merge_steps'])
+        page_stats = stats['page_stats']
+        if page_stats is not None:
+            lines.append('pages: %d free: %d (%.1f%%) auto_vacuum: %d' %
+                         (page_stats['page_count'],
+                          page_stats['freelist_count'],
+                          stats['fragmentation'] * 100,
+                          page_stats['auto_vacuum']))
+        return '\n'.join(lines)
@@ -79,7 +79,7 @@ from miro.plat.utils import (filename_to_unicode, unicode_to_filename,
 # how much slower converting a file is, compared to copying
 CONVERSION_SCALE = 500
 # schema version for device databases
-DB_VERSION = 198
+DB_VERSION = 203
 
 def unicode_to_path(path):
     """
@@ -1600,7 +1600,7 @@ def _device_not_valid(device):
         return True
     return False
 
-@eventloop.idle_iterator
+@eventloop.idle_iterator(lane=eventloop.LANE_BACKGROUND)
 def scan_device_for_files(device):
     # XXX is this as_idle() safe?
 
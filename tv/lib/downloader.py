@@ -368,6 +368,11 @@ class RemoteDownloader(DDBObject):
         return cls.make_view('id NOT IN (SELECT downloader_id from item)')
 
     def signal_change(self, needs_save=True, needs_signal_item=True):
+        if needs_save:
+            # let our items look up their feed counts before our new state
+            # gets saved
+            for item in self.item_list:
+                item.download_stats_will_change()
         DDBObject.signal_change(self, needs_save=needs_save)
         if needs_signal_item:
             for item in self.item_list:
@@ -35,17 +35,23 @@ network requests and scheduling.
 TODO: handle user setting clock back
 """
 
+import bisect
+import collections
 import errno
 import heapq
 import logging
+import math
 import Queue
 import select
 import socket
+import sys
 import threading
+import time
 import traceback
 
 from miro import app
 from miro import config
+from miro import futures
 from miro import trapcall
 from miro import signals
 from miro import util
@@ -54,6 +60,166 @@ from miro.plat.utils import thread_body
 
 cumulative = {}
 
+# Upper bounds (in seconds) of the buckets for the dispatch time histograms
+DISPATCH_TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+class CallStats(object):
+    """Timing statistics for all calls with a given name."""
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        # histogram[i] counts calls that took less than
+        # DISPATCH_TIME_BUCKETS[i], the last entry is everything else
+        self.histogram = [0] * (len(DISPATCH_TIME_BUCKETS) + 1)
+        # time between queueing an idle/urgent call and running it
+        self.wait_count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        # time between when a timeout was scheduled for and when it ran
+        self.late_count = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+
+    def to_dict(self):
+        return self.__dict__.copy()
+
+class EventLoopStats(object):
+    """Tracks how long event loop callbacks take to run and how long they
+    wait before running.
+
+    Stats are recorded by DelayedCall.dispatch(), which only runs in the
+    event loop thread.  Queue depths are recorded in whatever thread adds
+    the call, but the worst that can happen there is that we miss a max
+    value.
+    """
+
+    # Limit how many names we track.  Some callers build names from object
+    # reprs, which would otherwise make this grow without bound.
+    MAX_NAMES = 1000
+    OVERFLOW_NAME = '<other>'
+
+    def __init__(self):
+        self.enabled = True
+        self.reset()
+
+    def reset(self):
+        self.calls = {}
+        self.max_queue_depth = {}
+        self.reset_time = time.time()
+
+    def _get_call_stats(self, name):
+        try:
+            return self.calls[name]
+        except KeyError:
+            if len(self.calls) >= self.MAX_NAMES:
+                name = self.OVERFLOW_NAME
+                if name in self.calls:
+                    return self.calls[name]
+            stats = self.calls[name] = CallStats()
+            return stats
+
+    def record_call(self, name, start, end, queued_at=None,
+                    scheduled_time=None):
+        """Record a call that ran from start to end.
+
+        :param queued_at: when an idle/urgent call was added
+        :param scheduled_time: when a timeout was supposed to run
+        """
+        if not self.enabled:
+            return
+        stats = self._get_call_stats(name)
+        duration = end - start
+        stats.count += 1
+        stats.total_time += duration
+        if duration > stats.max_time:
+            stats.max_time = duration
+        stats.histogram[bisect.bisect(DISPATCH_TIME_BUCKETS, duration)] += 1
+        if scheduled_time is not None:
+            lateness = max(0, start - scheduled_time)
+            stats.late_count += 1
+            stats.total_lateness += lateness
+            if lateness > stats.max_lateness:
+                stats.max_lateness = lateness
+        elif queued_at is not None:
+            wait = start - queued_at
+            stats.wait_count += 1
+            stats.total_wait += wait
+            if wait > stats.max_wait:
+                stats.max_wait = wait
+
+    def record_queue_depth(self, queue_name, depth):
+        if self.enabled and depth > self.max_queue_depth.get(queue_name, 0):
+            self.max_queue_depth[queue_name] = depth
+
+    def get_stats(self):
+        """Get a snapshot of our stats.
+
+        :returns: dict with the keys "calls" (maps names to a dict of
+            CallStats attributes), "max_queue_depth" and "elapsed".
+        """
+        calls = {}
+        for name, stats in self.calls.items():
+            calls[name] = stats.to_dict()
+        return {
+            'calls': calls,
+            'max_queue_depth': self.max_queue_depth.copy(),
+            'elapsed': time.time() - self.reset_time,
+        }
+
+    def format_report(self, limit=None):
+        """Format our stats as a human-readable string.
+
+        Calls are sorted by the total time they took.
+
+        :param limit: only include this many names
+        """
+        snapshot = self.get_stats()
+        lines = ['Event loop stats for the last %.1f seconds' %
+                 snapshot['elapsed'], '']
+        lines.append('Max queue depths:')
+        for queue_name, depth in sorted(snapshot['max_queue_depth'].items()):
+            lines.append('    %s: %d' % (queue_name, depth))
+        lines.append('')
+        bucket_labels = ['<%gms' % (b * 1000) for b in DISPATCH_TIME_BUCKETS]
+        bucket_labels.append('>=%gms' % (DISPATCH_TIME_BUCKETS[-1] * 1000))
+        calls = sorted(snapshot['calls'].items(),
+                       key=lambda (name, stats): stats['total_time'],
+                       reverse=True)
+        if limit is not None:
+            calls = calls[:limit]
+        for name, stats in calls:
+            lines.append(name)
+            lines.append('    calls: %d total: %.3fs avg: %.4fs max: %.4fs' %
+                         (stats['count'], stats['total_time'],
+                          stats['total_time'] / stats['count'],
+                          stats['max_time']))
+            if stats['wait_count']:
+                lines.append('    queue wait avg: %.4fs max: %.4fs' %
+                             (stats['total_wait'] / stats['wait_count'],
+                              stats['max_wait']))
+            if stats['late_count']:
+                lines.append('    lateness avg: %.4fs max: %.4fs' %
+                             (stats['total_lateness'] / stats['late_count'],
+                              stats['max_lateness']))
+            histogram = ['%s: %d' % (label, count)
+                         for label, count in zip(bucket_labels,
+                                                 stats['histogram'])
+                         if count]
+            lines.append('    histogram: %s' % ', '.join(histogram))
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        """Write the output of format_report() to a file."""
+        f = open(path, 'w')
+        try:
+            f.write(self.format_report())
+            f.write('\n')
+        finally:
+            f.close()
+
+stats = EventLoopStats()
+
 class DelayedCall(object):
     def __init__(self, function, name, args, kwargs):
         self.function = function
@@ -61,6 +227,14 @@ class DelayedCall(object):
         self.args = args
         self.kwargs = kwargs
         self.canceled = False
+        self.queued_at = clock()
+        # set by Scheduler for timeouts
+        self.scheduled_time = None
+        self.scheduler = None
+        # timeouts can get canceled from other threads while the event loop
+        # is dispatching them.  Scheduler sets this to its lock, which we
+        # hold while we check and change self.canceled.
+        self.lock = None
 
     def _unlink(self):
         """Removes the references that this object has to the outside
@@ -70,17 +244,52 @@ class DelayedCall(object):
         self.function = self.args = self.kwargs = None
 
     def cancel(self):
+        if self.lock is None:
+            self._cancel()
+            return
+        self.lock.acquire()
+        try:
+            self._cancel()
+        finally:
+            self.lock.release()
+
+    def _cancel(self):
+        if self.canceled:
+            return
         self.canceled = True
         self._unlink()
+        if self.scheduler is not None:
+            self.scheduler.timeout_canceled()
+
+    def _start(self):
+        """Get the function and arguments to call.
+
+        :returns: (function, args, kwargs) or None if we were canceled
+        """
+        if self.canceled:
+            return None
+        call = (self.function, self.args, self.kwargs)
+        self._unlink()
+        return call
 
     def dispatch(self):
         success = True
-        if not self.canceled:
+        if self.lock is None:
+            call = self._start()
+        else:
+            self.lock.acquire()
+            try:
+                call = self._start()
+            finally:
+                self.lock.release()
+        if call is not None:
+            function, args, kwargs = call
             when = "While handling %s" % self.name
             start = clock()
-            success = trapcall.trap_call(when, self.function, *self.args,
-                    **self.kwargs)
+            success = trapcall.trap_call(when, function, *args, **kwargs)
             end = clock()
+            stats.record_call(self.name, start, end, self.queued_at,
+                              self.scheduled_time)
             if end-start > 0.5:
                 logging.timing("%s too slow (%.3f secs)",
                                self.name, end-start)
@@ -94,12 +303,30 @@ class DelayedCall(object):
                 logging.timing("%s cumulative is too slow (%.3f secs)",
                                self.name, total)
                 cumulative[self.name] = 0
-        self._unlink()
         return success
 
 class Scheduler(object):
+    """Keeps a heap of timeouts.
+
+    Canceled timeouts can't be removed from the middle of the heap cheaply,
+    so we count them instead.  Canceled entries at the top of the heap are
+    dropped right away so that next_timeout() is based on a live timer.  If
+    more than half of the heap is canceled, we rebuild it without them.
+
+    DelayedCall.cancel() and DelayedCall.dispatch() both use our lock, so a
+    timeout that gets canceled from another thread after we pop it won't
+    run.
+    """
+
+    # Don't bother compacting heaps smaller than this
+    COMPACT_MIN_CANCELED = 64
+
     def __init__(self):
         self.heap = []
+        self.canceled_count = 0
+        # add_timeout() gets called from other threads, so we need to
+        # protect the heap when we rebuild it.
+        self.lock = threading.Lock()
 
     def add_timeout(self, delay, function, name, args=None, kwargs=None):
         if args is None:
@@ -108,24 +335,77 @@ class Scheduler(object):
             kwargs = {}
         scheduled_time = clock() + delay
         dc = DelayedCall(function,  "timeout (%s)" % (name,), args, kwargs)
-        heapq.heappush(self.heap, (scheduled_time, dc))
+        dc.scheduled_time = scheduled_time
+        dc.scheduler = self
+        dc.lock = self.lock
+        self.lock.acquire()
+        try:
+            heapq.heappush(self.heap, (scheduled_time, dc))
+            heap_size = len(self.heap)
+        finally:
+            self.lock.release()
+        stats.record_queue_depth('timeout', heap_size)
         return dc
 
+    def timeout_canceled(self):
+        """Called by DelayedCall.cancel() for timeouts still in our heap.
+
+        DelayedCall.cancel() calls this with our lock held.
+        """
+        self.canceled_count += 1
+        if (self.canceled_count >= self.COMPACT_MIN_CANCELED and
+                self.canceled_count * 2 > len(self.heap)):
+            self._compact()
+
+    def _compact(self):
+        self.heap = [entry for entry in self.heap if not entry[1].canceled]
+        heapq.heapify(self.heap)
+        self.canceled_count = 0
+
+    def _drop_canceled(self):
+        # remove canceled entries from the top of the heap.  Call this with
+        # our lock held.
+        while self.heap and self.heap[0][1].canceled:
+            scheduled_time, dc = heapq.heappop(self.heap)
+            dc.scheduler = None
+            self.canceled_count -= 1
+
+    def live_timeout_count(self):
+        return len(self.heap) - self.canceled_count
+
     def next_timeout(self):
-        if len(self.heap) == 0:
-            return None
-        else:
-            return max(0, self.heap[0][0] - clock())
+        self.lock.acquire()
+        try:
+            self._drop_canceled()
+            if len(self.heap) == 0:
+                return None
+            else:
+                return max(0, self.heap[0][0] - clock())
+        finally:
+            self.lock.release()
 
     def has_pending_timeout(self):
-        return len(self.heap) > 0 and self.heap[0][0] < clock()
+        self.lock.acquire()
+        try:
+            self._drop_canceled()
+            return len(self.heap) > 0 and self.heap[0][0] < clock()
+        finally:
+            self.lock.release()
 
     def process_next_timeout(self):
-        time, dc = heapq.heappop(self.heap)
+        self.lock.acquire()
+        try:
+            scheduled_time, dc = heapq.heappop(self.heap)
+            dc.scheduler = None
+            if dc.canceled:
+                self.canceled_count -= 1
+        finally:
+            self.lock.release()
         return dc.dispatch()
 
 class CallQueue(object):
-    def __init__(self):
+    def __init__(self, name):
+        self.name = name
         self.queue = Queue.Queue()
         self.quit_flag = False
         self.queue_size_warning_count = 0
@@ -137,6 +417,8 @@ class CallQueue(object):
             kwargs = {}
         dc = DelayedCall(function, "idle (%s)" % (name,), args, kwargs)
         self.queue.put(dc)
+        queue_size = self.queue.qsize()
+        stats.record_queue_depth(self.name, queue_size)
 
         # Check if our queue size is too big and log a warning if so.  Only do
         # this a few times.  That should be enough to track down errors, but
@@ -145,7 +427,7 @@ class CallQueue(object):
         # NOTE: the code below doesn't take into account that this method
         # runs on multiple threads.  However, the worst that can happen is
         # we log an extra warning or two, so this doesn't seem bad.
-        if self.queue_size_warning_count < 5 and self.queue.qsize() > 1000:
+        if self.queue_size_warning_count < 5 and queue_size > 1000:
             if self.queue_size_warning_count < 5:
                 logging.stacktrace("Queued called size too large")
                 self.queue_size_warning_count += 1
@@ -165,60 +447,505 @@ class CallQueue(object):
             self.process_next_idle()
 
 
+# Lanes for idle callbacks, in priority order
+LANE_INTERACTIVE = 'interactive'
+LANE_NORMAL = 'normal'
+LANE_BACKGROUND = 'background'
+LANES = (LANE_INTERACTIVE, LANE_NORMAL, LANE_BACKGROUND)
+
+# Max time (in seconds) to spend on each lane per event loop iteration.  None
+# means no limit.  Once a lane uses up its budget, its calls wait until the
+# next iteration, which gives sockets and timeouts a chance to run.
+LANE_BUDGETS = {
+    LANE_INTERACTIVE: None,
+    LANE_NORMAL: 0.5,
+    LANE_BACKGROUND: 0.05,
+}
+
+class IdleLane(object):
+    """A single FIFO of idle calls with a time budget."""
+    def __init__(self, name, budget):
+        self.name = name
+        self.budget = budget
+        self.calls = collections.deque()
+        self.time_used = 0.0
+
+    def has_budget(self):
+        return self.budget is None or self.time_used < self.budget
+
+class IdleQueue(object):
+    """Queue of idle callbacks split into priority lanes.
+
+    Each call to process_next_idle() runs a call from the highest priority
+    lane that has calls and hasn't used up its time budget for this
+    iteration.  Lanes are checked before every call, so background work only
+    delays interactive work by the length of a single background call.
+
+    add_idle() can be called from any thread.  deque.append() and
+    deque.popleft() are atomic and only the event loop thread removes calls,
+    so we don't need to lock.
+    """
+    def __init__(self):
+        self.lanes = [IdleLane(name, LANE_BUDGETS[name]) for name in LANES]
+        self.lane_map = dict((lane.name, lane) for lane in self.lanes)
+        self.quit_flag = False
+        self.queue_size_warning_count = 0
+
+    def add_idle(self, function, name, args=None, kwargs=None,
+                 lane=LANE_NORMAL):
+        if args is None:
+            args = ()
+        if kwargs is None:
+            kwargs = {}
+        try:
+            idle_lane = self.lane_map[lane]
+        except KeyError:
+            raise ValueError("Unknown idle lane: %r" % (lane,))
+        dc = DelayedCall(function, "idle (%s)" % (name,), args, kwargs)
+        idle_lane.calls.append(dc)
+        queue_size = len(idle_lane.calls)
+        stats.record_queue_depth('idle-%s' % lane, queue_size)
+
+        # Check if our queue size is too big and log a warning if so.  Only do
+        # this a few times.  See CallQueue.add_idle() for why we don't worry
+        # about threads here.
+        if self.queue_size_warning_count < 5 and queue_size > 1000:
+            logging.stacktrace("Queued called size too large (%s lane)",
+                               lane)
+            self.queue_size_warning_count += 1
+
+        return dc
+
+    def start_iteration(self):
+        """Reset the time budgets for a new event loop iteration."""
+        for lane in self.lanes:
+            lane.time_used = 0.0
+
+    def has_pending_idle(self):
+        for lane in self.lanes:
+            if lane.calls:
+                return True
+        return False
+
+    def has_runnable_idle(self):
+        """Check if there are idle calls that should run in this event loop
+        iteration.
+        """
+        for lane in self.lanes:
+            if lane.calls and lane.has_budget():
+                return True
+        return False
+
+    def _next_lane(self):
+        for lane in self.lanes:
+            if lane.calls and lane.has_budget():
+                return lane
+        # Every lane with calls is over budget.  This only happens if we're
+        # called outside of the event loop (for example in the unittests),
+        # so ignore the budgets.
+        for lane in self.lanes:
+            if lane.calls:
+                return lane
+        raise IndexError("No pending idle calls")
+
+    def process_next_idle(self):
+        lane = self._next_lane()
+        dc = lane.calls.popleft()
+        start = clock()
+        try:
+            return dc.dispatch()
+        finally:
+            lane.time_used += clock() - start
+
+    def process_idles(self):
+        # Note: used for testing purposes
+        while self.has_pending_idle() and not self.quit_flag:
+            self.process_next_idle()
+
+# Task classes for call_in_thread_class().  Each tuple is (name, priority,
+# max_running).  Higher priority classes get threads first.  max_running
+# limits how many threads a class can use at once (None for no limit).
+TASK_CLASS_DEFAULT = 'default'
+TASK_CLASS_DNS = 'dns'
+TASK_CLASS_SHARING = 'sharing'
+TASK_CLASS_CODEGEN = 'codegen'
+TASK_CLASS_DB_MAINTENANCE = 'db maintenance'
+DEFAULT_TASK_CLASSES = (
+    (TASK_CLASS_DNS, 10, None),
+    (TASK_CLASS_DEFAULT, 0, None),
+    (TASK_CLASS_SHARING, 0, 2),
+    (TASK_CLASS_CODEGEN, -10, 1),
+    (TASK_CLASS_DB_MAINTENANCE, -10, 1),
+)
+
+class ThreadPoolCall(futures.Future):
+    """A call queued with the ThreadPool.
+
+    This is a Future for the return value of the function.  It's returned by
+    call_in_thread() so that callers can wait on it or cancel the call
+    before it starts.
+    """
+    def __init__(self, pool, task_class, callback, errback, function, name,
+                 args, kwargs):
+        futures.Future.__init__(self)
+        self.pool = pool
+        self.task_class = task_class
+        self.callback = callback
+        self.errback = errback
+        self.function = function
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.queued_at = clock()
+        self.started = False
+
+    def cancel(self):
+        """Cancel the call if it hasn't started yet.
+
+        :returns: True if the call was canceled.  If the call has already
+            started, we return False and the callback/errback will still be
+            called.
+        """
+        if not self.pool.cancel_call(self):
+            return False
+        return futures.Future.cancel(self)
+
+    def finish(self, success, value):
+        """Called in the event loop thread once the function returns."""
+        callback, errback = self.callback, self.errback
+        self.callback = self.errback = None
+        if success:
+            self.set_result(value)
+            if callback is not None:
+                callback(value)
+        else:
+            self.set_error(value)
+            if errback is not None:
+                errback(value)
+
+class ThreadPoolTaskClass(object):
+    """Group of thread pool calls that share a priority and a limit on the
+    number of threads they can use.
+    """
+    def __init__(self, name, priority=0, max_running=None):
+        self.name = name
+        self.priority = priority
+        self.max_running = max_running
+        self.calls = collections.deque()
+        self.running = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats_start = clock()
+        self.call_count = 0
+        self.canceled_count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.busy_time = 0.0
+
+    def can_start_call(self):
+        return bool(self.calls) and (self.max_running is None or
+                                     self.running < self.max_running)
+
+    def get_stats(self, thread_count):
+        elapsed = max(clock() - self.stats_start, 0.001)
+        if self.max_running is not None:
+            capacity = min(self.max_running, thread_count)
+        else:
+            capacity = thread_count
+        if self.call_count:
+            avg_wait = self.total_wait / self.call_count
+        else:
+            avg_wait = 0.0
+        return {
+            'priority': self.priority,
+            'max_running': self.max_running,
+            'queued': len(self.calls),
+            'running': self.running,
+            'call_count': self.call_count,
+            'canceled_count': self.canceled_count,
+            'avg_wait': avg_wait,
+            'max_wait': self.max_wait,
+            'utilization': self.busy_time / (elapsed * max(capacity, 1)),
+        }
+
 class ThreadPool(object):
     """The thread pool is used to handle calls like gethostbyname()
     that block and there's no asynchronous workaround.  What we do
     instead is call them in a separate thread and return the result in
     a callback that executes in the event loop.
+
+    Calls are grouped into task classes (see DEFAULT_TASK_CLASSES).  Free
+    threads take the oldest call from the highest priority class that's
+    under its max_running limit.
+
+    The pool starts MIN_THREADS threads.  If a call waits longer than
+    GROW_WAIT_TIME without a thread to run it, we add threads up to
+    MAX_THREADS.  Extra threads exit after sitting idle for
+    IDLE_THREAD_TIMEOUT seconds.  While there are only MIN_THREADS threads,
+    idle threads wait without a timeout.
     """
-    THREADS = 4
+    MIN_THREADS = 4
+    MAX_THREADS = 8
+    GROW_WAIT_TIME = 0.2
+    IDLE_THREAD_TIMEOUT = 30.0
 
     def __init__(self, event_loop):
         self.event_loop = event_loop
-        self.queue = Queue.Queue()
+        self.cond = threading.Condition()
+        self.task_classes = {}
+        # task classes sorted by priority, highest first
+        self.task_class_order = []
         self.threads = []
+        self.idle_thread_count = 0
+        self.thread_counter = 0
+        self.quit_flag = False
+        self.grow_check_dc = None
+        for name, priority, max_running in DEFAULT_TASK_CLASSES:
+            self.register_task_class(name, priority, max_running)
+
+    def register_task_class(self, name, priority=0, max_running=None):
+        """Add a task class or change an existing one's settings."""
+        self.cond.acquire()
+        try:
+            try:
+                task_class = self.task_classes[name]
+            except KeyError:
+                task_class = ThreadPoolTaskClass(name, priority, max_running)
+                self.task_classes[name] = task_class
+            else:
+                task_class.priority = priority
+                task_class.max_running = max_running
+            self.task_class_order = sorted(self.task_classes.values(),
+                    key=lambda tc: tc.priority, reverse=True)
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
 
     def init_threads(self):
-        while len(self.threads) < ThreadPool.THREADS:
-            t = threading.Thread(name='ThreadPool - %d' % len(self.threads),
-                                 target=thread_body,
-                                 args=[self.thread_loop])
-            t.setDaemon(True)
-            t.start()
-            self.threads.append(t)
+        self.cond.acquire()
+        try:
+            self.quit_flag = False
+            while len(self.threads) < self.MIN_THREADS:
+                self._start_thread()
+        finally:
+            self.cond.release()
+
+    def _start_thread(self):
+        # call with self.cond held
+        t = threading.Thread(name='ThreadPool - %d' % self.thread_counter,
+                             target=thread_body,
+                             args=[self.thread_loop])
+        self.thread_counter += 1
+        t.setDaemon(True)
+        self.threads.append(t)
+        t.start()
 
     def thread_loop(self):
         while True:
-            next_item = self.queue.get()
-            if next_item == "QUIT":
+            call = self._get_next_call()
+            if call is None:
                 break
-            else:
-                callback, errback, func, name, args, kwargs, = next_item
+            self._run_call(call)
+
+    def _pick_next_call(self):
+        # call with self.cond held
+        best = None
+        for task_class in self.task_class_order:
+            if best is not None and task_class.priority < best.priority:
+                break
+            if task_class.can_start_call():
+                if (best is None or task_class.calls[0].queued_at <
+                        best.calls[0].queued_at):
+                    best = task_class
+        if best is None:
+            return None
+        call = best.calls.popleft()
+        call.started = True
+        best.running += 1
+        wait = clock() - call.queued_at
+        best.call_count += 1
+        best.total_wait += wait
+        if wait > best.max_wait:
+            best.max_wait = wait
+        return call
+
+    def _get_next_call(self):
+        """Wait for a call to run.
+
+        Returns None if the thread should exit.
+        """
+        self.cond.acquire()
+        try:
+            idle_since = clock()
+            while not self.quit_flag:
+                call = self._pick_next_call()
+                if call is not None:
+                    return call
+                if (clock() - idle_since >= self.IDLE_THREAD_TIMEOUT and
+                        len(self.threads) > self.MIN_THREADS):
+                    break
+                self.idle_thread_count += 1
+                try:
+                    if len(self.threads) > self.MIN_THREADS:
+                        # we may need to exit, so wake up after the timeout
+                        self.cond.wait(self.IDLE_THREAD_TIMEOUT)
+                    else:
+                        # timed waits poll in python 2, so don't use them
+                        # for threads that will never exit.
+                        self.cond.wait()
+                finally:
+                    self.idle_thread_count -= 1
             try:
-                result = func(*args, **kwargs)
-            except KeyboardInterrupt:
-                raise
-            except Exception, exc:
-                logging.debug(">>> thread_loop: %s %s %s %s\n%s",
-                              func, name, args, kwargs,
-                              "".join(traceback.format_exc()))
-                func = errback
-                name = 'Thread Pool Errback (%s)' % name
-                args = (exc,)
-            else:
-                func = callback
-                name = 'Thread Pool Callback (%s)' % name
-                args = (result,)
-            if not self.event_loop.quit_flag:
-                self.event_loop.idle_queue.add_idle(func, name, args=args)
-                self.event_loop.wakeup()
+                self.threads.remove(threading.currentThread())
+            except ValueError:
+                pass # close_threads() already removed us
+            return None
+        finally:
+            self.cond.release()
+
+    def _run_call(self, call):
+        start = clock()
+        func = call.function
+        try:
+            result = func(*call.args, **call.kwargs)
+        except KeyboardInterrupt:
+            raise
+        except Exception, exc:
+            logging.debug(">>> thread_loop: %s %s %s %s\n%s",
+                          func, call.name, call.args, call.kwargs,
+                          "".join(traceback.format_exc()))
+            name = 'Thread Pool Errback (%s)' % call.name
+            args = (False, exc)
+        else:
+            name = 'Thread Pool Callback (%s)' % call.name
+            args = (True, result)
+        self.cond.acquire()
+        try:
+            call.task_class.running -= 1
+            call.task_class.busy_time += clock() - start
+            # our task class may have been at its limit
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        call.function = call.args = call.kwargs = None
+        if not self.event_loop.quit_flag:
+            self.event_loop.idle_queue.add_idle(call.finish, name, args=args)
+            self.event_loop.wakeup()
 
     def queue_call(self, callback, errback, function, name, *args, **kwargs):
-        self.queue.put((callback, errback, function, name, args, kwargs))
+        return self.queue_call_in_class(TASK_CLASS_DEFAULT, callback, errback,
+                                        function, name, args, kwargs)
+
+    def queue_call_in_class(self, task_class_name, callback, errback,
+                            function, name, args, kwargs):
+        self.cond.acquire()
+        try:
+            try:
+                task_class = self.task_classes[task_class_name]
+            except KeyError:
+                raise ValueError("Unknown task class: %r" %
+                                 (task_class_name,))
+            call = ThreadPoolCall(self, task_class, callback, errback,
+                                  function, name, args, kwargs)
+            task_class.calls.append(call)
+            self.cond.notify()
+            need_grow_check = (self.threads and
+                               len(self.threads) < self.MAX_THREADS and
+                               self.grow_check_dc is None)
+            if need_grow_check:
+                self.grow_check_dc = self.event_loop.scheduler.add_timeout(
+                        self.GROW_WAIT_TIME, self._check_grow,
+                        'thread pool grow check')
+        finally:
+            self.cond.release()
+        return call
+
+    def _check_grow(self):
+        """Add a thread if calls are waiting too long."""
+        self.cond.acquire()
+        try:
+            self.grow_check_dc = None
+            if self.quit_flag or not self.threads:
+                return
+            now = clock()
+            oldest_wait = 0
+            for task_class in self.task_class_order:
+                if task_class.can_start_call():
+                    oldest_wait = max(oldest_wait,
+                                      now - task_class.calls[0].queued_at)
+            if oldest_wait == 0:
+                return
+            if (oldest_wait >= self.GROW_WAIT_TIME and
+                    self.idle_thread_count == 0 and
+                    len(self.threads) < self.MAX_THREADS):
+                logging.debug("ThreadPool: calls waiting %.2fs, adding "
+                              "thread %d", oldest_wait, len(self.threads) + 1)
+                self._start_thread()
+            if len(self.threads) < self.MAX_THREADS:
+                # check again if there's still a backlog
+                self.grow_check_dc = self.event_loop.scheduler.add_timeout(
+                        self.GROW_WAIT_TIME, self._check_grow,
+                        'thread pool grow check')
+        finally:
+            self.cond.release()
+
+    def cancel_call(self, call):
+        self.cond.acquire()
+        try:
+            if call.started or call.done():
+                return False
+            call.task_class.calls.remove(call)
+            call.task_class.canceled_count += 1
+            call.callback = call.errback = call.function = None
+            call.args = call.kwargs = None
+            return True
+        finally:
+            self.cond.release()
+
+    def has_pending_calls(self):
+        self.cond.acquire()
+        try:
+            for task_class in self.task_class_order:
+                if task_class.calls:
+                    return True
+            return False
+        finally:
+            self.cond.release()
+
+    def get_stats(self):
+        """Get stats for each task class.
+
+        :returns: dict mapping task class names to dicts of stats
+        """
+        self.cond.acquire()
+        try:
+            thread_count = max(len(self.threads), 1)
+            return dict((name, task_class.get_stats(thread_count))
+                        for name, task_class in self.task_classes.items())
+        finally:
+            self.cond.release()
+
+    def reset_stats(self):
+        self.cond.acquire()
+        try:
+            for task_class in self.task_class_order:
+                task_class.reset_stats()
+        finally:
+            self.cond.release()
 
     def close_threads(self):
-        for x in xrange(len(self.threads)):
-            self.queue.put("QUIT")
+        self.cond.acquire()
+        try:
+            self.quit_flag = True
+            threads = self.threads
+            self.threads = []
+            if self.grow_check_dc is not None:
+                self.grow_check_dc.cancel()
+                self.grow_check_dc = None
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
         # Why is there a timeout on the join() here, what's wrong?  On
         # shutdown, the system waits for the eventloop to finish using 
         # eventloop.join() but eventloop calls close_threads() which wait
@@ -226,14 +953,253 @@ class ThreadPool(object):
         # in a blocking operation which is exactly the point of having them
         # so eventloop.join() in turn blocks.  So if it doesn't clean up
         # in time let the daemon flag in the Thread() do its job.  See #16584.
-        for t in self.threads:
+        for t in threads:
             try:
                 t.join(0.5)
             except StandardError:
                 pass
-        self.threads = []
+
+POLL_READ = 1
+POLL_WRITE = 2
+
+class Poller(object):
+    """Keeps track of the file descriptors that an event loop waits on.
+
+    Unlike calling select() directly, registrations persist across loop
+    iterations.  Users call register()/unregister() when the set of events
+    they're interested in changes, then call poll() to wait for events.
+
+    Subclasses implement _register(), _unregister() and _poll() for a
+    specific system call.
+    """
+    def __init__(self):
+        # maps fds to a bitmask of POLL_READ/POLL_WRITE
+        self.fds = {}
+
+    def register(self, fd, events):
+        """Set the events to wait for on a file descriptor.
+
+        :param fd: file descriptor to watch
+        :param events: bitmask of POLL_READ and POLL_WRITE.  If this is 0,
+        the file descriptor is unregistered.
+        """
+        if not events:
+            self.unregister(fd)
+            return
+        old_events = self.fds.get(fd)
+        if old_events == events:
+            return
+        self.fds[fd] = events
+        self._register(fd, events, old_events is not None)
+
+    def unregister(self, fd):
+        """Stop watching a file descriptor.
+
+        It's not an error to unregister a file descriptor that isn't
+        registered.
+        """
+        if self.fds.pop(fd, None) is not None:
+            self._unregister(fd)
+
+    def set_fds(self, readfds, writefds):
+        """Change the registrations to match a list of fds.
+
+        This is used to support event loops that calculate their file
+        descriptors each iteration.  Only fds that changed are passed to
+        _register() and _unregister().
+        """
+        wanted = {}
+        for fd in readfds:
+            wanted[fd] = POLL_READ
+        for fd in writefds:
+            wanted[fd] = wanted.get(fd, 0) | POLL_WRITE
+        for fd in self.fds.keys():
+            if fd not in wanted:
+                self.unregister(fd)
+        for fd, events in wanted.iteritems():
+            self.register(fd, events)
+
+    def poll(self, timeout):
+        """Wait for events.
+
+        :param timeout: max time to wait in seconds or None to wait forever
+        :returns: (read_fds_ready, write_fds_ready, exc_fds_ready) tuple
+        """
+        try:
+            return self._poll(timeout)
+        except (select.error, IOError), e:
+            if e.args[0] == errno.EINTR:
+                logging.warning("eventloop: %s", e)
+                return [], [], []
+            raise
+
+    def close(self):
+        self.fds = {}
+
+    def _register(self, fd, events, modify):
+        raise NotImplementedError()
+
+    def _unregister(self, fd):
+        raise NotImplementedError()
+
+    def _poll(self, timeout):
+        raise NotImplementedError()
+
+class SelectPoller(Poller):
+    """Poller that uses select().  This works everywhere, but is limited to
+    FD_SETSIZE file descriptors.
+    """
+    def __init__(self):
+        Poller.__init__(self)
+        self.readfds = set()
+        self.writefds = set()
+
+    def _register(self, fd, events, modify):
+        if events & POLL_READ:
+            self.readfds.add(fd)
+        else:
+            self.readfds.discard(fd)
+        if events & POLL_WRITE:
+            self.writefds.add(fd)
+        else:
+            self.writefds.discard(fd)
+
+    def _unregister(self, fd):
+        self.readfds.discard(fd)
+        self.writefds.discard(fd)
+
+    def _poll(self, timeout):
+        return select.select(self.readfds, self.writefds, [], timeout)
+
+    def close(self):
+        Poller.close(self)
+        self.readfds = set()
+        self.writefds = set()
+
+class _PollObjectPoller(Poller):
+    """Base class for pollers built on select.poll() style objects."""
+
+    # subclasses set these to the flags for their poll object
+    READ_MASK = WRITE_MASK = ERROR_MASK = 0
+
+    def __init__(self):
+        Poller.__init__(self)
+        self.poll_obj = self.make_poll_object()
+
+    def make_poll_object(self):
+        raise NotImplementedError()
+
+    def _convert_events(self, events):
+        mask = 0
+        if events & POLL_READ:
+            mask |= self.READ_MASK
+        if events & POLL_WRITE:
+            mask |= self.WRITE_MASK
+        return mask
+
+    def _register(self, fd, events, modify):
+        mask = self._convert_events(events)
+        if modify:
+            try:
+                self.poll_obj.modify(fd, mask)
+                return
+            except (IOError, OSError), e:
+                # The fd was closed and re-opened without being
+                # unregistered.  The kernel already dropped it, so register
+                # it again.
+                if e.errno not in (errno.ENOENT, errno.EBADF):
+                    raise
+        try:
+            self.poll_obj.register(fd, mask)
+        except (IOError, OSError), e:
+            if e.errno != errno.EEXIST:
+                raise
+            self.poll_obj.modify(fd, mask)
+
+    def _unregister(self, fd):
+        try:
+            self.poll_obj.unregister(fd)
+        except (IOError, OSError, KeyError, ValueError):
+            # the fd has already been closed, which removes it from the
+            # kernel's list.
+            pass
+
+    def _poll(self, timeout):
+        read_ready = []
+        write_ready = []
+        exc_ready = []
+        for fd, mask in self._call_poll(timeout):
+            events = self.fds.get(fd, 0)
+            if mask & self.ERROR_MASK:
+                # Report errors as readable/writable so that callbacks get
+                # a chance to see them, the same way select() does.
+                exc_ready.append(fd)
+                mask |= self.READ_MASK | self.WRITE_MASK
+            if mask & self.READ_MASK and events & POLL_READ:
+                read_ready.append(fd)
+            if mask & self.WRITE_MASK and events & POLL_WRITE:
+                write_ready.append(fd)
+        return read_ready, write_ready, exc_ready
+
+    def _call_poll(self, timeout):
+        raise NotImplementedError()
+
+class PollPoller(_PollObjectPoller):
+    """Poller that uses poll().  The number of fds isn't limited, but the
+    kernel still scans each one every call.
+    """
+    if hasattr(select, 'poll'):
+        READ_MASK = select.POLLIN | select.POLLPRI
+        WRITE_MASK = select.POLLOUT
+        ERROR_MASK = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+    def make_poll_object(self):
+        return select.poll()
+
+    def _call_poll(self, timeout):
+        if timeout is not None:
+            # poll() uses milliseconds.  Round up so that we don't spin
+            # waiting for a timeout that's less than 1ms away.
+            timeout = int(math.ceil(timeout * 1000))
+        return self.poll_obj.poll(timeout)
+
+class EpollPoller(_PollObjectPoller):
+    """Poller that uses epoll().  Work done is proportional to the number of
+    ready fds rather than the number registered.
+    """
+    if hasattr(select, 'epoll'):
+        READ_MASK = select.EPOLLIN | select.EPOLLPRI
+        WRITE_MASK = select.EPOLLOUT
+        ERROR_MASK = select.EPOLLERR | select.EPOLLHUP
+
+    def make_poll_object(self):
+        return select.epoll()
+
+    def _call_poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        return self.poll_obj.poll(timeout)
+
+    def close(self):
+        _PollObjectPoller.close(self)
+        self.poll_obj.close()
+
+def make_poller():
+    """Create the best Poller available on this system."""
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    elif hasattr(select, 'poll') and sys.platform != 'darwin':
+        # poll() is broken for some fd types on OS X, stick with select()
+        return PollPoller()
+    else:
+        return SelectPoller()
 
 class SimpleEventLoop(signals.SignalEmitter):
+    """Basic event loop.
+
+    Subclasses can either register fds with self.poller directly, or
+    override calc_fds() to return the fds to wait on for each iteration.
+    """
     def __init__(self):
         signals.SignalEmitter.__init__(self, 'thread-will-start',
                                        'thread-started',
@@ -243,6 +1209,8 @@ class SimpleEventLoop(signals.SignalEmitter):
         self.quit_flag = False
         self.wake_sender, self.wake_receiver = util.make_dummy_socket_pair()
         self.loop_ready = threading.Event()
+        self.poller = make_poller()
+        self.poller.register(self.wake_receiver.fileno(), POLL_READ)
 
     def loop(self):
         self.loop_ready.set()
@@ -250,28 +1218,45 @@ class SimpleEventLoop(signals.SignalEmitter):
         self.emit('thread-started', threading.currentThread())
         self.emit('thread-did-start')
 
+        wake_fd = self.wake_receiver.fileno()
         while not self.quit_flag:
             self.emit('begin-loop')
             timeout = self.calc_timeout()
-            readfds, writefds, excfds = self.calc_fds()
-            readfds.append(self.wake_receiver.fileno())
+            self.update_poller()
             try:
                 read_fds_ready, write_fds_ready, exc_fds_ready = \
-                        select.select(readfds, writefds, excfds, timeout)
-            except select.error, (err, detail):
-                if err == errno.EINTR:
-                    logging.warning ("eventloop: %s", detail)
-                else:
-                    self.emit('end-loop')
-                    raise
+                        self.poller.poll(timeout)
+            except (select.error, IOError, OSError):
+                self.emit('end-loop')
+                raise
             if self.quit_flag:
                 self.emit('end-loop')
                 break
-            if self.wake_receiver.fileno() in read_fds_ready:
+            if wake_fd in read_fds_ready:
                 self._slurp_waker_data()
+                read_fds_ready = [fd for fd in read_fds_ready
+                                  if fd != wake_fd]
             self.process_events(read_fds_ready, write_fds_ready, exc_fds_ready)
             self.emit('end-loop')
 
+    def calc_fds(self):
+        """Calculate the fds to wait on for this iteration.
+
+        :returns: (readfds, writefds, excfds) tuple or None if the subclass
+        manages self.poller itself.
+        """
+        return None
+
+    def update_poller(self):
+        """Update self.poller before waiting for events."""
+        fds = self.calc_fds()
+        if fds is None:
+            return
+        readfds, writefds, excfds = fds
+        readfds = list(readfds)
+        readfds.append(self.wake_receiver.fileno())
+        self.poller.set_fds(readfds, writefds)
+
     def wakeup(self):
         try:
             self.wake_sender.send("b")
@@ -286,8 +1271,8 @@ class EventLoop(SimpleEventLoop):
         SimpleEventLoop.__init__(self)
         self.create_signal('event-finished')
         self.scheduler = Scheduler()
-        self.idle_queue = CallQueue()
-        self.urgent_queue = CallQueue()
+        self.idle_queue = IdleQueue()
+        self.urgent_queue = CallQueue('urgent')
         self.threadpool = ThreadPool(self)
         self.read_callbacks = {}
         self.write_callbacks = {}
@@ -298,28 +1283,45 @@ class EventLoop(SimpleEventLoop):
         self.removed_read_callbacks = set()
         self.removed_write_callbacks = set()
 
+    def _update_poller_for_fd(self, fd):
+        events = 0
+        if fd in self.read_callbacks:
+            events |= POLL_READ
+        if fd in self.write_callbacks:
+            events |= POLL_WRITE
+        self.poller.register(fd, events)
+
     def add_read_callback(self, sock, callback):
-        self.read_callbacks[sock.fileno()] = callback
+        fd = sock.fileno()
+        self.read_callbacks[fd] = callback
+        self._update_poller_for_fd(fd)
 
     def remove_read_callback(self, sock):
-        del self.read_callbacks[sock.fileno()]
-        self.removed_read_callbacks.add(sock.fileno())
+        fd = sock.fileno()
+        del self.read_callbacks[fd]
+        self.removed_read_callbacks.add(fd)
+        self._update_poller_for_fd(fd)
 
     def add_write_callback(self, sock, callback):
-        self.write_callbacks[sock.fileno()] = callback
+        fd = sock.fileno()
+        self.write_callbacks[fd] = callback
+        self._update_poller_for_fd(fd)
 
     def remove_write_callback(self, sock):
-        del self.write_callbacks[sock.fileno()]
-        self.removed_write_callbacks.add(sock.fileno())
+        fd = sock.fileno()
+        del self.write_callbacks[fd]
+        self.removed_write_callbacks.add(fd)
+        self._update_poller_for_fd(fd)
 
     def call_in_thread(self, callback, errback, function, name,
                        *args, **kwargs):
-        self.threadpool.queue_call(callback, errback, function, name,
-                                  *args, **kwargs)
+        return self.threadpool.queue_call(callback, errback, function, name,
+                                          *args, **kwargs)
 
-    def run_idle_next_loop(self, function, name, args=None, kwargs=None):
+    def run_idle_next_loop(self, function, name, args=None, kwargs=None,
+                           lane=LANE_NORMAL):
         """Add an idle callback to be called on the next event loop."""
-        self.idles_for_next_loop.append((function, name, args, kwargs))
+        self.idles_for_next_loop.append((function, name, args, kwargs, lane))
 
     def process_events(self, read_fds_ready, write_fds_ready, exc_fds_ready):
         self._process_urgent_events()
@@ -334,21 +1336,23 @@ class EventLoop(SimpleEventLoop):
             if self.quit_flag:
                 break
 
-    def calc_fds(self):
-        return (self.read_callbacks.keys(), self.write_callbacks.keys(), [])
-
     def calc_timeout(self):
+        if self.idle_queue.has_pending_idle():
+            # Idles left over because their lane was over budget, don't
+            # wait before running them.
+            return 0
         return self.scheduler.next_timeout()
 
     def do_begin_loop(self):
         self.clear_removed_callbacks()
+        self.idle_queue.start_iteration()
         self._add_idles_for_next_loop()
 
     def _add_idles_for_next_loop(self):
         if not self.idles_for_next_loop:
             return
-        for func, name, args, kwargs in self.idles_for_next_loop:
-            self.idle_queue.add_idle(func, name, args, kwargs)
+        for func, name, args, kwargs, lane in self.idles_for_next_loop:
+            self.idle_queue.add_idle(func, name, args, kwargs, lane)
         self.idles_for_next_loop = []
         # call wakeup() to make sure we process the idles we just
         # added
@@ -378,7 +1382,7 @@ class EventLoop(SimpleEventLoop):
             yield callback
         while self.scheduler.has_pending_timeout():
             yield self.scheduler.process_next_timeout
-        while self.idle_queue.has_pending_idle():
+        while self.idle_queue.has_runnable_idle():
             yield self.idle_queue.process_next_idle
 
     def generate_callbacks(self, ready_list, map_, removed):
@@ -397,6 +1401,7 @@ class EventLoop(SimpleEventLoop):
                     success = trapcall.trap_call(when, function)
                     if not success:
                         del map_[fd]
+                        self._update_poller_for_fd(fd)
                     return success
                 yield callback_event
 
@@ -455,12 +1460,16 @@ def add_timeout(delay, function, name, args=None, kwargs=None):
     _eventloop.wakeup()
     return dc
 
-def add_idle(function, name, args=None, kwargs=None):
+def add_idle(function, name, args=None, kwargs=None, lane=LANE_NORMAL):
     """Schedule a function to be called when we get some spare time.
     Returns a ``DelayedCall`` object that can be used to cancel the
     call.
+
+    :param lane: priority lane to run the call in.  Use
+        ``LANE_INTERACTIVE`` for work that the user is waiting on and
+        ``LANE_BACKGROUND`` for long-running maintenance work.
     """
-    dc = _eventloop.idle_queue.add_idle(function, name, args, kwargs)
+    dc = _eventloop.idle_queue.add_idle(function, name, args, kwargs, lane)
     _eventloop.wakeup()
     return dc
 
@@ -476,13 +1485,43 @@ def add_urgent_call(function, name, args=None, kwargs=None):
 def call_in_thread(callback, errback, function, name, *args, **kwargs):
     """Schedule a function to be called in a separate thread.
 
+    callback and errback can be None.  Returns a ``ThreadPoolCall``, which
+    is a ``futures.Future`` for the result of the function.  It can also be
+    used to cancel the call before it starts.
+
     .. Warning::
 
        Do not put code that accesses the database or the UI here!
     """
-    _eventloop.call_in_thread(
+    return _eventloop.call_in_thread(
         callback, errback, function, name, *args, **kwargs)
 
+def call_in_thread_class(task_class, callback, errback, function, name,
+                         *args, **kwargs):
+    """Like ``call_in_thread()``, but run the call as part of a task class.
+
+    Task classes have their own priority and limit on how many threads they
+    can use, so that slow calls in one class don't hold up the others.  See
+    ``DEFAULT_TASK_CLASSES`` and ``register_thread_task_class()``.
+    """
+    return _eventloop.threadpool.queue_call_in_class(task_class, callback,
+            errback, function, name, args, kwargs)
+
+def register_thread_task_class(name, priority=0, max_running=None):
+    """Add a task class for ``call_in_thread_class()``.
+
+    :param priority: classes with a higher priority get threads first
+    :param max_running: max number of threads the class can use at once, or
+        None for no limit
+    """
+    _eventloop.threadpool.register_task_class(name, priority, max_running)
+
+def get_thread_pool_stats():
+    """Get utilization and wait time stats for each thread pool task
+    class.
+    """
+    return _eventloop.threadpool.get_stats()
+
 lt = None
 
 profile_file = None
@@ -563,7 +1602,7 @@ def as_urgent(func):
                                args=args, kwargs=kwargs)
     return queuer
 
-def idle_iterate(func, name, args=None, kwargs=None):
+def idle_iterate(func, name, args=None, kwargs=None, lane=LANE_NORMAL):
     """Iterate over a generator function using add_idle for each
     iteration.
 
@@ -582,33 +1621,45 @@ def idle_iterate(func, name, args=None, kwargs=None):
             yield
 
         eventloop.idle_iterate(foo, 'Foo', args=(1, 2, 3))
+
+    The steps run in the idle lane given by lane.  The generator can also
+    switch lanes by yielding one of the lane names (for example ``yield
+    eventloop.LANE_BACKGROUND``).
     """
     if args is None:
         args = ()
     if kwargs is None:
         kwargs = {}
     iterator = func(*args, **kwargs)
-    add_idle(_idle_iterate_step, name, args=(iterator, name))
+    add_idle(_idle_iterate_step, name, args=(iterator, name, lane),
+             lane=lane)
 
-def _idle_iterate_step(iterator, name):
+def _idle_iterate_step(iterator, name, lane):
     try:
         retval = iterator.next()
     except StopIteration:
         return
     else:
-        if retval is not None:
+        if retval in LANES:
+            lane = retval
+        elif retval is not None:
             logging.warn("idle_iterate yield value ignored: %s (%s)",
                          retval, name)
         _eventloop.run_idle_next_loop(_idle_iterate_step, name,
-                args=(iterator, name))
+                args=(iterator, name, lane), lane=lane)
 
-def idle_iterator(func):
+def idle_iterator(func=None, lane=LANE_NORMAL):
     """Decorator to wrap a generator function in a ``idle_iterate()``
     call.
+
+    Use it as ``@idle_iterator`` to run in the normal lane, or as
+    ``@idle_iterator(lane=LANE_BACKGROUND)`` to pick a lane.
     """
+    if func is None:
+        return lambda func: idle_iterator(func, lane)
     def queuer(*args, **kwargs):
         return idle_iterate(func, "%s() (using idle_iterator)" % func.__name__, 
-                            args=args, kwargs=kwargs)
+                            args=args, kwargs=kwargs, lane=lane)
     return queuer
 
 class DelayedFunctionCaller(object):
@@ -560,62 +560,54 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         if self.actualFeed:
             return self.actualFeed.clean_old_items()
 
-    def invalidate_counts(self):
-        for cached_count_attr in ('_num_available', '_num_unwatched',
-                '_num_downloaded', '_num_downloading'):
-            if cached_count_attr in self.__dict__:
-                del self.__dict__[cached_count_attr]
-
     def recalc_counts(self):
-        self.invalidate_counts()
+        """Tell the frontend that our counts may have changed.
+
+        The counts themselves are kept up to date by Item as items change.
+        """
         self.signal_change(needs_save=False)
         if self.in_folder():
             self.get_folder().signal_change(needs_save=False)
 
+    def _get_counts(self):
+        return models.Item.feed_counts(self.id)
+
     def num_downloaded(self):
         """Returns the number of downloaded items in the feed.
         """
-        try:
-            return self._num_downloaded
-        except AttributeError:
-            self._num_downloaded = self.downloaded_items.count()
-            return self._num_downloaded
+        return self._get_counts()['downloaded']
 
     def num_downloading(self):
         """Returns the number of downloading items in the feed.
         """
-        try:
-            return self._num_downloading
-        except AttributeError:
-            self._num_downloading = self.downloading_items.count()
-            return self._num_downloading
+        return self._get_counts()['downloading']
 
     def num_unwatched(self):
         """Returns string with number of unwatched videos in feed
         """
-        try:
-            return self._num_unwatched
-        except AttributeError:
-            self._num_unwatched = self.unwatched_items.count()
-            return self._num_unwatched
+        return self._get_counts()['unwatched']
+
+    def num_auto_pending(self):
+        """Returns the number of items that are waiting to be
+        auto-downloaded.
+        """
+        if not self.autoDownloadable:
+            return 0
+        counts = self._get_counts()
+        if self.getEverything:
+            return counts['not_downloaded']
+        else:
+            return counts['auto_eligible']
 
     def num_available(self):
         """Returns string with number of available videos in feed
         """
-        try:
-            return self._num_available
-        except AttributeError:
-            self._num_available = (self.available_items.count() -
-                    self.auto_pending_items.count())
-            return self._num_available
+        return (self._get_counts()['new'] -
+                self.num_auto_pending())
 
     def mark_as_viewed(self):
         """Sets the last time the feed was viewed to now
         """
-        try:
-            del self._num_available
-        except AttributeError:
-            pass
         for item in list(self.available_items):
             item.unset_new()
         if self.in_folder():
@@ -2103,7 +2095,7 @@ class DirectoryScannerImplBase(FeedImpl):
                     self.handle_watcher_updates,
                     "handle directory watcher updates")
 
-    @eventloop.idle_iterator
+    @eventloop.idle_iterator(lane=eventloop.LANE_BACKGROUND)
     def handle_watcher_updates(self):
         # If we are not longer valid just return
         if not self.ufeed.id_exists():
@@ -2168,7 +2160,7 @@ class DirectoryScannerImplBase(FeedImpl):
             self.updating = True
             self.schedule_update()
 
-    @eventloop.idle_iterator
+    @eventloop.idle_iterator(lane=eventloop.LANE_BACKGROUND)
     def do_update(self):
 
         def should_halt_early():
@@ -37,6 +37,7 @@ from miro import dialogs
 from miro import eventloop
 from miro import item
 from miro import folder
+from miro import queryprofile
 from miro import tabs
 from miro.frontends.cli import clidialog
 from miro.plat import resources
@@ -415,6 +416,52 @@ class MiroInterpreter(cmd.Cmd):
         return self.handle_item_complete(text, self._get_item_view(),
                 lambda i: i.is_downloaded())
 
+    @run_in_event_loop
+    def do_eventloopstats(self, line):
+        """eventloopstats [reset|threads|dump <path>] -- Prints timing stats
+        for event loop callbacks and thread pool task classes.
+        """
+        args = line.split(None, 1)
+        if not args:
+            print eventloop.stats.format_report(limit=20)
+        elif args[0] == 'reset':
+            eventloop.stats.reset()
+            eventloop._eventloop.threadpool.reset_stats()
+            print "Event loop stats reset."
+        elif args[0] == 'threads':
+            print "%-10s %6s %7s %6s %8s %8s %6s" % ("class", "queued",
+                    "running", "calls", "avg wait", "max wait", "util")
+            stats = eventloop.get_thread_pool_stats()
+            for name in sorted(stats):
+                info = stats[name]
+                print "%-10s %6d %7d %6d %8.3f %8.3f %5.1f%%" % (name,
+                        info['queued'], info['running'], info['call_count'],
+                        info['avg_wait'], info['max_wait'],
+                        info['utilization'] * 100)
+        elif args[0] == 'dump' and len(args) == 2:
+            eventloop.stats.dump(args[1])
+            print "Event loop stats written to %s" % args[1]
+        else:
+            print "Usage: eventloopstats [reset|threads|dump <path>]"
+
+    @run_in_event_loop
+    def do_querystats(self, line):
+        """querystats [reset|dump <path>] -- Prints stats for the SQL
+        queries run on the main database.
+        """
+        args = line.split(None, 1)
+        if not args:
+            print app.db.query_profiler.format_report(limit=20)
+        elif args[0] == 'reset':
+            app.db.query_profiler.reset()
+            print "Query stats reset."
+        elif args[0] == 'dump' and len(args) == 2:
+            queryprofile.write_reports(args[1],
+                                       [app.db.query_profiler.format_report()])
+            print "Query stats written to %s" % args[1]
+        else:
+            print "Usage: querystats [reset|dump <path>]"
+
     @run_in_event_loop
     def do_testdialog(self, line):
         """testdialog -- Tests the cli dialog system."""
@@ -106,6 +106,8 @@ class Application:
         messages.FrontendMessage.install_handler(self.message_handler)
         app.item_list_pool = itemlist.ItemListPool()
         app.item_tracker_updater = itemlist.ItemTrackerUpdater()
+        app.item_tracker_updater.add_result_cache(
+            app.item_list_pool.result_cache)
         app.info_updater = infoupdater.InfoUpdater()
         app.saved_items = set()
         app.watched_folder_manager = watchedfolders.WatchedFolderManager()
@@ -1088,6 +1090,26 @@ class Application:
             n = 0
         messages.ClogBackend(n).send_to_backend()
 
+    def dump_event_loop_stats(self):
+        """Devel method: write out timing stats for backend callbacks."""
+        title = _("Select File to write Event Loop Stats to")
+        path = dialogs.ask_for_save_pathname(title,
+                'miro-event-loop-stats.txt')
+        if path is not None:
+            messages.DumpEventLoopStats(path).send_to_backend()
+
+    def dump_query_stats(self):
+        """Devel method: write out stats for our SQL queries."""
+        title = _("Select File to write Query Stats to")
+        path = dialogs.ask_for_save_pathname(title,
+                'miro-query-stats.txt')
+        if path is not None:
+            frontend_reports = []
+            for pool in app.connection_pools.get_all_pools():
+                frontend_reports.append(pool.query_profiler.format_report())
+                frontend_reports.append(pool.format_report())
+            messages.DumpQueryStats(path, frontend_reports).send_to_backend()
+
     def profile_redraw(self):
         """Devel method: profile time to redraw part of the interface."""
 
@@ -90,11 +90,45 @@ _wrap_miro_fixed_list_store_iter_is_valid(PyGObject *self, PyObject *args, PyObj
 
 }
 
+static PyObject *
+_wrap_miro_fixed_list_store_insert_rows(PyGObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = { "position", "count", NULL };
+    int position, count;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs,"ii:Miro.FixedListStore.insert_rows", kwlist, &position, &count))
+        return NULL;
+    
+    miro_fixed_list_store_insert_rows(MIRO_FIXED_LIST_STORE(self->obj), position, count);
+    
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+static PyObject *
+_wrap_miro_fixed_list_store_remove_rows(PyGObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = { "position", "count", NULL };
+    int position, count;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs,"ii:Miro.FixedListStore.remove_rows", kwlist, &position, &count))
+        return NULL;
+    
+    miro_fixed_list_store_remove_rows(MIRO_FIXED_LIST_STORE(self->obj), position, count);
+    
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
 static const PyMethodDef _PyMiroFixedListStore_methods[] = {
     { "row_of_iter", (PyCFunction)_wrap_miro_fixed_list_store_row_of_iter, METH_VARARGS|METH_KEYWORDS,
       NULL },
     { "iter_is_valid", (PyCFunction)_wrap_miro_fixed_list_store_iter_is_valid, METH_VARARGS|METH_KEYWORDS,
       NULL },
+    { "insert_rows", (PyCFunction)_wrap_miro_fixed_list_store_insert_rows, METH_VARARGS|METH_KEYWORDS,
+      NULL },
+    { "remove_rows", (PyCFunction)_wrap_miro_fixed_list_store_remove_rows, METH_VARARGS|METH_KEYWORDS,
+      NULL },
     { NULL, NULL, 0, NULL }
 };
 
@@ -186,8 +186,9 @@ miro_fixed_list_store_init (MiroFixedListStore *self)
 static GtkTreeModelFlags
 miro_fixed_list_store_get_flags (GtkTreeModel *tree_model)
 {
-    return (GtkTreeModelFlags)(GTK_TREE_MODEL_LIST_ONLY |
-                               GTK_TREE_MODEL_ITERS_PERSIST);
+    // iters are just indexes, so they don't persist when rows are inserted
+    // or removed.
+    return GTK_TREE_MODEL_LIST_ONLY;
 }
 
 static gint
@@ -377,3 +378,43 @@ miro_fixed_list_store_iter_is_valid(MiroFixedListStore* miro_fls,
            pos < miro_fls->row_count);
 }
 
+void
+miro_fixed_list_store_insert_rows(MiroFixedListStore* miro_fls,
+                                  gint position,
+                                  gint count)
+{
+    GtkTreePath* path;
+    GtkTreeIter iter;
+    gint i;
+
+    g_assert(position >= 0 && position <= miro_fls->row_count);
+    g_assert(count >= 0);
+
+    for (i = position; i < position + count; i++) {
+        miro_fls->row_count++;
+        path = gtk_tree_path_new_from_indices(i, -1);
+        miro_fixed_list_store_make_iter(GTK_TREE_MODEL(miro_fls), &iter, i);
+        gtk_tree_model_row_inserted(GTK_TREE_MODEL(miro_fls), path, &iter);
+        gtk_tree_path_free(path);
+    }
+}
+
+void
+miro_fixed_list_store_remove_rows(MiroFixedListStore* miro_fls,
+                                  gint position,
+                                  gint count)
+{
+    GtkTreePath* path;
+    gint i;
+
+    g_assert(position >= 0 && count >= 0);
+    g_assert(position + count <= miro_fls->row_count);
+
+    // remove from the end, so that each path we emit is still correct
+    for (i = position + count - 1; i >= position; i--) {
+        miro_fls->row_count--;
+        path = gtk_tree_path_new_from_indices(i, -1);
+        gtk_tree_model_row_deleted(GTK_TREE_MODEL(miro_fls), path);
+        gtk_tree_path_free(path);
+    }
+}
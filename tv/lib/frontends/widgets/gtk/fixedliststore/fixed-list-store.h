@@ -35,9 +35,13 @@
  * MiroFixedListStore is a GtkTreeModel for a simple fixed-size list of items.
  *
  * MiroFixedListStore does next to nothing, but at least it does it fast :)
- * It stores no data at all, nor can rows be added, deleted, or reordered.  On
- * the plus side, this means that it implements the GtkTreeModel API pretty
- * close to as fast as possible.
+ * It stores no data at all, it only knows how many rows there are.  Rows can
+ * be inserted and removed, which just emits the GtkTreeModel signals so that
+ * views can update themselves without reloading the entire model.  On the
+ * plus side, this means that it implements the GtkTreeModel API pretty close
+ * to as fast as possible.
+ *
+ * Iters are just row indexes, so they don't persist across inserts/removes.
  *
  * The intended use is alongside another class to actually fetch the data and
  * to use a custom cell renderer function to set up the cell renderers.
@@ -97,3 +101,21 @@ miro_fixed_list_store_row_of_iter(MiroFixedListStore* miro_fls,
 gboolean
 miro_fixed_list_store_iter_is_valid(MiroFixedListStore* miro_fls,
                                     GtkTreeIter* iter);
+
+/*
+ * Insert rows before position and emit row-inserted for each one.
+ */
+
+void
+miro_fixed_list_store_insert_rows(MiroFixedListStore* miro_fls,
+                                  gint position,
+                                  gint count);
+
+/*
+ * Remove count rows starting at position and emit row-deleted for each one.
+ */
+
+void
+miro_fixed_list_store_remove_rows(MiroFixedListStore* miro_fls,
+                                  gint position,
+                                  gint count);
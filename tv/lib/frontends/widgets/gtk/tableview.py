@@ -114,6 +114,9 @@ class TreeViewScrolling(object):
         GTKScrollbarOwnerMixin, making this unnecessary.
         """
 
+    def visible_range_changed(self):
+        """Faux-signal; emitted when different rows might be visible."""
+
     @property
     def manually_scrolled(self):
         """Return whether the view has been scrolled explicitly by the user
@@ -146,6 +149,8 @@ class TreeViewScrolling(object):
         self.scrollbars = scrollbars
         for i, bar in enumerate(scrollbars):
             weak_connect(bar, 'changed', self.on_scroll_range_changed, i)
+        weak_connect(scrollbars[1], 'value-changed',
+                     self.on_scroll_value_changed)
         if self.restoring_scroll:
             self.set_scroll_position(self.restoring_scroll)
 
@@ -158,6 +163,10 @@ class TreeViewScrolling(object):
             self.set_scroll_position(self.restoring_scroll)
         # our wrapper handles the same thing for iters
         self.scroll_range_changed()
+        self.visible_range_changed()
+
+    def on_scroll_value_changed(self, adjustment):
+        self.visible_range_changed()
 
     def set_scroll_position(self, scroll_position):
         """Restore the scrollbars to a remembered state."""
@@ -1094,6 +1103,15 @@ class GTKScrollbarOwnerMixin(ScrollbarOwnerMixin):
         # we integrate TVS
         self._widget.scroll_range_changed = (lambda *a:
                 self.emit('scroll-range-changed'))
+        self._widget.visible_range_changed = self._on_visible_range_changed
+
+    def _on_visible_range_changed(self):
+        if self.model is None:
+            return
+        visible_range = self._widget.get_visible_range()
+        if visible_range is not None:
+            start_path, end_path = visible_range
+            self.model.set_visible_range(start_path[0], end_path[0] + 1)
 
     def set_scroller(self, scroller):
         """Set the Scroller object for this widget, if its ScrolledWindow is
@@ -1381,7 +1399,7 @@ class TableView(Widget, GTKSelectionOwnerMixin, DNDHandlerMixin,
         if (not isinstance(modelwrapper, ItemListModel) or
             modelwrapper.item_list.group_func is None):
             return
-        modelwrapper.item_list.group_info(path[0])
+        group_info = modelwrapper.item_list.get_group_info(path[0])
 
         start_row = path[0] - group_info[0]
         total_rows = group_info[1]
@@ -1523,6 +1541,14 @@ class TableModelBase(object):
     def cleanup(self):
         pass
 
+    def set_visible_range(self, start, end):
+        """Called by TableView when it scrolls.
+
+        :param start: index of the first visible row
+        :param end: index after the last visible row
+        """
+        pass
+
     def first_iter(self):
         return self._model.get_iter_first()
 
@@ -1669,14 +1695,32 @@ class ItemListModel(TableModelBase):
         self.item_list = item_list
         self.list_changed_handle = self.item_list.connect_before(
             "list-changed", self.on_list_changed)
+        self.list_diff_handle = self.item_list.connect(
+            "list-diff", self.on_list_diff)
+        self.applied_diff = False
         self._model = fixedliststore.FixedListStore(len(item_list))
 
     def cleanup(self):
         if self.list_changed_handle is not None:
             self.item_list.disconnect(self.list_changed_handle)
-            self.list_changed_handle = None
+            self.item_list.disconnect(self.list_diff_handle)
+            self.list_changed_handle = self.list_diff_handle = None
+
+    def on_list_diff(self, item_list, diff):
+        # Update our FixedListStore in place.  It emits the GTK signals for
+        # the rows that changed, so the GtkTreeView only needs to update
+        # those rows.
+        for start, count in reversed(diff.removed_ranges()):
+            self._model.remove_rows(start, count)
+        for start, count in diff.inserted_ranges():
+            self._model.insert_rows(start, count)
+        self.applied_diff = True
 
     def on_list_changed(self, item_list):
+        if self.applied_diff:
+            # on_list_diff() already updated our FixedListStore
+            self.applied_diff = False
+            return
         # When the list changes, we need to create a new FixedListStore object
         # to handle it.  ItemListModelHandler then updates the GtkTreeView
         # with this new model.
@@ -1685,6 +1729,9 @@ class ItemListModel(TableModelBase):
     def get_item(self, it):
         return self.item_list.get_row(self._model.row_of_iter(it))
 
+    def set_visible_range(self, start, end):
+        self.item_list.set_visible_range(start, end)
+
     def iter_for_id(self, item_id):
         """Get an iter that points to an item in this list."""
         row = self.item_list.get_index(item_id)
@@ -37,9 +37,12 @@ in the interface.
 """
 
 import collections
+import logging
+import sqlite3
 
 from miro import app
 from miro import prefs
+from miro import util
 from miro.data import item
 from miro.data import itemtrack
 from miro.frontends.widgets import itemfilter
@@ -65,7 +68,7 @@ class ItemList(itemtrack.ItemTracker):
     NOT_CALCULATED = object()
 
     def __init__(self, tab_type, tab_id, sort=None, group_func=None,
-                 filters=None, search_text=None):
+                 filters=None, search_text=None, result_cache=None):
         """Create a new ItemList
 
         Note: outside classes shouldn't call this directly.  Instead, they
@@ -77,6 +80,7 @@ class ItemList(itemtrack.ItemTracker):
         :param group_func: initial grouping to use
         :param filters: initial filters
         :param search_text: initial search text
+        :param result_cache: QueryResultCache to share with other lists
         """
         self.tab_type = tab_type
         self.tab_id = tab_id
@@ -93,7 +97,8 @@ class ItemList(itemtrack.ItemTracker):
         self.group_func = group_func
         itemtrack.ItemTracker.__init__(self, call_on_ui_thread,
                                        self._make_query(),
-                                       self._make_item_source())
+                                       self._make_item_source(),
+                                       result_cache=result_cache)
 
     def is_for_device(self):
         return self.tab_type.startswith('device-')
@@ -117,10 +122,22 @@ class ItemList(itemtrack.ItemTracker):
         itemtrack.ItemTracker._fetch_id_list(self)
         self._reset_group_info()
 
+    def _append_ids(self, new_ids):
+        itemtrack.ItemTracker._append_ids(self, new_ids)
+        self._reset_group_info()
+
     def _uncache_row_data(self, id_list):
         itemtrack.ItemTracker._uncache_row_data(self, id_list)
-        # items have changed, so we need to reset all group info
-        self._reset_group_info()
+        # items have changed, so we need to reset all group info calculated
+        # from the row data.  on_item_changes() handles the group index.
+        self.group_info = [ItemList.NOT_CALCULATED] * len(self)
+
+    def on_item_changes(self, message):
+        if (self.group_index is not None and
+            message.changed_columns.intersection(
+                self.group_func.group_attrs)):
+            self.group_index = None
+        itemtrack.ItemTracker.on_item_changes(self, message)
 
     def _make_base_query(self, tab_type, tab_id):
         if self.is_for_device():
@@ -301,6 +318,11 @@ class ItemList(itemtrack.ItemTracker):
         """
         if self.group_func is None:
             raise ValueError("no grouping set")
+        if self.group_index is None and self._can_index_groups():
+            self._calc_group_index()
+        if self.group_index is not None:
+            start, end = self.group_index.group_range(row)
+            return (row-start, end-start, self.get_row(start))
         if self.group_info[row] is ItemList.NOT_CALCULATED:
             self._calc_group_info(row)
         return self.group_info[row]
@@ -327,22 +349,53 @@ class ItemList(itemtrack.ItemTracker):
 
         get_group_info() can be used to find the position of an info inside
         its group.
+
+        Grouping functions made with grouping_from_attrs() are calculated
+        for the whole list at once from the database.  Other functions get
+        called on the rows near the one passed to get_group_info(), which
+        means loading those rows.
         """
         self.group_func = func
         self._reset_group_info()
 
     def _reset_group_info(self):
         self.group_info = [ItemList.NOT_CALCULATED] * len(self)
+        self.group_index = None
+
+    def _can_index_groups(self):
+        return (hasattr(self.group_func, 'group_attrs') and
+                self.item_fetcher is not None)
+
+    def _calc_group_index(self):
+        """Calculate group_index using the group_attrs of our group_func."""
+        try:
+            attr_values = self.item_fetcher.select_attrs(
+                self.group_func.group_attrs)
+        except sqlite3.DatabaseError, e:
+            logging.warn("%s while calculating groups", e, exc_info=True)
+            return
+        key_func = self.group_func.key_func
+        # lots of items have the same values (for example all tracks from an
+        # album), so only calculate the key once for each set of values
+        key_cache = {}
+        keys = []
+        for id_ in self.id_list:
+            values = attr_values.get(id_)
+            if values is None:
+                # item was deleted after we fetched our id list
+                keys.append(None)
+                continue
+            try:
+                key = key_cache[values]
+            except KeyError:
+                key = key_cache[values] = key_func(*values)
+            keys.append(key)
+        self.group_index = GroupIndex(keys)
 
     def _calc_group_info(self, row):
-        # FIXME: for normal item lists, this is fairly fast, but it is slow in
-        # a specific case:
-        #
-        # When the group function returns the same value for many items and
-        # those items need to be loaded.  This actually can happen pretty
-        # easily when you add a bunch of music files to miro, and we haven't
-        # run mutagen on them yet.  In that case, when you first switch to the
-        # music tab, basically all items will be in the same group.
+        # This is used for grouping functions that we can't calculate from
+        # the database.  It's slow if many items have the same group and
+        # need to be loaded.
         key = self.group_func(self.get_row(row))
         if key is None:
             # if group_func returns None, then put this item in a group by
@@ -360,6 +413,40 @@ class ItemList(itemtrack.ItemTracker):
         for row in xrange(start, end+1):
             self.group_info[row] = (row-start, total, self.get_row(start))
 
+class GroupIndex(object):
+    """Group boundaries for all rows in an ItemList.
+
+    We build this by run-length encoding the group keys of the rows.  After
+    that, finding the group for a row doesn't need to look at any other rows.
+    """
+
+    def __init__(self, keys):
+        """Create a GroupIndex
+
+        :param keys: group key for each row.  Adjacent rows with the same key
+        are in the same group, except for rows whose key is None, which are
+        always in a group by themselves.
+        """
+        # group number for each row
+        self.row_groups = []
+        # first row of each group, with the row count added to the end
+        self.group_starts = []
+        last_key = None
+        for row, key in enumerate(keys):
+            if key is None or key != last_key:
+                self.group_starts.append(row)
+            self.row_groups.append(len(self.group_starts) - 1)
+            last_key = key
+        self.group_starts.append(len(keys))
+
+    def group_range(self, row):
+        """Get the rows for the group that contains a row.
+
+        :returns: (start, end) tuple.  end is 1 past the last row
+        """
+        group = self.row_groups[row]
+        return self.group_starts[group], self.group_starts[group+1]
+
 class ItemTrackerUpdater(object):
     """Keep a list of ItemTrackers and call on_item_changes when needed.
 
@@ -372,6 +459,7 @@ class ItemTrackerUpdater(object):
         self.trackers = set()
         self.device_trackers = set()
         self.sharing_trackers = set()
+        self.result_caches = set()
 
     def _set_for_tracker(self, item_tracker):
         source_type_map = {
@@ -390,15 +478,30 @@ class ItemTrackerUpdater(object):
         except KeyError:
             logging.warn("KeyError in ItemTrackerUpdater.remove_tracker")
 
+    def add_result_cache(self, result_cache):
+        """Add a QueryResultCache to update.
+
+        We update result caches before any trackers, so that trackers that
+        refetch their lists don't use out of date results.
+        """
+        self.result_caches.add(result_cache)
+
+    def _update_result_caches(self, message, source_type):
+        for result_cache in self.result_caches:
+            result_cache.on_item_changes(message, source_type)
+
     def on_item_changes(self, message):
+        self._update_result_caches(message, item.ItemSource)
         for tracker in self.trackers:
             tracker.on_item_changes(message)
 
     def on_device_item_changes(self, message):
+        self._update_result_caches(message, item.DeviceItemSource)
         for tracker in self.device_trackers:
             tracker.on_item_changes(message)
 
     def on_sharing_item_changes(self, message):
+        self._update_result_caches(message, item.SharingItemSource)
         for tracker in self.sharing_trackers:
             tracker.on_item_changes(message)
 
@@ -411,10 +514,16 @@ class ItemListPool(object):
     want changes to the item list to be shared.  For example, if a user is
     playing items from a given tab and they change the filters on that tab, we
     want the PlaybackPlaylist to reflect those changes.
+
+    The lists in the pool share a QueryResultCache, so changing the sort or
+    filters of a list, or switching back to a tab, can often skip running
+    the query again.  Add result_cache to the ItemTrackerUpdater so that it
+    gets invalidated when items change.
     """
     def __init__(self):
         self.all_item_lists = set()
         self._refcounts = {}
+        self.result_cache = itemtrack.QueryResultCache()
 
     def get(self, tab_type, tab_id, sort=None, group_func=None, filters=None,
            search_text=None):
@@ -436,7 +545,7 @@ class ItemListPool(object):
                     return obj
         # no existing list found, make new list
         new_list = ItemList(tab_type, tab_id, sort, group_func, filters,
-                            search_text)
+                            search_text, self.result_cache)
         self.all_item_lists.add(new_list)
         app.item_tracker_updater.add_tracker(new_list)
         self._refcounts[new_list] = 1
@@ -470,28 +579,60 @@ class ItemListPool(object):
             app.item_tracker_updater.remove_tracker(item_list)
 
 # grouping functions
-def album_grouping(info):
+def grouping_from_attrs(*attr_names):
+    """Decorator to make a grouping function that only uses some attributes.
+
+    The decorated function inputs the values of those attributes instead of
+    an info.  The grouping function that we return inputs infos like
+    normal, but ItemList can also use it to calculate the groups for the
+    entire list from the database, without loading any rows.
+
+    attr_names should be ItemInfo attributes selected from the item table
+    with a column of the same name, since that's how ItemList decides if an
+    ItemChanges message changed the groups.
+    """
+    def decorator(key_func):
+        def grouping(info):
+            return key_func(*[getattr(info, name) for name in attr_names])
+        grouping.__name__ = key_func.__name__
+        grouping.__doc__ = key_func.__doc__
+        grouping.group_attrs = attr_names
+        grouping.key_func = key_func
+        return grouping
+    return decorator
+
+@grouping_from_attrs('album_artist', 'artist', 'album')
+def album_grouping(album_artist, artist, album):
     """Grouping function that groups infos by albums."""
-    if (info.album_artist_sort_key != (u'',) or
-        info.album_sort_key != (u'',)):
-        return (info.album_artist_sort_key, info.album_sort_key)
+    # this matches ItemInfo.album_artist_sort_key and album_sort_key
+    if album_artist:
+        album_artist_sort_key = util.name_sort_key(album_artist)
+    else:
+        album_artist_sort_key = util.name_sort_key(artist)
+    album_sort_key = util.name_sort_key(album)
+    if (album_artist_sort_key != (u'',) or
+        album_sort_key != (u'',)):
+        return (album_artist_sort_key, album_sort_key)
     else:
         return None
 
-def feed_grouping(info):
+@grouping_from_attrs('feed_id')
+def feed_grouping(feed_id):
     """Grouping function that groups infos by their feed."""
-    return info.feed_id
+    return feed_id
 
-def video_grouping(info):
+@grouping_from_attrs('show', 'parent_title', 'feed_id', 'parent_id')
+def video_grouping(show, parent_title, feed_id, parent_id):
     """Grouping function that groups infos for the videos tab.
 
     For this group, we try to figure out what "show" the item is in.  If the
     user has set a show we use that, otherwise we use the podcast.
 
     """
-    if info.show is not None:
-        return info.show
-    elif info.parent_title is not None:
-        return info.parent_title_for_sort
+    if show is not None:
+        return show
+    elif parent_title is not None:
+        # this matches ItemInfo.parent_title_for_sort
+        return (parent_title, feed_id, parent_id)
     else:
         return None
@@ -335,6 +335,14 @@ class DevMenu(Menu):
     def on_profile_redraw(menu_item):
         app.widgetapp.profile_redraw()
 
+    @menu_item(_("Dump Event Loop Stats"))
+    def on_dump_event_loop_stats(menu_item):
+        app.widgetapp.dump_event_loop_stats()
+
+    @menu_item(_("Dump Query Stats"))
+    def on_dump_query_stats(menu_item):
+        app.widgetapp.dump_query_stats()
+
     class TestIntentionalCrash(StandardError):
         pass
 
@@ -461,6 +469,10 @@ class DevMenu(Menu):
         item_list.emit('will-change')
         item_list.emit('items-changed', changed_ids)
 
+    @menu_item(_("Rebuild Search Index"))
+    def on_rebuild_search_index(menu_item):
+        messages.RebuildSearchIndex().send_to_backend()
+
     @menu_item(_("Force Main DB Save Error"))
     def on_force_device_db_save_error(menu_item):
         messages.ForceDBSaveError().send_to_backend()
@@ -0,0 +1,466 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""futures.py -- Futures and coroutines on top of the event loop.
+
+A Future represents the result of an operation that hasn't finished yet.
+httpclient.grab_url(), eventloop.call_in_thread() and workerprocess.send()
+all return futures.  Futures make it possible to combine several
+operations instead of chaining callbacks by hand::
+
+    @futures.coroutine
+    def update_feeds(urls):
+        results = yield futures.map_bounded(httpclient.grab_url, urls, 8)
+        ...
+        raise futures.Return(len(results))
+
+Futures are not thread-safe.  They should only be used from the event loop
+thread.
+"""
+
+import functools
+import logging
+import types
+
+from miro import trapcall
+
+class CanceledError(StandardError):
+    """A Future was canceled before it finished."""
+    pass
+
+class TimeoutError(StandardError):
+    """A Future didn't finish before the timeout passed to with_timeout()."""
+    pass
+
+class NotDoneError(StandardError):
+    """Tried to get the result of a Future that isn't done yet."""
+    pass
+
+class Return(Exception):
+    """Raise this in a coroutine to set its result.
+
+    (Generators can't use return with a value in python 2.)
+    """
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+PENDING, SUCCESS, FAILURE = range(3)
+
+class Future(object):
+    """Result of an operation that may not have finished yet.
+
+    Use add_callbacks() or add_done_callback() to be notified when it
+    finishes.  Callbacks added after the future is done are called
+    immediately.
+
+    :attribute canceled: True if cancel() was called before the future
+        finished
+    """
+    def __init__(self):
+        self._state = PENDING
+        self._value = None
+        self._done_callbacks = []
+        self.canceled = False
+
+    def __repr__(self):
+        if self._state == PENDING:
+            state = 'pending'
+        elif self.canceled:
+            state = 'canceled'
+        elif self._state == SUCCESS:
+            state = 'success'
+        else:
+            state = 'failure'
+        return '<%s (%s)>' % (self.__class__.__name__, state)
+
+    def done(self):
+        return self._state != PENDING
+
+    def succeeded(self):
+        return self._state == SUCCESS
+
+    def failed(self):
+        return self._state == FAILURE
+
+    def result(self):
+        """Get the result of the future.
+
+        If the operation failed, this raises its error.
+
+        :raises NotDoneError: the future isn't done yet
+        """
+        if self._state == PENDING:
+            raise NotDoneError()
+        elif self._state == FAILURE:
+            raise self._value
+        return self._value
+
+    def error(self):
+        """Get the error for a failed future, or None if it succeeded."""
+        if self._state == PENDING:
+            raise NotDoneError()
+        elif self._state == FAILURE:
+            return self._value
+        return None
+
+    def set_result(self, value):
+        """Finish the future successfully.
+
+        This does nothing if the future was canceled.
+        """
+        self._finish(SUCCESS, value)
+
+    def set_error(self, error):
+        """Finish the future with an error.
+
+        This does nothing if the future was canceled.
+        """
+        self._finish(FAILURE, error)
+
+    def cancel(self):
+        """Cancel the future.
+
+        The future fails with a CanceledError.  Subclasses extend this to
+        stop the underlying operation.
+
+        :returns: True if the future was canceled, False if it was already
+            done
+        """
+        if self._state != PENDING:
+            return False
+        self.canceled = True
+        self._finish(FAILURE, CanceledError())
+        return True
+
+    def _finish(self, state, value):
+        if self._state != PENDING:
+            if not self.canceled:
+                logging.warn("%s finished twice", self)
+            return
+        self._state = state
+        self._value = value
+        callbacks = self._done_callbacks
+        self._done_callbacks = None
+        for func in callbacks:
+            self._run_callback(func)
+
+    def _run_callback(self, func):
+        trapcall.trap_call('future callback: %s' % (func,), func, self)
+
+    def add_done_callback(self, func):
+        """Call func(future) when the future is done.
+
+        func is called for all outcomes: success, errors and cancellation.
+        """
+        if self._state == PENDING:
+            self._done_callbacks.append(func)
+        else:
+            self._run_callback(func)
+
+    def add_callbacks(self, callback, errback=None):
+        """Call callback(result) on success or errback(error) on failure.
+
+        If errback is None, errors are logged and otherwise ignored.
+        """
+        def on_done(future):
+            if future._state == SUCCESS:
+                callback(future._value)
+            elif errback is not None:
+                errback(future._value)
+            elif not future.canceled:
+                logging.warn("Unhandled error in %s: %s", future,
+                             future._value)
+        self.add_done_callback(on_done)
+
+    def chain(self, other):
+        """Finish other with the same result as this future."""
+        def on_done(future):
+            if future._state == SUCCESS:
+                other.set_result(future._value)
+            else:
+                other.set_error(future._value)
+        self.add_done_callback(on_done)
+
+def succeed(value=None):
+    """Get a Future that has already succeeded."""
+    future = Future()
+    future.set_result(value)
+    return future
+
+def fail(error):
+    """Get a Future that has already failed."""
+    future = Future()
+    future.set_error(error)
+    return future
+
+def _cancel_all(futures):
+    for future in futures:
+        future.cancel()
+
+def _cancel_with(outer, inner_futures):
+    """Cancel inner_futures if outer gets canceled."""
+    def on_done(future):
+        if future.canceled:
+            _cancel_all(inner_futures)
+    outer.add_done_callback(on_done)
+
+def gather(futures):
+    """Wait for several futures to finish.
+
+    :returns: a Future for the list of results, in the same order as
+        futures.  If any of them fails, the returned future fails with the
+        same error and the rest get canceled.
+    """
+    futures = list(futures)
+    outer = Future()
+    if not futures:
+        outer.set_result([])
+        return outer
+    results = [None] * len(futures)
+    # use a list so the closures can change the count
+    remaining = [len(futures)]
+    def make_callback(index):
+        def on_done(future):
+            if outer.done():
+                return
+            if future.failed():
+                outer.set_error(future.error())
+                _cancel_all(futures)
+                return
+            results[index] = future.result()
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                outer.set_result(results)
+        return on_done
+    _cancel_with(outer, futures)
+    for index, future in enumerate(futures):
+        future.add_done_callback(make_callback(index))
+    return outer
+
+def race(futures):
+    """Wait for the first of several futures to finish.
+
+    :returns: a Future that finishes with the same outcome as the first
+        future to finish.  The rest of the futures get canceled.
+    """
+    futures = list(futures)
+    if not futures:
+        raise ValueError("race() needs at least 1 future")
+    outer = Future()
+    def on_done(future):
+        if outer.done():
+            return
+        future.chain(outer)
+        _cancel_all(futures)
+    _cancel_with(outer, futures)
+    for future in futures:
+        future.add_done_callback(on_done)
+    return outer
+
+def with_timeout(future, timeout):
+    """Fail with a TimeoutError if a future takes too long.
+
+    :param timeout: seconds to wait
+    :returns: a Future that finishes with the same outcome as future, or
+        fails with TimeoutError after timeout seconds.  On a timeout, future
+        gets canceled.
+    """
+    from miro import eventloop
+    outer = Future()
+    def on_timeout():
+        if not outer.done():
+            outer.set_error(TimeoutError())
+            future.cancel()
+    dc = eventloop.add_timeout(timeout, on_timeout, 'future timeout')
+    def on_done(f):
+        dc.cancel()
+        if not outer.done():
+            f.chain(outer)
+    future.add_done_callback(on_done)
+    _cancel_with(outer, [future])
+    return outer
+
+def map_bounded(func, items, concurrency):
+    """Call func(item) for a list of items, with a limit on how many calls
+    are in progress at once.
+
+    :param func: function that takes an item and returns a Future
+    :param items: iterable of items
+    :param concurrency: max number of futures to have pending at once
+    :returns: a Future for the list of results, in the same order as items.
+        If any call fails, the returned future fails with the same error,
+        pending calls get canceled, and the rest of the items are skipped.
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+    items = list(items)
+    outer = Future()
+    results = [None] * len(items)
+    pending = {}
+    # use lists so the closures can change these
+    next_index = [0]
+    finished_count = [0]
+    starting = [False]
+
+    def start_calls():
+        # If func returns a future that's already done, add_done_callback()
+        # calls on_done() right away, which calls us again.  Let the loop
+        # that's already running start the next call instead of recursing.
+        if starting[0]:
+            return
+        starting[0] = True
+        try:
+            while (len(pending) < concurrency and
+                   next_index[0] < len(items) and not outer.done()):
+                index = next_index[0]
+                next_index[0] += 1
+                try:
+                    future = func(items[index])
+                except StandardError, e:
+                    outer.set_error(e)
+                    _cancel_all(pending.values())
+                    return
+                pending[index] = future
+                future.add_done_callback(make_callback(index))
+        finally:
+            starting[0] = False
+
+    def make_callback(index):
+        def on_done(future):
+            del pending[index]
+            if outer.done():
+                return
+            if future.failed():
+                outer.set_error(future.error())
+                _cancel_all(pending.values())
+                return
+            results[index] = future.result()
+            finished_count[0] += 1
+            if finished_count[0] == len(items):
+                outer.set_result(results)
+            else:
+                start_calls()
+        return on_done
+
+    def on_outer_done(future):
+        if future.canceled:
+            _cancel_all(pending.values())
+    outer.add_done_callback(on_outer_done)
+    if not items:
+        outer.set_result([])
+    else:
+        start_calls()
+    return outer
+
+def coroutine(func):
+    """Decorator that turns a generator function into a coroutine.
+
+    The generator yields futures (or lists of futures, which get passed to
+    gather()).  When the future is done, the generator resumes with its
+    result, or has its error raised at the yield statement.  Raise Return
+    to set the coroutine's result.
+
+    Calling the decorated function starts the coroutine and returns a
+    Future for its result.  Canceling that future cancels the future that
+    the coroutine is waiting on and closes the generator.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        outer = Future()
+        try:
+            gen = func(*args, **kwargs)
+        except Return, r:
+            outer.set_result(r.value)
+            return outer
+        except StandardError, e:
+            outer.set_error(e)
+            return outer
+        if not isinstance(gen, types.GeneratorType):
+            outer.set_result(gen)
+            return outer
+        _CoroutineRunner(gen, outer).run(None, None)
+        return outer
+    return wrapper
+
+class _CoroutineRunner(object):
+    def __init__(self, gen, outer):
+        self.gen = gen
+        self.outer = outer
+        self.waiting_on = None
+        outer.add_done_callback(self.on_outer_done)
+
+    def on_outer_done(self, outer):
+        if outer.canceled:
+            if self.waiting_on is not None:
+                self.waiting_on.cancel()
+                self.waiting_on = None
+            self.gen.close()
+
+    def run(self, value, error):
+        # loop instead of recursing for futures that are already done
+        while not self.outer.done():
+            try:
+                if error is not None:
+                    yielded = self.gen.throw(error)
+                else:
+                    yielded = self.gen.send(value)
+            except StopIteration:
+                self.outer.set_result(None)
+                return
+            except Return, r:
+                self.outer.set_result(r.value)
+                return
+            except StandardError, e:
+                self.outer.set_error(e)
+                return
+            if isinstance(yielded, (list, tuple)):
+                yielded = gather(yielded)
+            if not isinstance(yielded, Future):
+                value = None
+                error = TypeError("coroutine yielded %r, not a Future" %
+                                  (yielded,))
+                continue
+            if not yielded.done():
+                self.waiting_on = yielded
+                yielded.add_done_callback(self.on_yielded_done)
+                return
+            value, error = self._outcome(yielded)
+
+    def on_yielded_done(self, future):
+        if future is not self.waiting_on:
+            return
+        self.waiting_on = None
+        self.run(*self._outcome(future))
+
+    def _outcome(self, future):
+        if future.succeeded():
+            return future.result(), None
+        else:
+            return None, future.error()
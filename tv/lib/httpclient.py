@@ -49,11 +49,13 @@ from miro import app
 from miro import download_utils
 from miro import eventloop
 from miro import fileutil
+from miro import futures
 from miro import httpauth
 from miro import net
 from miro import prefs
 from miro import signals
 from miro import util
+from miro.clock import clock
 from miro.gtcache import gettext as _
 from miro.xhtmltools import url_encode_dict, multipart_encode
 from miro.plat import utils
@@ -880,11 +882,18 @@ class LibCURLManager(eventloop.SimpleEventLoop):
       - Runs a thread for pycurl to use
       - Manages the libcurl multi object
       - Handles adding/removing CurlTransfers objects
+
+    We use libcurl's socket interface, so libcurl tells us which sockets to
+    watch and we register them with our poller.  This avoids calling
+    curl_multi_fdset() which is limited to FD_SETSIZE sockets.
     """
 
     def __init__(self):
         eventloop.SimpleEventLoop.__init__(self)
         self.multi = pycurl.CurlMulti()
+        self.multi.setopt(pycurl.M_SOCKETFUNCTION, self.on_socket_change)
+        self.multi.setopt(pycurl.M_TIMERFUNCTION, self.on_timer_change)
+        self.timer_deadline = None
         self.transfer_map = {}
         self.transfers_to_add = Queue.Queue()
         self.transfers_to_remove = Queue.Queue()
@@ -907,6 +916,7 @@ class LibCURLManager(eventloop.SimpleEventLoop):
             self.multi.remove_handle(transfer.handle)
             transfer.handle.close()
         self.multi.close()
+        self.poller.close()
 
     def add_transfer(self, transfer):
         self.transfers_to_add.put(transfer)
@@ -919,30 +929,66 @@ class LibCURLManager(eventloop.SimpleEventLoop):
     def call_after_perform(self, callback):
         self.after_perform_callbacks.append(callback)
 
-    def calc_fds(self):
-        return self.multi.fdset()
+    def on_socket_change(self, what, fd, multi, socketp):
+        """Called by libcurl when it wants us to change how we watch a
+        socket.
+        """
+        if what == pycurl.POLL_REMOVE:
+            self.poller.unregister(fd)
+            return
+        events = 0
+        if what & pycurl.POLL_IN:
+            events |= eventloop.POLL_READ
+        if what & pycurl.POLL_OUT:
+            events |= eventloop.POLL_WRITE
+        self.poller.register(fd, events)
+
+    def on_timer_change(self, timeout_ms):
+        """Called by libcurl when it wants us to change the timeout."""
+        if timeout_ms < 0:
+            self.timer_deadline = None
+        else:
+            self.timer_deadline = clock() + timeout_ms / 1000.0
 
     def calc_timeout(self):
-        timeout = self.multi.timeout()
-        if timeout < 0:
+        if self.timer_deadline is None:
             # libcurl documentation says this means to wait "not too long"
             # Let's try 2 seconds
             return 2.0
         else:
-            return timeout / 1000.0
+            return max(0, self.timer_deadline - clock())
 
     def process_events(self, readfds, writefds, excfds):
         self.process_queues()
+        actions = {}
+        for fd in readfds:
+            actions[fd] = pycurl.CSELECT_IN
+        for fd in writefds:
+            actions[fd] = actions.get(fd, 0) | pycurl.CSELECT_OUT
+        for fd in excfds:
+            actions[fd] = actions.get(fd, 0) | pycurl.CSELECT_ERR
+        for fd, ev_bitmask in actions.iteritems():
+            self.socket_action(fd, ev_bitmask)
+        if (self.timer_deadline is not None and
+                self.timer_deadline <= clock()):
+            self.timer_deadline = None
+            self.socket_action(pycurl.SOCKET_TIMEOUT, 0)
+        self.update_stats()
+        self.run_after_perform_callbacks()
+        self.process_queues()
+        self.check_finished()
+
+    def socket_action(self, fd, ev_bitmask):
         while True:
-            rv, num_handles = self.multi.perform()
-            self.update_stats()
-            for callback in self.after_perform_callbacks:
-                trap_call('after perform callback', callback)
-            self.after_perform_callbacks = []
+            rv, num_handles = self.multi.socket_action(fd, ev_bitmask)
             if rv != pycurl.E_CALL_MULTI_PERFORM:
                 break
-        self.process_queues()
-        self.check_finished()
+
+    def run_after_perform_callbacks(self):
+        callbacks = self.after_perform_callbacks
+        self.after_perform_callbacks = []
+        for callback in callbacks:
+            trap_call('after perform callback', callback)
 
     def update_stats(self):
         for transfer in self.transfer_map.values():
@@ -961,6 +1007,8 @@ class LibCURLManager(eventloop.SimpleEventLoop):
                 continue
             self.transfer_map[transfer.handle] = transfer
             self.multi.add_handle(transfer.handle)
+            # make sure libcurl gets a chance to start the transfer
+            self.timer_deadline = clock()
 
         while True:
             try:
@@ -992,18 +1040,45 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         self.multi.remove_handle(handle)
         return transfer
 
-class HTTPClient(object):
+class HTTPClient(futures.Future):
     """HTTP client for a grab_url call.
 
     Most of the work for grab_url() happens in the lib curl thread.  This
     class provides an interface for code in the eventloop (and other threads)
     to use.
+
+    HTTPClient is also a Future for the info dict that grab_url() passes to
+    its callback.
     """
-    def __init__(self, transfer):
+    def __init__(self, transfer=None):
+        futures.Future.__init__(self)
         self.transfer = transfer
 
+    def wrap_callbacks(self, callback, errback):
+        """Wrap a callback/errback pair so that they also finish this
+        future.
+
+        callback and errback can be None.  They won't be called if the
+        client gets canceled.
+        """
+        def callback_wrapper(info):
+            if self.canceled:
+                return
+            self.set_result(info)
+            if callback is not None:
+                callback(info)
+        def errback_wrapper(error):
+            if self.canceled:
+                return
+            self.set_error(error)
+            if errback is not None:
+                errback(error)
+        return callback_wrapper, errback_wrapper
+
     def cancel(self, remove_file=False):
-        self.transfer.cancel(remove_file)
+        if self.transfer is not None:
+            self.transfer.cancel(remove_file)
+        return futures.Future.cancel(self)
 
     def get_stats(self):
         """Get the current download/upload stats
@@ -1021,7 +1096,7 @@ def sanitize_url(url):
     """
     return urllib.quote(url, safe="-_.!~*'();/?:@&=+$,%#")
 
-def grab_url(url, callback, errback, header_callback=None,
+def grab_url(url, callback=None, errback=None, header_callback=None,
         content_check_callback=None, write_file=None, etag=None, modified=None,
         default_mime_type=None, resume=False, post_vars=None,
         post_files=None, extra_headers=None):
@@ -1030,8 +1105,8 @@ def grab_url(url, callback, errback, header_callback=None,
     grab_url is a simple interface to the HTTPClient class.
 
     :param url: URL to download
-    :param callback: function to call on success
-    :param errback: function to call on error
+    :param callback: function to call on success, or None
+    :param errback: function to call on error, or None
     :param header_callback: function to call after we recieve the headers
     :param content_check_callback: function to call as we recieve content data
         return False to cancel the transfer.  Note: this function runs in the
@@ -1062,18 +1137,21 @@ def grab_url(url, callback, errback, header_callback=None,
         'filename': Name of the file that we should use to save the data
         'charset': Charset encoding of the data
 
-    :returns HTTPClient object
+    :returns HTTPClient object.  This is also a Future for the info dict
+        passed to callback.
     """
     url = sanitize_url(url)
+    client = HTTPClient()
+    callback, errback = client.wrap_callbacks(callback, errback)
     if url.startswith("file://"):
-        return _grab_file_url(url, callback, errback, default_mime_type)
+        _grab_file_url(url, callback, errback, default_mime_type)
     else:
         options = TransferOptions(url, etag, modified, resume, post_vars,
                 post_files, write_file, extra_headers)
-        transfer = CurlTransfer(options, callback, errback, header_callback,
-                content_check_callback)
-        transfer.start()
-        return HTTPClient(transfer)
+        client.transfer = CurlTransfer(options, callback, errback,
+                header_callback, content_check_callback)
+        client.transfer.start()
+    return client
 
 def _grab_file_url(url, callback, errback, default_mime_type):
     path = download_utils.get_file_url_path(url)
@@ -1097,27 +1175,34 @@ def _grab_file_url(url, callback, errback, default_mime_type):
             eventloop.add_idle(callback, 'grab file url callback',
                     args=(info,))
 
-def _grab_headers_using_get(url, callback, errback):
+def _grab_headers_using_get(client, url, callback, errback):
     options = TransferOptions(url)
     options._cancel_on_body_data = True
-    transfer = CurlTransfer(options, callback, errback)
-    transfer.start()
-    return HTTPClient(transfer)
+    client.transfer = CurlTransfer(options, callback, errback)
+    client.transfer.start()
+
+def grab_headers(url, callback=None, errback=None):
+    """Quickly get the headers for a URL
 
-def grab_headers(url, callback, errback):
-    """Quickly get the headers for a URL"""
+    :returns HTTPClient object.  This is also a Future for the info dict
+        passed to callback.
+    """
+    client = HTTPClient()
+    callback, errback = client.wrap_callbacks(callback, errback)
     def errback_intercept(error):
         if isinstance(error, AuthorizationCanceled):
             # don't bother asking again
             return errback(error)
-        _grab_headers_using_get(url, callback, errback)
+        if client.canceled:
+            return
+        _grab_headers_using_get(client, url, callback, errback)
 
     url = sanitize_url(url)
     options = TransferOptions(url)
     options.head_request = True
-    transfer = CurlTransfer(options, callback, errback_intercept)
-    transfer.start()
-    return HTTPClient(transfer)
+    client.transfer = CurlTransfer(options, callback, errback_intercept)
+    client.transfer.start()
+    return client
 
 def init_libcurl():
     pycurl.global_init(pycurl.GLOBAL_ALL)
@@ -97,6 +97,8 @@ class IconCacheUpdater:
         self.in_shutdown = True
 
 class IconCache(DDBObject):
+    cache_evictable = True
+
     def setup_new(self, dbItem):
         self.etag = None
         self.modified = None
@@ -314,6 +316,10 @@ class IconCache(DDBObject):
         self.updating = False
         self.needsUpdate = False
 
+    def can_evict(self):
+        return (not (self.updating or self.needsUpdate) and
+                DDBObject.can_evict(self))
+
     def is_valid(self):
         self.dbItem.confirm_db_thread()
         return self.filename and fileutil.exists(self.filename)
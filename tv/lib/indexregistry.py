@@ -0,0 +1,166 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.indexregistry`` -- Indexes derived from how we query tables.
+
+Rather than deciding which indexes to create by hand, object schemas list
+their access patterns in ``access_patterns``.  We derive an index for each
+pattern, skip the ones that an existing index already handles, and
+sync_indexes() creates or drops indexes so that the database matches.  It
+runs whenever we open a database for upgrading, so adding or removing a
+pattern doesn't require an upgrade function.
+
+Indexes that we manage are named with MANAGED_PREFIX.  Indexes from the
+schema's ``indexes`` and ``unique_indexes`` are never touched.
+"""
+
+import logging
+
+from miro import queryprofile
+
+MANAGED_PREFIX = 'auto_'
+
+class AccessPattern(object):
+    """Describes a way that we query a table.
+
+    The derived index uses the equality columns first, then the order_by
+    columns, then the include columns.  Columns tested with IS NULL count as
+    equality columns.  include columns make the index cover the query, so
+    SQLite doesn't need to read the table rows.
+
+    :param name: describes the query, for example the view that runs it
+    :param equality: columns that we test for a single value
+    :param order_by: columns that we sort or do range checks on
+    :param include: other columns that the query reads
+    """
+    def __init__(self, name, equality=(), order_by=(), include=()):
+        self.name = name
+        self.equality = tuple(equality)
+        self.order_by = tuple(order_by)
+        self.include = tuple(include)
+
+    def index_columns(self):
+        return self.equality + self.order_by + self.include
+
+    def __repr__(self):
+        return '<AccessPattern %s: %s>' % (self.name,
+                                           ', '.join(self.index_columns()))
+
+def index_name(table_name, columns):
+    return '%s%s_%s' % (MANAGED_PREFIX, table_name, '_'.join(columns))
+
+def _is_prefix(columns, other_columns):
+    return (len(columns) <= len(other_columns) and
+            tuple(other_columns[:len(columns)]) == tuple(columns))
+
+def managed_indexes(oschema):
+    """Get the indexes to create for an object schema's access patterns.
+
+    An index is skipped if its columns are a prefix of another index,
+    since SQLite can use the longer index for the same lookups.
+
+    :returns: list of (name, columns) tuples
+    """
+    existing = [tuple(columns) for name, columns in
+                tuple(oschema.indexes) + tuple(oschema.unique_indexes)]
+    candidates = []
+    for pattern in getattr(oschema, 'access_patterns', ()):
+        columns = pattern.index_columns()
+        if not columns or columns[0] == 'id':
+            # id is the primary key, no need for an index
+            continue
+        if columns not in candidates:
+            candidates.append(columns)
+    rv = []
+    for columns in candidates:
+        others = existing + [c for c in candidates if c != columns]
+        if not [other for other in others if _is_prefix(columns, other)]:
+            rv.append((index_name(oschema.table_name, columns), columns))
+    return rv
+
+def sync_indexes(cursor, object_schemas):
+    """Create and drop managed indexes to match our access patterns.
+
+    :returns: (created, dropped) tuple of index name lists
+    """
+    created = []
+    dropped = []
+    for oschema in object_schemas:
+        wanted = dict(managed_indexes(oschema))
+        cursor.execute("SELECT name FROM sqlite_master "
+                       "WHERE type='index' AND tbl_name=?",
+                       (oschema.table_name,))
+        existing = set(row[0] for row in cursor.fetchall())
+        for name in sorted(existing):
+            if name.startswith(MANAGED_PREFIX) and name not in wanted:
+                cursor.execute("DROP INDEX %s" % name)
+                dropped.append(name)
+        for name, columns in sorted(wanted.items()):
+            if name not in existing:
+                cursor.execute("CREATE INDEX %s ON %s (%s)" %
+                               (name, oschema.table_name, ', '.join(columns)))
+                created.append(name)
+    if created or dropped:
+        logging.info("sync_indexes: created %s, dropped %s", created,
+                     dropped)
+    return created, dropped
+
+def find_full_scans(cursor, queries, tables=None):
+    """Check queries for full table scans.
+
+    This is meant to be run against a database with realistic data that has
+    been ANALYZEd, since SQLite's query planner uses the table statistics.
+
+    :param cursor: cursor for the database
+    :param queries: list of (name, sql, values) tuples
+    :param tables: only report scans of these tables.  None reports all
+        tables.
+    :returns: list of (name, sql, plan) tuples for queries that do a full
+        table scan.  plan is a list of EXPLAIN QUERY PLAN details.
+    """
+    rv = []
+    for name, sql, values in queries:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, values)
+        plan = [row[-1] for row in cursor.fetchall()]
+        scanned = queryprofile.full_scan_tables(plan)
+        if tables is not None:
+            scanned = [t for t in scanned if t in tables]
+        if scanned:
+            rv.append((name, sql, plan))
+    return rv
+
+def format_full_scans(full_scans):
+    """Format the results of find_full_scans() as a human-readable string."""
+    lines = ['%d queries do full table scans' % len(full_scans), '']
+    for name, sql, plan in full_scans:
+        lines.append(name)
+        lines.append('    %s' % ' '.join(sql.split()))
+        for detail in plan:
+            lines.append('        %s' % detail)
+    return '\n'.join(lines)
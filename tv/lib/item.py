@@ -381,6 +381,210 @@ class _ItemsForPathCountTracker(object):
         except AttributeError:
             return # counts not created yet we can just ignore
 
+# SQL for items that count as downloaded for their feed.  Needs
+# remote_downloader joined as rd.
+_DOWNLOADED_SQL = ("(is_file_item OR rd.state in ('finished', 'uploading', "
+                   "'uploading-paused'))")
+_DOWNLOADED_STATES = ('finished', 'uploading', 'uploading-paused')
+_DOWNLOADING_STATES = ('downloading', 'uploading')
+
+class _FeedCountTracker(object):
+    """Helps Feed implement num_downloaded(), num_unwatched(), etc.
+
+    This class keeps per-feed item counts in memory.  We get the initial
+    counts for all feeds with one query, then update them as items get
+    inserted, changed and removed.  For each item that changes, we remember
+    what it's counted as so that we can subtract it when it changes again.
+    If we don't know that yet, we look it up in the database, which still
+    has the old values at that point.  Until someone asks for the counts, we
+    don't track anything.
+
+    verify() checks our counts against the database.
+    """
+
+    # names for the counts in the lists that get_counts() returns.
+    # auto_eligible is items that are eligible for auto-download and not
+    # downloaded yet.
+    COUNT_NAMES = ('downloaded', 'downloading', 'new', 'auto_eligible',
+                   'not_downloaded', 'unwatched')
+
+    # Keep these in sync with the feed_*_view() methods in Item and with
+    # _calc_flags()
+    _COLUMNS_SQL = ', '.join(
+        'SUM(CASE WHEN %s THEN 1 ELSE 0 END)' % expr for expr in (
+            _DOWNLOADED_SQL,
+            "rd.state in ('downloading', 'uploading') AND "
+            "rd.main_item_id=item.id",
+            "item.new",
+            "NOT item.was_downloaded AND item.eligible_for_autodownload",
+            "NOT item.was_downloaded",
+            "item.watched_time IS NULL AND "
+            "item.file_type in ('audio', 'video') AND %s" % _DOWNLOADED_SQL,
+        ))
+    _FROM_SQL = ("FROM item "
+                 "LEFT JOIN remote_downloader AS rd "
+                 "ON item.downloader_id=rd.id ")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # maps feed_id -> list of counts.  None until we run our first query
+        self.counts = None
+        # maps item id -> (feed_id, flags) for items that we've seen change
+        self.contributions = {}
+        self.db = None
+
+    def _check_db(self):
+        # start fresh if we switched to a new database (mostly for the unit
+        # tests)
+        if self.db is not app.db:
+            self.reset()
+            self.db = app.db
+
+    def _query_counts(self):
+        rows = app.db.execute("SELECT item.feed_id, %s %s"
+                              "WHERE item.feed_id IS NOT NULL "
+                              "GROUP BY item.feed_id" %
+                              (self._COLUMNS_SQL, self._FROM_SQL))
+        return dict((row[0], list(row[1:])) for row in rows)
+
+    def _query_contribution(self, item_id):
+        rows = app.db.execute("SELECT item.feed_id, %s %s"
+                              "WHERE item.id=? GROUP BY item.feed_id" %
+                              (self._COLUMNS_SQL, self._FROM_SQL),
+                              (item_id,))
+        if not rows or rows[0][0] is None:
+            return None
+        return (rows[0][0], tuple(rows[0][1:]))
+
+    def get_counts(self, feed_id):
+        """Get the counts for a feed.
+
+        :returns: list of counts, in the same order as COUNT_NAMES
+        """
+        self._check_db()
+        if self.counts is None:
+            self.counts = self._query_counts()
+            self.contributions = {}
+        try:
+            return self.counts[feed_id]
+        except KeyError:
+            counts = self.counts[feed_id] = [0] * len(self.COUNT_NAMES)
+            return counts
+
+    def _calc_contribution(self, item):
+        if item.feed_id is None:
+            return None
+        dler = item.downloader
+        if dler is not None:
+            state = dler.state
+        else:
+            state = None
+        downloaded = bool(item.is_file_item or state in _DOWNLOADED_STATES)
+        downloading = (state in _DOWNLOADING_STATES and
+                       dler.main_item_id == item.id)
+        not_downloaded = not item.was_downloaded
+        unwatched = (item.watched_time is None and
+                     item.file_type in ('audio', 'video') and downloaded)
+        return (item.feed_id, (
+            int(downloaded),
+            int(downloading),
+            int(bool(item.new)),
+            int(not_downloaded and bool(item.eligible_for_autodownload)),
+            int(not_downloaded),
+            int(unwatched),
+        ))
+
+    def _apply(self, contribution, sign):
+        if contribution is None or self.counts is None:
+            return
+        feed_id, flags = contribution
+        try:
+            counts = self.counts[feed_id]
+        except KeyError:
+            counts = self.counts[feed_id] = [0] * len(self.COUNT_NAMES)
+        for i, flag in enumerate(flags):
+            counts[i] += sign * flag
+
+    def remember_contribution(self, item):
+        """Make sure we know what an item is counted as.
+
+        Call this before an item changes in the database.
+        """
+        self._check_db()
+        if self.counts is None:
+            return
+        if (item.id not in self.contributions and
+                not item.db_info.bulk_sql_manager.will_insert(item.id)):
+            self.contributions[item.id] = self._query_contribution(item.id)
+
+    def item_inserted(self, item):
+        self._check_db()
+        if self.counts is None:
+            return
+        contribution = self._calc_contribution(item)
+        self.contributions[item.id] = contribution
+        self._apply(contribution, 1)
+
+    def item_changed(self, item):
+        self._check_db()
+        if (self.counts is None or
+                item.db_info.bulk_sql_manager.will_insert(item.id)):
+            # Either we're not tracking counts yet, or item_inserted() will
+            # count the item once it's in the database.
+            return
+        self.remember_contribution(item)
+        new_contribution = self._calc_contribution(item)
+        old_contribution = self.contributions[item.id]
+        if new_contribution != old_contribution:
+            self._apply(old_contribution, -1)
+            self._apply(new_contribution, 1)
+            self.contributions[item.id] = new_contribution
+
+    def item_removed(self, item):
+        self._check_db()
+        if self.counts is None:
+            return
+        try:
+            contribution = self.contributions.pop(item.id)
+        except KeyError:
+            # remember_contribution() wasn't called.  Requery all counts
+            # the next time someone needs them.
+            self.counts = None
+        else:
+            self._apply(contribution, -1)
+
+    def verify(self):
+        """Check our counts against the database.
+
+        Counts that don't match get logged and replaced with the database
+        values.
+
+        :returns: list of feed ids with counts that didn't match
+        """
+        self._check_db()
+        if self.counts is None:
+            return []
+        db_counts = self._query_counts()
+        mismatched = []
+        for feed_id, counts in self.counts.items():
+            correct = db_counts.get(feed_id, [0] * len(self.COUNT_NAMES))
+            if counts != correct:
+                logging.warn("feed counts for %s are wrong: %s (should be "
+                             "%s)", feed_id, counts, correct)
+                self.counts[feed_id] = correct
+                mismatched.append(feed_id)
+        for feed_id, correct in db_counts.items():
+            if feed_id not in self.counts:
+                self.counts[feed_id] = correct
+                if correct != [0] * len(self.COUNT_NAMES):
+                    mismatched.append(feed_id)
+        if mismatched:
+            # we don't know which items are off, so start over with those
+            self.contributions = {}
+        return mismatched
+
 class ItemChangeTracker(signals.SignalEmitter):
     """Tracks changes to items and send the ItemChanges message."""
     def __init__(self):
@@ -400,6 +604,12 @@ class ItemChangeTracker(signals.SignalEmitter):
         self.playlists_changed = False
 
     def after_event_finished(self, event_loop, success):
+        # With group commit, the database may still be holding our changes.
+        # The frontend reads items using its own connections, so wait until
+        # they're committed.  The group commit timeout runs as an event, so
+        # we'll get called again after that.
+        if app.db is not None and app.db.commit_pending():
+            return
         self.send_changes()
 
     def send_changes(self):
@@ -484,6 +694,7 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
     """
 
     ICON_CACHE_VITAL = False
+    cache_evictable = True
 
     # tweaked by the unittests to make things easier
     _allow_nonexistent_paths = False
@@ -533,6 +744,7 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         self._look_for_downloader()
         self._calc_parent_title()
         self.setup_common()
+        Item._path_count_tracker.add_item(self)
         self.split_item()
 
     def setup_restored(self):
@@ -546,19 +758,35 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
             app.local_metadata_manager.add_file(self.filename)
 
     def setup_common(self):
+        # Note: restored items are already counted by _path_count_tracker,
+        # since it gets its initial counts from the database.
         self.selected = False
         self.active = False
         self.expiring = None
         self.showMoreInfo = False
         self.playing = False
-        Item._path_count_tracker.add_item(self)
+
+    def can_evict(self):
+        return (not (self.selected or self.active or self.showMoreInfo or
+                     self.playing) and
+                MetadataItemBase.can_evict(self))
 
     def signal_change(self, needs_save=True, can_change_views=True):
         if ('torrent_title' in self.changed_attributes or
             'metadata_title' in self.changed_attributes):
             self.calc_title()
+        if not self.in_db_init:
+            Item._feed_count_tracker.item_changed(self)
         ItemBase.signal_change(self, needs_save, can_change_views)
 
+    def on_db_insert(self):
+        MetadataItemBase.on_db_insert(self)
+        Item._feed_count_tracker.item_inserted(self)
+
+    def removed_from_db(self):
+        Item._feed_count_tracker.item_removed(self)
+        MetadataItemBase.removed_from_db(self)
+
     def playlists_changed(self, added=False):
         """Called when the item gets added/removed from playlists."""
         Item.change_tracker.playlists_changed = True
@@ -574,6 +802,12 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         """Called when a playlist gets reordered."""
         Item.change_tracker.playlists_changed = True
 
+    def download_stats_will_change(self):
+        """Called before our downloader saves changes to the database."""
+        # our feed counts depend on the downloader state, so make sure that
+        # we know them before the old state is gone.
+        Item._feed_count_tracker.remember_contribution(self)
+
     def download_stats_changed(self):
         Item.change_tracker.dlstats_changed = True
         # TODO: I don't think we need the signal_change() call here once we
@@ -757,9 +991,7 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
 
     @classmethod
     def feed_downloaded_view(cls, feed_id):
-        return cls.make_view("feed_id=? AND "
-                "(is_file_item OR rd.state in ('finished', 'uploading', "
-                "'uploading-paused'))",
+        return cls.make_view("feed_id=? AND %s" % _DOWNLOADED_SQL,
                 (feed_id,),
                 joins={'remote_downloader AS rd': 'item.downloader_id=rd.id'})
 
@@ -786,9 +1018,7 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
     @classmethod
     def feed_unwatched_view(cls, feed_id):
         return cls.make_view("feed_id=? AND item.watched_time IS NULL AND "
-                "file_type in ('audio', 'video') AND "
-                "(is_file_item OR rd.state in ('finished', 'uploading', "
-                "'uploading-paused'))",
+                "file_type in ('audio', 'video') AND %s" % _DOWNLOADED_SQL,
                 (feed_id,),
                 joins={'remote_downloader AS rd': 'item.downloader_id=rd.id'})
 
@@ -939,6 +1169,17 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         return cls.make_view("downloader_id=?", (dler_id,))
 
     _path_count_tracker = _ItemsForPathCountTracker()
+    _feed_count_tracker = _FeedCountTracker()
+
+    @classmethod
+    def feed_counts(cls, feed_id):
+        """Get item counts for a feed without running a query.
+
+        :returns: dict mapping the names in _FeedCountTracker.COUNT_NAMES to
+            counts
+        """
+        counts = Item._feed_count_tracker.get_counts(feed_id)
+        return dict(zip(_FeedCountTracker.COUNT_NAMES, counts))
 
     @classmethod
     def have_item_for_path(cls, path):
@@ -984,7 +1225,7 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
                 offset_path = offset_path[1:]
             FileItem(path, parent_id=self.id, offset_path=offset_path)
 
-    @eventloop.idle_iterator
+    @eventloop.idle_iterator(lane=eventloop.LANE_BACKGROUND)
     def find_new_children(self, callback=None):
         """If this feed is a container item, walk through its
         directory and find any new children.  You may specify a callback
@@ -2087,6 +2328,7 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
 
     def remove(self):
         Item._path_count_tracker.remove_item(self)
+        Item._feed_count_tracker.remember_contribution(self)
         if self.has_downloader():
             self.set_downloader(None)
         self.remove_icon_cache()
@@ -2428,12 +2670,18 @@ class DeletedFileChecker(object):
     def __init__(self):
         # track items that we should call check_deleted for
         self.items_to_check = set()
+        # track ids that we've already checked.  Items can be restored more
+        # than once if LiveStorage evicts them, but we only need to check
+        # each one once.
+        self.checked_ids = set()
         # track if we have run_checks() scheduled as an idle callback
         self.check_scheduled = False
         # track if we should be checking yet
         self.started = False
 
     def schedule_check(self, item):
+        if item.id in self.checked_ids:
+            return
         self.items_to_check.add(item)
         self._ensure_run_checks_scheduled()
 
@@ -2472,6 +2720,7 @@ class DeletedFileChecker(object):
         app.bulk_sql_manager.start()
         try:
             for item in items_this_pass:
+                self.checked_ids.add(item.id)
                 if item.id_exists():
                     item.check_deleted()
         finally:
@@ -2829,6 +3078,17 @@ def setup_metadata_manager(cover_art_dir=None, screenshot_dir=None):
         cover_art_dir, screenshot_dir)
     app.local_metadata_manager.connect('new-metadata', on_new_metadata)
 
+FEED_COUNT_CHECK_INTERVAL = 3600
+
+def verify_feed_counts():
+    """Check that the feed counts we keep in memory match the database.
+
+    This runs every FEED_COUNT_CHECK_INTERVAL seconds.
+    """
+    Item._feed_count_tracker.verify()
+    eventloop.add_timeout(FEED_COUNT_CHECK_INTERVAL, verify_feed_counts,
+                          "verify feed counts")
+
 def setup_change_tracker():
     Item.change_tracker = ItemChangeTracker()
     DeviceItem.change_tracker = DeviceItemChangeTracker()
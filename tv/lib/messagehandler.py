@@ -51,6 +51,7 @@ from miro import itemsource
 from miro import messages
 from miro import filetypes
 from miro import prefs
+from miro import queryprofile
 from miro import singleclick
 from miro import subscription
 from miro import tabs
@@ -1606,6 +1607,35 @@ New ids: %s""", playlist_item_ids, message.item_ids)
         time.sleep(message.n)
         logging.debug('handle_clog_backend: Backend out of snooze.  Yawn!')
 
+    def handle_dump_event_loop_stats(self, message):
+        logging.info('writing event loop stats to %s', message.path)
+        eventloop.stats.dump(message.path)
+        if message.reset:
+            eventloop.stats.reset()
+
+    def handle_dump_query_stats(self, message):
+        logging.info('writing query stats to %s', message.path)
+        reports = [app.db.query_profiler.format_report()]
+        if app.db_maintainer is not None:
+            reports.append(app.db_maintainer.format_report())
+        reports.extend(message.frontend_reports)
+        queryprofile.write_reports(message.path, reports)
+        if message.reset:
+            app.db.query_profiler.reset()
+
+    def handle_rebuild_search_index(self, message):
+        title = _('Rebuilding Search Index')
+        messages.ProgressDialogStart(title).send_to_frontend()
+        def progress_callback(done, total):
+            if done < total:
+                text = '%s (%s/%s)' % (title, done, total)
+                progress = float(done) / total
+                messages.ProgressDialog(text, progress).send_to_frontend()
+            else:
+                logging.info('rebuilt search index for %d items', total)
+                messages.ProgressDialogFinished().send_to_frontend()
+        app.db.rebuild_fulltext_index(progress_callback)
+
     def handle_force_feedparser_processing(self, message):
         # For all our RSS feeds, force an update
         for f in feed.Feed.make_view():
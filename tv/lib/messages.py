@@ -890,6 +890,37 @@ class ForceDeviceDBSaveError(BackendMessage):
     def __init__(self, device_info):
         self.device_info = device_info
 
+class DumpEventLoopStats(BackendMessage):
+    """Dev message: write the event loop callback stats to a file.
+
+    :param path: file to write the report to
+    :param reset: reset the stats after writing them
+    """
+    def __init__(self, path, reset=False):
+        self.path = path
+        self.reset = reset
+
+class DumpQueryStats(BackendMessage):
+    """Dev message: write the SQL query stats to a file.
+
+    The report includes the backend database and the reports in
+    frontend_reports.
+
+    :param path: file to write the report to
+    :param frontend_reports: list of format_report() strings for the
+        frontend connection pools and their QueryProfilers
+    :param reset: reset the backend stats after writing them
+    """
+    def __init__(self, path, frontend_reports, reset=False):
+        self.path = path
+        self.frontend_reports = frontend_reports
+        self.reset = reset
+
+class RebuildSearchIndex(BackendMessage):
+    """Dev message: rebuild the full text search index for the main DB.
+    """
+    pass
+
 # Frontend Messages
 class DownloaderSyncCommandComplete(FrontendMessage):
     """Tell the frontend that the pause/resume all command are complete,
@@ -328,10 +328,12 @@ class AsyncSocket(object):
             eventloop.remove_write_callback(self.socket)
             trap_call(self, errback, ConnectionTimeout(host))
             self.connectionErrback = None
-        eventloop.call_in_thread(onAddressLookup, handleGetAddrInfoException,
-                                 socket.getaddrinfo,
-                                 "getAddrInfo - %s:%s" % (host, port),
-                                 host, port)
+        eventloop.call_in_thread_class(eventloop.TASK_CLASS_DNS,
+                                       onAddressLookup,
+                                       handleGetAddrInfoException,
+                                       socket.getaddrinfo,
+                                       "getAddrInfo - %s:%s" % (host, port),
+                                       host, port)
 
     def accept_connection(self, family, host, port, callback, errback):
         def finishAccept():
@@ -134,6 +134,13 @@ SHOW_PODCASTS_IN_VIDEO      = Pref(key='showPodcastsInVideo', default=True, plat
 SHOW_PODCASTS_IN_MUSIC      = Pref(key='showPodcastsInMusic', default=False, platformSpecific=False)
 REMEMBER_LAST_DISPLAY       = Pref(key='rememberLastDisplay', default=False, platformSpecific=False)
 PODCASTS_DEFAULT_VIEW       = Pref(key='podcastsDefaultView', default=0, platformSpecific=False)
+# max number of evictable objects (items, icon caches) that LiveStorage keeps
+# in memory.  Objects past this get evicted at the end of an event.
+OBJECT_CACHE_MAX_OBJECTS    = Pref(key='objectCacheMaxObjects', default=20000, platformSpecific=False)
+# group commit for the main database: max seconds to hold a transaction open
+# across events, and max statements per transaction.  0 seconds disables it.
+GROUP_COMMIT_DELAY          = Pref(key='groupCommitDelay', default=0.25, platformSpecific=False)
+GROUP_COMMIT_MAX_STATEMENTS = Pref(key='groupCommitMaxStatements', default=1000, platformSpecific=False)
 # metadata
 LAST_RETRY_NET_LOOKUP       = Pref(key='lastRetryNetLookup', default=0, platformSpecific=False)
 # This doesn't need to be defined on the platform, but it can be overridden there if the platform wants to.
@@ -0,0 +1,289 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.queryprofile`` -- Profile SQL queries.
+
+QueryProfiler aggregates statistics for the queries that we run, grouped by
+their normalized SQL (literals replaced with "?", "IN (?, ?, ...)" lists
+collapsed).  The first time a query runs slower than plan_threshold, we
+capture its EXPLAIN QUERY PLAN output, which is the easiest way to find
+queries that are missing an index.
+"""
+
+import collections
+import logging
+import math
+import re
+import threading
+import time
+
+_whitespace_re = re.compile(r'\s+')
+_string_literal_re = re.compile(r"'(?:[^']|'')*'")
+_number_literal_re = re.compile(r'\b\d+(?:\.\d+)?\b')
+_in_list_re = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+
+def normalize_sql(sql):
+    """Normalize an SQL statement so that similar queries group together.
+    """
+    sql = _whitespace_re.sub(' ', sql.strip())
+    sql = _string_literal_re.sub('?', sql)
+    sql = _number_literal_re.sub('?', sql)
+    return _in_list_re.sub('(?...)', sql)
+
+def full_scan_tables(plan):
+    """Get the tables that an EXPLAIN QUERY PLAN result scans without an
+    index.
+
+    Newer SQLite versions refer to aliased tables by their alias.
+
+    :param plan: list of strings from the detail column of the plan
+    :returns: list of table names
+    """
+    tables = []
+    for detail in plan:
+        # Older SQLite versions say "SCAN TABLE foo", newer ones "SCAN foo"
+        if (detail.startswith('SCAN ') and 'INDEX' not in detail and
+                'INTEGER PRIMARY KEY' not in detail and
+                not detail.startswith('SCAN CONSTANT ROW') and
+                not detail.startswith('SCAN SUBQUERY')):
+            words = detail.split()
+            if words[1] == 'TABLE':
+                tables.append(words[2])
+            else:
+                tables.append(words[1])
+    return tables
+
+def plan_has_full_scan(plan):
+    """Check if an EXPLAIN QUERY PLAN result scans a table without an index.
+
+    :param plan: list of strings from the detail column of the plan
+    """
+    return len(full_scan_tables(plan)) > 0
+
+class QueryStats(object):
+    """Statistics for all queries with the same normalized SQL."""
+
+    # how many recent durations we keep to calculate percentiles
+    SAMPLE_SIZE = 200
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+        self.samples = collections.deque(maxlen=self.SAMPLE_SIZE)
+        # EXPLAIN QUERY PLAN details, or None if we haven't captured it
+        self.plan = None
+
+    def percentile(self, percent):
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        index = int(math.ceil(len(samples) * percent / 100.0)) - 1
+        return samples[max(index, 0)]
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total_time': self.total_time,
+            'max_time': self.max_time,
+            'p95_time': self.percentile(95),
+            'rows': self.rows,
+            'plan': self.plan,
+            'full_scan': (self.plan is not None and
+                          plan_has_full_scan(self.plan)),
+        }
+
+class QueryProfiler(object):
+    """Tracks how long our SQL queries take.
+
+    record() can be called from multiple threads, for example the frontend
+    connection pool's connections share a single profiler.
+
+    :attribute enabled: set to False to stop recording queries
+    :attribute slow_threshold: log queries that take longer than this
+    :attribute plan_threshold: capture the query plan for queries that take
+        longer than this
+    """
+
+    # Limit how many queries we track.  Some code puts literal values in
+    # SQL in ways that normalize_sql() doesn't catch.
+    MAX_QUERIES = 1000
+    OVERFLOW_SQL = '<other>'
+
+    def __init__(self, name, slow_threshold=0.5, plan_threshold=0.05):
+        self.name = name
+        self.enabled = True
+        self.slow_threshold = slow_threshold
+        self.plan_threshold = plan_threshold
+        self._lock = threading.Lock()
+        # maps raw SQL -> normalized SQL.  With the statement cache most
+        # queries use the same SQL text, so this saves us from running the
+        # regexes every time.
+        self._normalized = {}
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.queries = {}
+            self.reset_time = time.time()
+        finally:
+            self._lock.release()
+
+    def _normalize(self, sql):
+        try:
+            return self._normalized[sql]
+        except KeyError:
+            if len(self._normalized) >= self.MAX_QUERIES * 2:
+                self._normalized = {}
+            normalized = self._normalized[sql] = normalize_sql(sql)
+            return normalized
+
+    def _get_query_stats(self, normalized):
+        try:
+            return self.queries[normalized]
+        except KeyError:
+            if len(self.queries) >= self.MAX_QUERIES:
+                normalized = self.OVERFLOW_SQL
+                if normalized in self.queries:
+                    return self.queries[normalized]
+            stats = self.queries[normalized] = QueryStats()
+            return stats
+
+    def record(self, sql, values, duration, rows=None, explain=None):
+        """Record a query.
+
+        :param sql: SQL that we ran
+        :param values: values that we bound to the SQL
+        :param duration: how long the query took
+        :param rows: number of rows the query returned, if known
+        :param explain: function to get the query plan.  It will be called
+            with sql and values and should return the rows from EXPLAIN QUERY
+            PLAN.  We only call it the first time a query crosses
+            plan_threshold.
+        """
+        if not self.enabled:
+            return
+        if duration > self.slow_threshold:
+            logging.timing("query slow (%0.3f seconds): %s", duration, sql)
+        self._lock.acquire()
+        try:
+            normalized = self._normalize(sql)
+            stats = self._get_query_stats(normalized)
+            stats.count += 1
+            stats.total_time += duration
+            if duration > stats.max_time:
+                stats.max_time = duration
+            stats.samples.append(duration)
+            if rows is not None:
+                stats.rows += rows
+            need_plan = (stats.plan is None and explain is not None and
+                         duration > self.plan_threshold)
+            if need_plan:
+                # set the plan now so other threads don't also try to capture
+                # it
+                stats.plan = []
+        finally:
+            self._lock.release()
+        if need_plan:
+            stats.plan = self._capture_plan(sql, values, explain)
+
+    def _capture_plan(self, sql, values, explain):
+        try:
+            plan_rows = explain(sql, values)
+        except StandardError, e:
+            # some statements, like CREATE TABLE, can't be explained
+            logging.debug("Error running EXPLAIN QUERY PLAN for %s: %s", sql,
+                          e)
+            return []
+        # The last column is the detail text.  Older SQLite versions return 3
+        # columns, newer ones return 4.
+        return [row[-1] for row in plan_rows]
+
+    def get_stats(self):
+        """Get a snapshot of our stats.
+
+        :returns: dict with the keys "queries" (maps normalized SQL to a dict
+            with count, total_time, max_time, p95_time, rows, plan and
+            full_scan), "name" and "elapsed".
+        """
+        self._lock.acquire()
+        try:
+            queries = dict((sql, stats.to_dict())
+                           for sql, stats in self.queries.items())
+        finally:
+            self._lock.release()
+        return {
+            'name': self.name,
+            'queries': queries,
+            'elapsed': time.time() - self.reset_time,
+        }
+
+    def format_report(self, limit=None):
+        """Format our stats as a human-readable string.
+
+        Queries are sorted by the total time they took.
+
+        :param limit: only include this many queries
+        """
+        snapshot = self.get_stats()
+        lines = ['Query stats for %s for the last %.1f seconds' %
+                 (snapshot['name'], snapshot['elapsed']), '']
+        queries = sorted(snapshot['queries'].items(),
+                         key=lambda (sql, stats): stats['total_time'],
+                         reverse=True)
+        if limit is not None:
+            queries = queries[:limit]
+        for sql, stats in queries:
+            lines.append(sql)
+            lines.append('    count: %d total: %.3fs avg: %.4fs p95: %.4fs '
+                         'max: %.4fs rows: %d' %
+                         (stats['count'], stats['total_time'],
+                          stats['total_time'] / stats['count'],
+                          stats['p95_time'], stats['max_time'],
+                          stats['rows']))
+            if stats['plan']:
+                if stats['full_scan']:
+                    lines.append('    plan (FULL SCAN):')
+                else:
+                    lines.append('    plan:')
+                for detail in stats['plan']:
+                    lines.append('        %s' % detail)
+        return '\n'.join(lines)
+
+def write_reports(path, reports):
+    """Write a list of reports from format_report() to a file."""
+    f = open(path, 'w')
+    try:
+        for report in reports:
+            f.write(report)
+            f.write('\n\n')
+    finally:
+        f.close()
@@ -50,6 +50,7 @@ Go to the bottom of this file for the current database schema.
 import datetime
 import time
 from types import NoneType
+from miro.indexregistry import AccessPattern
 from miro.plat.utils import PlatformFilenameType
 
 class ValidationError(StandardError):
@@ -326,6 +327,13 @@ class ObjectSchema(object):
     * ``table_name`` -- SQL table name to store the class in
     * ``fields`` -- list of (name, SchemaItem) pairs.  One item for
       each attribute that should be stored to disk.
+    * ``lazy_columns`` -- names of columns that we don't load when objects
+      are restored.  They get loaded the first time one is accessed.  Use
+      this for big columns that most code doesn't need.  Only simple
+      columns (SchemaSimpleItem) can be lazy.
+    * ``access_patterns`` -- list of AccessPatterns that describe how we
+      query the table.  indexregistry creates indexes for them, so they don't
+      need to be added to ``indexes`` or created in an upgrade function.
     """
 
     @classmethod
@@ -338,6 +346,8 @@ class ObjectSchema(object):
 
     indexes = ()
     unique_indexes = ()
+    lazy_columns = ()
+    access_patterns = ()
 
 class MultiClassObjectSchema(ObjectSchema):
     """ObjectSchema where rows will be restored to different python
@@ -364,6 +374,8 @@ class NoObjectSchema(object):
 
     indexes = ()
     unique_indexes = ()
+    lazy_columns = ()
+    access_patterns = ()
 
 from miro.database import DDBObject
 from miro.databaselog import DBLogEntry
@@ -485,6 +497,10 @@ class ItemSchema(MultiClassObjectSchema):
         ('metadata_title', SchemaString(noneOk=True)),
     ]
 
+    # descriptions can be big and are only needed when displaying an item,
+    # which uses ItemInfo instead.
+    lazy_columns = ('entry_description', 'description')
+
     indexes = (
             ('item_feed', ('feed_id',)),
             ('item_feed_visible', ('feed_id', 'deleted')),
@@ -495,6 +511,24 @@ class ItemSchema(MultiClassObjectSchema):
             ('item_filename', ('filename',)),
     )
 
+    access_patterns = (
+        AccessPattern('Item.latest_in_feed_view()',
+                      equality=('feed_id',), order_by=('release_date',)),
+        AccessPattern('Item.feed_expiring_view()',
+                      equality=('feed_id', 'keep'),
+                      order_by=('watched_time',)),
+        # video, music and other tabs in the frontend
+        AccessPattern('ItemList media tabs',
+                      equality=('file_type', 'deleted')),
+        # frontend "newly downloaded" display, watched_time and parent_id
+        # are checked with IS NULL.
+        AccessPattern('newly downloaded display',
+                      equality=('parent_id', 'watched_time', 'expired'),
+                      order_by=('downloaded_time',)),
+        AccessPattern('recently watched display',
+                      equality=('file_type',), order_by=('last_watched',)),
+    )
+
 class DeviceItemSchema(ObjectSchema):
     """Schema for items on devices.  This only gets used for device databases
     """
@@ -810,6 +844,11 @@ class PlaylistItemMapSchema(DDBObjectSchema):
         ('playlist_item_map_item_id', ('item_id',)),
     )
 
+    access_patterns = (
+        AccessPattern('Item.playlist_view()', equality=('playlist_id',),
+                      order_by=('position',)),
+    )
+
 class PlaylistFolderItemMapSchema(DDBObjectSchema):
     klass = PlaylistFolderItemMap
     table_name = 'playlist_folder_item_map'
@@ -824,6 +863,11 @@ class PlaylistFolderItemMapSchema(DDBObjectSchema):
         ('playlist_folder_item_map_item_id', ('item_id',)),
     )
 
+    access_patterns = (
+        AccessPattern('Item.playlist_folder_view()',
+                      equality=('playlist_id',), order_by=('position',)),
+    )
+
 class TabOrderSchema(DDBObjectSchema):
     klass = TabOrder
     table_name = 'taborder_order'
@@ -998,7 +1042,7 @@ class MetadataEntrySchema(DDBObjectSchema):
         ('metadata_entry_status_and_source', ('status_id', 'source')),
     )
 
-VERSION = 201
+VERSION = 203
 
 object_schemas = [
     IconCacheSchema, ItemSchema, FeedSchema,
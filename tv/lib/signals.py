@@ -244,6 +244,14 @@ class SignalEmitter(object):
         callbacks = self.get_callbacks(callback_handle[0])
         callbacks.remove_callback(callback_handle[1])
 
+    def has_callbacks(self):
+        """Check if any callbacks are connected to our signals."""
+        for callback_set in self.signal_callbacks.itervalues():
+            if (callback_set.callbacks or callback_set.callbacks_after or
+                    callback_set.callbacks_before):
+                return True
+        return False
+
     def disconnect_all(self):
         for signal in self.signal_callbacks:
             self.signal_callbacks[signal] = CallbackSet()
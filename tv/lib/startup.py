@@ -53,6 +53,7 @@ from miro import commandline
 from miro import controller
 from miro import extensionmanager
 from miro import database
+from miro import dbmaintenance
 from miro import databaselog
 from miro import databaseupgrade
 from miro import dbupgradeprogress
@@ -249,7 +250,10 @@ def startup_for_frontend(obj, thread):
     item.setup_deleted_checker()
     logging.info("Restoring database...")
     start = time.time()
-    app.db = storedatabase.LiveStorage()
+    app.db = storedatabase.LiveStorage(
+        group_commit_delay=app.config.get(prefs.GROUP_COMMIT_DELAY),
+        group_commit_max_statements=app.config.get(
+            prefs.GROUP_COMMIT_MAX_STATEMENTS))
     try:
         app.db.upgrade_database()
     except databaseupgrade.DatabaseTooNewError:
@@ -267,6 +271,7 @@ def startup_for_frontend(obj, thread):
     except storedatabase.UpgradeError:
         raise StartupError(None, None)
     database.initialize()
+    app.db_maintainer = dbmaintenance.DatabaseMaintainer(app.db)
     downloader.reset_download_stats()
     end = time.time()
     logging.timing("Database upgrade time: %.3f", end - start)
@@ -515,6 +520,11 @@ def on_frontend_started():
     eventloop.add_timeout(60, item.update_incomplete_metadata,
             "update metadata data")
     eventloop.add_timeout(90, clear_icon_cache_orphans, "clear orphans")
+    eventloop.add_timeout(120, app.db.convert_old_containers,
+            "convert old container columns")
+    app.db_maintainer.start()
+    eventloop.add_timeout(item.FEED_COUNT_CHECK_INTERVAL,
+            item.verify_feed_counts, "verify feed counts")
 
 def setup_global_feeds():
     setup_global_feed(u'dtv:manualFeed', initiallyAutoDownloadable=False)
@@ -610,7 +620,7 @@ def _get_theme_history():
     else:
         return theme.ThemeHistory()
 
-@eventloop.idle_iterator
+@eventloop.idle_iterator(lane=eventloop.LANE_BACKGROUND)
 def clear_icon_cache_orphans():
     # delete icon_cache rows from the database with no associated
     # item/feed/guide.
@@ -40,10 +40,12 @@ separate column.
 Most columns are stored using SQLite datatypes (``INTEGER``, ``REAL``,
 ``TEXT``, ``DATETIME``, etc.).  However some of our python values,
 don't have an equivalent (lists, dicts and timedelta objects).  For
-those, we store the python representation of the object.  This makes
-the column look similar to a JSON value, although not quite the same.
-The hope is that it will be human readable.  We use the type
-``pythonrepr`` to label these columns.
+timedeltas, we store a string.  For lists, dicts and tuples, we store a
+BLOB in the format from the containerformat module.  Older databases stored
+the python representation of the object for those columns, we still read
+that format and convert it when the rows are saved (or by
+``LiveStorage.convert_old_containers()``).  We use the type ``pythonrepr``
+to label these columns.
 """
 
 import glob
@@ -56,6 +58,7 @@ import traceback
 import time
 import os
 import sys
+import weakref
 from cStringIO import StringIO
 
 try:
@@ -64,6 +67,7 @@ except ImportError:
     from pysqlite2 import dbapi2 as sqlite3
 
 from miro import app
+from miro import containerformat
 from miro import crashreport
 from miro import convert20database
 from miro import databaseupgrade
@@ -71,10 +75,12 @@ from miro import dbupgradeprogress
 from miro import dialogs
 from miro import eventloop
 from miro import fileutil
+from miro import indexregistry
 from miro import messages
 from miro import schema
 from miro import signals
 from miro import prefs
+from miro import queryprofile
 from miro import util
 from miro.data import fulltextsearch
 from miro.data import item
@@ -174,6 +180,98 @@ class DatabaseObjectCache(object):
         """Clear all objects in the cache"""
         self._objects = {}
 
+class StatementCache(object):
+    """Caches the SQL text that LiveStorage builds for its queries.
+
+    Statements are stored by a key made from the parts of the query (table,
+    where clause, joins, etc).  Every value that changes between calls,
+    including object ids, gets bound as a parameter, so the same key always
+    yields the same SQL text.  That means we only build the string once and
+    that sqlite3's own statement cache can reuse the prepared statement.
+    """
+
+    # sqlite3 keeps this many prepared statements per connection
+    SQLITE_CACHE_SIZE = 250
+    # Some code puts literal values in its where clauses.  Start over if we
+    # get this many statements rather than growing forever.
+    MAX_SIZE = 2000
+
+    def __init__(self):
+        self._statements = {}
+        self.reset_stats()
+
+    def get(self, key, builder, *args):
+        """Get the SQL for a statement.
+
+        :param key: hashable key that identifies the statement
+        :param builder: function that returns the SQL text.  It gets called
+            with args if key isn't in the cache yet.
+        :returns: SQL text
+        """
+        try:
+            sql = self._statements[key]
+        except KeyError:
+            self._stats['misses'] += 1
+            if len(self._statements) >= self.MAX_SIZE:
+                self._statements = {}
+            sql = self._statements[key] = builder(*args)
+        else:
+            self._stats['hits'] += 1
+        return sql
+
+    def clear(self):
+        self._statements = {}
+
+    def reset_stats(self):
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+        }
+
+    def get_stats(self):
+        """Get stats for the cache.
+
+        :returns: dict with these keys:
+            - hits: statements that we found in the cache
+            - misses: statements that we had to build
+            - size: number of statements in the cache
+            - hit_rate: hits / (hits + misses), or 0 if there have been no
+              lookups
+        """
+        stats = self._stats.copy()
+        stats['size'] = len(self._statements)
+        lookups = stats['hits'] + stats['misses']
+        if lookups:
+            stats['hit_rate'] = float(stats['hits']) / lookups
+        else:
+            stats['hit_rate'] = 0.0
+        return stats
+
+def pad_ids_for_sqlite(id_list):
+    """Pad a chunk of ids for an "id IN (...)" clause.
+
+    If we used the exact number of ids, we would build a different statement
+    for nearly every query.  Instead we round up to the next power of 2
+    (capped at the chunk size of util.split_values_for_sqlite()) by
+    repeating the last id, which doesn't change the results.  This keeps
+    the number of distinct statements small.
+
+    :param id_list: list of ids from util.split_values_for_sqlite()
+    :returns: tuple of ids to bind
+    """
+    count = len(id_list)
+    size = 1
+    while size < count:
+        size *= 2
+    size = min(size, max(count, 990))
+    id_list = tuple(id_list)
+    if size > count:
+        id_list += (id_list[-1],) * (size - count)
+    return id_list
+
+def _in_clause_sql(sql_start, count):
+    return "%s(%s)" % (sql_start, ', '.join('?' * count))
+
 class LiveStorageErrorHandler(object):
     """Handle database errors for LiveStorage.
     """
@@ -380,15 +478,35 @@ class LiveStorage(signals.SignalEmitter):
     Attributes:
 
     - cache -- DatabaseObjectCache object
+    - object_cache_budget -- max number of evictable objects to keep in
+      memory (see evict_objects())
+    - group_commit_delay -- see __init__()
+    - group_commit_max_statements -- see __init__()
+
+    Group commit:
+
+    Normally we commit at the end of every event that wrote to the database.
+    When group_commit_delay is set, we keep the transaction open across
+    events instead and commit once it's that many seconds old, or once it has
+    group_commit_max_statements statements in it.  Each event's writes are
+    wrapped in a savepoint, so a failed event only rolls back its own
+    changes.  Call finish_transaction() to commit right away on paths that
+    need the data to be durable.
 
     Signals:
 
     - transaction-finished(success) -- We committed or rolled back a
     transaction
     """
+    # item table that item_fts indexes, see fulltextsearch
+    fulltext_table = 'item'
+    fulltext_path_column = 'filename'
+    fulltext_has_entry_description = True
+
     def __init__(self, path=None, error_handler=None, preallocate=None,
                  object_schemas=None, schema_version=None,
-                 start_in_temp_mode=False):
+                 start_in_temp_mode=False, object_cache_budget=None,
+                 group_commit_delay=0, group_commit_max_statements=1000):
         """Create a LiveStorage for a database
 
         :param path: path to the database (or ":memory:")
@@ -402,6 +520,12 @@ class LiveStorage(signals.SignalEmitter):
         :param start_in_temp_mode: True if this database should start in
                                    temporary mode (running in memory, but
                                    checking if it can write to the disk)
+        :param object_cache_budget: max number of evictable objects to keep
+            in memory.  Defaults to prefs.OBJECT_CACHE_MAX_OBJECTS.
+        :param group_commit_delay: max number of seconds to hold a
+            transaction open across events.  0 disables group commit.
+        :param group_commit_max_statements: commit a grouped transaction at
+            the end of the event where it reaches this many statements.
         """
         signals.SignalEmitter.__init__(self)
         self.create_signal("transaction-finished")
@@ -413,6 +537,9 @@ class LiveStorage(signals.SignalEmitter):
             object_schemas = schema.object_schemas
         if schema_version is None:
             schema_version = schema.VERSION
+        if object_cache_budget is None:
+            object_cache_budget = app.config.get(
+                prefs.OBJECT_CACHE_MAX_OBJECTS)
 
         # version of sqlite3
         try:
@@ -432,7 +559,7 @@ class LiveStorage(signals.SignalEmitter):
         self.cache = DatabaseObjectCache()
         self.raise_load_errors = False # only gets set in unittests
         self.force_directory_creation = True # False for device databases
-        self._query_times = {}
+        self.query_profiler = queryprofile.QueryProfiler('backend database')
         self.path = path
         self._quitting_from_operational_error = False
         self._object_schemas = object_schemas
@@ -442,10 +569,48 @@ class LiveStorage(signals.SignalEmitter):
         self._all_schemas = []
         self._object_map = {} # maps object id -> DDBObjects in memory
         self._ids_loaded = set()
+        # Objects that we evicted from _object_map.  If something else still
+        # holds a reference to them, we need to use the same object when
+        # they get loaded again.
+        self._evicted_objects = weakref.WeakValueDictionary()
+        # maps object id -> last access for objects that can be evicted
+        self._object_access = {}
+        self._access_counter = itertools.count()
+        self.object_cache_budget = object_cache_budget
+        self._next_eviction_check = object_cache_budget
+        self.reset_object_cache_stats()
+        self.statement_cache = StatementCache()
         self._statements_in_transaction = []
+        self.group_commit_delay = group_commit_delay
+        self.group_commit_max_statements = group_commit_max_statements
+        # time that our current transaction started
+        self._transaction_start = None
+        # index in _statements_in_transaction of the SAVEPOINT for the
+        # current event, or None if the event hasn't written anything
+        self._event_savepoint = None
+        # DelayedCall to commit a grouped transaction
+        self._group_commit_timeout = None
+        # maps schema -> list of (index, name) for its container columns
+        self._container_columns = {}
+        # maps schema -> fields that we load when restoring objects (all
+        # fields except lazy_columns)
+        self._restore_fields = {}
+        # maps schema -> list of (index, name) for the container columns in
+        # _restore_fields
+        self._restore_container_columns = {}
+        # maps schema -> frozenset of lazy column names
+        self._lazy_columns = {}
+        # maps (id, table_name) -> dict of container column values that are
+        # on disk.  update_obj() uses this to skip unchanged columns.
+        self._saved_container_values = {}
         eventloop.connect("event-finished", self.on_event_finished)
         for oschema in object_schemas:
             self._all_schemas.append(oschema)
+            self._container_columns[oschema] = [
+                (i, name) for i, (name, schema_item) in
+                enumerate(oschema.fields)
+                if isinstance(schema_item, schema.SchemaReprContainer)]
+            self._setup_lazy_columns(oschema)
             for klass in oschema.ddb_object_classes():
                 self._schema_map[klass] = oschema
                 for field_name, schema_item in oschema.fields:
@@ -462,6 +627,25 @@ class LiveStorage(signals.SignalEmitter):
         if self.preallocate:
             self._preallocate_space()
 
+    def _setup_lazy_columns(self, oschema):
+        lazy_columns = frozenset(oschema.lazy_columns)
+        fields = dict(oschema.fields)
+        for name in lazy_columns:
+            if name == 'id' or not isinstance(fields.get(name),
+                                              schema.SchemaSimpleItem):
+                raise ValueError("%s can't be a lazy column for %s" %
+                                 (name, oschema.table_name))
+        self._lazy_columns[oschema] = lazy_columns
+        # our SELECT statements depend on the lazy columns
+        self.statement_cache.clear()
+        self._restore_fields[oschema] = [(name, schema_item)
+                for name, schema_item in oschema.fields
+                if name not in lazy_columns]
+        self._restore_container_columns[oschema] = [
+            (i, name) for i, (name, schema_item) in
+            enumerate(self._restore_fields[oschema])
+            if isinstance(schema_item, schema.SchemaReprContainer)]
+
     def open_connection(self, path=None, start_in_temp_mode=False):
         if path is None:
             path = self.path
@@ -473,7 +657,8 @@ class LiveStorage(signals.SignalEmitter):
             try:
                 self.connection = sqlite3.connect(path,
                         isolation_level=None,
-                        detect_types=sqlite3.PARSE_DECLTYPES)
+                        detect_types=sqlite3.PARSE_DECLTYPES,
+                        cached_statements=StatementCache.SQLITE_CACHE_SIZE)
             except sqlite3.DatabaseError, e:
                 logging.warn("Error opening sqlite database: %s", e)
                 action = self.error_handler.handle_open_error()
@@ -489,6 +674,7 @@ class LiveStorage(signals.SignalEmitter):
                     raise
 
         self.cursor = self.connection.cursor()
+        fulltextsearch.setup_rank_function(self.connection)
         if path != ':memory:' and not self.temp_mode:
             self._switch_to_wal_mode()
 
@@ -498,14 +684,20 @@ class LiveStorage(signals.SignalEmitter):
         WAL mode allows for better concurency between readers and writers and
         is generally faster than other modes.  See:
         http://www.sqlite.org/wal.html
+
+        We also set auto_vacuum=INCREMENTAL, so that dbmaintenance can free
+        unused pages.  This only has an effect on new databases and needs to
+        happen before we switch to WAL mode.
         """
         try:
+            self.cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
             self.cursor.execute("PRAGMA journal_mode=wal");
         except sqlite3.DatabaseError:
             msg = "Error running 'PRAGMA journal_mode=wal'"
             self.error_handler.handle_load_error()
             self._handle_load_error(msg, init_schema=False)
-            # rerun the command with our fresh database
+            # rerun the commands with our fresh database
+            self.cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
             self.cursor.execute("PRAGMA journal_mode=wal");
         # check that we actually succesfully switch to wal mode
         actual_mode = self.cursor.fetchall()[0][0]
@@ -527,8 +719,9 @@ class LiveStorage(signals.SignalEmitter):
         trying to open a database file.
         """
         self.connection = sqlite3.connect(':memory:',
-                                          isolation_level=None,
-                                          detect_types=sqlite3.PARSE_DECLTYPES)
+                isolation_level=None,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                cached_statements=StatementCache.SQLITE_CACHE_SIZE)
         self.temp_mode = True
         eventloop.add_timeout(300,
                               self._try_save_temp_to_disk,
@@ -788,8 +981,65 @@ class LiveStorage(signals.SignalEmitter):
                                               self.show_upgrade_progress())
             self.set_version()
             self._change_database_file_back()
+        self._sync_indexes()
         self.current_version = self._schema_version
 
+    def _sync_indexes(self):
+        """Create or drop the indexes for our schemas' access patterns.
+
+        This is cheap if the indexes are already in sync, so we run it every
+        time we check for upgrades.  See indexregistry for details.
+        """
+        self._run_in_own_transaction(indexregistry.sync_indexes,
+                                     self.cursor, self._object_schemas)
+
+    def convert_old_containers(self):
+        """Convert container columns stored with repr() in the background.
+
+        See databaseupgrade.upgrade202().
+        """
+        eventloop.idle_iterate(self._convert_old_containers,
+                               "convert old container columns",
+                               lane=eventloop.LANE_BACKGROUND)
+
+    def _convert_old_containers(self):
+        for oschema in self._all_schemas:
+            columns = [name for i, name in self._container_columns[oschema]]
+            if not columns:
+                continue
+            start_id = 0
+            while start_id is not None:
+                # run our own transaction, so that the updates don't get
+                # committed one at a time.
+                start_id = self._run_in_own_transaction(
+                    databaseupgrade.convert_repr_containers, self.cursor,
+                    oschema.table_name, columns, start_id)
+                yield
+
+    def _run_in_own_transaction(self, func, *args):
+        """Run func(*args) in a transaction of its own.
+
+        This is for code that uses self.cursor directly, rather than
+        execute().  We commit our current transaction first.  If func
+        raises, we roll back everything that it did.
+
+        :returns: func's return value
+        """
+        self.finish_transaction()
+        self.cursor.execute("BEGIN TRANSACTION")
+        try:
+            rv = func(*args)
+        except:
+            exc_info = sys.exc_info()
+            try:
+                self.cursor.execute("ROLLBACK TRANSACTION")
+            except sqlite3.OperationalError:
+                # SQLite already rolled back the transaction
+                pass
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.cursor.execute("COMMIT TRANSACTION")
+        return rv
+
     def _upgrade_20_database(self):
         self.cursor.execute("SELECT COUNT(*) FROM sqlite_master "
                 "WHERE type='table' and name = 'dtv_objects'")
@@ -867,23 +1117,130 @@ class LiveStorage(signals.SignalEmitter):
         key = (obj.id, obj.db_info.db.table_name(obj.__class__))
         self._object_map[key] = obj
         self._ids_loaded.add(key)
+        if obj.cache_evictable:
+            self._object_access[key] = self._access_counter.next()
 
     def forget_object(self, obj):
         key = (obj.id, obj.db_info.db.table_name(obj.__class__))
         try:
             del self._object_map[key]
         except KeyError:
-            details = ('storedatabase.forget_object: '
-                       'key error in forget_object: %s (obj: %s)' %
-                       (obj.id, obj))
-            logging.error(details)
+            if self._evicted_objects.pop(key, None) is None:
+                details = ('storedatabase.forget_object: '
+                           'key error in forget_object: %s (obj: %s)' %
+                           (obj.id, obj))
+                logging.error(details)
         self._ids_loaded.discard(key)
+        self._object_access.pop(key, None)
+        self._saved_container_values.pop(key, None)
 
     def forget_all_objects(self):
         self._object_map = {}
         self._ids_loaded = set()
+        self._evicted_objects = weakref.WeakValueDictionary()
+        self._object_access = {}
+        self._saved_container_values = {}
+
+    def _revive_object(self, key):
+        """Move an evicted object that's still alive back into
+        _object_map.
+
+        :returns: the object
+        :raises KeyError: the object isn't alive anymore
+        """
+        obj = self._evicted_objects.pop(key)
+        self._object_map[key] = obj
+        self._ids_loaded.add(key)
+        self._object_access[key] = self._access_counter.next()
+        self._object_cache_stats['revived'] += 1
+        return obj
+
+    def evict_objects(self):
+        """Evict the least recently used objects if we're over budget.
+
+        Only objects from classes with cache_evictable set and whose
+        can_evict() method returns True get evicted.  Evicted objects are
+        kept in a weak map, so code that still has a reference to one gets
+        the same object if it's loaded again.  Otherwise they're restored
+        from the database the next time they're needed.
+
+        This gets called at the end of each event, when nothing should be
+        using the objects.
+
+        :returns: number of objects evicted
+        """
+        if len(self._object_access) <= self._next_eviction_check:
+            return 0
+        # Evict down to 90% of the budget so that we don't need to do this
+        # every event.
+        target = int(self.object_cache_budget * 0.9)
+        to_evict = len(self._object_access) - target
+        lru = sorted(self._object_access.iteritems(), key=lambda i: i[1])
+        evicted = 0
+        for key, access in lru:
+            if evicted >= to_evict:
+                break
+            obj = self._object_map.get(key)
+            if obj is None:
+                del self._object_access[key]
+                continue
+            if not obj.can_evict():
+                continue
+            del self._object_map[key]
+            del self._object_access[key]
+            self._ids_loaded.discard(key)
+            self._saved_container_values.pop(key, None)
+            self._evicted_objects[key] = obj
+            evicted += 1
+        # If most of our objects can't be evicted, don't keep trying at the
+        # end of every event.
+        self._next_eviction_check = max(self.object_cache_budget,
+                len(self._object_access) + self.object_cache_budget / 10)
+        self._object_cache_stats['evicted'] += evicted
+        logging.debug("LiveStorage: evicted %d objects (%d remaining)",
+                      evicted, len(self._object_map))
+        return evicted
+
+    def reset_object_cache_stats(self):
+        self._object_cache_stats = {
+            'hits': 0,
+            'revived': 0,
+            'misses': 0,
+            'evicted': 0,
+        }
+
+    def get_object_cache_stats(self):
+        """Get stats for the in-memory object cache.
+
+        :returns: dict with these keys:
+            - hits: lookups for objects that were in memory
+            - revived: lookups for evicted objects that were still alive
+            - misses: objects that we had to load from the database
+            - evicted: objects evicted by evict_objects()
+            - size: number of objects in memory
+            - evictable: number of evictable objects in memory
+            - evicted_alive: evicted objects still referenced elsewhere
+            - budget: object_cache_budget
+        """
+        stats = self._object_cache_stats.copy()
+        stats['size'] = len(self._object_map)
+        stats['evictable'] = len(self._object_access)
+        stats['evicted_alive'] = len(self._evicted_objects)
+        stats['budget'] = self.object_cache_budget
+        return stats
+
+    def get_statement_cache_stats(self):
+        """Get stats for the SQL statement cache.
+
+        See StatementCache.get_stats() for the keys.
+        """
+        return self.statement_cache.get_stats()
 
     def _insert_sql_for_schema(self, obj_schema):
+        return self.statement_cache.get(('insert', obj_schema.table_name),
+                self._build_insert_sql, obj_schema)
+
+    def _build_insert_sql(self, obj_schema):
         return "INSERT INTO %s (%s) VALUES(%s)" % (obj_schema.table_name,
                 ', '.join(name for name, schema_item in obj_schema.fields),
                 ', '.join('?' for i in xrange(len(obj_schema.fields))))
@@ -901,6 +1258,27 @@ class LiveStorage(signals.SignalEmitter):
                 schema_item, value))
         return values
 
+    def _remember_container_values(self, obj_schema, obj_id, values,
+                                   columns=None):
+        """Remember the values for an object's container columns.
+
+        :param values: list of SQL values for all columns in obj_schema
+        :param columns: list of (index, name) tuples for the containers in
+            values.  By default we use the indexes for obj_schema.fields.
+        """
+        if columns is None:
+            columns = self._container_columns[obj_schema]
+        if not columns:
+            return
+        key = (obj_id, obj_schema.table_name)
+        saved = {}
+        for i, name in columns:
+            # only remember values in the current format.  That way we
+            # always rewrite columns stored using repr().
+            if values[i] is None or isinstance(values[i], buffer):
+                saved[name] = values[i]
+        self._saved_container_values[key] = saved
+
     def insert_obj(self, obj):
         """Add a new DDBObject to disk."""
 
@@ -908,6 +1286,7 @@ class LiveStorage(signals.SignalEmitter):
         values = self._values_for_obj(obj_schema, obj)
         sql = self._insert_sql_for_schema(obj_schema)
         self.execute(sql, values, is_update=True)
+        self._remember_container_values(obj_schema, obj.id, values)
         obj.reset_changed_attributes()
 
     def bulk_insert(self, objects):
@@ -926,7 +1305,8 @@ class LiveStorage(signals.SignalEmitter):
             value_list.append(self._values_for_obj(obj_schema, obj))
         sql = self._insert_sql_for_schema(obj_schema)
         self.execute(sql, value_list, is_update=True, many=True)
-        for obj in objects:
+        for obj, values in itertools.izip(objects, value_list):
+            self._remember_container_values(obj_schema, obj.id, values)
             obj.reset_changed_attributes()
 
     def update_obj(self, obj):
@@ -935,23 +1315,37 @@ class LiveStorage(signals.SignalEmitter):
         obj_schema = self._schema_map[obj.__class__]
         setters = []
         values = []
+        key = (obj.id, obj_schema.table_name)
+        saved_containers = self._saved_container_values.get(key, {})
+        new_containers = {}
         for name, schema_item in obj_schema.fields:
             if (isinstance(schema_item, schema.SchemaSimpleItem) and
                     name not in obj.changed_attributes):
                 continue
-            setters.append('%s=?' % name)
             value = getattr(obj, name)
             try:
                 schema_item.validate(value)
             except schema.ValidationError:
                 logging.warn("error validating %s for %s", name, obj)
                 raise
-            values.append(self._converter.to_sql(obj_schema, name,
-                schema_item, value))
+            sql_value = self._converter.to_sql(obj_schema, name,
+                schema_item, value)
+            if isinstance(schema_item, schema.SchemaReprContainer):
+                # Containers can be changed in-place, so we can't rely on
+                # changed_attributes.  Compare against what's on disk.
+                if (name in saved_containers and
+                        sql_value == saved_containers[name]):
+                    continue
+                new_containers[name] = sql_value
+            setters.append(name)
+            values.append(sql_value)
         obj.reset_changed_attributes()
+        if new_containers:
+            self._saved_container_values.setdefault(key, {}).update(
+                new_containers)
         if values:
-            sql = "UPDATE %s SET %s WHERE id=%s" % (obj_schema.table_name,
-                    ', '.join(setters), obj.id)
+            sql = self._update_sql(obj_schema, setters)
+            values.append(obj.id)
             self.execute(sql, values, is_update=True)
             if (self.cursor.rowcount != 1 and not
                     self._quitting_from_operational_error):
@@ -963,11 +1357,29 @@ class LiveStorage(signals.SignalEmitter):
                             "(id: %s, count: %s)" %
                             (obj.id, self.cursor.rowcount))
 
+    def _update_sql(self, obj_schema, columns):
+        """Get the SQL to update some columns of a row.
+
+        The values for columns should be bound in order, followed by the id.
+        """
+        columns = tuple(columns)
+        return self.statement_cache.get(
+                ('update', obj_schema.table_name, columns),
+                self._build_update_sql, obj_schema.table_name, columns)
+
+    def _build_update_sql(self, table_name, columns):
+        return "UPDATE %s SET %s WHERE id=?" % (table_name,
+                ', '.join('%s=?' % name for name in columns))
+
     def remove_obj(self, obj):
         """Remove a DDBObject from disk."""
 
         schema = self._schema_map[obj.__class__]
-        sql = "DELETE FROM %s WHERE id=?" % (schema.table_name)
+        # code that handles the removed signal may still need the values
+        self.load_lazy_columns([obj])
+        sql = self.statement_cache.get(('delete', schema.table_name, 1),
+                _in_clause_sql, "DELETE FROM %s WHERE id IN " %
+                schema.table_name, 1)
         self.execute(sql, (obj.id,), is_update=True)
         self.forget_object(obj)
 
@@ -984,13 +1396,17 @@ class LiveStorage(signals.SignalEmitter):
         for obj in objects:
             if obj_schema != self._schema_map[obj.__class__]:
                 raise ValueError("Incompatible types for bulk remove")
+        # code that handles the removed signal may still need the values
+        self.load_lazy_columns(objects)
         # we can only feed sqlite so many variables at once, send it chunks of
         # 900 ids at once
+        sql_start = "DELETE FROM %s WHERE id IN " % obj_schema.table_name
         for objects_chunk in util.split_values_for_sqlite(objects):
-            commas = ','.join('?' for x in xrange(len(objects_chunk)))
-            sql = "DELETE FROM %s WHERE id IN (%s)" % (obj_schema.table_name,
-                    commas)
-            self.execute(sql, [o.id for o in objects_chunk], is_update=True)
+            id_list = pad_ids_for_sqlite([o.id for o in objects_chunk])
+            sql = self.statement_cache.get(
+                    ('delete', obj_schema.table_name, len(id_list)),
+                    _in_clause_sql, sql_start, len(id_list))
+            self.execute(sql, id_list, is_update=True)
         for obj in objects:
             self.forget_object(obj)
 
@@ -1015,11 +1431,20 @@ class LiveStorage(signals.SignalEmitter):
         This will throw a KeyError if id is not in the database, or if the
         object for id has not been loaded yet.
         """
-        return self._object_map[(id_, self.table_name(klass))]
+        key = (id_, self.table_name(klass))
+        try:
+            obj = self._object_map[key]
+        except KeyError:
+            return self._revive_object(key)
+        if key in self._object_access:
+            self._object_access[key] = self._access_counter.next()
+        self._object_cache_stats['hits'] += 1
+        return obj
 
     def id_alive(self, id_, klass):
         """Check if an id exists and is loaded in the database."""
-        return (id_, self.table_name(klass)) in self._object_map
+        key = (id_, self.table_name(klass))
+        return key in self._object_map or key in self._evicted_objects
 
     def fetch_item_infos(self, item_ids):
         return item.fetch_item_infos(self.connection, item_ids)
@@ -1030,14 +1455,44 @@ class LiveStorage(signals.SignalEmitter):
     def schema_fields(self, klass):
         return self._schema_map[klass].fields
 
+    def table_fields(self, table_name):
+        """Get a dict mapping column names to SchemaItems for a table.
+
+        :raises KeyError: table_name isn't one of our tables
+        """
+        for oschema in self._all_schemas:
+            if oschema.table_name == table_name:
+                return dict(oschema.fields)
+        raise KeyError(table_name)
+
     def object_from_class_table(self, obj, klass):
         return self._schema_map[klass] is self._schema_map[obj.__class__]
 
+    def _cached_query(self, kind, select, table_name, where, joins, order_by,
+            limit):
+        """Get the SQL for a SELECT statement from our statement cache."""
+        if joins is not None:
+            joins = tuple(joins.items())
+        return self.statement_cache.get(
+                (kind, table_name, where, joins, order_by, limit),
+                self._build_query, select, table_name, where, joins,
+                order_by, limit)
+
+    def _build_query(self, select, table_name, where, joins, order_by, limit):
+        return select + self._get_query_bottom(table_name, where, joins,
+                order_by, limit)
+
     def _get_query_bottom(self, table_name, where, joins, order_by, limit):
+        """Build the part of a SELECT statement after the column list.
+
+        joins can be a dict or a sequence of (table, on_clause) tuples.
+        """
+        if isinstance(joins, dict):
+            joins = joins.items()
         sql = StringIO()
         sql.write("FROM %s\n" % table_name)
         if joins is not None:
-            for join_table, join_where in joins.items():
+            for join_table, join_where in joins:
                 sql.write('LEFT JOIN %s ON %s\n' % (join_table, join_where))
         if where is not None:
             sql.write("WHERE %s" % where)
@@ -1055,39 +1510,50 @@ class LiveStorage(signals.SignalEmitter):
         table_name = self.table_name(klass)
         unrestored_ids = []
         for id_ in id_list:
-            if (id_, table_name) not in self._ids_loaded:
-                unrestored_ids.append(id_)
+            key = (id_, table_name)
+            if key not in self._ids_loaded:
+                try:
+                    self._revive_object(key)
+                except KeyError:
+                    unrestored_ids.append(id_)
         if unrestored_ids:
+            self._object_cache_stats['misses'] += len(unrestored_ids)
             # restore any objects that we don't already have in memory.
             schema = self._schema_map[klass]
             self._restore_objects(schema, unrestored_ids, db_info)
             return True
         return False
 
+    def query_ids_sql(self, table_name, where, order_by=None, joins=None,
+            limit=None):
+        """Get the SQL that query_ids() runs."""
+        return self._cached_query('ids', "SELECT %s.id " % table_name,
+                table_name, where, joins, order_by, limit)
+
     def query_ids(self, table_name, where, values=None, order_by=None,
             joins=None, limit=None):
-        sql = StringIO()
-        sql.write("SELECT %s.id " % table_name)
-        sql.write(self._get_query_bottom(table_name, where, joins,
-            order_by, limit))
-        self.cursor.execute(sql.getvalue(), values)
-        return (row[0] for row in self.cursor.fetchall())
+        sql = self.query_ids_sql(table_name, where, order_by, joins, limit)
+        if values is None:
+            values = ()
+        rows = self._time_execute(sql, values, False, fetch=True)
+        return (row[0] for row in rows)
 
     def _restore_objects(self, schema, id_set, db_info):
         column_names = ['%s.%s' % (schema.table_name, f[0])
-                for f in schema.fields]
+                for f in self._restore_fields[schema]]
+        sql_start = "SELECT %s FROM %s WHERE id IN " % (
+            ', '.join(column_names), schema.table_name)
 
         # we can only feed sqlite so many variables at once, send it chunks of
         # 900 ids at once
         id_list = tuple(id_set)
         for id_list_chunk in util.split_values_for_sqlite(id_list):
-            sql = StringIO()
-            sql.write("SELECT %s " % (', '.join(column_names),))
-            sql.write("FROM %s WHERE id IN (%s)" % (schema.table_name, 
-                ', '.join('?' for i in xrange(len(id_list_chunk)))))
-
-            self.cursor.execute(sql.getvalue(), id_list_chunk)
-            for row in self.cursor.fetchall():
+            id_list_chunk = pad_ids_for_sqlite(id_list_chunk)
+            sql = self.statement_cache.get(
+                    ('restore', schema.table_name, len(id_list_chunk)),
+                    _in_clause_sql, sql_start, len(id_list_chunk))
+            rows = self._time_execute(sql, id_list_chunk, False, fetch=True)
+            for row in rows:
                 self._restore_object_from_row(schema, row, db_info)
 
     def _restore_object_from_row(self, schema, db_row, db_info):
@@ -1095,7 +1561,7 @@ class LiveStorage(signals.SignalEmitter):
         columns_to_update = []
         values_to_update = []
         for (name, schema_item), value in \
-                itertools.izip(schema.fields, db_row):
+                itertools.izip(self._restore_fields[schema], db_row):
             try:
                 value = self._converter.from_sql(schema, name, schema_item,
                         value)
@@ -1120,23 +1586,65 @@ class LiveStorage(signals.SignalEmitter):
         if columns_to_update:
             # We are using some values that are different than what's stored
             # in disk.  Update the database to make things match.
-            setters = ['%s=?' % c for c in columns_to_update]
-            sql = "UPDATE %s SET %s WHERE id=%s" % (schema.table_name,
-                    ', '.join(setters), restored_data['id'])
+            sql = self._update_sql(schema, columns_to_update)
+            values_to_update.append(restored_data['id'])
             self.execute(sql, values_to_update)
+        self._remember_container_values(schema, restored_data['id'], db_row,
+                self._restore_container_columns[schema])
+        if self._lazy_columns[schema]:
+            restored_data['unloaded_columns'] = self._lazy_columns[schema]
         klass = schema.get_ddb_class(restored_data)
         return klass(restored_data=restored_data, db_info=db_info)
 
+    def load_lazy_columns(self, objects):
+        """Load the lazy columns for a list of objects.
+
+        Objects that don't have unloaded columns are ignored.  Use this to
+        load the columns for many objects at once, rather than having each
+        one load them with a separate query when they get accessed.
+        """
+        to_load = {}
+        for obj in objects:
+            if obj.unloaded_columns:
+                obj_schema = self._schema_map[obj.__class__]
+                to_load.setdefault(obj_schema, {})[obj.id] = obj
+        for obj_schema, obj_map in to_load.items():
+            fields = [(name, schema_item)
+                      for name, schema_item in obj_schema.fields
+                      if name in self._lazy_columns[obj_schema]]
+            sql_start = "SELECT id, %s FROM %s WHERE id IN " % (
+                ', '.join(name for name, schema_item in fields),
+                obj_schema.table_name)
+            id_list = obj_map.keys()
+            for id_list_chunk in util.split_values_for_sqlite(id_list):
+                id_list_chunk = pad_ids_for_sqlite(id_list_chunk)
+                sql = self.statement_cache.get(
+                        ('lazy', obj_schema.table_name, len(id_list_chunk)),
+                        _in_clause_sql, sql_start, len(id_list_chunk))
+                for row in self.execute(sql, id_list_chunk):
+                    obj = obj_map[row[0]]
+                    for (name, schema_item), value in itertools.izip(fields,
+                                                                     row[1:]):
+                        # don't overwrite values that were set while the
+                        # column was unloaded
+                        if name not in obj.__dict__:
+                            obj.__dict__[name] = self._converter.from_sql(
+                                obj_schema, name, schema_item, value)
+            for obj in obj_map.itervalues():
+                for name, schema_item in fields:
+                    if name not in obj.__dict__:
+                        # the row is gone from the database
+                        obj.__dict__[name] = None
+                del obj.unloaded_columns
+
     def persistent_object_count(self):
         return len(self._object_map)
 
     def query_count(self, table_name, where, values=None, joins=None,
             limit=None):
-        sql = StringIO()
-        sql.write('SELECT COUNT(*) ')
-        sql.write(self._get_query_bottom(table_name, where, joins,
-            None, limit))
-        return self.execute(sql.getvalue(), values)[0][0]
+        sql = self._cached_query('count', 'SELECT COUNT(*) ', table_name,
+                where, joins, None, limit)
+        return self.execute(sql, values)[0][0]
 
     def delete(self, klass, where, values):
         schema = self._schema_map[klass]
@@ -1149,11 +1657,10 @@ class LiveStorage(signals.SignalEmitter):
     def select(self, klass, columns, where, values, joins=None, limit=None,
             convert=True):
         schema = self._schema_map[klass]
-        sql = StringIO()
-        sql.write('SELECT %s ' % ', '.join(columns))
-        sql.write(self._get_query_bottom(schema.table_name, where, joins, None,
-            limit))
-        results = self.execute(sql.getvalue(), values)
+        sql = self._cached_query(('select', tuple(columns)),
+                'SELECT %s ' % ', '.join(columns), schema.table_name, where,
+                joins, None, limit)
+        results = self.execute(sql, values)
         if not convert:
             return results
         schema_items = [self._schema_column_map[schema, c] for c in columns]
@@ -1168,9 +1675,82 @@ class LiveStorage(signals.SignalEmitter):
         return rows
 
     def on_event_finished(self, eventloop, success):
-        self.finish_transaction(commit=success)
+        if self.group_commit_delay:
+            self._finish_event_savepoint(success)
+            self._maybe_group_commit()
+        else:
+            self.finish_transaction(commit=success)
+        self.evict_objects()
+
+    def _finish_event_savepoint(self, success):
+        """Release or roll back the savepoint for the event that finished."""
+        if self._event_savepoint is None:
+            return
+        if success:
+            self.execute("RELEASE SAVEPOINT event", is_update=True)
+        else:
+            del self._statements_in_transaction[self._event_savepoint:]
+            if not self._quitting_from_operational_error:
+                self.cursor.execute("ROLLBACK TO SAVEPOINT event")
+                self.cursor.execute("RELEASE SAVEPOINT event")
+            # we don't know what's on disk anymore
+            self._saved_container_values = {}
+            if not self._statements_in_transaction:
+                # nothing else to commit.  End the transaction so that
+                # _statements_in_transaction and the connection agree.
+                self._finish_empty_transaction()
+        self._event_savepoint = None
+
+    def _finish_empty_transaction(self):
+        if not self._quitting_from_operational_error:
+            self.cursor.execute("ROLLBACK TRANSACTION")
+        self._cancel_group_commit()
+        self._transaction_start = None
+
+    def _maybe_group_commit(self):
+        """Commit our transaction if it's big or old enough.
+
+        Otherwise, make sure that there's a timeout to commit it later.
+        """
+        if not self._statements_in_transaction:
+            return
+        age = time.time() - self._transaction_start
+        if (age >= self.group_commit_delay or
+                len(self._statements_in_transaction) >=
+                self.group_commit_max_statements):
+            self.finish_transaction()
+        elif self._group_commit_timeout is None:
+            self._group_commit_timeout = eventloop.add_timeout(
+                self.group_commit_delay - age, self._on_group_commit_timeout,
+                "group commit")
+
+    def _on_group_commit_timeout(self):
+        self._group_commit_timeout = None
+        self.finish_transaction()
+
+    def _cancel_group_commit(self):
+        if self._group_commit_timeout is not None:
+            self._group_commit_timeout.cancel()
+            self._group_commit_timeout = None
+
+    def commit_pending(self):
+        """Are there writes that haven't been committed yet?
+
+        With group commit on, this can be True after an event finishes.
+        Code that notifies other connections about changes should wait until
+        it's False.
+        """
+        return len(self._statements_in_transaction) > 0
 
     def finish_transaction(self, commit=True):
+        """Commit (or roll back) our current transaction.
+
+        With group commit on, this is how to flush writes that we're holding
+        back to the disk.
+        """
+        self._cancel_group_commit()
+        self._event_savepoint = None
+        self._transaction_start = None
         if len(self._statements_in_transaction) == 0:
             return
         if not self._quitting_from_operational_error:
@@ -1178,6 +1758,8 @@ class LiveStorage(signals.SignalEmitter):
                 self.cursor.execute("COMMIT TRANSACTION")
             else:
                 self.cursor.execute("ROLLBACK TRANSACTION")
+                # we don't know what's on disk anymore
+                self._saved_container_values = {}
         self._statements_in_transaction = []
         self.emit("transaction-finished", commit)
 
@@ -1198,14 +1780,19 @@ class LiveStorage(signals.SignalEmitter):
 
         if is_update and len(self._statements_in_transaction) == 0:
             self.cursor.execute("BEGIN TRANSACTION")
+            self._transaction_start = time.time()
 
         if values is None:
             values = ()
 
         if is_update:
+            if self.group_commit_delay and self._event_savepoint is None:
+                self._start_event_savepoint()
             self._statements_in_transaction.append((sql, values, many))
+        results = None
         try:
-            self._time_execute(sql, values, many)
+            results = self._time_execute(sql, values, many,
+                                         fetch=not is_update)
         except sqlite3.DatabaseError, e:
             self._log_error(sql, values, many, e)
             if is_update:
@@ -1221,17 +1808,58 @@ class LiveStorage(signals.SignalEmitter):
 
         if is_update:
             return None
-        else:
+        elif results is None:
+            # we re-ran the statement after an error
             return self.cursor.fetchall()
+        else:
+            return results
+
+    def _start_event_savepoint(self):
+        # The SAVEPOINT goes in _statements_in_transaction so that
+        # _try_rerunning_transaction() re-creates it along with the rest of
+        # the transaction.
+        self._event_savepoint = len(self._statements_in_transaction)
+        sql = "SAVEPOINT event"
+        self._statements_in_transaction.append((sql, (), False))
+        try:
+            self._time_execute(sql, (), False)
+        except sqlite3.DatabaseError, e:
+            self._log_error(sql, (), False, e)
+            self._current_select_statement = None
+            self._handle_operational_error(e, True)
+
+    def _time_execute(self, sql, values, many, fetch=False):
+        """Execute a statement and record it with our query profiler.
 
-    def _time_execute(self, sql, values, many):
+        :param fetch: fetch and return the result rows.  SQLite does most of
+            the work for a SELECT while we fetch the rows, so this gives us a
+            much better timing than timing execute() alone.
+        """
         start = time.time()
         if many:
             self.cursor.executemany(sql, values)
         else:
             self.cursor.execute(sql, values)
+        if fetch:
+            results = self.cursor.fetchall()
+            row_count = len(results)
+        else:
+            results = None
+            row_count = max(self.cursor.rowcount, 0)
         end = time.time()
-        self._check_time(sql, end-start)
+        if many:
+            if values:
+                values = values[0]
+            else:
+                values = ()
+        self.query_profiler.record(sql, values, end - start, row_count,
+                                   self._explain_query)
+        return results
+
+    def _explain_query(self, sql, values):
+        # use a separate cursor so we don't lose the results of our query
+        return self.connection.execute("EXPLAIN QUERY PLAN " + sql,
+                                       values).fetchall()
 
     def _log_error(self, sql, values, many, e):
             # printing the traceback here in whole rather than doing
@@ -1305,6 +1933,9 @@ class LiveStorage(signals.SignalEmitter):
             # reset _statements_in_transaction.  The data for the old DB is
             # now lost
             self._statements_in_transaction = []
+            self._event_savepoint = None
+            self._transaction_start = None
+            self._cancel_group_commit()
             self.cursor = self.connection.cursor()
             self._init_database()
             return False
@@ -1312,30 +1943,6 @@ class LiveStorage(signals.SignalEmitter):
             logging.warn("Bad return value for handle_save_error: %s", action)
             raise
 
-    def _check_time(self, sql, query_time):
-        SINGLE_QUERY_LIMIT = 0.5
-        CUMULATIVE_LIMIT = 1.0
-        if query_time > SINGLE_QUERY_LIMIT:
-            logging.timing("query slow (%0.3f seconds): %s", query_time, sql)
-
-        return # comment out to test cumulative query times
-
-        # more than half a second in the last
-        old_times = self._query_times.setdefault(sql, [])
-        now = time.time()
-        dropoff_time = now - 5
-        cumulative = query_time
-        for i in reversed(xrange(len(old_times))):
-            old_time, old_query_time = old_times[i]
-            if old_time < dropoff_time:
-                old_times = old_times[i+1:]
-                break
-            cumulative += old_query_time
-        old_times.append((now, query_time))
-        if cumulative > CUMULATIVE_LIMIT:
-            logging.timing('query cumulatively slow: %0.2f '
-                    '(%0.03f): %s', cumulative, query_time, sql)
-
     def _calc_created_new(self):
         """Decide if the database that we just opened is new."""
         self.cursor.execute("SELECT COUNT(*) FROM sqlite_master "
@@ -1356,12 +1963,54 @@ class LiveStorage(signals.SignalEmitter):
             for name, columns in schema.unique_indexes:
                 self.cursor.execute("CREATE UNIQUE INDEX %s ON %s (%s)" %
                         (name, schema.table_name, ', '.join(columns)))
+        indexregistry.sync_indexes(self.cursor, self._object_schemas)
         self._create_variables_table()
         self.set_version()
         self.setup_fulltext_search()
 
     def setup_fulltext_search(self):
-        fulltextsearch.setup_fulltext_search(self.connection)
+        fulltextsearch.setup_fulltext_search(self.connection,
+                self.fulltext_table, self.fulltext_path_column,
+                self.fulltext_has_entry_description)
+
+    def rebuild_fulltext_index(self, progress_callback=None):
+        """Rebuild item_fts in the background.
+
+        This is for existing databases whose index got out of date or too
+        fragmented.  We index a chunk of items at a time and commit after
+        each one, so the rest of the app keeps running while we work.
+
+        :param progress_callback: function to call after each chunk.  It's
+            passed (items_done, total_items) and gets called with
+            items_done == total_items once we're finished.
+        """
+        eventloop.idle_iterate(self._rebuild_fulltext_index,
+                               "rebuild fulltext index",
+                               args=(progress_callback,),
+                               lane=eventloop.LANE_BACKGROUND)
+
+    def _rebuild_fulltext_index(self, progress_callback):
+        columns = fulltextsearch.fulltext_columns(
+            self.fulltext_path_column, self.fulltext_has_entry_description)
+        self.cursor.execute("SELECT COUNT(*) FROM %s" % self.fulltext_table)
+        total = self.cursor.fetchone()[0]
+        done = 0
+        start_id = 0
+        while start_id is not None:
+            # run our own transaction, like _convert_old_containers().  If
+            # rebuild_chunk() fails, this rolls back its DELETE so that the
+            # items stay searchable.
+            start_id, count = self._run_in_own_transaction(
+                fulltextsearch.rebuild_chunk, self.cursor,
+                self.fulltext_table, columns, start_id)
+            done = min(done + count, total)
+            if progress_callback is not None and start_id is not None:
+                progress_callback(done, total)
+            yield
+        self._run_in_own_transaction(fulltextsearch.optimize,
+                                     self.connection)
+        if progress_callback is not None:
+            progress_callback(total, total)
 
     def _get_size_info(self):
         """Get info about the database size
@@ -1469,14 +2118,16 @@ class LiveStorage(signals.SignalEmitter):
 
 class DeviceLiveStorage(LiveStorage):
     """Version of LiveStorage used for a device."""
-    def setup_fulltext_search(self):
-        fulltextsearch.setup_fulltext_search(self.connection, 'device_item')
+    fulltext_table = 'device_item'
 
     def show_upgrade_progress(self):
         return False
 
 class SharingLiveStorage(LiveStorage):
     """Version of LiveStorage used for a device."""
+    fulltext_table = 'sharing_item'
+    fulltext_path_column = 'video_path'
+    fulltext_has_entry_description = False
 
     def __init__(self, path, share_name, object_schemas):
         error_handler = SharingLiveStorageErrorHandler(share_name)
@@ -1495,11 +2146,6 @@ class SharingLiveStorage(LiveStorage):
         self.cursor.execute("PRAGMA temp_store=MEMORY")
         self.cursor.execute("PRAGMA journal_mode=MEMORY")
 
-    def setup_fulltext_search(self):
-        fulltextsearch.setup_fulltext_search(self.connection, 'sharing_item',
-                                             path_column='video_path',
-                                             has_entry_description=False)
-
 class SQLiteConverter(object):
     def __init__(self):
         self._to_sql_converters = {
@@ -1581,9 +2227,13 @@ class SQLiteConverter(object):
         return filename_to_unicode(value)
 
     def _repr_to_sql(self, value, schema_item):
-        return repr(value)
+        return buffer(containerformat.encode(value))
 
     def _repr_from_sql(self, value, schema_item):
+        if isinstance(value, buffer):
+            return containerformat.decode(value)
+        # Older databases store these columns using repr().  We convert them
+        # when the object gets saved, or by convert_old_containers().
         return eval(value, __builtins__, {'datetime': datetime, 'time': _TIME_MODULE_SHADOW})
 
     def _string_set_to_sql(self, value, schema_item):
@@ -55,6 +55,14 @@ from miro.test.databasesanitytest import *
 from miro.test.subscriptiontest import *
 from miro.test.opmltest import *
 from miro.test.schedulertest import *
+from miro.test.eventlooptest import *
+from miro.test.futurestest import *
+from miro.test.queryprofiletest import *
+from miro.test.dbmaintenancetest import *
+from miro.test.connectionpooltest import *
+from miro.test.itemstoretest import *
+from miro.test.fulltextsearchtest import *
+from miro.test.searchtest import *
 from miro.test.networktest import *
 from miro.test.httpclienttest import *
 from miro.test.httpdownloadertest import *
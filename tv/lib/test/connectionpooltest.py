@@ -0,0 +1,129 @@
+import threading
+import time
+
+from miro.data import connectionpool
+from miro.test.framework import MiroTestCase
+
+class ConnectionPoolTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.db_path = self.make_temp_path('.sqlite')
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.destroy()
+        MiroTestCase.tearDown(self)
+
+    def make_pool(self, **kwargs):
+        pool = connectionpool.ConnectionPool(self.db_path, **kwargs)
+        self.pools.append(pool)
+        return pool
+
+    def test_reuse(self):
+        pool = self.make_pool(min_connections=0, max_connections=2)
+        connection = pool.get_connection()
+        pool.release_connection(connection)
+        # connections stay open until they've been idle for idle_ttl
+        self.assert_(pool.get_connection() is connection)
+        self.assertEquals(pool.get_stats()['opened'], 1)
+
+    def test_idle_ttl(self):
+        pool = self.make_pool(min_connections=1, max_connections=3)
+        connections = [pool.get_connection() for i in xrange(3)]
+        for connection in connections:
+            pool.release_connection(connection)
+        self.assertEquals(len(pool.free_connections), 3)
+        pool.close_idle_connections()
+        self.assertEquals(len(pool.free_connections), 3)
+        pool.close_idle_connections(0)
+        # we should keep min_connections open, using the one that was most
+        # recently released
+        self.assertEquals(pool.free_connections, [connections[-1]])
+        self.assertEquals(pool.all_connections, set([connections[-1]]))
+        self.assertEquals(pool.get_stats()['expired'], 2)
+
+    def test_idle_ttl_on_release(self):
+        pool = self.make_pool(min_connections=0, max_connections=2,
+                              idle_ttl=0)
+        connection = pool.get_connection()
+        pool.release_connection(connection)
+        self.assertEquals(len(pool.all_connections), 0)
+
+    def test_warm_up(self):
+        pool = self.make_pool(min_connections=3, max_connections=5)
+        pool.warm_up()
+        self.assertEquals(len(pool.free_connections), 3)
+        pool.warm_up(10)
+        self.assertEquals(len(pool.free_connections), 5)
+        self.assertEquals(pool.get_stats()['checkouts'], 1)
+
+    def test_extra_connections(self):
+        # If the current thread has all the connections, there's no point
+        # in waiting.  We should open an extra one right away.
+        pool = self.make_pool(min_connections=0, max_connections=2)
+        connections = [pool.get_connection() for i in xrange(3)]
+        self.assertEquals(len(set(connections)), 3)
+        stats = pool.get_stats()
+        self.assertEquals(stats['overflows'], 1)
+        self.assertEquals(stats['waits'], 0)
+        self.assertEquals(stats['in_use'], 3)
+        self.assertEquals(stats['max_in_use'], 3)
+        # the extra connection gets closed once it's released
+        pool.release_connection(connections.pop())
+        self.assertEquals(len(pool.all_connections), 2)
+        self.assertEquals(pool.free_connections, [])
+        for connection in connections:
+            pool.release_connection(connection)
+        self.assertEquals(len(pool.free_connections), 2)
+        self.assertEquals(pool.get_stats()['in_use'], 0)
+
+    def start_thread_with_connection(self, pool, hold_time):
+        """Start a thread that holds a connection for a while."""
+        got_connection = threading.Event()
+        def thread_func():
+            connection = pool.get_connection()
+            got_connection.set()
+            time.sleep(hold_time)
+            pool.release_connection(connection)
+        thread = threading.Thread(target=thread_func)
+        thread.start()
+        got_connection.wait()
+        return thread
+
+    def test_wait(self):
+        pool = self.make_pool(min_connections=0, max_connections=1)
+        thread = self.start_thread_with_connection(pool, 0.1)
+        connection = pool.get_connection(timeout=5.0)
+        thread.join()
+        stats = pool.get_stats()
+        self.assertEquals(stats['waits'], 1)
+        self.assert_(stats['wait_time'] > 0.0)
+        self.assertEquals(stats['overflows'], 0)
+        self.assertEquals(pool.all_connections, set([connection]))
+
+    def test_wait_timeout(self):
+        pool = self.make_pool(min_connections=0, max_connections=1)
+        thread = self.start_thread_with_connection(pool, 0.2)
+        connection = pool.get_connection(timeout=0.01)
+        stats = pool.get_stats()
+        self.assertEquals(stats['waits'], 1)
+        self.assertEquals(stats['overflows'], 1)
+        self.assertEquals(len(pool.all_connections), 2)
+        thread.join()
+        pool.release_connection(connection)
+        self.assertEquals(len(pool.all_connections), 1)
+
+    def test_release_errors(self):
+        pool = self.make_pool()
+        other_pool = self.make_pool()
+        connection = other_pool.get_connection()
+        self.assertRaises(ValueError, pool.release_connection, connection)
+
+    def test_report(self):
+        pool = self.make_pool()
+        with pool.context() as connection:
+            connection.execute("SELECT 1")
+        report = pool.format_report()
+        self.assert_(self.db_path in report)
+        self.assert_('checkouts: 2' in report)
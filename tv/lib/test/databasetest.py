@@ -7,6 +7,7 @@ from miro import databaselog
 from miro import item
 from miro import feed
 from miro import schema
+from miro import viewpredicate
 
 class DatabaseTestCase(MiroTestCase):
     def setUp(self):
@@ -209,6 +210,193 @@ class DDBObjectTestCase(MiroTestCase):
         testobj.bar = 2
         self.assertEquals(testobj.changed_attributes, set(['foo']))
 
+class PredicateObject(database.DDBObject):
+    def setup_new(self, name=None, count=0, flag=False, owner_id=None):
+        self.name = name
+        self.count = count
+        self.flag = flag
+        self.owner_id = owner_id
+        self.data = None
+
+class PredicateObjectSchema(schema.ObjectSchema):
+    klass = PredicateObject
+    table_name = 'predicate_object'
+    fields = [
+        ('id', schema.SchemaInt()),
+        ('name', schema.SchemaString(noneOk=True)),
+        ('count', schema.SchemaInt()),
+        ('flag', schema.SchemaBool()),
+        ('owner_id', schema.SchemaInt(noneOk=True)),
+        ('data', schema.SchemaDict({}, {}, noneOk=True)),
+    ]
+
+class FakeObject(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class ViewPredicateTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.columns = dict(PredicateObjectSchema.fields)
+        self.obj = FakeObject(id=1, name=u'foo', count=3, flag=True,
+                              owner_id=None, data=None)
+
+    def compile(self, where, values=()):
+        return viewpredicate.compile_where(where, values, 'predicate_object',
+                                           self.columns)
+
+    def check(self, where, values=(), expected=True):
+        predicate = self.compile(where, values)
+        self.assertNotEquals(predicate, None)
+        self.assertEquals(predicate(self.obj), expected)
+
+    def test_comparisons(self):
+        self.check("name='foo'")
+        self.check("name=?", (u'foo',))
+        self.check("name<>?", (u'bar',))
+        self.check("predicate_object.count = 3")
+        self.check("count >= ?", (3,))
+        self.check("count < 3", expected=False)
+        self.check("name='it''s'", expected=False)
+
+    def test_null(self):
+        self.check("owner_id IS NULL")
+        self.check("owner_id IS NOT NULL", expected=False)
+        self.check("data IS NULL")
+        # comparisons with NULL are never true
+        self.check("owner_id=1", expected=False)
+        self.check("NOT owner_id=1", expected=False)
+        self.check("owner_id<>1", expected=False)
+
+    def test_in(self):
+        self.check("count IN (1, 2, 3)")
+        self.check("count NOT IN (?, ?)", (1, 2))
+        self.check("name IN ('bar')", expected=False)
+
+    def test_boolean_logic(self):
+        self.check("flag")
+        self.check("NOT flag", expected=False)
+        self.check("flag AND (count=1 OR name='foo')")
+        self.check("count=1 AND name='foo'", expected=False)
+        # NULL OR TRUE is TRUE, NULL AND TRUE is NULL
+        self.check("owner_id=1 OR flag")
+        self.check("owner_id=1 AND flag", expected=False)
+        self.check("NOT (owner_id=1 AND flag)", expected=False)
+        self.check("NOT (owner_id=1 AND NOT flag)")
+
+    def test_columns(self):
+        predicate = self.compile("flag AND (count=? OR owner_id IS NULL)",
+                                 (1,))
+        self.assertEquals(predicate.columns,
+                          set(['flag', 'count', 'owner_id']))
+        self.assertEquals(self.compile(None).columns, set())
+
+    def test_unsupported(self):
+        for where, values in [
+                ("name LIKE 'foo%'", ()),
+                ("feed.userTitle='booya'", ()),
+                ("unknown_column=1", ()),
+                ("lower(name)='foo'", ()),
+                ("count=?", (u'3',)),
+                ("name=?", (3,)),
+                ("data={}", ()),
+                ("name", ()),
+                ("count=? AND flag", ()),
+                ("count=1", (1,)),
+                ("count=1 flag", ()),
+                ("id IN (SELECT id FROM predicate_object)", ()),
+            ]:
+            self.assertEquals(self.compile(where, values), None,
+                              "compiled %r" % where)
+
+class ViewTrackerPredicateTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.reload_database(schema_version=0,
+                object_schemas=[PredicateObjectSchema])
+        self.objects = [PredicateObject(u'obj%d' % i, count=i)
+                        for i in range(10)]
+        self.query_count_calls = 0
+        self.query_ids_calls = 0
+        self.patch_function('miro.storedatabase.LiveStorage.query_count',
+                            self.counting_wrapper(app.db.query_count,
+                                                  'query_count_calls'))
+        self.patch_function('miro.storedatabase.LiveStorage.query_ids',
+                            self.counting_wrapper(app.db.query_ids,
+                                                  'query_ids_calls'))
+
+    def counting_wrapper(self, func, attr):
+        def wrapper(db, *args, **kwargs):
+            setattr(self, attr, getattr(self, attr) + 1)
+            return func(*args, **kwargs)
+        return wrapper
+
+    def make_tracker(self, where, values=()):
+        tracker = PredicateObject.make_view(where, values).make_tracker()
+        tracker.added = []
+        tracker.removed = []
+        tracker.changed = []
+        tracker.connect('added', lambda t, obj: t.added.append(obj))
+        tracker.connect('removed', lambda t, obj: t.removed.append(obj))
+        tracker.connect('changed', lambda t, obj: t.changed.append(obj))
+        self.query_count_calls = self.query_ids_calls = 0
+        return tracker
+
+    def test_in_memory_check(self):
+        tracker = self.make_tracker('flag AND count < ?', (5,))
+        self.assertNotEquals(tracker.predicate, None)
+        self.objects[0].flag = True
+        self.objects[0].signal_change()
+        self.objects[7].flag = True
+        self.objects[7].signal_change()
+        self.objects[0].count = 8
+        self.objects[0].signal_change()
+        self.assertEquals(tracker.added, [self.objects[0]])
+        self.assertEquals(tracker.removed, [self.objects[0]])
+        self.assertEquals(tracker.changed, [])
+        self.assertEquals(self.query_count_calls, 0)
+        self.assertEquals(self.query_ids_calls, 0)
+
+    def test_unsaved_changes(self):
+        # if the object has unsaved changes to a column that the view uses,
+        # the database is the one to trust
+        tracker = self.make_tracker('flag')
+        self.objects[0].flag = True
+        self.objects[0].signal_change(needs_save=False)
+        self.assertEquals(tracker.added, [])
+        self.assertEquals(self.query_count_calls, 1)
+
+    def test_fallback(self):
+        tracker = self.make_tracker("name LIKE 'obj1%'")
+        self.assertEquals(tracker.predicate, None)
+        self.objects[1].name = u'other'
+        self.objects[1].signal_change()
+        self.assertEquals(tracker.removed, [self.objects[1]])
+        self.assertEquals(self.query_count_calls, 1)
+
+    def test_bulk(self):
+        # in bulk mode, the trackers should check all changed objects at
+        # once.  For views that we can't check in memory, that means 1 query.
+        sql_tracker = self.make_tracker("name LIKE 'changed%'")
+        memory_tracker = self.make_tracker("count >= 5")
+        app.bulk_sql_manager.start()
+        for obj in self.objects:
+            obj.name = u'changed'
+            obj.count += 1
+            obj.signal_change()
+        self.objects[3].remove()
+        self.assertEquals(sql_tracker.added, [])
+        app.bulk_sql_manager.finish()
+        self.assertEquals(self.query_ids_calls, 1)
+        self.assertEquals(self.query_count_calls, 0)
+        self.assertEquals(sql_tracker.added,
+                          self.objects[:3] + self.objects[4:])
+        self.assertEquals(sql_tracker.removed, [])
+        self.assertEquals(memory_tracker.added, [self.objects[4]])
+        self.assertEquals(memory_tracker.changed, self.objects[5:])
+        self.assertEquals(len(sql_tracker), 9)
+        self.assertEquals(len(memory_tracker), 6)
+
 class DatabaseLoggingTest(MiroTestCase):
     def check_db_logs(self, count):
         records = self.log_filter.records
@@ -0,0 +1,181 @@
+import os
+import sqlite3
+import time
+
+from miro import app
+from miro import dbmaintenance
+from miro.test.framework import MiroTestCase, EventLoopTest
+
+class RunMaintenanceTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.db_path = self.make_temp_path('.sqlite')
+        self.connection = sqlite3.connect(self.db_path,
+                                          isolation_level=None)
+        self.connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.connection.execute("PRAGMA journal_mode=wal")
+        # let the WAL grow so that we have something to checkpoint
+        self.connection.execute("PRAGMA wal_autocheckpoint=0")
+        self.connection.execute("CREATE TABLE item (data TEXT)")
+        self.old_checkpoint_size = dbmaintenance.WAL_CHECKPOINT_SIZE
+        self.old_restart_size = dbmaintenance.WAL_RESTART_SIZE
+
+    def tearDown(self):
+        dbmaintenance.WAL_CHECKPOINT_SIZE = self.old_checkpoint_size
+        dbmaintenance.WAL_RESTART_SIZE = self.old_restart_size
+        self.connection.close()
+        MiroTestCase.tearDown(self)
+
+    def add_rows(self, count):
+        self.connection.execute("BEGIN")
+        self.connection.executemany("INSERT INTO item VALUES (?)",
+                                    [('x' * 1000,)] * count)
+        self.connection.execute("COMMIT")
+
+    def test_passive_checkpoint(self):
+        self.add_rows(100)
+        wal_size = dbmaintenance.wal_size(self.db_path)
+        self.assert_(wal_size > 100 * 1000)
+        dbmaintenance.WAL_CHECKPOINT_SIZE = wal_size - 1
+        result = dbmaintenance.run_maintenance(self.db_path, False, False)
+        self.assertEquals(result['checkpoint'], 'PASSIVE')
+        self.assert_(result['pages_checkpointed'] > 0)
+        self.assert_(not result['checkpoint_busy'])
+
+    def test_restart_checkpoint(self):
+        self.add_rows(100)
+        dbmaintenance.WAL_RESTART_SIZE = 0
+        result = dbmaintenance.run_maintenance(self.db_path, False, False)
+        self.assertEquals(result['checkpoint'], 'RESTART')
+        self.assert_(not result['checkpoint_busy'])
+        # the next writes should reuse the WAL from the beginning rather
+        # than growing it
+        self.add_rows(100)
+        self.assertEquals(dbmaintenance.wal_size(self.db_path),
+                          result['wal_size_before'])
+
+    def test_no_checkpoint(self):
+        self.add_rows(1)
+        result = dbmaintenance.run_maintenance(self.db_path, False, False)
+        self.assertEquals(result['checkpoint'], None)
+
+    def test_vacuum(self):
+        self.add_rows(500)
+        self.connection.execute("DELETE FROM item")
+        result = dbmaintenance.run_maintenance(self.db_path, False, False)
+        self.assertEquals(result['vacuumed_pages'], 0)
+        self.assert_(dbmaintenance.fragmentation(result['page_stats']) >
+                     dbmaintenance.FRAGMENTATION_LIMIT)
+        result = dbmaintenance.run_maintenance(self.db_path, True, False)
+        self.assert_(result['vacuumed_pages'] > 0)
+        self.assertEquals(result['page_stats']['freelist_count'], 0)
+
+    def test_analyze(self):
+        self.connection.execute("CREATE INDEX item_data ON item (data)")
+        self.add_rows(10)
+        result = dbmaintenance.run_maintenance(self.db_path, False, True)
+        self.assert_(result['analyzed'])
+        rows = self.connection.execute("SELECT * FROM sqlite_stat1")
+        self.assert_(len(rows.fetchall()) > 0)
+
+    def test_fts_merge(self):
+        self.connection.execute("CREATE VIRTUAL TABLE item_fts "
+                                "USING fts4(title text)")
+        # each commit adds a segment to the index.  FTS4 merges them itself
+        # once there's 16, so this leaves 14 for us to merge.
+        for i in xrange(30):
+            self.connection.execute("INSERT INTO item_fts(title) VALUES (?)",
+                                    ('title %d' % i,))
+        result = dbmaintenance.run_maintenance(self.db_path, False, False,
+                                               True)
+        self.assert_(result['fts_merge_steps'] > 0)
+        result = dbmaintenance.run_maintenance(self.db_path, False, False,
+                                               True)
+        self.assertEquals(result['fts_merge_steps'], 0)
+
+    def test_busy(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        self.connection.execute("INSERT INTO item VALUES ('x')")
+        old_timeout = dbmaintenance.BUSY_TIMEOUT
+        dbmaintenance.BUSY_TIMEOUT = 0
+        try:
+            result = dbmaintenance.run_maintenance(self.db_path, False,
+                                                   True)
+        finally:
+            dbmaintenance.BUSY_TIMEOUT = old_timeout
+            self.connection.execute("ROLLBACK")
+        self.assert_(result['busy'])
+        self.assert_(not result['analyzed'])
+
+class DatabaseMaintainerTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.reload_database(self.make_temp_path('.sqlite'))
+        self.maintainer = dbmaintenance.DatabaseMaintainer(app.db)
+
+    def tearDown(self):
+        self.maintainer.stop()
+        EventLoopTest.tearDown(self)
+
+    def test_new_database_auto_vacuum(self):
+        page_stats = dbmaintenance.read_page_stats(app.db.cursor)
+        self.assertEquals(page_stats['auto_vacuum'],
+                          dbmaintenance.AUTO_VACUUM_INCREMENTAL)
+
+    def test_disabled_for_memory_db(self):
+        self.reload_database()
+        maintainer = dbmaintenance.DatabaseMaintainer(app.db)
+        self.assert_(not maintainer.enabled)
+        maintainer.start()
+        self.assertEquals(maintainer._timeout, None)
+
+    def test_idle(self):
+        self.maintainer.start()
+        self.maintainer.last_commit = 0
+        self.assert_(self.maintainer.is_idle())
+        app.db.set_variable('test', 1)
+        self.assert_(not self.maintainer.is_idle())
+
+    def test_check(self):
+        self.maintainer.last_commit = 0
+        self.maintainer.check()
+        self.assert_(self.maintainer._running)
+        # we shouldn't start a second run while the first one is going
+        self.maintainer.check()
+        self.processThreads()
+        self.process_idles()
+        self.assert_(not self.maintainer._running)
+        stats = self.maintainer.get_stats()
+        self.assertEquals(stats['runs'], 1)
+        self.assertEquals(stats['analyzes'], 1)
+        self.assert_(not self.maintainer.analyze_due())
+        self.assert_(stats['page_stats']['page_count'] > 0)
+        report = self.maintainer.format_report()
+        self.assert_('analyzes: 1' in report)
+
+    def test_check_not_idle(self):
+        self.maintainer.check()
+        self.assert_(not self.maintainer._running)
+        self.assertEquals(self.maintainer.get_stats()['runs'], 0)
+
+    def test_record_result(self):
+        page_stats = {'page_count': 100, 'freelist_count': 20,
+                      'page_size': 1024, 'auto_vacuum': 2}
+        self.maintainer.record_result({
+            'checkpoint': 'PASSIVE', 'checkpoint_busy': True,
+            'pages_checkpointed': 10, 'vacuumed_pages': 5,
+            'analyzed': False, 'fts_merge_steps': 3, 'busy': False,
+            'page_stats': page_stats,
+            'wal_size_before': 5000, 'wal_size_after': 100,
+            'duration': 0.5,
+        })
+        stats = self.maintainer.get_stats()
+        self.assertEquals(stats['passive_checkpoints'], 1)
+        self.assertEquals(stats['checkpoints_busy'], 1)
+        self.assertEquals(stats['pages_checkpointed'], 10)
+        self.assertEquals(stats['vacuums'], 1)
+        self.assertEquals(stats['vacuumed_pages'], 5)
+        self.assertEquals(stats['fts_merge_steps'], 3)
+        self.assertEquals(stats['wal_size'], 100)
+        self.assertEquals(stats['max_wal_size'], 5000)
+        self.assertAlmostEquals(stats['fragmentation'], 0.2)
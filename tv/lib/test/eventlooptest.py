@@ -0,0 +1,482 @@
+import select
+import threading
+import time
+
+from miro import eventloop
+from miro import util
+from miro.test.framework import MiroTestCase, EventLoopTest
+
+class PollerTestBase(object):
+    # mixin for the poller tests, subclasses also derive from MiroTestCase
+    poller_class = None
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.poller = self.poller_class()
+        self.sock1, self.sock2 = util.make_dummy_socket_pair()
+
+    def tearDown(self):
+        self.poller.close()
+        self.sock1.close()
+        self.sock2.close()
+        MiroTestCase.tearDown(self)
+
+    def check_poll(self, read_ready, write_ready):
+        r, w, x = self.poller.poll(0.1)
+        self.assertSameSet(r, read_ready)
+        self.assertSameSet(w, write_ready)
+
+    def test_read(self):
+        fd = self.sock2.fileno()
+        self.poller.register(fd, eventloop.POLL_READ)
+        self.check_poll([], [])
+        self.sock1.send("x")
+        self.check_poll([fd], [])
+        # registrations stay around until we unregister
+        self.check_poll([fd], [])
+        self.poller.unregister(fd)
+        self.check_poll([], [])
+
+    def test_write(self):
+        fd = self.sock1.fileno()
+        self.poller.register(fd, eventloop.POLL_WRITE)
+        self.check_poll([], [fd])
+        self.poller.register(fd, eventloop.POLL_READ | eventloop.POLL_WRITE)
+        self.sock2.send("x")
+        self.check_poll([fd], [fd])
+        self.poller.register(fd, 0)
+        self.check_poll([], [])
+
+    def test_unregister_unknown(self):
+        # unregistering something that's not registered should be a no-op
+        self.poller.unregister(self.sock1.fileno())
+
+    def test_set_fds(self):
+        fd1 = self.sock1.fileno()
+        fd2 = self.sock2.fileno()
+        self.sock1.send("x")
+        self.poller.set_fds([fd2], [fd1])
+        self.check_poll([fd2], [fd1])
+        self.poller.set_fds([fd2], [])
+        self.check_poll([fd2], [])
+        self.assertEquals(self.poller.fds, {fd2: eventloop.POLL_READ})
+
+class SelectPollerTest(PollerTestBase, MiroTestCase):
+    poller_class = eventloop.SelectPoller
+
+if hasattr(select, 'poll'):
+    class PollPollerTest(PollerTestBase, MiroTestCase):
+        poller_class = eventloop.PollPoller
+
+if hasattr(select, 'epoll'):
+    class EpollPollerTest(PollerTestBase, MiroTestCase):
+        poller_class = eventloop.EpollPoller
+
+class EventLoopPollerTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.sock1, self.sock2 = util.make_dummy_socket_pair()
+        self.read_data = []
+
+    def tearDown(self):
+        eventloop.stop_handling_socket(self.sock2)
+        self.sock1.close()
+        self.sock2.close()
+        EventLoopTest.tearDown(self)
+
+    def on_readable(self):
+        self.read_data.append(self.sock2.recv(1024))
+        eventloop.remove_read_callback(self.sock2)
+        self.stopEventLoop(abnormal=False)
+
+    def test_read_callback(self):
+        poller = eventloop._eventloop.poller
+        fd = self.sock2.fileno()
+        eventloop.add_read_callback(self.sock2, self.on_readable)
+        self.assertEquals(poller.fds[fd], eventloop.POLL_READ)
+        self.sock1.send("hello")
+        self.runEventLoop()
+        self.assertEquals(self.read_data, ["hello"])
+        # removing the callback should also remove the poller registration
+        self.assert_(fd not in poller.fds)
+
+class EventLoopStatsTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        # clear out any idles that the setup code scheduled
+        self.runPendingIdles()
+        eventloop.stats.reset()
+        self.calls = []
+
+    def callback(self, *args):
+        self.calls.append(args)
+
+    def test_idle_stats(self):
+        for i in xrange(3):
+            eventloop.add_idle(self.callback, "foo", args=(i,))
+        eventloop.add_idle(self.callback, "bar")
+        self.runPendingIdles()
+        stats = eventloop.stats.get_stats()
+        foo_stats = stats['calls']['idle (foo)']
+        self.assertEquals(foo_stats['count'], 3)
+        self.assertEquals(foo_stats['wait_count'], 3)
+        self.assertEquals(sum(foo_stats['histogram']), 3)
+        self.assertEquals(foo_stats['late_count'], 0)
+        self.assertEquals(stats['calls']['idle (bar)']['count'], 1)
+        self.assertEquals(stats['max_queue_depth']['idle-normal'], 4)
+
+    def test_timeout_stats(self):
+        eventloop.add_timeout(0, self.callback, "foo")
+        eventloop.add_timeout(0.1, self.stopEventLoop, "stop", args=(False,))
+        self.runEventLoop()
+        foo_stats = eventloop.stats.get_stats()['calls']['timeout (foo)']
+        self.assertEquals(foo_stats['count'], 1)
+        self.assertEquals(foo_stats['late_count'], 1)
+        self.assertEquals(foo_stats['wait_count'], 0)
+
+    def test_canceled_calls_not_counted(self):
+        dc = eventloop.add_idle(self.callback, "foo")
+        dc.cancel()
+        self.runPendingIdles()
+        self.assert_('idle (foo)' not in eventloop.stats.get_stats()['calls'])
+
+    def test_name_limit(self):
+        stats = eventloop.EventLoopStats()
+        stats.MAX_NAMES = 2
+        for i in xrange(5):
+            stats.record_call("foo-%d" % i, 0, 0.1, queued_at=0)
+        calls = stats.get_stats()['calls']
+        self.assertEquals(len(calls), 3)
+        self.assertEquals(calls['<other>']['count'], 3)
+
+    def test_dump(self):
+        eventloop.add_idle(self.callback, "foo")
+        self.runPendingIdles()
+        path = self.make_temp_path('.txt')
+        eventloop.stats.dump(path)
+        report = open(path).read()
+        self.assert_('idle (foo)' in report)
+
+    def test_disabled(self):
+        eventloop.stats.enabled = False
+        try:
+            eventloop.add_idle(self.callback, "foo")
+            self.runPendingIdles()
+        finally:
+            eventloop.stats.enabled = True
+        self.assertEquals(eventloop.stats.get_stats()['calls'], {})
+
+class IdleLaneTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.runPendingIdles()
+        self.idle_queue = eventloop._eventloop.idle_queue
+        self.calls = []
+
+    def callback(self, value):
+        self.calls.append(value)
+
+    def test_priority(self):
+        eventloop.add_idle(self.callback, "bg", args=('bg',),
+                           lane=eventloop.LANE_BACKGROUND)
+        eventloop.add_idle(self.callback, "normal", args=('normal',))
+        eventloop.add_idle(self.callback, "interactive",
+                           args=('interactive',),
+                           lane=eventloop.LANE_INTERACTIVE)
+        self.runPendingIdles()
+        self.assertEquals(self.calls, ['interactive', 'normal', 'bg'])
+
+    def test_interactive_preempts_background(self):
+        # interactive calls added while background work is running should
+        # run before the next background call.
+        def background_work(value):
+            self.calls.append(value)
+            if value == 'bg1':
+                eventloop.add_idle(self.callback, "interactive",
+                                   args=('interactive',),
+                                   lane=eventloop.LANE_INTERACTIVE)
+        for value in ('bg1', 'bg2'):
+            eventloop.add_idle(background_work, "bg", args=(value,),
+                               lane=eventloop.LANE_BACKGROUND)
+        self.runPendingIdles()
+        self.assertEquals(self.calls, ['bg1', 'interactive', 'bg2'])
+
+    def test_budget(self):
+        self.idle_queue.start_iteration()
+        background = self.idle_queue.lane_map[eventloop.LANE_BACKGROUND]
+        eventloop.add_idle(self.callback, "bg", args=('bg',),
+                           lane=eventloop.LANE_BACKGROUND)
+        self.assert_(self.idle_queue.has_runnable_idle())
+        background.time_used = background.budget
+        # over budget: the call waits for the next iteration
+        self.assert_(not self.idle_queue.has_runnable_idle())
+        self.assert_(self.idle_queue.has_pending_idle())
+        self.assertEquals(eventloop._eventloop.calc_timeout(), 0)
+        self.idle_queue.start_iteration()
+        self.assert_(self.idle_queue.has_runnable_idle())
+
+    def test_unknown_lane(self):
+        self.assertRaises(ValueError, eventloop.add_idle, self.callback,
+                          "foo", lane='bogus')
+
+    def test_idle_iterate_lanes(self):
+        def gen():
+            self.calls.append(self.current_lane())
+            yield eventloop.LANE_BACKGROUND
+            self.calls.append(self.current_lane())
+            yield
+            self.calls.append(self.current_lane())
+        eventloop.idle_iterate(gen, "gen", lane=eventloop.LANE_INTERACTIVE)
+        self.check_lanes([eventloop.LANE_INTERACTIVE,
+                          eventloop.LANE_BACKGROUND,
+                          eventloop.LANE_BACKGROUND])
+
+    def test_idle_iterator_decorator(self):
+        @eventloop.idle_iterator(lane=eventloop.LANE_BACKGROUND)
+        def gen():
+            self.calls.append(self.current_lane())
+            yield
+        gen()
+        self.check_lanes([eventloop.LANE_BACKGROUND])
+
+    def current_lane(self):
+        return self.lane_running
+
+    def check_lanes(self, correct_lanes):
+        # Run the idle queue by hand so that we can track which lane each
+        # call came from.
+        for lane in correct_lanes:
+            eventloop._eventloop._add_idles_for_next_loop()
+            self.lane_running = self.idle_queue._next_lane().name
+            self.idle_queue.process_next_idle()
+        self.assertEquals(self.calls, correct_lanes)
+
+class SchedulerCancelTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.scheduler = eventloop.Scheduler()
+        self.calls = []
+
+    def callback(self, value):
+        self.calls.append(value)
+
+    def add_timeouts(self, count, delay=10):
+        return [self.scheduler.add_timeout(delay, self.callback, 'foo',
+                                           args=(i,))
+                for i in xrange(count)]
+
+    def test_canceled_top_dropped(self):
+        first = self.scheduler.add_timeout(0, self.callback, 'first',
+                                           args=('first',))
+        self.scheduler.add_timeout(10, self.callback, 'second',
+                                   args=('second',))
+        first.cancel()
+        # next_timeout() should be based on the live timer
+        self.assert_(self.scheduler.next_timeout() > 5)
+        self.assertEquals(len(self.scheduler.heap), 1)
+        self.assertEquals(self.scheduler.canceled_count, 0)
+        self.assert_(not self.scheduler.has_pending_timeout())
+
+    def test_compact(self):
+        count = self.scheduler.COMPACT_MIN_CANCELED * 4
+        timeouts = self.add_timeouts(count)
+        for dc in timeouts[:-1]:
+            dc.cancel()
+        self.assertEquals(self.scheduler.live_timeout_count(), 1)
+        # the heap should have been compacted as we went along
+        self.assert_(len(self.scheduler.heap) <= count / 2)
+
+    def test_double_cancel(self):
+        timeouts = self.add_timeouts(2)
+        timeouts[0].cancel()
+        timeouts[0].cancel()
+        self.assertEquals(self.scheduler.live_timeout_count(), 1)
+
+    def test_cancel_after_dispatch(self):
+        dc = self.scheduler.add_timeout(0, self.callback, 'foo', args=(1,))
+        while self.scheduler.has_pending_timeout():
+            self.scheduler.process_next_timeout()
+        dc.cancel()
+        self.assertEquals(self.calls, [1])
+        self.assertEquals(self.scheduler.canceled_count, 0)
+        self.assertEquals(self.scheduler.live_timeout_count(), 0)
+
+    def test_live_timeouts_still_run(self):
+        timeouts = self.add_timeouts(200, delay=0)
+        for dc in timeouts[::2]:
+            dc.cancel()
+        while self.scheduler.has_pending_timeout():
+            self.scheduler.process_next_timeout()
+        self.assertEquals(self.calls, range(1, 200, 2))
+        self.assertEquals(self.scheduler.heap, [])
+
+    def test_cancel_after_pop(self):
+        # Cancel a timeout from another thread right after
+        # process_next_timeout() pops it.  It shouldn't run.
+        dc = self.scheduler.add_timeout(0, self.callback, 'foo', args=(1,))
+        real_lock = self.scheduler.lock
+        class CancelingLock(object):
+            def __init__(self):
+                self.release_count = 0
+            def acquire(self):
+                real_lock.acquire()
+            def release(self):
+                real_lock.release()
+                self.release_count += 1
+                if self.release_count == 1:
+                    # this is the release after popping dc
+                    thread = threading.Thread(target=dc.cancel)
+                    thread.start()
+                    thread.join()
+        self.scheduler.lock = dc.lock = CancelingLock()
+        self.scheduler.process_next_timeout()
+        self.assertEquals(self.calls, [])
+        self.assert_(dc.canceled)
+
+    def test_cancel_waits_for_lock(self):
+        # cancel() from another thread has to wait while the event loop
+        # holds the scheduler lock
+        dc = self.scheduler.add_timeout(0, self.callback, 'foo', args=(1,))
+        self.scheduler.lock.acquire()
+        try:
+            thread = threading.Thread(target=dc.cancel)
+            thread.start()
+            thread.join(0.1)
+            self.assert_(not dc.canceled)
+        finally:
+            self.scheduler.lock.release()
+        thread.join()
+        self.assert_(dc.canceled)
+        self.assertEquals(self.scheduler.live_timeout_count(), 0)
+
+class ThreadPoolTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        # don't start any threads, so we can check the order calls get
+        # picked in
+        self.pool = eventloop.ThreadPool(eventloop._eventloop)
+        self.results = []
+
+    def tearDown(self):
+        self.pool.close_threads()
+        EventLoopTest.tearDown(self)
+
+    def queue(self, task_class, name):
+        return self.pool.queue_call_in_class(task_class, self.results.append,
+                                             None, lambda: name, name, (), {})
+
+    def pick_names(self):
+        names = []
+        self.pool.cond.acquire()
+        try:
+            while True:
+                call = self.pool._pick_next_call()
+                if call is None:
+                    return names
+                names.append(call.name)
+        finally:
+            self.pool.cond.release()
+
+    def test_priority(self):
+        self.queue(eventloop.TASK_CLASS_CODEGEN, 'codegen')
+        self.queue(eventloop.TASK_CLASS_DEFAULT, 'default1')
+        self.queue(eventloop.TASK_CLASS_SHARING, 'sharing')
+        self.queue(eventloop.TASK_CLASS_DNS, 'dns')
+        self.queue(eventloop.TASK_CLASS_DEFAULT, 'default2')
+        # dns is highest priority, default and sharing are tied so they go
+        # in FIFO order, codegen is last.
+        self.assertEquals(self.pick_names(),
+                          ['dns', 'default1', 'sharing', 'default2',
+                           'codegen'])
+
+    def test_max_running(self):
+        self.pool.register_task_class('limited', 5, max_running=2)
+        for i in range(4):
+            self.queue('limited', 'limited%d' % i)
+        self.queue(eventloop.TASK_CLASS_DEFAULT, 'default')
+        self.assertEquals(self.pick_names(),
+                          ['limited0', 'limited1', 'default'])
+        # finishing a call lets the next one start
+        self.pool.task_classes['limited'].running -= 1
+        self.assertEquals(self.pick_names(), ['limited2'])
+
+    def test_unknown_class(self):
+        self.assertRaises(ValueError, self.queue, 'not-a-class', 'foo')
+
+    def test_cancel(self):
+        call = self.queue(eventloop.TASK_CLASS_DEFAULT, 'canceled')
+        self.queue(eventloop.TASK_CLASS_DEFAULT, 'kept')
+        self.assert_(call.cancel())
+        self.assert_(not call.cancel())
+        self.assertEquals(self.pick_names(), ['kept'])
+        stats = self.pool.get_stats()[eventloop.TASK_CLASS_DEFAULT]
+        self.assertEquals(stats['canceled_count'], 1)
+        self.assertEquals(stats['call_count'], 1)
+
+    def test_cancel_after_start(self):
+        call = self.queue(eventloop.TASK_CLASS_DEFAULT, 'started')
+        self.pick_names()
+        self.assert_(not call.cancel())
+
+    def test_run_calls(self):
+        self.pool.init_threads()
+        for i in range(10):
+            self.queue(eventloop.TASK_CLASS_DEFAULT, i)
+        while self.pool.has_pending_calls():
+            time.sleep(0.01)
+        self.pool.close_threads()
+        self.runPendingIdles()
+        self.assertSameSet(self.results, range(10))
+        stats = self.pool.get_stats()[eventloop.TASK_CLASS_DEFAULT]
+        self.assertEquals(stats['call_count'], 10)
+        self.assertEquals(stats['queued'], 0)
+        self.assertEquals(stats['running'], 0)
+
+    def test_grow(self):
+        self.pool.GROW_WAIT_TIME = 0.01
+        self.pool.init_threads()
+        event = threading.Event()
+        for i in range(self.pool.MIN_THREADS + 1):
+            self.pool.queue_call_in_class(eventloop.TASK_CLASS_DEFAULT,
+                                          self.results.append, None,
+                                          event.wait, 'block', (5,), {})
+        # wait until all MIN_THREADS threads are busy
+        for i in range(100):
+            if self.pool.idle_thread_count == 0:
+                break
+            time.sleep(0.01)
+        time.sleep(0.02)
+        self.pool._check_grow()
+        self.assertEquals(len(self.pool.threads), self.pool.MIN_THREADS + 1)
+        event.set()
+
+    def check_idle_wait(self, thread_count):
+        # replace our condition with one that records the timeout for
+        # wait(), then tells the thread to quit
+        timeouts = []
+        pool = self.pool
+        class FakeCondition(object):
+            def acquire(self):
+                pass
+            def release(self):
+                pass
+            def wait(self, timeout=None):
+                timeouts.append(timeout)
+                pool.quit_flag = True
+        real_cond = pool.cond
+        pool.cond = FakeCondition()
+        pool.threads = [object() for i in xrange(thread_count)]
+        try:
+            self.assertEquals(pool._get_next_call(), None)
+        finally:
+            pool.cond = real_cond
+            pool.threads = []
+        return timeouts
+
+    def test_core_threads_dont_poll(self):
+        self.assertEquals(self.check_idle_wait(self.pool.MIN_THREADS),
+                          [None])
+
+    def test_extra_threads_wait_with_timeout(self):
+        self.assertEquals(self.check_idle_wait(self.pool.MIN_THREADS + 1),
+                          [self.pool.IDLE_THREAD_TIMEOUT])
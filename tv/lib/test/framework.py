@@ -569,8 +569,7 @@ class MiroTestCase(unittest.TestCase):
         app.db_error_handler = mock.Mock()
 
     def clear_ddb_object_cache(self):
-        app.db._ids_loaded = set()
-        app.db._object_map = {}
+        app.db.forget_all_objects()
         app.db.cache = storedatabase.DatabaseObjectCache()
 
     def setup_new_database(self, path, **kwargs):
@@ -589,9 +588,7 @@ class MiroTestCase(unittest.TestCase):
 
     def reload_object(self, obj):
         # force an object to be reloaded from the databas.
-        key = (obj.id, app.db.table_name(obj.__class__))
-        del app.db._object_map[key]
-        app.db._ids_loaded.remove(key)
+        app.db.forget_object(obj)
         return obj.__class__.get_by_id(obj.id)
 
     def handle_error(self, obj, report):
@@ -705,12 +702,12 @@ class EventLoopTest(MiroTestCase):
         eventloop.add_idle(function, name, args=None, kwargs=None)
 
     def hasIdles(self):
-        return not (eventloop._eventloop.idle_queue.queue.empty() and
-                    eventloop._eventloop.urgent_queue.queue.empty())
+        return (eventloop._eventloop.idle_queue.has_pending_idle() or
+                eventloop._eventloop.urgent_queue.has_pending_idle())
 
     def processThreads(self):
         eventloop._eventloop.threadpool.init_threads()
-        while not eventloop._eventloop.threadpool.queue.empty():
+        while eventloop._eventloop.threadpool.has_pending_calls():
             sleep(0.05)
         eventloop._eventloop.threadpool.close_threads()
 
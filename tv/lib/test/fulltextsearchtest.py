@@ -0,0 +1,117 @@
+from miro import app
+from miro.data import fulltextsearch
+from miro.test import testobjects
+from miro.test.framework import EventLoopTest
+
+class FullTextSearchTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.feed = testobjects.make_feed()
+        self.items = [testobjects.make_item(self.feed, u'item-%d' % i)
+                      for i in xrange(5)]
+        app.db.finish_transaction()
+
+    def segment_count(self):
+        app.db.cursor.execute("SELECT COUNT(*) FROM item_fts_segdir")
+        return app.db.cursor.fetchone()[0]
+
+    def search(self, term):
+        app.db.cursor.execute("SELECT docid FROM item_fts "
+                              "WHERE item_fts MATCH ? ORDER BY docid",
+                              (term,))
+        return [row[0] for row in app.db.cursor.fetchall()]
+
+    def test_status_change_doesnt_reindex(self):
+        segments = self.segment_count()
+        item = self.items[0]
+        item.watched_time = item.last_watched = item.creation_time
+        item.signal_change()
+        app.db.finish_transaction()
+        self.assertEquals(self.segment_count(), segments)
+
+    def test_text_change_reindexes(self):
+        segments = self.segment_count()
+        item = self.items[0]
+        item.title = u'changed'
+        item.signal_change()
+        app.db.finish_transaction()
+        self.assertNotEquals(self.segment_count(), segments)
+        self.assertEquals(self.search('changed'), [item.id])
+        self.assertEquals(self.search('item'),
+                          [i.id for i in self.items[1:]])
+
+    def test_merge(self):
+        for i in xrange(20):
+            item = testobjects.make_item(self.feed, u'extra-%d' % i)
+            app.db.finish_transaction()
+        segments = self.segment_count()
+        steps = 0
+        while fulltextsearch.merge(app.db.connection, segments=2):
+            steps += 1
+        self.assert_(steps > 0)
+        self.assert_(self.segment_count() < segments)
+        # merging shouldn't change the results
+        self.assertEquals(len(self.search('extra')), 20)
+        self.assertEquals(self.search('item'), [i.id for i in self.items])
+
+    def test_rebuild(self):
+        # delete an entry and add one for an item that doesn't exist
+        app.db.cursor.execute("DELETE FROM item_fts WHERE docid=?",
+                              (self.items[2].id,))
+        app.db.cursor.execute("INSERT INTO item_fts(docid, title) "
+                              "VALUES (?, 'item')",
+                              (self.items[-1].id + 100,))
+        progress = []
+        def progress_callback(done, total):
+            progress.append((done, total))
+        old_chunk = fulltextsearch.rebuild_chunk
+        def rebuild_chunk(cursor, table, columns, start_id):
+            return old_chunk(cursor, table, columns, start_id, limit=2)
+        fulltextsearch.rebuild_chunk = rebuild_chunk
+        try:
+            app.db.rebuild_fulltext_index(progress_callback)
+            self.runPendingIdles()
+        finally:
+            fulltextsearch.rebuild_chunk = old_chunk
+        app.db.cursor.execute("SELECT COUNT(*) FROM item")
+        total = app.db.cursor.fetchone()[0]
+        self.assertEquals(progress, [(2, total), (4, total), (total, total)])
+        self.assertEquals(self.search('item'), [i.id for i in self.items])
+        app.db.cursor.execute("SELECT COUNT(*) FROM item_fts")
+        self.assertEquals(app.db.cursor.fetchone()[0], total)
+
+    def test_rebuild_error(self):
+        # if rebuilding a chunk fails, its items should stay in the index
+        def rebuild_chunk(cursor, table, columns, start_id):
+            cursor.execute("DELETE FROM item_fts")
+            raise ValueError()
+        old_chunk = fulltextsearch.rebuild_chunk
+        fulltextsearch.rebuild_chunk = rebuild_chunk
+        try:
+            self.assertRaises(ValueError, list,
+                              app.db._rebuild_fulltext_index(None))
+        finally:
+            fulltextsearch.rebuild_chunk = old_chunk
+        self.assertEquals(self.search('item'), [i.id for i in self.items])
+
+    def test_rank(self):
+        item1, item2 = self.items[:2]
+        item1.description = u'foo'
+        item1.signal_change()
+        item2.title = u'foo'
+        item2.signal_change()
+        app.db.finish_transaction()
+        # matches in the title count more
+        app.db.cursor.execute("SELECT docid FROM item_fts "
+                              "WHERE item_fts MATCH 'foo' "
+                              "ORDER BY fts_rank(matchinfo(item_fts, ?), 2.0) "
+                              "DESC", (fulltextsearch.MATCHINFO_FORMAT,))
+        self.assertEquals([row[0] for row in app.db.cursor],
+                          [item2.id, item1.id])
+
+    def test_tokenize(self):
+        self.assertEquals(fulltextsearch.tokenize(u'Foo-bar_BAZ2 \xc9t\xc9'),
+                          [u'foo', u'bar', u'baz2', u'\xc9t\xc9'])
+        self.assertEquals(fulltextsearch.tokenize('/tmp/Foo.avi'),
+                          [u'tmp', u'foo', u'avi'])
+        self.assertEquals(fulltextsearch.tokenize(None), [])
@@ -0,0 +1,213 @@
+from miro import eventloop
+from miro import futures
+from miro.test.framework import MiroTestCase, EventLoopTest
+
+class FutureTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.results = []
+        self.errors = []
+
+    def callback(self, result):
+        self.results.append(result)
+
+    def errback(self, error):
+        self.errors.append(error)
+
+    def test_result(self):
+        future = futures.Future()
+        future.add_callbacks(self.callback, self.errback)
+        self.assert_(not future.done())
+        self.assertRaises(futures.NotDoneError, future.result)
+        future.set_result(123)
+        self.assert_(future.done())
+        self.assertEquals(future.result(), 123)
+        self.assertEquals(future.error(), None)
+        self.assertEquals(self.results, [123])
+        self.assertEquals(self.errors, [])
+
+    def test_error(self):
+        future = futures.Future()
+        future.add_callbacks(self.callback, self.errback)
+        error = ValueError()
+        future.set_error(error)
+        self.assertRaises(ValueError, future.result)
+        self.assertEquals(future.error(), error)
+        self.assertEquals(self.results, [])
+        self.assertEquals(self.errors, [error])
+
+    def test_callback_after_done(self):
+        future = futures.succeed('foo')
+        future.add_callbacks(self.callback, self.errback)
+        self.assertEquals(self.results, ['foo'])
+
+    def test_cancel(self):
+        future = futures.Future()
+        future.add_callbacks(self.callback, self.errback)
+        self.assert_(future.cancel())
+        self.assert_(future.canceled)
+        self.assert_(not future.cancel())
+        self.assertEquals(len(self.errors), 1)
+        self.assert_(isinstance(self.errors[0], futures.CanceledError))
+        # results that come in after a cancel are ignored
+        future.set_result(1)
+        self.assertEquals(self.results, [])
+
+    def test_gather(self):
+        future_list = [futures.Future() for i in range(3)]
+        gathered = futures.gather(future_list)
+        gathered.add_callbacks(self.callback, self.errback)
+        future_list[2].set_result(2)
+        future_list[0].set_result(0)
+        self.assert_(not gathered.done())
+        future_list[1].set_result(1)
+        self.assertEquals(self.results, [[0, 1, 2]])
+
+    def test_gather_empty(self):
+        self.assertEquals(futures.gather([]).result(), [])
+
+    def test_gather_error(self):
+        future_list = [futures.Future() for i in range(3)]
+        gathered = futures.gather(future_list)
+        future_list[0].set_result(0)
+        future_list[1].set_error(ValueError())
+        self.assertRaises(ValueError, gathered.result)
+        self.assert_(future_list[2].canceled)
+
+    def test_gather_cancel(self):
+        future_list = [futures.Future() for i in range(3)]
+        futures.gather(future_list).cancel()
+        for future in future_list:
+            self.assert_(future.canceled)
+
+    def test_race(self):
+        future_list = [futures.Future() for i in range(3)]
+        raced = futures.race(future_list)
+        future_list[1].set_result('winner')
+        self.assertEquals(raced.result(), 'winner')
+        self.assert_(future_list[0].canceled)
+        self.assert_(future_list[2].canceled)
+
+    def test_map_bounded(self):
+        pending = {}
+        def func(item):
+            pending[item] = futures.Future()
+            return pending[item]
+        mapped = futures.map_bounded(func, range(10), 3)
+        finished = 0
+        while pending:
+            self.assert_(len(pending) <= 3)
+            item = min(pending)
+            pending.pop(item).set_result(item * 2)
+            finished += 1
+        self.assertEquals(finished, 10)
+        self.assertEquals(mapped.result(), [i * 2 for i in range(10)])
+
+    def test_map_bounded_error(self):
+        calls = []
+        def func(item):
+            calls.append(item)
+            if item == 2:
+                return futures.fail(ValueError())
+            return futures.succeed(item)
+        mapped = futures.map_bounded(func, range(10), 2)
+        self.assertRaises(ValueError, mapped.result)
+        self.assertEquals(calls, [0, 1, 2])
+
+    def test_map_bounded_done_futures(self):
+        # futures that are already done shouldn't make us recurse
+        count = 5000
+        mapped = futures.map_bounded(futures.succeed, range(count), 3)
+        self.assertEquals(mapped.result(), range(count))
+
+    def test_map_bounded_mixed_futures(self):
+        pending = []
+        def func(item):
+            if item % 1000 == 0:
+                pending.append(futures.Future())
+                return pending[-1]
+            return futures.succeed(item)
+        mapped = futures.map_bounded(func, range(5000), 2)
+        while pending:
+            future = pending.pop(0)
+            future.set_result(None)
+        self.assertEquals(mapped.result(),
+                          [i % 1000 and i or None for i in range(5000)])
+
+    def test_coroutine(self):
+        first = futures.Future()
+        second = futures.Future()
+        @futures.coroutine
+        def coro(value):
+            a = yield first
+            b, c = yield [second, futures.succeed(value)]
+            raise futures.Return(a + b + c)
+        result = coro(100)
+        self.assert_(not result.done())
+        first.set_result(1)
+        self.assert_(not result.done())
+        second.set_result(10)
+        self.assertEquals(result.result(), 111)
+
+    def test_coroutine_error(self):
+        future = futures.Future()
+        @futures.coroutine
+        def coro():
+            try:
+                yield future
+            except ValueError:
+                raise futures.Return('caught')
+        result = coro()
+        future.set_error(ValueError())
+        self.assertEquals(result.result(), 'caught')
+
+    def test_coroutine_uncaught_error(self):
+        @futures.coroutine
+        def coro():
+            yield futures.succeed(None)
+            raise ValueError()
+        self.assertRaises(ValueError, coro().result)
+
+    def test_coroutine_cancel(self):
+        future = futures.Future()
+        closed = []
+        @futures.coroutine
+        def coro():
+            try:
+                yield future
+            finally:
+                closed.append(True)
+        coro().cancel()
+        self.assert_(future.canceled)
+        self.assertEquals(closed, [True])
+
+class FutureEventLoopTest(EventLoopTest):
+    def test_timeout(self):
+        future = futures.Future()
+        timed = futures.with_timeout(future, 0.0)
+        self.run_pending_timeouts()
+        self.assertRaises(futures.TimeoutError, timed.result)
+        self.assert_(future.canceled)
+
+    def test_timeout_not_reached(self):
+        future = futures.Future()
+        timed = futures.with_timeout(future, 0.0)
+        future.set_result('foo')
+        self.run_pending_timeouts()
+        self.assertEquals(timed.result(), 'foo')
+
+    def test_call_in_thread(self):
+        def func(a, b):
+            return a + b
+        result = eventloop.call_in_thread(None, None, func, 'test', 1, 2)
+        self.processThreads()
+        self.runPendingIdles()
+        self.assertEquals(result.result(), 3)
+
+    def test_call_in_thread_error(self):
+        def func():
+            raise ValueError()
+        result = eventloop.call_in_thread(None, None, func, 'test')
+        self.processThreads()
+        self.runPendingIdles()
+        self.assertRaises(ValueError, result.result)
@@ -23,9 +23,7 @@ TEST_PATH = 'test.txt'
 def uses_mock_httpclient(fun):
     def _uses_mock_httpclient(self):
         self.mocked_multi = httpclient.curl_manager.multi = mock.Mock()
-        self.mocked_multi.timeout.return_value = -1
-        self.mocked_multi.fdset.return_value = ([], [], [])
-        self.mocked_multi.perform.return_value = (None, None)
+        self.mocked_multi.socket_action.return_value = (None, None)
         return fun(self)
     wrapped = functools.update_wrapper(_uses_mock_httpclient, fun)
     return uses_httpclient(wrapped)
@@ -91,6 +89,17 @@ class HTTPClientTest(HTTPClientTestBase):
         self.grab_url("file://" + path)
         self.assertEquals(self.grab_url_info['body'], self.test_response_data)
 
+    @uses_httpclient
+    def test_future(self):
+        self.grab_url(self.httpserver.build_url('test.txt'))
+        self.assert_(self.client.done())
+        self.assertEquals(self.client.result()['body'],
+                          self.test_response_data)
+        self.expecting_errback = True
+        self.grab_url(self.httpserver.build_url('badfile.txt'))
+        self.assert_(isinstance(self.client.error(),
+            httpclient.UnexpectedStatusCode))
+
     @uses_httpclient
     def test_simple_get_url_with_spaces(self):
         self.grab_url(self.httpserver.build_url('test%20with%20spaces.txt'))
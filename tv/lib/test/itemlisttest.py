@@ -244,6 +244,115 @@ class ItemListTest(MiroTestCase):
             self.assertEquals(group_info[1], 1)
             self.assertEquals(group_info[2], list_items[i])
 
+    def set_albums(self):
+        # give the items 3 albums, with some items without an album
+        albums = [u'Album A', u'album a', u'Album B', u'', u'']
+        for i, item in enumerate(self.items):
+            item.album = albums[i % len(albums)]
+            item.artist = u'Artist'
+            if i % len(albums) == 1:
+                # use album_artist instead of artist, this should still be
+                # in the same album as the first item
+                item.artist = None
+                item.album_artist = u'artist'
+            if not item.album:
+                item.artist = u''
+            item.signal_change()
+        app.db.finish_transaction()
+        self.item_list.set_sort(itemsort.AlbumSort())
+
+    def calc_group_infos_from_rows(self, grouping_func):
+        # calculate group info using a grouping function that ItemList can't
+        # calculate from the database.
+        self.item_list.set_grouping(lambda info: grouping_func(info))
+        group_infos = [self.item_list.get_group_info(i)
+                       for i in xrange(len(self.item_list))]
+        self.assertEquals(self.item_list.group_index, None)
+        return group_infos
+
+    def check_group_index(self, grouping_func):
+        correct_group_infos = self.calc_group_infos_from_rows(grouping_func)
+        self.item_list.set_grouping(grouping_func)
+        group_infos = [self.item_list.get_group_info(i)
+                       for i in xrange(len(self.item_list))]
+        self.assertNotEquals(self.item_list.group_index, None)
+        self.assertEquals(group_infos, correct_group_infos)
+
+    def test_group_index(self):
+        self.set_albums()
+        self.check_group_index(itemlist.album_grouping)
+        # the items with an album should be in 2 groups, the other items
+        # should be in a group by themselves.
+        group_sizes = sorted(
+            self.item_list.get_group_info(i)[1]
+            for i in xrange(len(self.item_list))
+            if self.item_list.get_group_info(i)[0] == 0)
+        self.assertEquals(group_sizes, [1, 1, 1, 1, 2, 4])
+        self.check_group_index(itemlist.feed_grouping)
+        self.check_group_index(itemlist.video_grouping)
+
+    def test_group_index_doesnt_load_rows(self):
+        # put all items in the same album.  We should be able to get the
+        # group info for the last one without loading the others.
+        for item in self.items:
+            item.album = u'Album'
+            item.signal_change()
+        app.db.finish_transaction()
+        self.refresh_item_list()
+        self.item_list.FETCH_ROW_CHUNK_SIZE = 1
+        self.item_list.set_grouping(itemlist.album_grouping)
+        last_row = len(self.item_list) - 1
+        index, count, first_info = self.item_list.get_group_info(last_row)
+        self.assertEquals((index, count), (last_row, len(self.items)))
+        self.assertEquals(first_info, self.item_list.get_row(0))
+        # we should only have loaded the first row, plus the next one since
+        # _ensure_row_loaded() always loads 1 extra
+        self.assert_(len(self.item_list.row_data) <= 2)
+
+    def test_group_index_item_changes(self):
+        self.set_albums()
+        self.item_list.set_grouping(itemlist.album_grouping)
+        self.item_list.get_group_info(0)
+        group_index = self.item_list.group_index
+        # changing columns that the grouping doesn't use should keep the
+        # group index around
+        first_info = self.item_list.get_row(0)
+        for item in self.items:
+            if item.id == first_info.id:
+                item.title = u'new-title'
+                item.signal_change()
+        app.db.finish_transaction()
+        msg = messages.ItemChanges(set(), set([first_info.id]), set(),
+                                   set(['title']), False, False)
+        self.item_list.on_item_changes(msg)
+        self.assert_(self.item_list.group_index is group_index)
+        self.assertEquals(self.item_list.get_group_info(0)[2].title,
+                          u'new-title')
+        # changing an album should recalculate it
+        for item in self.items:
+            if item.id == first_info.id:
+                item.album = u'Other Album'
+                item.signal_change()
+        app.db.finish_transaction()
+        msg = messages.ItemChanges(set(), set([first_info.id]), set(),
+                                   set(['album']), False, False)
+        self.item_list.on_item_changes(msg)
+        self.assertEquals(self.item_list.group_index, None)
+        self.check_group_index(itemlist.album_grouping)
+
+class GroupIndexTest(MiroTestCase):
+    def test_group_index(self):
+        keys = [1, 1, 1, None, None, 2, 1, 1]
+        group_index = itemlist.GroupIndex(keys)
+        self.assertEquals([group_index.group_range(i)
+                           for i in xrange(len(keys))],
+                          [(0, 3), (0, 3), (0, 3), (3, 4), (4, 5), (5, 6),
+                           (6, 8), (6, 8)])
+
+    def test_empty(self):
+        group_index = itemlist.GroupIndex([])
+        self.assertEquals(group_index.group_starts, [0])
+
 class TestItemListPool(MiroTestCase):
     def setUp(self):
         MiroTestCase.setUp(self)
@@ -281,6 +390,22 @@ class TestItemListPool(MiroTestCase):
         self.item_list.on_item_changes.assert_called_once_with(fake_message)
         self.item_list2.on_item_changes.assert_called_once_with(fake_message)
 
+    def test_result_cache(self):
+        result_cache = self.pool.result_cache
+        app.item_tracker_updater.add_result_cache(result_cache)
+        self.assert_(self.item_list.result_cache is result_cache)
+        self.assert_(self.item_list2.result_cache is result_cache)
+        # reversing the sort should use the cached results
+        self.item_list.set_sort(itemsort.DateSort(False))
+        self.assertEquals(result_cache.derived, 1)
+        misses = result_cache.misses
+        # ItemChanges messages should remove cached results before the
+        # lists refetch their ids.
+        message = messages.ItemChanges([], [], [self.items[0].id], [],
+                                       False, False)
+        app.item_tracker_updater.on_item_changes(message)
+        self.assertEquals(result_cache.misses, misses + 2)
+
     def test_release(self):
         # Test that we actually remove objects from the pool once there are no
         # more references to them.
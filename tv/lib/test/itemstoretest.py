@@ -0,0 +1,163 @@
+import datetime
+
+from miro import app
+from miro.data import item
+from miro.data import itemstore
+from miro.test import testobjects
+from miro.test.framework import MiroTestCase
+
+class ColumnarItemStoreTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.init_data_package()
+        self.feed, self.items = testobjects.make_feed_with_items(5)
+        self.items[0].album = u'Album'
+        self.items[1].album = u'Al' + u'bum'
+        for i in self.items[:2]:
+            i.signal_change()
+        app.db.finish_transaction()
+        self.infos = item.fetch_item_infos(app.db.connection,
+                                           [i.id for i in self.items])
+        self.store = itemstore.ColumnarItemStore(item.ItemSource())
+
+    def column_index(self, attr_name):
+        for i, column in enumerate(item.ItemSelectInfo.select_columns):
+            if column.attr_name == attr_name:
+                return i
+        raise ValueError(attr_name)
+
+    def make_info(self, info, **values):
+        row_data = list(info.row_data)
+        for attr_name, value in values.items():
+            row_data[self.column_index(attr_name)] = value
+        return item.ItemInfo(tuple(row_data))
+
+    def get_new_info(self, id_):
+        # force the store to make a new ItemInfo, rather than returning the
+        # one that it has cached.
+        self.store._info_cache.remove(id_)
+        return self.store[id_]
+
+    def check_info(self, info):
+        new_info = self.get_new_info(info.id)
+        self.assertEquals(new_info, info)
+        self.assertEquals([type(v) for v in new_info.row_data],
+                          [type(v) for v in info.row_data])
+
+    def test_store(self):
+        for info in self.infos:
+            self.store[info.id] = info
+        self.assertEquals(len(self.store), len(self.infos))
+        self.assertSameSet(self.store.keys(), [i.id for i in self.infos])
+        for info in self.infos:
+            self.assert_(info.id in self.store)
+            self.check_info(info)
+        self.assert_(-1 not in self.store)
+        self.assertRaises(KeyError, self.store.__getitem__, -1)
+        self.assertEquals(self.store.get(-1), None)
+
+    def test_column_types(self):
+        # check that we store values in arrays when we can
+        columns = dict((c.attr_name, column) for c, column in
+                       zip(item.ItemSelectInfo.select_columns,
+                           self.store.columns))
+        self.assertEquals(type(columns['feed_id']), itemstore._ArrayColumn)
+        self.assertEquals(type(columns['release_date']),
+                          itemstore._DateTimeColumn)
+        self.assertEquals(type(columns['title']), itemstore._StringColumn)
+
+    def test_values_that_dont_fit(self):
+        info = self.make_info(self.infos[0],
+                              feed_id=None,
+                              size=2 ** 70,
+                              release_date=datetime.datetime(9999, 1, 1),
+                              watched_time=datetime.datetime(1970, 1, 1, 0,
+                                                             0, 0, 1))
+        self.store[info.id] = info
+        self.check_info(info)
+        # the other infos should still work with the converted columns
+        for info in self.infos[1:]:
+            self.store[info.id] = info
+            self.check_info(info)
+
+    def test_update(self):
+        error_info = item.DBErrorItemInfo(-1)
+        big_info = self.make_info(self.infos[1], size=2 ** 70)
+        self.store.update([(info.id, info) for info in self.infos] +
+                          [(error_info.id, error_info),
+                           (big_info.id, big_info)])
+        self.assertEquals(len(self.store), len(self.infos) + 1)
+        self.assert_(self.store[error_info.id] is error_info)
+        # the last value for an id wins, like with dict.update()
+        self.check_info(big_info)
+        for info in self.infos[:1] + self.infos[2:]:
+            self.check_info(info)
+
+    def test_interned_strings(self):
+        for info in self.infos:
+            self.store[info.id] = info
+        self.assert_(self.infos[0].album is not self.infos[1].album)
+        info1 = self.get_new_info(self.infos[0].id)
+        info2 = self.get_new_info(self.infos[1].id)
+        self.assert_(info1.album is info2.album)
+        # strings that aren't used anymore get dropped
+        del self.store[self.infos[0].id]
+        del self.store[self.infos[1].id]
+        self.store._compact_strings()
+        self.assert_(u'Album' not in self.store._strings)
+
+    def test_remove(self):
+        for info in self.infos:
+            self.store[info.id] = info
+        old_slot = self.store._slots[self.infos[0].id]
+        del self.store[self.infos[0].id]
+        self.assert_(self.infos[0].id not in self.store)
+        self.assertEquals(len(self.store), len(self.infos) - 1)
+        self.assertRaises(KeyError, self.store.__delitem__,
+                          self.infos[0].id)
+        # new data should re-use the slot without any old values
+        slot_count = self.store._slot_count
+        info = self.make_info(self.infos[1], id=-10, album=None)
+        self.store[info.id] = info
+        self.assertEquals(self.store._slots[info.id], old_slot)
+        self.assertEquals(self.store._slot_count, slot_count)
+        self.check_info(info)
+        self.store.clear()
+        self.assertEquals(len(self.store), 0)
+
+    def test_grow(self):
+        # add more infos than we have slots for at the start
+        count = self.store.MIN_GROW_SLOTS * 3
+        infos = [self.make_info(self.infos[i % len(self.infos)], id=-i - 1)
+                 for i in xrange(count)]
+        for info in infos:
+            self.store[info.id] = info
+        self.assert_(self.store._slot_count >= count)
+        self.assertEquals(len(self.store), count)
+        for info in infos:
+            self.check_info(info)
+
+    def test_other_infos(self):
+        error_info = item.DBErrorItemInfo(self.infos[0].id)
+        self.store[self.infos[0].id] = error_info
+        self.assert_(self.store[self.infos[0].id] is error_info)
+        self.assertEquals(len(self.store), 1)
+        # storing a regular ItemInfo should replace it
+        self.store[self.infos[0].id] = self.infos[0]
+        self.check_info(self.infos[0])
+        self.assertEquals(len(self.store), 1)
+        # and the other way around
+        self.store[self.infos[0].id] = error_info
+        self.assert_(self.store[self.infos[0].id] is error_info)
+        self.assert_(self.infos[0].id in self.store.ids())
+        del self.store[self.infos[0].id]
+        self.assert_(self.infos[0].id not in self.store)
+        self.assertEquals(self.store._other_infos, {})
+
+    def test_snapshots(self):
+        info = self.infos[0]
+        self.store[info.id] = info
+        old_info = self.get_new_info(info.id)
+        self.store[info.id] = self.make_info(info, title=u'new title')
+        self.assertEquals(old_info.title, info.title)
+        self.assertEquals(self.get_new_info(info.id).title, u'new title')
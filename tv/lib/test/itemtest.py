@@ -547,3 +547,126 @@ class ItemSizeTest(MiroTestCase):
         with self.allow_warnings():
             item.set_filename('non-existant-path')
         self.check_size(item, None)
+
+class FeedCountTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed, self.items = testobjects.make_feed_with_items(4)
+        self.file_items = [testobjects.make_file_item(self.feed, u'file%d' % i)
+                           for i in xrange(3)]
+        self.other_feed, self.other_items = \
+                testobjects.make_feed_with_items(2)
+
+    def tearDown(self):
+        # undo disallow_count_queries()
+        Item._feed_count_tracker.__dict__.pop('_query_counts', None)
+        MiroTestCase.tearDown(self)
+
+    def check_counts(self, feed=None):
+        if feed is None:
+            feed = self.feed
+        self.assertEquals(feed.num_downloaded(),
+                          feed.downloaded_items.count())
+        self.assertEquals(feed.num_downloading(),
+                          feed.downloading_items.count())
+        self.assertEquals(feed.num_unwatched(), feed.unwatched_items.count())
+        self.assertEquals(feed.num_available(),
+                          feed.available_items.count() -
+                          feed.auto_pending_items.count())
+
+    def disallow_count_queries(self):
+        # after the counts are loaded, changes shouldn't need to requery
+        # them
+        tracker = Item._feed_count_tracker
+        tracker._query_counts = mock.Mock(
+            side_effect=AssertionError("counts requeried"))
+
+    def test_initial_counts(self):
+        self.check_counts()
+        self.check_counts(self.other_feed)
+        self.assertEquals(self.feed.num_downloaded(), 3)
+        self.assertEquals(self.feed.num_unwatched(), 3)
+
+    def test_changes(self):
+        self.check_counts()
+        self.disallow_count_queries()
+        self.file_items[0].mark_watched()
+        self.items[0].unset_new()
+        self.items[1].cancel_auto_download()
+        testobjects.make_file_item(self.feed, u'new-file')
+        self.check_counts()
+        self.assertEquals(self.feed.num_unwatched(), 3)
+
+    def test_restored_items(self):
+        self.check_counts()
+        self.disallow_count_queries()
+        ids = [i.id for i in self.items]
+        self.clear_ddb_object_cache()
+        # we haven't seen these items change, so we need to look up their
+        # old values in the database.
+        Item.get_by_id(ids[0]).unset_new()
+        Item.get_by_id(ids[1]).remove()
+        self.check_counts()
+        self.assertEquals(self.feed.num_available(), 2)
+
+    def test_remove(self):
+        self.check_counts()
+        self.disallow_count_queries()
+        self.file_items[0].remove()
+        self.items[0].remove()
+        self.check_counts()
+        self.assertEquals(self.feed.num_downloaded(), 2)
+
+    def test_move_to_other_feed(self):
+        self.check_counts()
+        self.disallow_count_queries()
+        self.file_items[0].feed_id = self.other_feed.id
+        self.file_items[0].signal_change()
+        self.check_counts()
+        self.check_counts(self.other_feed)
+        self.assertEquals(self.other_feed.num_downloaded(), 1)
+
+    def test_auto_download_mode(self):
+        self.check_counts()
+        self.disallow_count_queries()
+        for mode in (u'off', u'new', u'all'):
+            self.feed.set_auto_download_mode(mode)
+            self.check_counts()
+
+    def test_bulk_insert(self):
+        self.check_counts()
+        app.bulk_sql_manager.start()
+        try:
+            testobjects.add_items_to_feed(self.feed, 3, file_items=True,
+                                          prefix=u'bulk')
+        finally:
+            app.bulk_sql_manager.finish()
+        self.check_counts()
+        self.assertEquals(self.feed.num_downloaded(), 6)
+
+    def test_downloader_state_changes(self):
+        item = self.items[0]
+        item.set_downloader(RemoteDownloader(u'http://example.com/dl', item))
+        dler = item.downloader
+        self.check_counts()
+        self.disallow_count_queries()
+        for state in (u'downloading', u'paused', u'downloading',
+                      u'finished'):
+            # forget what the item was counted as, like we would for an
+            # item that was just restored from the database.
+            Item._feed_count_tracker.contributions.clear()
+            dler.state = state
+            dler.signal_change()
+            self.check_counts()
+            self.assertEquals(self.feed.num_downloading(),
+                              int(state == u'downloading'))
+
+    def test_verify(self):
+        self.check_counts()
+        self.assertEquals(Item._feed_count_tracker.verify(), [])
+        counts = Item._feed_count_tracker.get_counts(self.feed.id)
+        counts[0] += 10
+        with self.allow_warnings():
+            mismatched = Item._feed_count_tracker.verify()
+        self.assertEquals(mismatched, [self.feed.id])
+        self.check_counts()
@@ -31,6 +31,7 @@
 
 import datetime
 import itertools
+import random
 
 from miro import app
 from miro import downloader
@@ -39,6 +40,7 @@ from miro import messages
 from miro import models
 from miro import sharing
 from miro.data import item
+from miro.data import itemstore
 from miro.data import itemtrack
 from miro.test import mock
 from miro.data import connectionpool
@@ -322,7 +324,7 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
 
         # initially we should just store None for our data as a placeholder
         # until we actually do the fetch.
-        self.assertEquals(self.tracker.row_data, {})
+        self.assertEquals(len(self.tracker.row_data), 0)
         # we should have an idle callback to schedule fetching the row data.
         self.assertEqual(self.idle_scheduler.call_count, 1)
         self.run_all_tracker_idles()
@@ -330,6 +332,124 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
             self.assertNotEquals(row, None)
         self.check_tracker_items()
 
+    def loaded_rows(self):
+        return sorted(self.tracker.id_to_index[id_]
+                      for id_ in self.tracker.row_data)
+
+    def test_visible_range(self):
+        # test that we only prefetch rows near the visible ones for lists
+        # bigger than max_loaded_rows
+        self.tracker.FETCH_ROW_CHUNK_SIZE = 2
+        self.tracker.READ_AHEAD_ROWS = 1
+        self.tracker.max_loaded_rows = 4
+        self.tracker.set_visible_range(3, 5)
+        self.run_all_tracker_idles()
+        self.assertEquals(self.loaded_rows(), [2, 3, 4, 5])
+        # scroll down, we should load the new rows then forget the ones
+        # furthest from them.
+        self.tracker.set_visible_range(7, 9)
+        self.run_all_tracker_idles()
+        self.assertEquals(self.loaded_rows(), [6, 7, 8, 9])
+        # we should be able to load rows that we forgot
+        self.check_tracker_items()
+        # get_items() loads everything, we should forget those rows in our
+        # next idle callback
+        self.assertEquals(len(self.tracker.row_data), 10)
+        self.tracker.set_visible_range(0, 1)
+        self.run_all_tracker_idles()
+        self.assertEquals(self.loaded_rows(), [0, 1, 2, 3])
+
+    def count_done_fetching_calls(self):
+        self.done_fetching_count = 0
+        real_done_fetching = self.tracker.item_fetcher.done_fetching
+        def done_fetching():
+            self.done_fetching_count += 1
+            real_done_fetching()
+        self.tracker.item_fetcher.done_fetching = done_fetching
+
+    def test_visible_range_finishes_transaction(self):
+        # big lists should finish their read transaction once the rows
+        # around the visible ones are loaded
+        self.tracker.FETCH_ROW_CHUNK_SIZE = 2
+        self.tracker.READ_AHEAD_ROWS = 1
+        self.tracker.max_loaded_rows = 4
+        self.count_done_fetching_calls()
+        self.tracker.set_visible_range(3, 5)
+        self.run_all_tracker_idles()
+        self.assertEquals(self.done_fetching_count, 1)
+        # scrolling to other rows should load them in a new transaction,
+        # then finish that one too
+        self.tracker.set_visible_range(7, 9)
+        self.run_all_tracker_idles()
+        self.assertEquals(self.loaded_rows(), [6, 7, 8, 9])
+        self.assertEquals(self.done_fetching_count, 2)
+        self.check_tracker_items()
+
+    def test_removed_after_done_fetching(self):
+        # If an item gets removed after we finish our read transaction, we
+        # may not be able to load its row before we get the ItemChanges
+        # message
+        self.tracker.FETCH_ROW_CHUNK_SIZE = 2
+        self.tracker.READ_AHEAD_ROWS = 1
+        self.tracker.max_loaded_rows = 4
+        self.tracker.set_visible_range(0, 1)
+        self.run_all_tracker_idles()
+        removed_id = self.tracker.id_list[8]
+        models.Item.get_by_id(removed_id).remove()
+        app.db.finish_transaction()
+        self.assertEquals(self.tracker.get_row(8).id, removed_id)
+        self.assertEquals(self.tracker.get_row(9).id,
+                          self.tracker.id_list[9])
+        self.process_items_changed_messages()
+        self.assert_(not self.tracker.item_in_list(removed_id))
+        self.check_tracker_items()
+
+    def test_visible_range_small_list(self):
+        # lists smaller than max_loaded_rows still get fully loaded in the
+        # background
+        self.tracker.FETCH_ROW_CHUNK_SIZE = 2
+        self.tracker.READ_AHEAD_ROWS = 1
+        self.tracker.set_visible_range(3, 5)
+        self.run_tracker_idle()
+        self.assertEquals(self.loaded_rows(), [1, 2, 3])
+        self.run_all_tracker_idles()
+        self.assertEquals(self.loaded_rows(), range(10))
+
+    def test_load_rows_before_last_chunk(self):
+        # we start looking for unloaded rows where we found the last one.
+        # Make sure we still go back for rows before that.
+        self.tracker.FETCH_ROW_CHUNK_SIZE = 2
+        self.tracker.READ_AHEAD_ROWS = 1
+        self.run_all_tracker_idles()
+        self.tracker._uncache_row_data([self.tracker.id_list[1]])
+        self.tracker._schedule_idle_work()
+        self.run_all_tracker_idles()
+        self.assertEquals(self.loaded_rows(), range(10))
+
+    def test_playable_ids_with_partial_list(self):
+        self.tracker.max_loaded_rows = 4
+        self.tracker.FETCH_ROW_CHUNK_SIZE = 2
+        self.tracker.READ_AHEAD_ROWS = 1
+        self.tracker.set_visible_range(0, 1)
+        self.run_all_tracker_idles()
+        self.assertEquals(len(self.tracker.row_data), 2)
+        playable_ids = [i.id for i in self.tracked_items if i.is_playable()]
+        self.assertSameSet(self.tracker.get_playable_ids(), playable_ids)
+        self.assertEquals(self.tracker.has_playables(), bool(playable_ids))
+        # we shouldn't need to load the whole list to answer those
+        self.assertEquals(len(self.tracker.row_data), 2)
+
+    def test_select_attrs(self):
+        attr_values = self.tracker.item_fetcher.select_attrs(
+            ('title', 'feed_id'))
+        correct_values = dict((i.id, (i.title, i.feed_id))
+                              for i in self.tracked_items)
+        self.assertEquals(attr_values, correct_values)
+        # select_attrs() should still work after we've loaded everything
+        self.run_all_tracker_idles()
+        self.assertEquals(self.tracker.item_fetcher.select_attrs(
+            ('title', 'feed_id')), correct_values)
+
     def check_items_changed_after_message(self, changed_items):
         self.process_items_changed_messages()
         signal_args = self.check_one_signal('items-changed')
@@ -365,6 +485,46 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
         self.check_list_change_after_message()
         self.check_tracker_items()
 
+    def test_list_diff(self):
+        list_diff_handler = mock.Mock()
+        self.tracker.connect('list-diff', list_diff_handler)
+        # load all the rows
+        self.tracker.get_items()
+        # add an item
+        new_item = testobjects.make_item(self.tracked_feed, u'new item')
+        self.check_list_change_after_message()
+        self.assertEquals(list_diff_handler.call_count, 1)
+        diff = list_diff_handler.call_args[0][1]
+        self.assertEquals(diff.removed, [])
+        self.assertEquals(diff.inserted,
+                          [self.tracker.get_index(new_item.id)])
+        # we should still have the data for the old items
+        self.assertEquals(len(self.tracker.row_data), 10)
+        self.check_tracker_items()
+        # move an item to the end of the list
+        list_diff_handler.reset_mock()
+        old_id_list = list(self.tracker.id_list)
+        # pick an item that isn't already at the end
+        item1 = [i for i in self.tracked_items
+                 if i.id != old_id_list[-1]][0]
+        item1.release_date += datetime.timedelta(days=400)
+        item1.signal_change()
+        self.check_list_change_after_message()
+        diff = list_diff_handler.call_args[0][1]
+        self.assertEquals(self.tracker.id_list[-1], item1.id)
+        # Usually this removes item1 and inserts it at the end.  If item1
+        # was right before the end, we may move the last item instead.
+        self.assertEquals(len(diff.removed), 1)
+        self.assertEquals(len(diff.inserted), 1)
+        del old_id_list[diff.removed[0]]
+        old_id_list.insert(diff.inserted[0],
+                           self.tracker.id_list[diff.inserted[0]])
+        self.assertEquals(old_id_list, self.tracker.id_list)
+        # item1 changed, so we should have unloaded it
+        self.assertEquals(len(self.tracker.row_data), 10)
+        self.assert_(item1.id not in self.tracker.row_data)
+        self.check_tracker_items()
+
     def test_item_changes_after_finished(self):
         # test item changes after we've finished fetching all rows
         while not self.tracker.idle_work_scheduled:
@@ -475,6 +635,229 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
         self.check_one_signal('list-changed')
         self.check_tracker_items([])
 
+    def set_titles(self, *titles):
+        changed = []
+        for item, title in zip(self.tracked_items, titles):
+            item.title = title
+            item.signal_change()
+            changed.append(item)
+        app.db.finish_transaction()
+        self.check_items_changed_after_message(changed)
+        return changed
+
+    def make_search_query(self, search_text, ranked=False):
+        query = itemtrack.ItemTrackerQuery()
+        query.add_condition('feed_id', '=', self.tracked_feed.id)
+        query.set_order_by(['release_date'])
+        query.set_search(search_text, ranked=ranked)
+        return query
+
+    def test_ranked_search(self):
+        item1, item2, item3 = self.set_titles(u'foo bar baz qux quux',
+                                              u'foo foo foo', u'bar')
+        self.tracker.change_query(self.make_search_query('foo', True))
+        self.check_one_signal('list-changed')
+        # item2 mentions foo more and has a shorter title, so it should be
+        # first, even if item1 has an earlier release date.
+        self.check_tracker_items([item2, item1], sort_items=False)
+        self.tracker.change_query(self.make_search_query('bar', True))
+        self.check_one_signal('list-changed')
+        self.check_tracker_items([item3, item1], sort_items=False)
+
+    def test_search_pages(self):
+        foo_items = self.set_titles(*[u'foo %d' % i for i in xrange(5)])
+        query = self.make_search_query('foo')
+        query.set_limit(2)
+        self.tracker.change_query(query)
+        self.check_one_signal('list-changed')
+        self.sort_item_list(foo_items)
+        self.check_tracker_items(foo_items[:2])
+        self.assert_(self.tracker.has_more())
+        self.assert_(self.tracker.load_more())
+        self.check_one_signal('list-changed')
+        self.check_tracker_items(foo_items[:4])
+        self.assert_(self.tracker.load_more())
+        self.check_one_signal('list-changed')
+        self.check_tracker_items(foo_items)
+        self.assert_(not self.tracker.has_more())
+        self.assert_(not self.tracker.load_more())
+        self.check_no_signals()
+        # refetching the list should keep all the pages we loaded
+        foo_items[0].title = u'foo changed'
+        foo_items[0].signal_change()
+        app.db.finish_transaction()
+        self.process_items_changed_messages()
+        self.check_tracker_items(foo_items)
+
+    def test_search_cache(self):
+        item1, item2, item3 = self.set_titles(u'foo bar', u'foobar',
+                                              u'food baz')
+        cache = self.tracker.search_cache
+        searches = [
+            ('fo', [item1, item2, item3]),
+            ('foo', [item1, item2, item3]),
+            ('foob', [item2]),
+            ('foo b', [item1]),
+            ('foo ba', [item1]),
+        ]
+        for search_text, correct_items in searches:
+            self.tracker.change_query(self.make_search_query(search_text))
+            self.check_one_signal('list-changed')
+            self.check_tracker_items(correct_items)
+        # only the first search should have run the full query
+        self.assertEquals(cache.misses, 1)
+        self.assertEquals(cache.hits, 4)
+        # changes to columns that we don't search or query on shouldn't
+        # clear the cache
+        item1.rating = 5
+        item1.signal_change()
+        app.db.finish_transaction()
+        self.process_items_changed_messages()
+        self.tracker.change_query(self.make_search_query('foo bar'))
+        self.check_tracker_items([item1])
+        self.assertEquals(cache.hits, 5)
+        # changing text that we search should clear the cache
+        item2.title = u'other'
+        item2.signal_change()
+        app.db.finish_transaction()
+        self.process_items_changed_messages()
+        self.tracker.change_query(self.make_search_query('foob'))
+        self.check_tracker_items([])
+        self.assertEquals(cache.misses, 2)
+        # so should changing a column that we order by.  (The tracker
+        # re-runs its current query when it sees the change, so that's a
+        # miss too)
+        item1.release_date = item1.release_date - datetime.timedelta(days=1)
+        item1.signal_change()
+        app.db.finish_transaction()
+        self.process_items_changed_messages()
+        self.assertEquals(cache.misses, 3)
+        self.tracker.change_query(self.make_search_query('food'))
+        self.check_tracker_items([item3])
+        self.assertEquals(cache.misses, 4)
+        # ranked searches and searches with a limit don't use the cache
+        self.tracker.change_query(self.make_search_query('foo', True))
+        self.tracker.change_query(self.make_search_query('food', True))
+        query = self.make_search_query('foo')
+        query.set_limit(10)
+        self.tracker.change_query(query)
+        self.assertEquals((cache.hits, cache.misses), (5, 4))
+
+    def check_result_cache_ids(self, result_cache, query):
+        # make a tracker using result_cache and check that it has the same
+        # ids as running the query.
+        tracker = itemtrack.ItemTracker(self.idle_scheduler, query,
+                                        item.ItemSource(),
+                                        result_cache=result_cache)
+        try:
+            connection = self.connection_pool.get_connection()
+            try:
+                correct_ids = query.select_ids(connection)
+            finally:
+                self.connection_pool.release_connection(connection)
+            self.assertEquals(tracker.id_list, correct_ids)
+        finally:
+            tracker.destroy()
+
+    def check_result_cache_stats(self, result_cache, hits, derived, misses):
+        self.assertEquals((result_cache.hits, result_cache.derived,
+                           result_cache.misses), (hits, derived, misses))
+
+    def test_result_cache(self):
+        result_cache = itemtrack.QueryResultCache()
+        query = self.tracker.query
+        self.check_result_cache_ids(result_cache, query)
+        self.check_result_cache_stats(result_cache, 0, 0, 1)
+        self.check_result_cache_ids(result_cache, query.copy())
+        self.check_result_cache_stats(result_cache, 1, 0, 1)
+        # reversing the order should use the cached ids
+        reverse_query = query.copy()
+        reverse_query.set_order_by(['-release_date'])
+        self.check_result_cache_ids(result_cache, reverse_query)
+        self.check_result_cache_stats(result_cache, 1, 1, 1)
+        # so should adding conditions
+        filtered_query = query.copy()
+        filtered_query.add_complex_condition(['id'], 'item.id % 2 = 0')
+        self.check_result_cache_ids(result_cache, filtered_query)
+        self.check_result_cache_stats(result_cache, 1, 2, 1)
+        filtered_query.add_condition('title', '!=', u'foo')
+        filtered_query.set_order_by(['-release_date'])
+        self.check_result_cache_ids(result_cache, filtered_query)
+        self.check_result_cache_stats(result_cache, 1, 3, 1)
+        # we can't use the cache if a cached query has conditions we don't
+        other_query = itemtrack.ItemTrackerQuery()
+        other_query.add_condition('feed_id', '=', self.other_feed1.id)
+        other_query.set_order_by(['release_date'])
+        self.check_result_cache_ids(result_cache, other_query)
+        self.check_result_cache_stats(result_cache, 1, 3, 2)
+        # or if the sort is different
+        title_query = query.copy()
+        title_query.set_order_by(['title'])
+        self.check_result_cache_ids(result_cache, title_query)
+        self.check_result_cache_stats(result_cache, 1, 3, 3)
+
+    def test_result_cache_item_changes(self):
+        result_cache = itemtrack.QueryResultCache()
+        query = self.tracker.query
+        self.check_result_cache_ids(result_cache, query)
+        title_query = query.copy()
+        title_query.set_order_by(['title'])
+        self.check_result_cache_ids(result_cache, title_query)
+        self.assertEquals(len(result_cache.entries), 2)
+        # changing the release date should only drop the results that use
+        # it.
+        changed_item = self.tracked_items[0]
+        changed_item.release_date -= datetime.timedelta(days=30)
+        changed_item.signal_change()
+        app.db.finish_transaction()
+        message = self.get_items_changed_message()
+        # messages for other item sources shouldn't change anything
+        result_cache.on_item_changes(message, item.DeviceItemSource)
+        self.assertEquals(len(result_cache.entries), 2)
+        result_cache.on_item_changes(message, item.ItemSource)
+        self.assertEquals([e[1].order_by for e in result_cache.entries],
+                          [title_query.order_by])
+        self.check_result_cache_ids(result_cache, query)
+        self.check_result_cache_stats(result_cache, 0, 0, 3)
+
+    def check_result_cache_items(self, result_cache, query):
+        # like check_result_cache_ids(), but also load the items, which
+        # fails if the ids don't match the tracker's transaction
+        tracker = itemtrack.ItemTracker(self.idle_scheduler, query,
+                                        item.ItemSource(),
+                                        result_cache=result_cache)
+        try:
+            connection = self.connection_pool.get_connection()
+            try:
+                correct_ids = query.select_ids(connection)
+            finally:
+                self.connection_pool.release_connection(connection)
+            self.assertEquals([i.id for i in tracker.get_items()],
+                              correct_ids)
+        finally:
+            tracker.destroy()
+
+    def test_result_cache_before_message(self):
+        # the backend can change items before we get the ItemChanges message
+        # for it.  Results from before that shouldn't be used.
+        result_cache = itemtrack.QueryResultCache()
+        query = self.tracker.query
+        reverse_query = query.copy()
+        reverse_query.set_order_by(['-release_date'])
+        self.check_result_cache_items(result_cache, query)
+        self.check_result_cache_stats(result_cache, 0, 0, 1)
+        self.tracked_items[0].remove()
+        app.db.finish_transaction()
+        self.check_result_cache_items(result_cache, query)
+        self.check_result_cache_stats(result_cache, 0, 0, 2)
+        testobjects.make_item(self.tracked_feed, u'new item')
+        app.db.finish_transaction()
+        self.check_result_cache_items(result_cache, reverse_query)
+        self.check_result_cache_stats(result_cache, 0, 0, 3)
+        # without changes we should use the cache again
+        self.check_result_cache_items(result_cache, query)
+        self.check_result_cache_stats(result_cache, 0, 1, 3)
+
     def test_search_for_torrent(self):
         # test searching for the string "torrent" in this case, we should 
         # match items that are torrents.
@@ -753,6 +1136,23 @@ class ItemTrackTestNonWALMode(ItemTrackTestWALMode):
     def force_wal_mode(self):
         self.connection_pool.wal_mode = False
 
+class ItemTrackTestColumnarStore(ItemTrackTestWALMode):
+    """Run the ItemTracker tests with a ColumnarItemStore for row data."""
+    def setup_tracker(self):
+        query = itemtrack.ItemTrackerQuery()
+        query.add_condition('feed_id', '=', self.tracked_feed.id)
+        query.set_order_by(['release_date'])
+        self.tracker = itemtrack.ItemTracker(self.idle_scheduler, query,
+                                             item.ItemSource(),
+                                             columnar_store=True)
+
+    def test_row_data_type(self):
+        self.assert_(isinstance(self.tracker.row_data,
+                                itemstore.ColumnarItemStore))
+        # the store doesn't change how many rows we keep loaded
+        self.assertEquals(self.tracker.max_loaded_rows,
+                          itemtrack.ItemTracker.MAX_LOADED_ROWS)
+
 class DeviceItemTrackTestWALMode(ItemTrackTestCase):
     def setup_items(self):
         self.device = testobjects.make_mock_device()
@@ -793,6 +1193,16 @@ class DeviceItemTrackTestWALMode(ItemTrackTestCase):
         self.process_items_changed_messages()
         self.check_list(self.audio1, self.video1)
 
+    def test_select_attrs(self):
+        # device items don't have feed_id, select_attrs() should use the
+        # default value from ItemInfo for it.
+        attr_values = self.tracker.item_fetcher.select_attrs(
+            ('title', 'feed_id'))
+        self.assertEquals(attr_values, {
+            self.audio1.id: (self.audio1.title, None),
+            self.audio2.id: (self.audio2.title, None),
+        })
+
 class DeviceItemTrackTestNoWALMode(DeviceItemTrackTestWALMode):
     def force_wal_mode(self):
         self.connection_pool.wal_mode = False
@@ -908,6 +1318,41 @@ class SharingItemTrackTestNOWalMode(SharingItemTrackTestWalMode):
     def force_wal_mode(self):
         self.connection_pool.wal_mode = False
 
+class ListDiffTest(MiroTestCase):
+    def check_diff(self, old_ids, new_ids, change_count=None):
+        diff = itemtrack.ListDiff.calc(old_ids, new_ids)
+        result = list(old_ids)
+        for index in reversed(diff.removed):
+            del result[index]
+        for index in diff.inserted:
+            result.insert(index, new_ids[index])
+        self.assertEquals(result, new_ids)
+        if change_count is not None:
+            self.assertEquals(len(diff), change_count)
+        return diff
+
+    def test_calc(self):
+        self.check_diff([], [], 0)
+        self.check_diff([1, 2, 3], [1, 2, 3], 0)
+        self.check_diff([1, 2, 3], [1, 4, 2, 3], 1)
+        self.check_diff([1, 2, 3], [1, 3], 1)
+        self.check_diff([1, 2, 3], [2, 3, 1], 2)
+        self.check_diff([1, 2, 3, 4], [4, 3, 2, 1], 6)
+        self.check_diff([1, 2, 3], [], 3)
+        self.check_diff([], [1, 2], 2)
+
+    def test_random(self):
+        rand = random.Random(0)
+        for i in xrange(50):
+            old_ids = rand.sample(xrange(100), rand.randint(0, 30))
+            new_ids = rand.sample(xrange(100), rand.randint(0, 30))
+            self.check_diff(old_ids, new_ids)
+
+    def test_ranges(self):
+        diff = itemtrack.ListDiff([0, 1, 2, 5], [3, 7, 8])
+        self.assertEquals(diff.removed_ranges(), [(0, 3), (5, 1)])
+        self.assertEquals(diff.inserted_ranges(), [(3, 1), (7, 2)])
+
 class ItemInfoAttributeTest(MiroTestCase):
     # Test that DeviceItemInfo and SharingItemInfo to make sure that they
     # define the same attributes that ItemInfo does
@@ -0,0 +1,573 @@
+"""Performance tests and benchmarks.
+
+These don't run as part of the normal test suite.  Run them by passing
+"performancetest" on the command line (see MiroTestLoader).
+"""
+
+import datetime
+import gc
+import inspect
+import random
+import sqlite3
+import sys
+import time
+
+from miro import app
+from miro import containerformat
+from miro import eventloop
+from miro import feed
+from miro import indexregistry
+from miro import item
+from miro import schema
+from miro import search
+from miro import storedatabase
+from miro.data import itemstore
+from miro.data import itemtrack
+from miro.data.item import ItemSource
+from miro.test import testobjects
+from miro.test.framework import MiroTestCase
+
+class BenchmarkTestCase(MiroTestCase):
+    def time_it(self, description, func, *args, **kwargs):
+        start = time.time()
+        rv = func(*args, **kwargs)
+        print '%s: %.3fs' % (description, time.time() - start)
+        return rv
+
+class SchedulerBenchmark(BenchmarkTestCase):
+    TIMEOUT_COUNT = 100000
+
+    def test_schedule_and_cancel(self):
+        scheduler = eventloop.Scheduler()
+        def callback():
+            pass
+        def schedule():
+            return [scheduler.add_timeout(60 + i * 0.001, callback, 'bench')
+                    for i in xrange(self.TIMEOUT_COUNT)]
+        timeouts = self.time_it('schedule %d timeouts' % self.TIMEOUT_COUNT,
+                                schedule)
+        # keep every 100th timeout alive
+        def cancel():
+            for i, dc in enumerate(timeouts):
+                if i % 100 != 0:
+                    dc.cancel()
+        self.time_it('cancel %d timeouts' % self.TIMEOUT_COUNT, cancel)
+        live_count = self.TIMEOUT_COUNT / 100
+        self.assertEquals(scheduler.live_timeout_count(), live_count)
+        # the heap should stay proportional to the live timers
+        self.assert_(len(scheduler.heap) <= live_count * 2 +
+                     scheduler.COMPACT_MIN_CANCELED)
+        self.time_it('1000 next_timeout() calls',
+                     lambda: [scheduler.next_timeout() for i in xrange(1000)])
+
+class ObjectCacheBenchmark(BenchmarkTestCase):
+    ITEM_COUNT = 20000
+    BUDGET = 2000
+
+    def test_iterate_large_view(self):
+        app.db.object_cache_budget = self.BUDGET
+        app.db._next_eviction_check = self.BUDGET
+        def make_items():
+            app.bulk_sql_manager.start()
+            feed = testobjects.make_feed()
+            testobjects.add_items_to_feed(feed, self.ITEM_COUNT)
+            app.bulk_sql_manager.finish()
+            return feed
+        feed = self.time_it('create %d items' % self.ITEM_COUNT, make_items)
+        item._deleted_file_checker.items_to_check.clear()
+        app.db.evict_objects()
+        self.clear_ddb_object_cache()
+        # iterate through the items in chunks, ending the event after each
+        # one like the real event loop would.
+        max_size = [0]
+        def iterate():
+            id_list = list(item.Item.make_view().id_list())
+            for start in xrange(0, len(id_list), 500):
+                view = item.Item.make_view('id IN (%s)' % ', '.join(
+                    str(id_) for id_ in id_list[start:start+500]))
+                for obj in view:
+                    pass
+                obj = view = None
+                # pretend that DeletedFileChecker ran
+                item._deleted_file_checker.items_to_check.clear()
+                app.db.on_event_finished(None, True)
+                max_size[0] = max(max_size[0],
+                                  app.db.get_object_cache_stats()['evictable'])
+        self.time_it('iterate %d items with a budget of %d' %
+                     (self.ITEM_COUNT, self.BUDGET), iterate)
+        self.time_it('iterate again', iterate)
+        gc.collect()
+        stats = app.db.get_object_cache_stats()
+        print stats
+        # the resident set should stay within budget + 1 chunk
+        self.assert_(max_size[0] <= self.BUDGET + 500)
+        self.assert_(stats['evicted_alive'] < self.BUDGET)
+
+class ContainerRestoreBenchmark(BenchmarkTestCase):
+    VALUE_COUNT = 20000
+    FEED_COUNT = 2000
+
+    def make_value(self, i):
+        # something like the etag/modified/linkHistory columns for a feed
+        return {
+            u'etag': u'"%x-abcdef"' % i,
+            u'modified': u'Mon, 18 Oct 2010 12:00:%02d GMT' % (i % 60),
+            u'history': [u'http://example.com/%d/page%d' % (i, j)
+                         for j in range(5)],
+            u'updated': datetime.datetime(2010, 10, 18, 12, 0, i % 60),
+        }
+
+    def test_decode(self):
+        converter = storedatabase.SQLiteConverter()
+        schema_item = schema.SchemaReprContainer()
+        values = [self.make_value(i) for i in xrange(self.VALUE_COUNT)]
+        reprs = [repr(v) for v in values]
+        blobs = self.time_it('encode %d values' % self.VALUE_COUNT,
+                             lambda: [buffer(containerformat.encode(v))
+                                      for v in values])
+        old = self.time_it('restore %d values using eval()' %
+                           self.VALUE_COUNT,
+                           lambda: [converter._repr_from_sql(r, schema_item)
+                                    for r in reprs])
+        new = self.time_it('restore %d values using containerformat' %
+                           self.VALUE_COUNT,
+                           lambda: [converter._repr_from_sql(b, schema_item)
+                                    for b in blobs])
+        self.assertEquals(old, new)
+        self.assertEquals(new, values)
+
+    def test_restore_feeds(self):
+        def make_feeds():
+            return [feed.Feed(u'dtv:savedsearch/all?q=dogs%d' % i)
+                    for i in xrange(self.FEED_COUNT)]
+        feeds = self.time_it('create %d feeds' % self.FEED_COUNT, make_feeds)
+        for f in feeds:
+            impl = f.actualFeed
+            impl.etag = dict((u'http://example.com/%d/%d' % (f.id, j),
+                              u'"%x-abcdef"' % j) for j in range(5))
+            impl.modified = dict((u'http://example.com/%d/%d' % (f.id, j),
+                                  u'Mon, 18 Oct 2010 12:00:00 GMT')
+                                 for j in range(5))
+            impl.signal_change()
+        def restore():
+            self.clear_ddb_object_cache()
+            return list(feed.SavedSearchFeedImpl.make_view())
+        self.time_it('restore %d feed impls (binary containers)' %
+                     self.FEED_COUNT, restore)
+        app.db.cursor.execute("SELECT id, etag, modified "
+                              "FROM saved_search_feed_impl")
+        for impl_id, etag, modified in app.db.cursor.fetchall():
+            app.db.cursor.execute("UPDATE saved_search_feed_impl "
+                                  "SET etag=?, modified=? WHERE id=?",
+                                  (repr(containerformat.decode(etag)),
+                                   repr(containerformat.decode(modified)),
+                                   impl_id))
+        impls = self.time_it('restore %d feed impls (repr containers)' %
+                             self.FEED_COUNT, restore)
+        def save():
+            for impl in impls:
+                app.db.update_obj(impl)
+        self.time_it('save %d feed impls (converting containers)' %
+                     self.FEED_COUNT, save)
+        self.time_it('save %d feed impls (unchanged containers)' %
+                     self.FEED_COUNT, save)
+
+class LazyColumnBenchmark(BenchmarkTestCase):
+    ITEM_COUNT = 5000
+
+    def restore_items(self):
+        self.clear_ddb_object_cache()
+        gc.collect()
+        return list(item.Item.make_view())
+
+    def restore_items_prefetched(self):
+        self.clear_ddb_object_cache()
+        gc.collect()
+        return list(item.Item.make_view(load_lazy_columns=True))
+
+    def test_restore_items(self):
+        def make_items():
+            app.bulk_sql_manager.start()
+            feed = testobjects.make_feed()
+            for i in xrange(self.ITEM_COUNT):
+                testobjects.make_item(feed, u'item%d' % i,
+                                      entry_description=u'<p>%s</p>' %
+                                      (u'description text ' * 200))
+            app.bulk_sql_manager.finish()
+        self.time_it('create %d items' % self.ITEM_COUNT, make_items)
+        lazy_columns = schema.ItemSchema.lazy_columns
+        try:
+            schema.ItemSchema.lazy_columns = ()
+            app.db._setup_lazy_columns(schema.ItemSchema)
+            self.time_it('restore %d items (no lazy columns)' %
+                         self.ITEM_COUNT, self.restore_items)
+        finally:
+            schema.ItemSchema.lazy_columns = lazy_columns
+            app.db._setup_lazy_columns(schema.ItemSchema)
+        items = self.time_it('restore %d items (lazy columns)' %
+                             self.ITEM_COUNT, self.restore_items)
+        self.time_it('load descriptions for %d items' % self.ITEM_COUNT,
+                     app.db.load_lazy_columns, items)
+        self.time_it('restore %d items (lazy columns, prefetched)' %
+                     self.ITEM_COUNT,
+                     self.restore_items_prefetched)
+
+class FeedCountBenchmark(BenchmarkTestCase):
+    FEED_COUNT = 500
+    ITEMS_PER_FEED = 20
+
+    def count_queries(self):
+        stats = app.db.query_profiler.get_stats()
+        return sum(query['count'] for query in stats['queries'].values())
+
+    def test_feed_counts(self):
+        def make_feeds():
+            app.bulk_sql_manager.start()
+            feeds = []
+            for i in xrange(self.FEED_COUNT):
+                feed, items = testobjects.make_feed_with_items(
+                    self.ITEMS_PER_FEED)
+                feeds.append(feed)
+            app.bulk_sql_manager.finish()
+            return feeds
+        feeds = self.time_it('create %d feeds' % self.FEED_COUNT, make_feeds)
+        def get_counts():
+            # what ChannelInfo and the auto-downloader need for each feed
+            for feed in feeds:
+                feed.num_downloaded()
+                feed.num_downloading()
+                feed.num_unwatched()
+                feed.num_available()
+        item.Item._feed_count_tracker.reset()
+        app.db.query_profiler.reset()
+        self.time_it('get counts for %d feeds' % self.FEED_COUNT,
+                     get_counts)
+        first_pass_queries = self.count_queries()
+        print 'queries for the first pass: %d' % first_pass_queries
+        # change an item in each feed, then get the counts again.  The first
+        # time an item changes, we look up its old values by id.
+        app.db.query_profiler.reset()
+        for feed in feeds:
+            for obj in feed.items:
+                obj.unset_new()
+                break
+            feed.recalc_counts()
+        print 'queries while changing items: %d' % self.count_queries()
+        app.db.query_profiler.reset()
+        self.time_it('get counts after changes', get_counts)
+        print 'queries after changes: %d' % self.count_queries()
+        # at most one query to load the counts for all feeds
+        self.assert_(first_pass_queries <= 1)
+        self.assertEquals(self.count_queries(), 0)
+
+class SearchBenchmark(BenchmarkTestCase):
+    """Benchmark matching items against searches, like search feeds do."""
+    ITEM_COUNT = 100000
+    WORD_COUNT = 20000
+    SEARCHES = ['q', 'qua', 'quartz', 'quartz sil', 'quartz -silver',
+                '"quartz silver"']
+
+    def make_corpus(self):
+        rand = random.Random(0)
+        letters = 'abcdefghijklmnopqrstuvwxyz'
+        words = [''.join(rand.choice(letters)
+                         for i in xrange(rand.randint(3, 9)))
+                 for i in xrange(self.WORD_COUNT)]
+        # make sure our search terms are in there.  quartz is in about 5%
+        # of the items and silver in about 1%.
+        words[50] = 'quartz'
+        words[200] = 'silver'
+        def text(count):
+            # use a log-uniform distribution, so that low-numbered words are
+            # common and high-numbered ones are rare, like in real text.
+            return u' '.join(words[int(self.WORD_COUNT ** rand.random()) - 1]
+                             for i in xrange(count))
+        return [u' '.join([text(4), text(15), text(1), text(2), text(2)])
+                for i in xrange(self.ITEM_COUNT)]
+
+    def test_text_matches(self):
+        corpus = self.time_it('make %d item corpus' % self.ITEM_COUNT,
+                              self.make_corpus)
+        for search_text in self.SEARCHES:
+            start = time.time()
+            matches = [text for text in corpus
+                       if search.text_matches(text, search_text)]
+            print 'search %-20r %5d matches %.3fus per item' % (
+                search_text, len(matches),
+                (time.time() - start) * 1000000 / self.ITEM_COUNT)
+        # lots of different searches shouldn't grow the parsed search cache
+        # past its limit
+        for i in xrange(search.SEARCH_CACHE_SIZE * 10):
+            search.text_matches(corpus[i], u'search %d' % i)
+        self.assert_(len(search._search_cache.dict) <=
+                     search.SEARCH_CACHE_SIZE)
+
+class SyntheticItemsBenchmark(BenchmarkTestCase):
+    """Base class for benchmarks that need a database full of items.
+
+    make_synthetic_database() inserts the rows directly, which is much faster
+    than creating Item objects.
+    """
+    ITEM_COUNT = 200000
+    FEED_COUNT = 200
+    PLAYLIST_COUNT = 20
+
+    def make_synthetic_database(self):
+        rand = random.Random(0)
+        cursor = app.db.cursor
+        cursor.execute("BEGIN TRANSACTION")
+        feed_urls = [u'http://example.com/feed-%d' % i
+                     for i in xrange(self.FEED_COUNT - 3)]
+        feed_urls.extend([u'dtv:manualFeed', u'dtv:search',
+                          u'dtv:searchDownloads'])
+        cursor.executemany("INSERT INTO feed (id, orig_url, autoDownloadable, "
+                           "getEverything) VALUES (?, ?, 0, 0)",
+                           [(i + 1, url) for i, url in enumerate(feed_urls)])
+        def item_rows():
+            now = datetime.datetime.now()
+            for i in xrange(self.ITEM_COUNT):
+                id_ = self.FEED_COUNT + i + 1
+                downloaded = rand.random() < 0.3
+                watched = downloaded and rand.random() < 0.5
+                if downloaded:
+                    downloader_id = id_ + self.ITEM_COUNT
+                else:
+                    downloader_id = None
+                date = now - datetime.timedelta(minutes=i)
+                # every 20th item is a container for the next 5 items
+                is_container = (i % 20 == 0)
+                if i % 20 in (1, 2, 3, 4, 5):
+                    parent_id = id_ - i % 20
+                else:
+                    parent_id = None
+                yield (id_, rand.randint(1, self.FEED_COUNT), downloader_id,
+                       parent_id, rand.choice(('video', 'audio', 'other')),
+                       False, u'item %d' % i, date, date,
+                       downloaded and date or None,
+                       watched and date or None, watched and date or None,
+                       False, False, False, is_container, False, False,
+                       False)
+        cursor.executemany("INSERT INTO item (id, feed_id, downloader_id, "
+                           "parent_id, file_type, deleted, title, "
+                           "release_date, creation_time, downloaded_time, "
+                           "watched_time, last_watched, expired, keep, "
+                           "is_file_item, is_container_item, was_downloaded, "
+                           "pending_manual_download, auto_downloaded) "
+                           "VALUES (%s)" % ', '.join('?' * 19), item_rows())
+        cursor.execute("INSERT INTO remote_downloader (id, state, "
+                       "main_item_id) SELECT downloader_id, 'finished', id "
+                       "FROM item WHERE downloader_id IS NOT NULL")
+        cursor.executemany("INSERT INTO playlist_item_map (id, playlist_id, "
+                           "item_id, position) VALUES (?, ?, ?, ?)",
+                           [(self.ITEM_COUNT * 2 + i + 1,
+                             i % self.PLAYLIST_COUNT + 1,
+                             self.FEED_COUNT + i + 1, i)
+                            for i in xrange(0, self.ITEM_COUNT, 50)])
+        cursor.execute("COMMIT TRANSACTION")
+        cursor.execute("ANALYZE")
+
+class IndexCheckBenchmark(SyntheticItemsBenchmark):
+    """Check our item queries for full table scans.
+
+    This fills the database with synthetic items, then uses
+    indexregistry.find_full_scans() on the SQL for the Item views and for
+    the frontend's ItemTrackerQuery objects.
+    """
+
+    def backend_queries(self):
+        queries = []
+        for name in dir(item.Item):
+            if not name.endswith('_view'):
+                continue
+            method = getattr(item.Item, name)
+            if not inspect.ismethod(method):
+                continue
+            arg_names, varargs, varkw, defaults = inspect.getargspec(method)
+            # skip cls and any arguments with default values
+            arg_names = arg_names[1:len(arg_names) - len(defaults or ())]
+            args = []
+            for arg_name in arg_names:
+                if arg_name == 'watched_before':
+                    args.append(datetime.datetime.now())
+                elif arg_name == 'path':
+                    args.append('/tmp/synthetic.mp3')
+                else:
+                    args.append(1)
+            view = method(*args)
+            sql = app.db.query_ids_sql(view.table_name, view.where,
+                                       view.order_by, view.joins,
+                                       view.limit)
+            values = view.values or ()
+            try:
+                app.db.cursor.execute("EXPLAIN " + sql, values)
+            except sqlite3.DatabaseError, e:
+                print 'skipping Item.%s(): %s' % (name, e)
+                continue
+            queries.append(('Item.%s()' % name, sql, values))
+        return queries
+
+    def frontend_queries(self):
+        def make_query(name, conditions, order_by=None, limit=None):
+            query = itemtrack.ItemTrackerQuery()
+            for condition in conditions:
+                query.add_condition(*condition)
+            if order_by is not None:
+                query.set_order_by(order_by)
+            if limit is not None:
+                query.set_limit(limit)
+            sql, args = query.select_ids_sql()
+            return (name, sql, args)
+        return [
+            make_query('videos tab', [('file_type', '=', 'video'),
+                                      ('deleted', '=', False)],
+                       ['-release_date']),
+            make_query('music tab', [('file_type', '=', 'audio'),
+                                     ('deleted', '=', False)],
+                       ['title']),
+            make_query('feed tab', [('feed_id', '=', 1)], ['-release_date']),
+            make_query('folder contents', [('parent_id', '=', 1)]),
+            make_query('playlist tab',
+                       [('playlist_item_map.playlist_id', '=', 1)],
+                       ['playlist_item_map.position']),
+            make_query('newly downloaded display',
+                       [('downloaded_time', 'IS NOT', None),
+                        ('expired', '=', False),
+                        ('parent_id', 'IS', None),
+                        ('watched_time', 'IS', None)],
+                       ['-downloaded_time'], limit=20),
+            make_query('recently watched display',
+                       [('file_type', '=', 'video'),
+                        ('watched_time', 'IS NOT', None)],
+                       ['-last_watched'], limit=20),
+        ]
+
+    def run_queries(self, queries):
+        for name, sql, values in queries:
+            app.db.cursor.execute(sql, values).fetchall()
+
+    def test_check_indexes(self):
+        self.time_it('create %d synthetic items' % self.ITEM_COUNT,
+                     self.make_synthetic_database)
+        queries = self.backend_queries() + self.frontend_queries()
+        self.time_it('run %d queries' % len(queries), self.run_queries,
+                     queries)
+        full_scans = indexregistry.find_full_scans(app.db.cursor, queries,
+                                                   tables=('item',))
+        print indexregistry.format_full_scans(full_scans)
+
+def deep_sizeof(obj, exclude=()):
+    """Get the memory used by obj and all the objects it references.
+
+    :param exclude: objects to skip, along with everything they reference
+    """
+    seen = set(id(o) for o in exclude)
+    to_check = [obj]
+    total = 0
+    while to_check:
+        obj = to_check.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        to_check.extend(gc.get_referents(obj))
+    return total
+
+class ColumnarStoreBenchmark(SyntheticItemsBenchmark):
+    """Compare ItemTracker's dict row data with ColumnarItemStore.
+
+    We measure the memory that the row data uses and how long it takes to
+    draw each frame while scrolling through a big list.
+    """
+    ITEM_COUNT = 50000
+    # number of rows that the view shows at once
+    PAGE_SIZE = 40
+    # rows to scroll by for each frame
+    SCROLL_STEP = 120
+
+    def setUp(self):
+        SyntheticItemsBenchmark.setUp(self)
+        self.init_data_package()
+        self.make_synthetic_database()
+        self.idle_callbacks = []
+
+    def make_tracker(self, **kwargs):
+        query = itemtrack.ItemTrackerQuery()
+        query.add_condition('deleted', '=', False)
+        query.set_order_by(['-release_date'])
+        return itemtrack.ItemTracker(self.idle_callbacks.append, query,
+                                     ItemSource(), **kwargs)
+
+    def run_idle_callbacks(self, max_count=None):
+        count = 0
+        while self.idle_callbacks:
+            if max_count is not None and count >= max_count:
+                return
+            self.idle_callbacks.pop(0)()
+            count += 1
+
+    def row_data_size(self, tracker):
+        exclude = [tracker.item_source]
+        if isinstance(tracker.row_data, itemstore.ColumnarItemStore):
+            exclude.append(tracker.row_data.select_columns)
+        return deep_sizeof(tracker.row_data, exclude)
+
+    def measure_memory(self, description, **kwargs):
+        tracker = self.make_tracker(**kwargs)
+        self.time_it('%s: load %d rows' % (description, len(tracker)),
+                     self.run_idle_callbacks)
+        gc.collect()
+        size = self.row_data_size(tracker)
+        row_count = len(tracker.row_data)
+        print '%s: %d rows loaded, %.1fMB (%d bytes per row)' % (
+            description, row_count, size / 1048576.0, size / row_count)
+        tracker.destroy()
+        return size / row_count
+
+    def scroll(self, tracker, starts):
+        """Scroll through a list and time each frame.
+
+        For each frame, we get the visible rows like the view would, then
+        run one idle callback to simulate the time between frames.
+        """
+        frame_times = []
+        for start in starts:
+            frame_start = time.time()
+            end = min(start + self.PAGE_SIZE, len(tracker))
+            tracker.set_visible_range(start, end)
+            for i in xrange(start, end):
+                tracker.get_row(i)
+            frame_times.append(time.time() - frame_start)
+            self.run_idle_callbacks(max_count=1)
+        return frame_times
+
+    def print_frame_times(self, description, frame_times):
+        frame_times = sorted(frame_times)
+        print '%s: %d frames, mean %.2fms, 95th %.2fms, max %.2fms' % (
+            description, len(frame_times),
+            sum(frame_times) * 1000 / len(frame_times),
+            frame_times[int(len(frame_times) * 0.95)] * 1000,
+            frame_times[-1] * 1000)
+
+    def measure_scrolling(self, description, **kwargs):
+        tracker = self.make_tracker(**kwargs)
+        # let the initial prefetching finish
+        self.run_idle_callbacks()
+        down = range(0, len(tracker), self.SCROLL_STEP)
+        up = list(reversed(down))
+        self.print_frame_times('%s: scroll down' % description,
+                               self.scroll(tracker, down))
+        self.print_frame_times('%s: scroll back up' % description,
+                               self.scroll(tracker, up))
+        tracker.destroy()
+
+    def test_memory(self):
+        dict_size = self.measure_memory('dict', max_loaded_rows=sys.maxint)
+        columnar_size = self.measure_memory('columnar',
+                                            max_loaded_rows=sys.maxint,
+                                            columnar_store=True)
+        self.assert_(columnar_size < dict_size)
+
+    def test_scrolling(self):
+        # use the default max_loaded_rows
+        self.measure_scrolling('dict')
+        self.measure_scrolling('columnar', columnar_store=True)
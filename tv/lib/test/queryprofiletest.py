@@ -0,0 +1,124 @@
+import sqlite3
+
+from miro import app
+from miro import queryprofile
+from miro.test.framework import MiroTestCase, EventLoopTest
+
+class NormalizeSQLTest(MiroTestCase):
+    def test_literals(self):
+        self.assertEquals(queryprofile.normalize_sql(
+            "SELECT id FROM item WHERE feed_id=12 AND title='it''s'"),
+            "SELECT id FROM item WHERE feed_id=? AND title=?")
+        # numbers inside identifiers should stay
+        self.assertEquals(queryprofile.normalize_sql(
+            "SELECT col2 FROM table3 WHERE x > 1.5"),
+            "SELECT col2 FROM table3 WHERE x > ?")
+
+    def test_in_lists(self):
+        self.assertEquals(queryprofile.normalize_sql(
+            "SELECT id FROM item\n   WHERE id IN (?, ?,?)"),
+            "SELECT id FROM item WHERE id IN (?...)")
+        self.assertEquals(queryprofile.normalize_sql(
+            "DELETE FROM item WHERE id IN (1, 2, 3)"),
+            "DELETE FROM item WHERE id IN (?...)")
+
+class QueryProfilerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.profiler = queryprofile.QueryProfiler('test',
+                                                   plan_threshold=0.1)
+        self.explain_calls = []
+
+    def explain(self, sql, values):
+        self.explain_calls.append((sql, values))
+        return [(0, 0, 0, 'SCAN TABLE item')]
+
+    def test_aggregate(self):
+        for i in xrange(1, 101):
+            self.profiler.record('SELECT * FROM item WHERE id=%d' % i, (),
+                                 i / 1000.0, rows=1)
+        stats = self.profiler.get_stats()
+        self.assertEquals(stats['queries'].keys(),
+                          ['SELECT * FROM item WHERE id=?'])
+        query_stats = stats['queries']['SELECT * FROM item WHERE id=?']
+        self.assertEquals(query_stats['count'], 100)
+        self.assertAlmostEquals(query_stats['total_time'], 5.05)
+        self.assertAlmostEquals(query_stats['max_time'], 0.1)
+        self.assertAlmostEquals(query_stats['p95_time'], 0.095)
+        self.assertEquals(query_stats['rows'], 100)
+
+    def test_capture_plan(self):
+        sql = 'SELECT * FROM item WHERE title=?'
+        self.profiler.record(sql, ('a',), 0.01, explain=self.explain)
+        self.assertEquals(self.explain_calls, [])
+        self.profiler.record(sql, ('b',), 0.2, explain=self.explain)
+        self.profiler.record(sql, ('c',), 0.3, explain=self.explain)
+        # we should only capture the plan once
+        self.assertEquals(self.explain_calls, [(sql, ('b',))])
+        query_stats = self.profiler.get_stats()['queries'][sql]
+        self.assertEquals(query_stats['plan'], ['SCAN TABLE item'])
+        self.assert_(query_stats['full_scan'])
+        self.assert_('FULL SCAN' in self.profiler.format_report())
+
+    def test_explain_error(self):
+        def explain(sql, values):
+            raise sqlite3.OperationalError()
+        self.profiler.record('SELECT 1', (), 1.0, explain=explain)
+        query_stats = self.profiler.get_stats()['queries']['SELECT ?']
+        self.assertEquals(query_stats['plan'], [])
+
+    def test_full_scan(self):
+        connection = sqlite3.connect(':memory:')
+        connection.execute("CREATE TABLE item(id INTEGER PRIMARY KEY, "
+                           "title TEXT, feed_id INTEGER)")
+        connection.execute("CREATE INDEX item_feed ON item (feed_id)")
+        def plan(sql):
+            return [row[-1] for row in
+                    connection.execute("EXPLAIN QUERY PLAN " + sql)]
+        self.assert_(queryprofile.plan_has_full_scan(
+            plan("SELECT * FROM item WHERE title='a'")))
+        self.assert_(not queryprofile.plan_has_full_scan(
+            plan("SELECT * FROM item WHERE feed_id=1")))
+        self.assert_(not queryprofile.plan_has_full_scan(
+            plan("SELECT * FROM item WHERE id=1")))
+
+    def test_max_queries(self):
+        self.profiler.MAX_QUERIES = 2
+        self.profiler.record('SELECT a FROM item', (), 0.1)
+        self.profiler.record('SELECT b FROM item', (), 0.1)
+        self.profiler.record('SELECT c FROM item', (), 0.1)
+        self.profiler.record('SELECT d FROM item', (), 0.1)
+        queries = self.profiler.get_stats()['queries']
+        self.assertEquals(len(queries), 3)
+        self.assertEquals(queries[self.profiler.OVERFLOW_SQL]['count'], 2)
+
+    def test_disabled(self):
+        self.profiler.enabled = False
+        self.profiler.record('SELECT 1', (), 0.1)
+        self.assertEquals(self.profiler.get_stats()['queries'], {})
+
+    def test_reset(self):
+        self.profiler.record('SELECT 1', (), 0.1)
+        self.profiler.reset()
+        self.assertEquals(self.profiler.get_stats()['queries'], {})
+
+class LiveStorageProfileTest(EventLoopTest):
+    def test_profile(self):
+        profiler = app.db.query_profiler
+        profiler.reset()
+        profiler.plan_threshold = -1
+        app.db.execute("CREATE TABLE profile_test(id INTEGER PRIMARY KEY, "
+                       "name TEXT)", is_update=True)
+        app.db.execute("INSERT INTO profile_test(name) VALUES (?)", (u'a',),
+                       is_update=True)
+        rows = app.db.execute("SELECT name FROM profile_test WHERE name=?",
+                              (u'a',))
+        self.assertEquals(rows, [(u'a',)])
+        queries = profiler.get_stats()['queries']
+        insert_stats = queries[
+            'INSERT INTO profile_test(name) VALUES (?...)']
+        self.assertEquals(insert_stats['count'], 1)
+        self.assertEquals(insert_stats['rows'], 1)
+        select_stats = queries['SELECT name FROM profile_test WHERE name=?']
+        self.assertEquals(select_stats['rows'], 1)
+        self.assert_(select_stats['full_scan'])
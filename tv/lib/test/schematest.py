@@ -109,5 +109,16 @@ class TestValidation(MiroTestCase):
         # the actual class object shouldn't
         self.assertRaises(ValidationError, schemaobject.validate, TestObject)
 
+class AccessPatternTest(MiroTestCase):
+    def test_columns_exist(self):
+        for oschema in schema.object_schemas:
+            columns = set(name for name, schema_item in oschema.fields)
+            for pattern in oschema.access_patterns:
+                for column in pattern.index_columns():
+                    if column not in columns:
+                        raise AssertionError("%s not in %s (%r)" %
+                                             (column, oschema.table_name,
+                                              pattern))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,40 @@
+from miro import search
+from miro.test import testobjects
+from miro.test.framework import MiroTestCase, EventLoopTest
+
+class BooleanSearchTest(MiroTestCase):
+    def check_parse(self, search_text, positive_terms, negative_terms=()):
+        parsed = search.BooleanSearch(search_text)
+        self.assertEquals(parsed.positive_terms, list(positive_terms))
+        self.assertEquals(parsed.negative_terms, list(negative_terms))
+
+    def test_parse(self):
+        self.check_parse(u'Foo  bar', [u'foo', u'bar'])
+        self.check_parse(u'foo -bar', [u'foo'], [u'bar'])
+        self.check_parse(u'"foo bar" baz', [u'foo bar', u'baz'])
+        self.check_parse(u'-"foo bar', [], [u'foo bar'])
+
+    def test_parse_cache(self):
+        old_cache = search._search_cache
+        search._search_cache = search._BooleanSearchCache(4)
+        try:
+            parsed = search._get_boolean_search(u'foo')
+            self.assert_(search._get_boolean_search(u'foo') is parsed)
+            for i in xrange(10):
+                search._get_boolean_search(u'term %d' % i)
+            self.assert_(len(search._search_cache.dict) <= 4)
+        finally:
+            search._search_cache = old_cache
+
+class ItemMatchesSearchTest(EventLoopTest):
+    def test_matches_search(self):
+        feed = testobjects.make_feed()
+        item = testobjects.make_item(feed, u'Linux Kernel Talk',
+                                     description=u'all about schedulers')
+        self.assert_(item.matches_search(None))
+        self.assert_(item.matches_search(u'linux'))
+        self.assert_(item.matches_search(u'ernel sched'))
+        self.assert_(not item.matches_search(u'linux -talk'))
+        self.assert_(not item.matches_search(u'kernels'))
+        self.assert_(search.calc_search_text(item).startswith(
+            u'linux kernel talk all about schedulers'))
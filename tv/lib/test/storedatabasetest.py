@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
 import unittest
 import string
@@ -8,6 +8,7 @@ import time
 import sqlite3
 
 from miro import app
+from miro import containerformat
 from miro import database
 from miro import databaseupgrade
 from miro import devices
@@ -18,6 +19,8 @@ from miro import feed
 from miro import folder
 from miro import widgetstate
 from miro import guide
+from miro import indexregistry
+from miro import queryprofile
 from miro import schema
 from miro import signals
 from miro import tabs
@@ -564,6 +567,440 @@ class ObjectMemoryTest(FakeSchemaTest):
         lee.remove()
         self.assertEquals(0, len(app.db._object_map))
 
+class ObjectEvictionTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        RestorableHuman.cache_evictable = True
+        self.reload_test_database()
+        app.db.object_cache_budget = app.db._next_eviction_check = 10
+
+    def tearDown(self):
+        del RestorableHuman.cache_evictable
+        FakeSchemaTest.tearDown(self)
+
+    def make_humans(self, count):
+        return [RestorableHuman(u'human%d' % i, i, 1.5, []).id
+                for i in xrange(count)]
+
+    def test_evict(self):
+        ids = self.make_humans(50)
+        self.assertEquals(app.db.evict_objects(), 41)
+        stats = app.db.get_object_cache_stats()
+        self.assertEquals(stats['evictable'], 9)
+        self.assertEquals(stats['evicted'], 41)
+        # the most recently used objects should be kept
+        for id_ in ids[-9:]:
+            self.assert_(app.db.id_alive(id_, RestorableHuman))
+        # evicted objects should get reloaded from disk
+        human = RestorableHuman.get_by_id(ids[0])
+        self.assertEquals(human.name, u'human0')
+        self.assert_(human.iveBeenRestored)
+        self.assertEquals(app.db.get_object_cache_stats()['misses'], 1)
+
+    def test_evict_on_event_finished(self):
+        self.make_humans(50)
+        app.db.on_event_finished(None, True)
+        self.assertEquals(app.db.get_object_cache_stats()['evictable'], 9)
+
+    def test_identity(self):
+        self.make_humans(20)
+        human = RestorableHuman(u'kept', 30, 1.5, [])
+        self.make_humans(20)
+        app.db.evict_objects()
+        self.assert_((human.id, 'restorable_human') not in app.db._ids_loaded)
+        # human is still referenced, so we should get the same object back
+        self.assert_(RestorableHuman.get_by_id(human.id) is human)
+        self.assertEquals(app.db.get_object_cache_stats()['revived'], 1)
+        self.assert_((human.id, 'restorable_human') in app.db._ids_loaded)
+
+    def test_unsaved_changes_not_evicted(self):
+        human = RestorableHuman(u'changed', 30, 1.5, [])
+        human.name = u'new-name'
+        human_id = human.id
+        del human
+        self.make_humans(20)
+        app.db.evict_objects()
+        self.assert_(human_id in [key[0] for key in app.db._object_map])
+
+    def test_remove_evicted(self):
+        human = RestorableHuman(u'removed', 30, 1.5, [])
+        self.make_humans(20)
+        app.db.evict_objects()
+        human.remove()
+        self.assert_(not app.db.id_alive(human.id, RestorableHuman))
+        self.assertRaises(database.ObjectNotFoundError,
+                          RestorableHuman.get_by_id, human.id)
+
+class GroupCommitTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        app.db.finish_transaction()
+        app.db.group_commit_delay = 10
+        app.db.group_commit_max_statements = 1000
+        self.other_connection = sqlite3.connect(self.save_path)
+
+    def tearDown(self):
+        self.other_connection.close()
+        FakeSchemaTest.tearDown(self)
+
+    def saved_names(self):
+        # read from a different connection so we only see committed data
+        cursor = self.other_connection.execute("SELECT name FROM human")
+        return set(row[0] for row in cursor)
+
+    def test_commit_delayed(self):
+        Human(u'sam', 30, 1.8, [])
+        app.db.on_event_finished(None, True)
+        Human(u'tim', 31, 1.8, [])
+        app.db.on_event_finished(None, True)
+        self.assert_(app.db.commit_pending())
+        self.assertEquals(self.saved_names(), set([u'lee']))
+        # the timeout should commit both events at once
+        app.db._group_commit_timeout.dispatch()
+        self.assert_(not app.db.commit_pending())
+        self.assertEquals(self.saved_names(), set([u'lee', u'sam', u'tim']))
+
+    def test_commit_after_delay(self):
+        app.db.group_commit_delay = 0.001
+        Human(u'sam', 30, 1.8, [])
+        time.sleep(0.01)
+        app.db.on_event_finished(None, True)
+        self.assert_(not app.db.commit_pending())
+        self.assertEquals(self.saved_names(), set([u'lee', u'sam']))
+
+    def test_max_statements(self):
+        app.db.group_commit_max_statements = 5
+        Human(u'sam', 30, 1.8, [])
+        app.db.on_event_finished(None, True)
+        self.assert_(app.db.commit_pending())
+        for i in range(5):
+            Human(u'human%d' % i, 30, 1.8, [])
+        app.db.on_event_finished(None, True)
+        self.assert_(not app.db.commit_pending())
+        self.assertEquals(len(self.saved_names()), 7)
+
+    def test_failed_event(self):
+        Human(u'sam', 30, 1.8, [])
+        app.db.on_event_finished(None, True)
+        Human(u'tim', 31, 1.8, [])
+        app.db.on_event_finished(None, False)
+        app.db.finish_transaction()
+        # only the failed event's changes should be rolled back
+        self.assertEquals(self.saved_names(), set([u'lee', u'sam']))
+
+    def test_failed_only_event(self):
+        Human(u'tim', 31, 1.8, [])
+        app.db.on_event_finished(None, False)
+        self.assert_(not app.db.commit_pending())
+        self.assertEquals(app.db._group_commit_timeout, None)
+        Human(u'sam', 30, 1.8, [])
+        app.db.finish_transaction()
+        self.assertEquals(self.saved_names(), set([u'lee', u'sam']))
+
+    def test_rerun_transaction(self):
+        Human(u'sam', 30, 1.8, [])
+        app.db.on_event_finished(None, True)
+        Human(u'tim', 31, 1.8, [])
+        # simulate an error that made SQLite roll back our transaction
+        app.db.cursor.execute("ROLLBACK TRANSACTION")
+        app.db._current_select_statement = None
+        self.assert_(app.db._try_rerunning_transaction())
+        app.db.on_event_finished(None, False)
+        app.db.finish_transaction()
+        self.assertEquals(self.saved_names(), set([u'lee', u'sam']))
+
+    def test_item_changes_wait_for_commit(self):
+        tracker = item.ItemChangeTracker()
+        tracker.send_changes = mock.Mock()
+        Human(u'sam', 30, 1.8, [])
+        app.db.on_event_finished(None, True)
+        tracker.after_event_finished(None, True)
+        self.assertEquals(tracker.send_changes.call_count, 0)
+        app.db._group_commit_timeout.dispatch()
+        app.db.on_event_finished(None, True)
+        tracker.after_event_finished(None, True)
+        self.assertEquals(tracker.send_changes.call_count, 1)
+
+class LazyColumnTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        HumanSchema.lazy_columns = ('name', 'id_code')
+        self.lee.id_code = 'abc'
+        self.lee.signal_change()
+        self.reload_test_database()
+        self.sam = Human(u"sam", 30, 1.8, [])
+        self.clear_ddb_object_cache()
+
+    def tearDown(self):
+        del HumanSchema.lazy_columns
+        FakeSchemaTest.tearDown(self)
+
+    def count_selects(self):
+        self.select_count = 0
+        old_execute = app.db.execute
+        def execute(sql, values=None, is_update=False, many=False):
+            if sql.startswith('SELECT'):
+                self.select_count += 1
+            return old_execute(sql, values, is_update, many)
+        app.db.execute = execute
+
+    def test_load_on_access(self):
+        lee = Human.get_by_id(self.lee.id)
+        self.assert_('name' not in lee.__dict__)
+        self.assertEquals(lee.age, 25)
+        self.count_selects()
+        self.assertEquals(lee.name, u'lee')
+        self.assertEquals(lee.id_code, 'abc')
+        self.assertEquals(self.select_count, 1)
+        self.assertEquals(lee.unloaded_columns, frozenset())
+
+    def test_other_attributes(self):
+        lee = Human.get_by_id(self.lee.id)
+        self.assert_(not hasattr(lee, 'not_a_column'))
+        self.assert_(not hasattr(Human(u'ben', 1, 1.0, []), 'not_a_column'))
+
+    def test_set_before_load(self):
+        lee = Human.get_by_id(self.lee.id)
+        lee.name = u'lee2'
+        lee.signal_change()
+        self.assertEquals(lee.name, u'lee2')
+        self.assertEquals(lee.id_code, 'abc')
+        lee = self.reload_object(lee)
+        self.assertEquals(lee.name, u'lee2')
+        self.assertEquals(lee.id_code, 'abc')
+
+    def test_save_without_load(self):
+        lee = Human.get_by_id(self.lee.id)
+        lee.age = 26
+        lee.signal_change()
+        self.assert_('name' not in lee.__dict__)
+        lee = self.reload_object(lee)
+        self.assertEquals(lee.age, 26)
+        self.assertEquals(lee.name, u'lee')
+
+    def make_more_humans(self, count):
+        names = [u'human-%d' % i for i in xrange(count)]
+        for name in names:
+            Human(name, 20, 1.5, [])
+        self.clear_ddb_object_cache()
+        return names
+
+    def test_prefetch(self):
+        names = self.make_more_humans(20)
+        view = Human.make_view(load_lazy_columns=True)
+        self.count_selects()
+        humans = list(view)
+        # the lazy columns for all the objects should be loaded with 1
+        # query
+        self.assertEquals(self.select_count, 1)
+        self.assertSameSet([h.name for h in humans],
+                           [u'lee', u'sam'] + names)
+        self.assertEquals(self.select_count, 1)
+
+    def test_no_prefetch(self):
+        # without load_lazy_columns, each object loads its own columns
+        self.make_more_humans(20)
+        humans = list(Human.make_view())
+        self.count_selects()
+        for h in humans:
+            h.name
+        self.assertEquals(self.select_count, len(humans))
+
+    def test_remove(self):
+        lee = Human.get_by_id(self.lee.id)
+        lee.remove()
+        self.assertEquals(lee.name, u'lee')
+
+    def test_only_simple_columns(self):
+        HumanSchema.lazy_columns = ('friend_names',)
+        self.assertRaises(ValueError, self.reload_test_database)
+
+class StatementCacheTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        self.sql_run = []
+        old_execute = app.db.execute
+        def execute(sql, values=None, is_update=False, many=False):
+            self.sql_run.append(sql)
+            return old_execute(sql, values, is_update, many)
+        app.db.execute = execute
+        app.db.statement_cache.reset_stats()
+
+    def test_update_binds_id(self):
+        sam = Human(u"sam", 30, 1.8, [])
+        self.sql_run = []
+        app.db.statement_cache.reset_stats()
+        self.lee.age = 26
+        self.lee.signal_change()
+        sam.age = 31
+        sam.signal_change()
+        # favorite_colors always gets written, since it's not a simple
+        # column
+        self.assertEquals(self.sql_run,
+                          ['UPDATE human SET age=?, favorite_colors=? '
+                           'WHERE id=?'] * 2)
+        stats = app.db.get_statement_cache_stats()
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals(stats['hits'], 1)
+        self.assertEquals(stats['hit_rate'], 0.5)
+        # check that the updates actually happened
+        self.assertEquals(self.reload_object(self.lee).age, 26)
+        self.assertEquals(self.reload_object(sam).age, 31)
+
+    def test_queries(self):
+        for i in xrange(3):
+            list(Human.make_view('age > ?', (i,)))
+            Human.make_view('age > ?', (i,)).count()
+        stats = app.db.get_statement_cache_stats()
+        self.assertEquals(stats['misses'], 2)
+        self.assertEquals(stats['hits'], 4)
+
+    def test_restore(self):
+        # restoring different numbers of objects should be able to share
+        # statements
+        humans = [Human(u'human%d' % i, i, 1.0, []) for i in xrange(7)]
+        self.clear_ddb_object_cache()
+        for i in xrange(5, 9):
+            app.db.ensure_objects_loaded(Human,
+                                         [h.id for h in humans[:i]],
+                                         app.db_info)
+            self.clear_ddb_object_cache()
+        restore_sql = set(sql for sql in app.db.statement_cache._statements
+                          .values() if sql.startswith('SELECT human.id'))
+        self.assertEquals(len(restore_sql), 1)
+        self.assertSameSet([h.name for h in Human.make_view()],
+                           [u'lee'] + [h.name for h in humans])
+
+    def test_pad_ids(self):
+        self.assertEquals(storedatabase.pad_ids_for_sqlite([1]), (1,))
+        self.assertEquals(storedatabase.pad_ids_for_sqlite([1, 2, 3]),
+                          (1, 2, 3, 3))
+        self.assertEquals(len(storedatabase.pad_ids_for_sqlite(range(600))),
+                          990)
+        self.assertEquals(len(storedatabase.pad_ids_for_sqlite(range(990))),
+                          990)
+
+    def test_bulk_remove(self):
+        humans = [Human(u'human%d' % i, i, 1.0, []) for i in xrange(3)]
+        app.db.bulk_remove(humans)
+        self.assertEquals(self.sql_run[-1],
+                          'DELETE FROM human WHERE id IN (?, ?, ?, ?)')
+        self.assertSameSet([h.name for h in Human.make_view()], [u'lee'])
+
+    def test_max_size(self):
+        cache = storedatabase.StatementCache()
+        cache.MAX_SIZE = 2
+        cache.get(1, str, 1)
+        cache.get(2, str, 2)
+        self.assertEquals(cache.get_stats()['size'], 2)
+        cache.get(3, str, 3)
+        self.assertEquals(cache.get_stats()['size'], 1)
+        self.assertEquals(cache.get(3, str, 'not used'), '3')
+
+class IndexRegistryTest(FakeSchemaTest):
+    def tearDown(self):
+        if 'access_patterns' in HumanSchema.__dict__:
+            del HumanSchema.access_patterns
+        FakeSchemaTest.tearDown(self)
+
+    def get_indexes(self):
+        app.db.cursor.execute("SELECT name, sql FROM sqlite_master "
+                              "WHERE type='index' AND tbl_name='human'")
+        return dict(app.db.cursor.fetchall())
+
+    def test_managed_indexes(self):
+        class TestSchema(HumanSchema):
+            indexes = (('human_name', ('name',)),)
+            access_patterns = (
+                indexregistry.AccessPattern('name', equality=('name',)),
+                indexregistry.AccessPattern('id', equality=('id',)),
+                indexregistry.AccessPattern('age', equality=('age',)),
+                indexregistry.AccessPattern('age and name',
+                                            equality=('age',),
+                                            order_by=('name',)),
+                indexregistry.AccessPattern('age and name 2',
+                                            equality=('age',),
+                                            order_by=('name',)),
+                indexregistry.AccessPattern('covering',
+                                            equality=('meters_tall',),
+                                            include=('age',)),
+            )
+        # name is handled by human_name, id is the primary key and age is
+        # handled by the (age, name) index.
+        self.assertEquals(indexregistry.managed_indexes(TestSchema), [
+            ('auto_human_age_name', ('age', 'name')),
+            ('auto_human_meters_tall_age', ('meters_tall', 'age')),
+        ])
+
+    def test_sync(self):
+        HumanSchema.access_patterns = (
+            indexregistry.AccessPattern('age', equality=('age',),
+                                        order_by=('name',)),
+        )
+        self.reload_test_database()
+        indexes = self.get_indexes()
+        self.assertEquals(indexes['auto_human_age_name'],
+                          'CREATE INDEX auto_human_age_name ON human '
+                          '(age, name)')
+        # the index should be used for our query
+        plan = [row[-1] for row in app.db.execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM human WHERE age=? "
+            "ORDER BY name", (10,))]
+        self.assert_(not queryprofile.plan_has_full_scan(plan))
+        # change the access patterns, the old index should be dropped
+        HumanSchema.access_patterns = (
+            indexregistry.AccessPattern('name', equality=('name',)),
+        )
+        self.reload_test_database()
+        indexes = self.get_indexes()
+        self.assert_('auto_human_age_name' not in indexes)
+        self.assert_('auto_human_name' in indexes)
+        # syncing again should be a no-op
+        self.assertEquals(indexregistry.sync_indexes(app.db.cursor,
+                                                     [HumanSchema]),
+                          ([], []))
+
+    def test_sync_error(self):
+        HumanSchema.access_patterns = (
+            indexregistry.AccessPattern('age', equality=('age',)),
+        )
+        old_sync_indexes = indexregistry.sync_indexes
+        def sync_indexes(cursor, object_schemas):
+            old_sync_indexes(cursor, object_schemas)
+            raise ValueError()
+        indexregistry.sync_indexes = sync_indexes
+        try:
+            self.assertRaises(ValueError, app.db._sync_indexes)
+        finally:
+            indexregistry.sync_indexes = old_sync_indexes
+        # the index we created should have been rolled back
+        self.assert_('auto_human_age' not in self.get_indexes())
+
+    def test_new_database(self):
+        HumanSchema.access_patterns = (
+            indexregistry.AccessPattern('age', equality=('age',)),
+        )
+        self.remove_database()
+        self.reload_database(self.save_path, upgrade=False,
+                             object_schemas=self.OBJECT_SCHEMAS)
+        self.assert_('auto_human_age' in self.get_indexes())
+
+    def test_find_full_scans(self):
+        queries = [
+            ('by id', 'SELECT name FROM human WHERE id=?', (1,)),
+            ('by age', 'SELECT name FROM human WHERE age=?', (1,)),
+            ('join', 'SELECT human.name FROM pcf_programmer '
+             'JOIN human ON human.id = pcf_programmer.id', ()),
+        ]
+        full_scans = indexregistry.find_full_scans(app.db.cursor, queries,
+                                                   tables=('human',))
+        self.assertEquals([name for name, sql, plan in full_scans],
+                          ['by age'])
+        full_scans = indexregistry.find_full_scans(app.db.cursor, queries)
+        self.assertEquals([name for name, sql, plan in full_scans],
+                          ['by age', 'join'])
+        self.assert_(indexregistry.format_full_scans(full_scans))
+
 class ValidationTest(FakeSchemaTest):
     def assert_object_valid(self, obj):
         obj.signal_change()
@@ -623,7 +1060,7 @@ class CorruptReprTest(FakeSchemaTest):
         self.assertEqual(restored_lee.stuff, 'testing123')
         app.db.cursor.execute("SELECT stuff from human WHERE name='lee'")
         row = app.db.cursor.fetchone()
-        self.assertEqual(row[0], "'testing123'")
+        self.assertEqual(containerformat.decode(row[0]), 'testing123')
 
     def test_repr_failure_no_handler(self):
         app.db.cursor.execute("UPDATE pcf_programmer SET stuff='{baddata' "
@@ -631,6 +1068,167 @@ class CorruptReprTest(FakeSchemaTest):
         with self.allow_warnings():
             self.assertRaises(SyntaxError, self.reload_object, self.ben)
 
+class ContainerFormatTest(FakeSchemaTest):
+    def check_round_trip(self, value):
+        encoded = containerformat.encode(value)
+        self.assert_(containerformat.is_encoded(encoded))
+        decoded = containerformat.decode(buffer(encoded))
+        self.assertEquals(decoded, value)
+        return decoded
+
+    def test_round_trip(self):
+        decoded = self.check_round_trip([u'a', 'b', 1, 2L ** 70, 1.5, True,
+                                         None])
+        # unicode and str values need to stay distinct
+        self.assertEquals([type(v) for v in decoded],
+                          [unicode, str, int, long, float, bool, type(None)])
+        self.check_round_trip({'str key': (1, 2), u'unicode key': {}})
+        self.check_round_trip({u'date': datetime(2012, 1, 2, 3, 4, 5, 6),
+                               u'nested': [(datetime(2000, 1, 1),)]})
+        self.check_round_trip([])
+
+    def test_struct_time(self):
+        # struct_time values get stored as 9-tuples, like they did when we
+        # used repr()
+        value = time.localtime()
+        decoded = containerformat.decode(containerformat.encode([value]))
+        self.assertEquals(decoded, [tuple(value)])
+        self.assertEquals(type(decoded[0]), tuple)
+
+    def test_special_keys(self):
+        # dicts that look like the objects we use for special types need to
+        # round trip too
+        self.check_round_trip({u'b': u'x'})
+        self.check_round_trip([{u'dt': [2000, 1, 1, 0, 0, 0, 0]}])
+        self.check_round_trip({u't': (1, 2), u'd': {}})
+        self.check_round_trip({1: u'int key', (1, 'a'): u'tuple key',
+                               'str key': None})
+        self.check_round_trip({u'delta': timedelta(1, 2, 3),
+                               u'bytes': '\x00\xff'})
+        # values without special types are stored as plain JSON
+        encoded = containerformat.encode({u'foo': [1, u'bar', None]})
+        self.assertEquals(encoded[5:], '{"foo":[1,"bar",null]}')
+
+    def check_bad_data(self, data):
+        self.assertRaises(containerformat.FormatError,
+                          containerformat.decode, data)
+
+    def test_bad_data(self):
+        self.check_bad_data("{'foo': 1}")
+        self.check_bad_data("MRC\x02\x00")
+        newer_version = "MRC\xff\x00" + containerformat.encode({})[5:]
+        self.check_bad_data(newer_version)
+        # marshal data from the first version of the format
+        self.check_bad_data("MRC\x01\x00{\x00\x00\x00\x00\x00\x00\x00\x00")
+        self.check_bad_data("MRC\x02\x00{\"foo\"")
+        # bad values for special types
+        for special in ('{"dt":[2000,1]}', '{"dt":[2000,13,1,0,0,0,0]}',
+                        '{"dt":"2000"}', '{"td":[1.5,0,0]}', '{"b":1}',
+                        '{"b":"\\u0100"}', '{"t":{}}', '{"d":[[1]]}',
+                        '{"d":[[[1],2]]}', '[' * 100000 + ']' * 100000):
+            self.check_bad_data("MRC\x02\x01" + special)
+
+    def get_column_type(self, column, obj):
+        app.db.cursor.execute("SELECT typeof(%s) FROM human WHERE id=?" %
+                              column, (obj.id,))
+        return app.db.cursor.fetchone()[0]
+
+    def set_repr_values(self, obj):
+        app.db.cursor.execute("UPDATE human "
+                              "SET friend_names=?, high_scores=? WHERE id=?",
+                              (repr(obj.friend_names),
+                               repr(obj.high_scores), obj.id))
+
+    def test_stored_as_blob(self):
+        self.assertEquals(self.get_column_type('high_scores', self.lee),
+                          'blob')
+        self.lee.stuff = None
+        self.lee.signal_change()
+        self.assertEquals(self.get_column_type('stuff', self.lee), 'null')
+
+    def test_old_format_converted_on_save(self):
+        self.set_repr_values(self.lee)
+        lee = self.reload_object(self.lee)
+        self.assertEquals(self.get_column_type('high_scores', lee), 'text')
+        self.assertEquals(lee.high_scores, {u'virtual bowling': 212})
+        lee.signal_change()
+        self.assertEquals(self.get_column_type('high_scores', lee), 'blob')
+        self.assertEquals(self.get_column_type('friend_names', lee), 'blob')
+        lee = self.reload_object(lee)
+        self.assertEquals(lee.high_scores, {u'virtual bowling': 212})
+
+    def test_unchanged_containers_not_written(self):
+        statements = []
+        def execute(sql, values=None, is_update=False, many=False):
+            statements.append(sql)
+            return old_execute(sql, values, is_update, many)
+        old_execute = app.db.execute
+        app.db.execute = execute
+        try:
+            self.lee.name = u'lee2'
+            self.lee.signal_change()
+            # changing a container in place should still get saved
+            self.lee.high_scores[u'pinball'] = 100
+            self.lee.signal_change()
+            self.lee.signal_change()
+        finally:
+            del app.db.execute
+        self.assertEquals(len(statements), 3)
+        self.assert_('name' in statements[0])
+        self.assert_('high_scores' not in statements[0])
+        self.assert_('high_scores' in statements[1])
+        self.assert_('friend_names' not in statements[1])
+        self.assert_('high_scores' not in statements[2])
+        lee = self.reload_object(self.lee)
+        self.assertEquals(lee.high_scores[u'pinball'], 100)
+
+    def test_convert_repr_containers(self):
+        sam = Human(u"sam", 30, 1.8, [self.lee])
+        for obj in (self.lee, sam):
+            self.set_repr_values(obj)
+        start_id = 0
+        chunks = 0
+        while start_id is not None:
+            start_id = databaseupgrade.convert_repr_containers(app.db.cursor,
+                'human', ['friend_names', 'high_scores', 'stuff'], start_id,
+                limit=1)
+            chunks += 1
+        self.assertEquals(chunks, 3)
+        for obj in (self.lee, sam):
+            self.assertEquals(self.get_column_type('high_scores', obj),
+                              'blob')
+            self.assertEquals(self.get_column_type('friend_names', obj),
+                              'blob')
+        lee = self.reload_object(self.lee)
+        self.assertEquals(lee.high_scores, {u'virtual bowling': 212})
+        sam = self.reload_object(sam)
+        self.assertEquals(sam.friend_names, [u'lee'])
+
+    def test_convert_old_containers(self):
+        self.set_repr_values(self.lee)
+        app.db.convert_old_containers()
+        self.runPendingIdles()
+        self.assertEquals(self.get_column_type('high_scores', self.lee),
+                          'blob')
+
+    def test_convert_old_containers_error(self):
+        self.set_repr_values(self.lee)
+        def convert_repr_containers(cursor, table_name, columns, start_id):
+            cursor.execute("UPDATE human SET high_scores=? WHERE id=?",
+                           (buffer(containerformat.encode({})),
+                            self.lee.id))
+            raise ValueError()
+        old_convert = databaseupgrade.convert_repr_containers
+        databaseupgrade.convert_repr_containers = convert_repr_containers
+        try:
+            self.assertRaises(ValueError, list,
+                              app.db._convert_old_containers())
+        finally:
+            databaseupgrade.convert_repr_containers = old_convert
+        # the UPDATE should have been rolled back
+        self.assertEquals(self.get_column_type('high_scores', self.lee),
+                          'text')
+
 class ConverterTest(StoreDatabaseTest):
     def test_convert_repr(self):
         converter = storedatabase.SQLiteConverter()
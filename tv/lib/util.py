@@ -1190,6 +1190,7 @@ class Cache(object):
             new_access_times[key] = time
         self.dict = new_dict
         self.access_times = new_access_times
+        self.invalidators = new_invalidators
 
     def create_new_value(self, val, invalidator=None):
         raise NotImplementedError()
@@ -0,0 +1,378 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""viewpredicate.py -- Evaluate View WHERE clauses in python.
+
+ViewTracker needs to check if objects are in its view every time they
+change.  Running a SQL query for each check is slow when lots of objects
+change at once, so for simple WHERE clauses we compile a python predicate
+that checks the in-memory DDBObject instead.
+
+We only handle a small subset of SQL: column comparisons with literals or
+? parameters, IS [NOT] NULL, [NOT] IN lists, bare boolean columns, and
+AND/OR/NOT.  compile_where() returns None for anything else (joins, LIKE,
+functions, subqueries, ...) and ViewTracker falls back to SQL.
+
+Predicates follow SQL's 3-valued logic, so comparisons with NULL are
+unknown and only a true result puts an object in the view.
+"""
+
+import re
+
+class UnsupportedSQL(ValueError):
+    """The WHERE clause uses SQL that we can't compile."""
+    pass
+
+def _column_kinds():
+    """Get the SchemaItem classes that we compare as numbers and as text.
+
+    Other column types are stored differently in the database than in
+    memory, so we only support IS NULL checks for them.
+    """
+    # schema imports database, which imports us, so we can't import it at
+    # the module level.
+    from miro import schema
+    return ((schema.SchemaBool, schema.SchemaInt, schema.SchemaFloat),
+            (schema.SchemaString, schema.SchemaURL))
+
+_token_re = re.compile(r"""
+    \s*(?:
+        (?P<string>'(?:[^']|'')*')
+        |(?P<number>\d+(?:\.\d+)?)
+        |(?P<op>==|!=|<>|<=|>=|=|<|>)
+        |(?P<param>\?)
+        |(?P<punct>[(),])
+        |(?P<name>[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)?)
+    )""", re.VERBOSE)
+
+KEYWORDS = set(['AND', 'OR', 'NOT', 'IS', 'NULL', 'IN'])
+# keywords that we know we don't support.  Anything in this set that shows up
+# as a name means we give up.
+UNSUPPORTED_KEYWORDS = set(['LIKE', 'GLOB', 'BETWEEN', 'SELECT', 'EXISTS',
+    'CASE', 'COLLATE', 'ESCAPE', 'MATCH', 'REGEXP', 'CAST'])
+
+def _tokenize(where):
+    tokens = []
+    pos = 0
+    where = where.rstrip()
+    while pos < len(where):
+        m = _token_re.match(where, pos)
+        if m is None:
+            raise UnsupportedSQL("can't parse %r" % where[pos:])
+        pos = m.end()
+        kind = m.lastgroup
+        text = m.group(kind)
+        if kind == 'string':
+            value = text[1:-1].replace("''", "'")
+            if isinstance(value, str):
+                value = value.decode('utf-8')
+            tokens.append(('literal', value))
+        elif kind == 'number':
+            if '.' in text:
+                tokens.append(('literal', float(text)))
+            else:
+                tokens.append(('literal', int(text)))
+        elif kind == 'name':
+            upper = text.upper()
+            if upper in KEYWORDS:
+                tokens.append(('keyword', upper))
+            elif upper in UNSUPPORTED_KEYWORDS:
+                raise UnsupportedSQL(text)
+            else:
+                tokens.append(('name', text))
+        else:
+            tokens.append((kind, text))
+    return tokens
+
+def _and(left, right):
+    def evaluate(obj):
+        a = left(obj)
+        if a is False:
+            return False
+        b = right(obj)
+        if b is False:
+            return False
+        if a is None or b is None:
+            return None
+        return True
+    return evaluate
+
+def _or(left, right):
+    def evaluate(obj):
+        a = left(obj)
+        if a is True:
+            return True
+        b = right(obj)
+        if b is True:
+            return True
+        if a is None or b is None:
+            return None
+        return False
+    return evaluate
+
+def _not(operand):
+    def evaluate(obj):
+        value = operand(obj)
+        if value is None:
+            return None
+        return not value
+    return evaluate
+
+_comparisons = {
+    '=': lambda a, b: a == b,
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<>': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+class _Parser(object):
+    """Recursive descent parser that turns a WHERE clause into a function
+    that takes an object and returns True, False, or None (unknown).
+    """
+    def __init__(self, tokens, values, table_name, columns):
+        self.tokens = tokens
+        self.pos = 0
+        self.values = list(values)
+        self.value_index = 0
+        self.table_name = table_name
+        self.columns = columns
+        self.columns_used = set()
+        self.numeric_types, self.text_types = _column_kinds()
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def accept(self, kind, text=None):
+        token = self.peek()
+        if token[0] == kind and (text is None or token[1] == text):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, kind, text=None):
+        if not self.accept(kind, text):
+            raise UnsupportedSQL("expected %s %s" % (kind, text))
+
+    def parse(self):
+        predicate = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise UnsupportedSQL("extra tokens: %s" % (self.tokens[self.pos:],))
+        if self.value_index != len(self.values):
+            raise UnsupportedSQL("wrong number of values")
+        return predicate
+
+    def parse_or(self):
+        predicate = self.parse_and()
+        while self.accept('keyword', 'OR'):
+            predicate = _or(predicate, self.parse_and())
+        return predicate
+
+    def parse_and(self):
+        predicate = self.parse_not()
+        while self.accept('keyword', 'AND'):
+            predicate = _and(predicate, self.parse_not())
+        return predicate
+
+    def parse_not(self):
+        if self.accept('keyword', 'NOT'):
+            return _not(self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        if self.accept('punct', '('):
+            predicate = self.parse_or()
+            self.expect('punct', ')')
+            return predicate
+        kind, text = self.peek()
+        if kind != 'name':
+            raise UnsupportedSQL("expected column name, got %r" % text)
+        self.next()
+        name, schema_item = self.lookup_column(text)
+        kind, text = self.peek()
+        if kind == 'op':
+            self.next()
+            value = self.parse_value(schema_item)
+            return self.make_comparison(name, _comparisons[text], value)
+        elif self.accept('keyword', 'IS'):
+            negate = self.accept('keyword', 'NOT')
+            self.expect('keyword', 'NULL')
+            return self.make_null_check(name, negate)
+        elif kind == 'keyword' and text in ('IN', 'NOT'):
+            negate = self.accept('keyword', 'NOT')
+            self.expect('keyword', 'IN')
+            return self.make_in_check(name, self.parse_value_list(schema_item),
+                                      negate)
+        else:
+            return self.make_bool_check(name, schema_item)
+
+    def lookup_column(self, text):
+        if '.' in text:
+            table, name = text.split('.', 1)
+            if table != self.table_name:
+                raise UnsupportedSQL("column from another table: %s" % text)
+        else:
+            name = text
+        try:
+            schema_item = self.columns[name]
+        except KeyError:
+            raise UnsupportedSQL("unknown column: %s" % text)
+        self.columns_used.add(name)
+        return name, schema_item
+
+    def parse_value(self, schema_item):
+        kind, text = self.next()
+        if kind == 'literal':
+            value = text
+        elif kind == 'param':
+            if self.value_index >= len(self.values):
+                raise UnsupportedSQL("not enough values")
+            value = self.values[self.value_index]
+            self.value_index += 1
+        else:
+            raise UnsupportedSQL("expected value, got %r" % text)
+        self.check_value_type(value, schema_item)
+        return value
+
+    def parse_value_list(self, schema_item):
+        self.expect('punct', '(')
+        values = [self.parse_value(schema_item)]
+        while self.accept('punct', ','):
+            values.append(self.parse_value(schema_item))
+        self.expect('punct', ')')
+        return values
+
+    def check_value_type(self, value, schema_item):
+        # Only compare values when python and sqlite will agree on the
+        # result
+        if isinstance(schema_item, self.numeric_types):
+            if isinstance(value, (int, long, float)):
+                return
+        elif isinstance(schema_item, self.text_types):
+            if isinstance(value, unicode):
+                return
+            if isinstance(value, str):
+                try:
+                    value.decode('ascii')
+                except UnicodeError:
+                    pass
+                else:
+                    return
+        raise UnsupportedSQL("can't compare %r to %s" % (value,
+                             schema_item.__class__.__name__))
+
+    def make_comparison(self, name, compare, value):
+        def evaluate(obj):
+            column_value = getattr(obj, name)
+            if column_value is None:
+                return None
+            return compare(column_value, value)
+        return evaluate
+
+    def make_null_check(self, name, negate):
+        def evaluate(obj):
+            return (getattr(obj, name) is None) != negate
+        return evaluate
+
+    def make_in_check(self, name, values, negate):
+        def evaluate(obj):
+            column_value = getattr(obj, name)
+            if column_value is None:
+                return None
+            return (column_value in values) != negate
+        return evaluate
+
+    def make_bool_check(self, name, schema_item):
+        if not isinstance(schema_item, self.numeric_types):
+            raise UnsupportedSQL("can't use %s as a boolean" % name)
+        def evaluate(obj):
+            column_value = getattr(obj, name)
+            if column_value is None:
+                return None
+            return column_value != 0
+        return evaluate
+
+class ViewPredicate(object):
+    """Compiled WHERE clause.
+
+    :attribute columns: set of column names that the predicate uses
+    """
+    def __init__(self, evaluate, columns):
+        self._evaluate = evaluate
+        self.columns = frozenset(columns)
+
+    def can_check(self, obj):
+        """Check if the in-memory values of obj are good to use.
+
+        If any column that we use has unsaved changes, then the database
+        might not agree with the object, so ViewTracker should use SQL.  We
+        also use SQL if we would need to load a lazy column.
+        """
+        if self.columns.intersection(obj.changed_attributes):
+            return False
+        unloaded = getattr(obj, 'unloaded_columns', None)
+        if unloaded and [c for c in self.columns.intersection(unloaded)
+                         if c not in obj.__dict__]:
+            return False
+        return True
+
+    def __call__(self, obj):
+        """Check if obj matches the WHERE clause.
+
+        :raises AttributeError: obj is missing one of our columns
+        """
+        return self._evaluate(obj) is True
+
+def compile_where(where, values, table_name, columns):
+    """Compile a WHERE clause into a ViewPredicate
+
+    :param where: WHERE clause, or None to match everything
+    :param values: values for the ? parameters in where
+    :param table_name: table the view is for
+    :param columns: dict mapping column names to SchemaItems for the table
+    :returns: ViewPredicate, or None if the WHERE clause is too complex
+    """
+    if where is None or not where.strip():
+        return ViewPredicate(lambda obj: True, ())
+    try:
+        parser = _Parser(_tokenize(where), values, table_name, columns)
+        evaluate = parser.parse()
+    except UnsupportedSQL:
+        return None
+    return ViewPredicate(evaluate, parser.columns_used)
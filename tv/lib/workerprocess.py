@@ -43,6 +43,7 @@ from miro import clock
 from miro import eventloop
 from miro import feedparserutil
 from miro import filetags
+from miro import futures
 from miro import messagetools
 from miro import moviedata
 from miro import subprocessmanager
@@ -507,14 +508,30 @@ def shutdown():
     _subprocess_manager.shutdown()
 
 # API for sending tasks
-def send(msg, callback, errback):
+def send(msg, callback=None, errback=None):
     """Send a message to the worker process.
 
     :param msg: Message to send
-    :param callback: function to call on success
-    :param errback: function to call on error
+    :param callback: function to call on success, or None
+    :param errback: function to call on error, or None
+    :returns: a futures.Future for the task's result.  Canceling the future
+        doesn't stop the task, but callback and errback won't be called.
     """
-    _miro_task_queue.add_task(msg, callback, errback)
+    future = futures.Future()
+    def task_callback(msg, result):
+        if future.canceled:
+            return
+        future.set_result(result)
+        if callback is not None:
+            callback(msg, result)
+    def task_errback(msg, error):
+        if future.canceled:
+            return
+        future.set_error(error)
+        if errback is not None:
+            errback(msg, error)
+    _miro_task_queue.add_task(msg, task_callback, task_errback)
+    return future
 
 def cancel_tasks_for_files(paths):
     """Cancel mutagen and movie data tasks for a list of paths."""
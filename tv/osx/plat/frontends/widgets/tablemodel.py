@@ -121,6 +121,14 @@ class TableModelBase(signals.SignalEmitter):
         self.create_signal('row-changed')
         self.create_signal('structure-will-change')
 
+    def set_visible_range(self, start, end):
+        """Called by TableView before it draws.
+
+        :param start: index of the first visible row
+        :param end: index after the last visible row
+        """
+        pass
+
     def check_column_values(self, column_values):
         if len(self.column_types) != len(column_values):
             raise ValueError("Wrong number of columns")
@@ -257,6 +265,9 @@ class ItemListModel(signals.SignalEmitter):
     def on_will_change(self, item_list):
         self.emit("structure-will-change")
 
+    def set_visible_range(self, start, end):
+        self.item_list.set_visible_range(start, end)
+
     def _iter_for_row(self, row):
         if row < 0:
             raise IndexError(row)
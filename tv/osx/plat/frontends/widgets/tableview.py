@@ -1005,6 +1005,17 @@ class MiroTableView(NSTableView):
     for name, value in TableViewCommon.__dict__.items():
         locals()[name] = value
 
+    def drawRect_(self, rect):
+        # Tell the model which rows we're showing before we draw them.
+        # ItemListModel uses this to prefetch rows around them.
+        model = wrappermap.wrapper(self).model
+        if model is not None:
+            visible_rows = self.rowsInRect_(self.visibleRect())
+            model.set_visible_range(visible_rows.location,
+                                    visible_rows.location +
+                                    visible_rows.length)
+        NSTableView.drawRect_(self, rect)
+
 class MiroOutlineView(NSOutlineView):
     SuperClass = NSOutlineView
     for name, value in TableViewCommon.__dict__.items():
@@ -282,7 +282,6 @@ class MiroBuild (py2app):
         self.distribution.ext_modules.append(self.get_growl_image_ext())
         self.distribution.ext_modules.append(self.get_fasttypes_ext())
         self.distribution.ext_modules.append(self.get_namecollation_ext())
-        self.distribution.ext_modules.append(self.get_ngrams_ext())
 
         self.distribution.packages = [
             'miro',
@@ -370,10 +369,6 @@ class MiroBuild (py2app):
                 libraries=['sqlite3'],
             )
 
-    def get_ngrams_ext(self):
-        return Extension("miro.ngrams",
-                [os.path.join(PORTABLE_DIR, 'ngrams.c')])
-
     
     def fillTemplate(self, templatepath, outpath, **vars):
         s = open(templatepath, 'rt').read()
@@ -187,11 +187,6 @@ sys.path.insert(0, os.path.join(GSTREAMER_PATH, 'lib', 'site-packages', 'gst-0.1
 
 
 #### Extensions ####
-ngrams_ext = \
-    Extension("miro.ngrams",
-        [os.path.join(portable_dir, 'ngrams.c')],
-    )
-
 pygtkhacks_ext = Extension(
     "miro.frontends.widgets.gtk.pygtkhacks",
     sources=[
@@ -287,7 +282,6 @@ os.environ['PATH'] = ';'.join([
 
 # Private extension modules to build.
 ext_modules = [
-    ngrams_ext,
     pygtkhacks_ext,
     namecollation_ext,
     fixedliststore_ext,